@@ -10,10 +10,10 @@ if __name__ == "__main__":
 from PyQt4 import QtGui, QtCore
 import LogWidgetTemplate
 from acq4.pyqtgraph import FeedbackButton
-import acq4.util.configfile as configfile
 from acq4.util.DataManager import DirHandle
 from acq4.util.HelpfulException import HelpfulException
 from acq4.util.Mutex import Mutex
+from acq4.util.LogStore import LogStore
 import numpy as np
 from acq4.pyqtgraph import FileDialog
 from acq4.util.debug import printExc
@@ -36,6 +36,14 @@ Stylesheet = """
     .timestamp {color: #000;}
 """
 
+## colors used for one-line entries in the log list (should match Stylesheet)
+msgTypeColors = {
+    'error': '#900',
+    'warning': '#740',
+    'user': '#009',
+    'status': '#090',
+}
+
 pageTemplate = """
 <html>
 <head>
@@ -75,7 +83,7 @@ class LogWindow(QtGui.QMainWindow):
     
 
     """LogWindow contains a LogWidget inside a window. LogWindow is responsible for collecting messages generated by the program/user, formatting them into a nested dictionary,
-    and saving them in a log.txt file. The LogWidget takes care of displaying messages.
+    and saving them in a log.db file (see LogStore). The LogWidget takes care of displaying messages.
     
     Messages can be logged by calling logMsg or logExc functions from acq4.Manager. These functions call the LogWindow.logMsg and LogWindow.logExc functions, but other classes 
     should not call the LogWindow functions directly.
@@ -98,10 +106,9 @@ class LogWindow(QtGui.QMainWindow):
         #global WIN
         global WIN
         WIN = self
-        self.msgCount = 0
-        self.logCount=0
         self.logFile = None
-        configfile.writeConfigFile('', self.fileName())  ## start a new temp log file, destroying anything left over from the last session.
+        self.store = LogStore()  ## temporary (in-memory) log until a storage directory is set
+        self.wid.setStore(self.store)
         self.buttons = [] ## weak references to all Log Buttons get added to this list, so it's easy to make them all do things, like flash red.
         self.lock = Mutex()
         self.errorDialog = ErrorDialog()
@@ -123,7 +130,7 @@ class LogWindow(QtGui.QMainWindow):
               docs: a list of strings where documentation related to the message can be found
               reasons: a list of reasons (as strings) for the message
               traceback: a list of formatted callstack/trackback objects (formatting a traceback/callstack returns a list of strings), usually looks like [['line 1', 'line 2', 'line3'], ['line1', 'line2']]
-           Feel free to add your own keyword arguments. These will be saved in the log.txt file, but will not affect the content or way that messages are displayed.
+           Feel free to add your own keyword arguments. These will be saved with the entry in the log.db file of the current storage directory (see acq4.util.LogStore), but will not affect the content or way that messages are displayed.
         """
 
         ## for thread-safetyness:
@@ -141,18 +148,16 @@ class LogWindow(QtGui.QMainWindow):
         else:
             kwargs['currentDir'] = None
         
-        now = str(time.strftime('%Y.%m.%d %H:%M:%S'))
-        name = 'LogEntry_' + str(self.msgCount)
-        self.msgCount += 1
+        now = time.time()
         entry = {
             #'docs': None,
             #'reasons': None,
             'message': msg,
-            'timestamp': now,
+            'timestamp': str(time.strftime('%Y.%m.%d %H:%M:%S', time.localtime(now))),
+            'time': now,
             'importance': importance,
             'msgType': msgType,
             #'exception': exception,
-            'id': self.msgCount,
         }
         for k in kwargs:
             entry[k] = kwargs[k]
@@ -163,7 +168,7 @@ class LogWindow(QtGui.QMainWindow):
         if entry.get('exception', None) is not None and 'msgType' in entry['exception']:
             entry['msgType'] = entry['exception']['msgType']
         
-        self.saveEntry({name:entry})
+        self.saveEntry(entry)  ## assigns entry['id']
         self.wid.addEntry(entry) ## takes care of displaying the entry if it passes the current filters on the logWidget
         #self.wid.displayEntry(entry)
         
@@ -275,38 +280,35 @@ class LogWindow(QtGui.QMainWindow):
     def fileName(self):
         ## return the log file currently used
         if self.logFile is None:
-            return "tempLog.txt"
+            return "temporary log"
         else:
             return self.logFile.name()
         
     def setLogDir(self, dh):
-        if self.fileName() == dh.name():
+        if self.getLogDir() == dh:
             return
         
         oldfName = self.fileName()
-        if self.logFile is not None:
-            self.logMsg('Moving log storage to %s.' % (self.logFile.name(relativeTo=self.manager.baseDir))) ## make this note before we change the log file, so when a log ends, you know where it went after.
-        
         self.logMsg('Moving log storage to %s.' % (dh.name(relativeTo=self.manager.baseDir))) ## make this note before we change the log file, so when a log ends, you know where it went after.
         
-        if oldfName == 'tempLog.txt':
-            with self.lock:
-                temp = configfile.readConfigFile(oldfName)
-        else:
-            temp = {}
-                
-        if dh.exists('log.txt'):
-            self.logFile = dh['log.txt']
-            with self.lock:
-                self.msgCount = len(configfile.readConfigFile(self.logFile.name()))
-            newTemp = {}
-            for v in temp.values():
-                self.msgCount += 1
-                newTemp['LogEntry_'+str(self.msgCount)] = v
-            self.saveEntry(newTemp)
-        else:
-            self.logFile = dh.createFile('log.txt')
-            self.saveEntry(temp)
+        with self.lock:
+            oldStore = self.store
+            if dh.exists('log.db'):
+                self.logFile = dh['log.db']
+                store = LogStore(self.logFile.name())
+            else:
+                self.logFile = dh.createFile('log.db')
+                store = LogStore(self.logFile.name())
+                if dh.exists('log.txt'):
+                    ## one-time import of a log written by an older version
+                    LogStore.fromLegacyFile(dh['log.txt'].name(), store=store)
+            
+            ## entries logged before any storage directory was set are copied to the new log
+            if oldStore.fileName == ':memory:':
+                store.extend([dict(e) for e in oldStore.entries(oldStore.query())])
+            oldStore.close()
+            self.store = store
+        self.wid.setStore(store)
         
         self.logMsg('Moved log storage from %s to %s.' % (oldfName, self.fileName()))
         self.wid.ui.dirLabel.setText("Current Storage Directory: " + self.fileName())
@@ -318,19 +320,77 @@ class LogWindow(QtGui.QMainWindow):
         else:
             return self.logFile.parent()
     
-    def saveEntry(self, entry):  
+    def saveEntry(self, entry):
+        ## queued; the store writes entries to disk in batches
+        with self.lock:
+            return self.store.append(entry)
+    
+    def flushLog(self):
+        """Block until all log entries have been written to disk."""
         with self.lock:
-            configfile.appendConfigFile(entry, self.fileName())
+            self.store.flush()
     
     def disablePopups(self, disable):
         self.errorDialog.disable(disable)
 
 
+class LogModel(QtCore.QAbstractListModel):
+    """List model presenting one row per log entry, for a set of entry ids in a LogStore.
+    Entries are only read from the store when their rows are displayed.
+    """
+    def __init__(self, parent=None):
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.store = None
+        self.idBuffer = np.empty(0, dtype=np.int64)
+        self.nIds = 0
+
+    def setEntries(self, store, ids):
+        self.beginResetModel()
+        self.store = store
+        self.idBuffer = np.array(ids, dtype=np.int64)
+        self.nIds = len(self.idBuffer)
+        self.endResetModel()
+
+    def appendEntry(self, eid):
+        ## make more room if needed
+        if self.nIds == len(self.idBuffer):
+            newBuffer = np.empty(max(1000, 2 * len(self.idBuffer)), dtype=np.int64)
+            newBuffer[:self.nIds] = self.idBuffer[:self.nIds]
+            self.idBuffer = newBuffer
+        self.beginInsertRows(QtCore.QModelIndex(), self.nIds, self.nIds)
+        self.idBuffer[self.nIds] = eid
+        self.nIds += 1
+        self.endInsertRows()
+
+    def ids(self):
+        return self.idBuffer[:self.nIds]
+
+    def entryId(self, row):
+        return int(self.idBuffer[row])
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.nIds
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.nIds or self.store is None:
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            entry = self.store.entry(self.entryId(index.row()))
+            msg = entry.get('message', '')
+            if not isinstance(msg, basestring):
+                msg = str(msg)
+            return "%s  %s" % (entry.get('timestamp', ''), msg.split('\n', 1)[0])
+        elif role == QtCore.Qt.ForegroundRole:
+            entry = self.store.entry(self.entryId(index.row()))
+            return QtGui.QBrush(QtGui.QColor(msgTypeColors.get(entry.get('msgType'), '#000')))
+        return None
+
+
 class LogWidget(QtGui.QWidget):
     
-    sigDisplayEntry = QtCore.Signal(object) ## for thread-safetyness
     sigAddEntry = QtCore.Signal(object) ## for thread-safetyness
-    sigScrollToAnchor = QtCore.Signal(object)  # for internal use.
     
     def __init__(self, parent, manager):
         QtGui.QWidget.__init__(self, parent)
@@ -340,60 +400,57 @@ class LogWidget(QtGui.QWidget):
         #self.ui.input.hide()
         self.ui.filterTree.topLevelItem(1).setExpanded(True)
         
-        self.entries = [] ## stores all log entries in memory
-        self.cache = {} ## for storing html strings of entries that have already been processed
-        self.displayedEntries = []
-        #self.currentEntries = None ## recordArray that stores currently displayed entries -- so that if filters get more restrictive we can just refilter this list instead of filtering everything
+        ## Entries are listed one line each in a virtualized list view; the selected
+        ## entry is shown in full (with reasons, docs, traceback) in ui.output.
+        self.model = LogModel(self)
+        self.entryList = QtGui.QListView()
+        self.entryList.setUniformItemSizes(True)
+        self.entryList.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        self.entryList.setModel(self.model)
+        self.ui.gridLayout.removeWidget(self.ui.output)
+        self.outputSplitter = QtGui.QSplitter(QtCore.Qt.Vertical)
+        self.outputSplitter.addWidget(self.entryList)
+        self.outputSplitter.addWidget(self.ui.output)
+        self.outputSplitter.setSizes([400, 100])
+        self.ui.gridLayout.addWidget(self.outputSplitter, 1, 0, 1, 3)
+        self.ui.output.document().setDefaultStyleSheet(Stylesheet)
+        
+        self.store = None
+        self.ownStore = False  ## whether the store was opened by this widget (and should be closed by it)
         self.typeFilters = []
         self.importanceFilter = 0
         self.dirFilter = False
-        self.entryArrayBuffer = np.zeros(1000, dtype=[ ### a record array for quick filtering of entries
-            ('index', 'int32'),
-            ('importance', 'int32'),
-            ('msgType', '|S10'),
-            ('directory', '|S100'),
-            ('entryId', 'int32')
-        ])
-        self.entryArray = self.entryArrayBuffer[:0]
         
         self.filtersChanged()
         
-        self.sigDisplayEntry.connect(self.displayEntry, QtCore.Qt.QueuedConnection)
         self.sigAddEntry.connect(self.addEntry, QtCore.Qt.QueuedConnection)
         self.ui.exportHtmlBtn.clicked.connect(self.exportHtml)
         self.ui.filterTree.itemChanged.connect(self.setCheckStates)
         self.ui.importanceSlider.valueChanged.connect(self.filtersChanged)
         #self.ui.logView.linkClicked.connect(self.linkClicked)
         self.ui.output.anchorClicked.connect(self.linkClicked)
-        self.sigScrollToAnchor.connect(self.scrollToAnchor, QtCore.Qt.QueuedConnection)
-        
-        #page = self.ui.logView.page()
-        #page.setLinkDelegationPolicy(page.DelegateAllLinks)
+        self.entryList.selectionModel().currentChanged.connect(self.currentEntryChanged)
+        
+    def setStore(self, store, own=False):
+        """Display entries from *store* (a LogStore). If *own* is True, the store
+        will be closed when it is replaced."""
+        if self.store is not None and self.ownStore and self.store is not store:
+            self.store.close()
+        self.store = store
+        self.ownStore = own
+        self.filterEntries()
         
     def loadFile(self, f):
-        """Load the file, f. f must be able to be read by configfile.py"""
-        log = configfile.readConfigFile(f)
-        self.entries = []
-        self.entryArrayBuffer = np.zeros(len(log),dtype=[
-            ('index', 'int32'),
-            ('importance', 'int32'),
-            ('msgType', '|S10'),
-            ('directory', '|S100'),
-            ('entryId', 'int32')
-        ])
-        self.entryArray = self.entryArrayBuffer[:]
-                                   
-        i = 0
-        for k,v in log.iteritems():
-            v['id'] = k[9:]  ## record unique ID to facilitate HTML generation (javascript needs this ID)
-            self.entries.append(v)
-            self.entryArray[i] = np.array([(i, v.get('importance', 5), v.get('msgType', 'status'), v.get('currentDir', ''), v.get('entryId', v['id']))], dtype=[('index', 'int32'), ('importance', 'int32'), ('msgType', '|S10'), ('directory', '|S100'), ('entryId', 'int32')])
-            i += 1
-            
-        self.filterEntries() ## puts all entries through current filters and displays the ones that pass
+        """Load the log file, f. This may be a log.db file or a log.txt file 
+        written by older versions (which must be readable by configfile.py)"""
+        if os.path.splitext(f)[1] == '.txt':
+            store = LogStore.fromLegacyFile(f)
+        else:
+            store = LogStore(f)
+        self.setStore(store, own=True)
         
     def addEntry(self, entry):
-        ## All incoming messages begin here
+        ## All incoming messages begin here. The entry must already have been added to self.store.
 
         ## for thread-safetyness:
         isGuiThread = QtCore.QThread.currentThread() == QtCore.QCoreApplication.instance().thread()
@@ -401,28 +458,7 @@ class LogWidget(QtGui.QWidget):
             self.sigAddEntry.emit(entry)
             return
         
-        self.entries.append(entry)
-        i = len(self.entryArray)
-        
-        entryDir = entry.get('currentDir', None)
-        if entryDir is None:
-            entryDir = ''
-            
-        arr = np.array([(i, entry['importance'], entry['msgType'], entryDir, entry['id'])], dtype = [('index', 'int32'), ('importance', 'int32'), ('msgType', '|S10'), ('directory', '|S100'), ('entryId', 'int32')])
-        
-        ## make more room if needed
-        if len(self.entryArrayBuffer) == len(self.entryArray):
-            newArray = np.empty(len(self.entryArrayBuffer)+1000, self.entryArrayBuffer.dtype)
-            newArray[:len(self.entryArray)] = self.entryArray
-            self.entryArrayBuffer = newArray
-        self.entryArray = self.entryArrayBuffer[:len(self.entryArray)+1]
-        #self.entryArray[i] = [(i, entry['importance'], entry['msgType'], entry['currentDir'])]
-        self.entryArray[i] = arr
         self.checkDisplay(entry) ## displays the entry if it passes the current filters
-        #np.append(self.entryArray, np.array(i, [[i, entry['importance'], entry['msgType'], entry['currentDir']]]), dtype = [('index', int), ('importance', int), ('msgType', str), ('directory', str)])
-
-
-
 
     def setCheckStates(self, item, column):
         if item == self.ui.filterTree.topLevelItem(1):
@@ -463,111 +499,40 @@ class LogWidget(QtGui.QWidget):
         else:
             self.dirFilter = False
         
-    
+    def filterArgs(self):
+        ## current filters, as arguments to LogStore.query() and LogStore.matches()
+        return {
+            'minImportance': self.importanceFilter,
+            'msgTypes': self.typeFilters,
+            'dirPrefix': self.dirFilter if self.dirFilter is not False else None,
+        }
         
     def filterEntries(self):
-        """Runs each entry in self.entries through the filters and displays if it makes it through."""
-        ### make self.entries a record array, then filtering will be much faster (to OR true/false arrays, + them)
-        typeMask = self.entryArray['msgType'] == ''
-        for t in self.typeFilters:
-            typeMask += self.entryArray['msgType'] == t
-        mask = (self.entryArray['importance'] > self.importanceFilter) * typeMask
-        if self.dirFilter != False:
-            d = np.ascontiguousarray(self.entryArray['directory'])
-            j = len(self.dirFilter)
-            i = len(d)
-            d = d.view(np.byte).reshape(i, 100)[:, :j]
-            d = d.reshape(i*j).view('|S%d' % j)
-            mask *= (d == self.dirFilter)
-            
-            
+        """Display all entries in the store that pass the current filters."""
+        if self.store is None:
+            ids = []
+        else:
+            ids = self.store.query(**self.filterArgs())
+        self.model.setEntries(self.store, ids)
         self.ui.output.clear()
-        global Stylesheet
-        self.ui.output.document().setDefaultStyleSheet(Stylesheet)
-        #global pageTemplate
-        #self.ui.logView.setHtml(pageTemplate)
-        indices = list(self.entryArray[mask]['index'])
-        inds = indices
-        
-        #if self.dirFilter != False:
-            #j = len(self.dirFilter)
-            #for i, n in inds:
-                #if not self.entries[n]['currentDir'][:j] == self.dirFilter:
-                    #indices.pop(i)
-                    
-        self.displayEntry([self.entries[i] for i in indices])
+        self.entryList.scrollToBottom()
                           
     def checkDisplay(self, entry):
         ### checks whether entry passes the current filters and displays it if it does.
-        if entry['msgType'] not in self.typeFilters:
+        if self.store is None or not self.store.matches(entry, **self.filterArgs()):
             return
-        elif entry['importance'] < self.importanceFilter:
-            return
-        elif self.dirFilter is not False:
-            if entry['currentDir'][:len(self.dirFilter)] != self.dirFilter:
-                return
-        else:
-            self.displayEntry([entry])
-    
-        
-    def displayEntry(self, entries):
-        ## entries should be a list of log entries
-        
-        ## for thread-safetyness:
-        isGuiThread = QtCore.QThread.currentThread() == QtCore.QCoreApplication.instance().thread()
-        if not isGuiThread:
-            self.sigDisplayEntry.emit(entries)
-            return
-        
-        for entry in entries:
-            if not self.cache.has_key(id(entry)):
-                self.cache[id(entry)] = self.generateEntryHtml(entry)
-                
-                ## determine message color:
-                #if entry['msgType'] == 'status':
-                    #color = 'green'
-                #elif entry['msgType'] == 'user':
-                    #color = 'blue'
-                #elif entry['msgType'] == 'error':
-                    #color = 'red'
-                #elif entry['msgType'] == 'warning':
-                    #color = '#DD4400' ## orange
-                #else:
-                    #color = 'black'
-                    
-                #if entry.has_key('exception') or entry.has_key('docs') or entry.has_key('reasons'):
-                    ##self.displayComplexMessage(entry, color)
-                    #self.displayComplexMessage(entry)
-                #else: 
-                    #self.displayText(entry['message'], entry, color, timeStamp=entry['timestamp'])
-                    
-            #for x in self.cache[id(entry)]:
-                #self.ui.output.appendHtml(x)
-                
-            html = self.cache[id(entry)]
-            #frame = self.ui.logView.page().currentFrame()
-            #isMax = frame.scrollBarValue(QtCore.Qt.Vertical) == frame.scrollBarMaximum(QtCore.Qt.Vertical)
-            sb = self.ui.output.verticalScrollBar()
-            isMax = sb.value() == sb.maximum()
-            
-            #frame.findFirstElement('body').appendInside(html)
-            self.ui.output.append(html)
-            self.displayedEntries.append(entry)
+        sb = self.entryList.verticalScrollBar()
+        isMax = sb.value() == sb.maximum()
+        self.model.appendEntry(entry['id'])
+        if isMax:
+            self.entryList.scrollToBottom()
             
-            if isMax:
-                ## can't scroll to end until the web frame has processed the html change
-                #frame.setScrollBarValue(QtCore.Qt.Vertical, frame.scrollBarMaximum(QtCore.Qt.Vertical))
-                
-                ## Calling processEvents anywhere inside an error handler is forbidden
-                ## because this can lead to Qt complaining about paint() recursion.
-                #QtGui.QApplication.processEvents()  
-                #self.ui.output.scrollToAnchor(str(entry['id']))
-                
-                self.sigScrollToAnchor.emit(str(entry['id']))  ## queued connection
-            #self.ui.logView.update()
-            
-    def scrollToAnchor(self, anchor):
-        self.ui.output.scrollToAnchor(anchor)
+    def currentEntryChanged(self, current, previous):
+        if not current.isValid():
+            self.ui.output.clear()
+            return
+        entry = self.store.entry(self.model.entryId(current.row()))
+        self.ui.output.setHtml(self.generateEntryHtml(entry))
                 
     def generateEntryHtml(self, entry):
         msg = self.cleanText(entry['message'])
@@ -700,7 +665,7 @@ class LogWidget(QtGui.QWidget):
                 #self.displayTraceback(tb, entry, number=i+n)
         if count == 1:
             exc = "<div class=\"exception\"><ol>" + "\n".join(["<li>%s</li>" % ex for ex in text]) + "</ol></div>"
-            tbStr = "\n".join(["<li><b>%s</b><br/><span class='traceback'>%s</span></li>" % (messages[i], tb) for i,tb in enumerate(traceback)])
+            tbStr = "\n".join(["<li><b>%s</b><br/><span class='traceback'>%s</span></li>" % (messages[i], tbHtml) for i, tbHtml in enumerate(traceback)])
             #traceback = "<div class=\"traceback\" id=\"%s\"><ol>"%str(entryId) + tbStr + "</ol></div>"
             entry['tracebackHtml'] = tbStr
 
@@ -773,18 +738,18 @@ class LogWidget(QtGui.QWidget):
                 #doc = re.sub(r'<a href="exc:%s">(<[^>]+>)*Show traceback %s(<[^>]+>)*</a>'%(str(e['id']), str(e['id'])), e['tracebackHtml'], doc)
                 
         global pageTemplate
-        doc = pageTemplate
-        for e in self.displayedEntries:
-            doc += self.cache[id(e)]
-        for e in self.displayedEntries:
-            if e.has_key('tracebackHtml'):
-                doc = re.sub(r'<a href="exc:%s">(<[^>]+>)*Show traceback %s(<[^>]+>)*</a>'%(str(e['id']), str(e['id'])), e['tracebackHtml'], doc)
-            
-            
-        
-        #doc = self.ui.logView.page().currentFrame().toHtml()
+        ## write displayed entries in chunks so that very long logs need not be held in memory as html
+        ids = self.model.ids()
         f = open(fileName, 'w')
-        f.write(doc.encode('utf-8'))
+        f.write(pageTemplate.encode('utf-8'))
+        for start in range(0, len(ids), 1000):
+            doc = ''
+            for e in self.store.entries(ids[start:start+1000]):
+                html = self.generateEntryHtml(e)
+                if e.has_key('tracebackHtml'):
+                    html = re.sub(r'<a href="exc:%s">(<[^>]+>)*Show traceback %s(<[^>]+>)*</a>'%(str(e['id']), str(e['id'])), e['tracebackHtml'], html)
+                doc += html
+            f.write(doc.encode('utf-8'))
         f.close()
         
         
@@ -818,20 +783,15 @@ class LogWidget(QtGui.QWidget):
             self.manager.showDocumentation(url[4:])
         elif url[:4] == 'exc:':
             cursor = self.ui.output.document().find('Show traceback %s' % url[4:])
-            try:
-                tb = self.entries[int(url[4:])-1]['tracebackHtml']
-            except IndexError:
-                try:
-                    tb = self.entries[self.entryArray[self.entryArray['entryId']==(int(url[4:]))]['index']]['tracebackHtml']
-                except:
-                    print "requested index %d, but only %d entries exist." % (int(url[4:])-1, len(self.entries))
-                    raise
-            cursor.insertHtml(tb)
+            entry = self.store.entry(int(url[4:]))
+            if 'tracebackHtml' not in entry:
+                self.generateEntryHtml(entry)  ## also generates tracebackHtml
+            cursor.insertHtml(entry['tracebackHtml'])
 
     def clear(self):
         #self.ui.logView.setHtml("")
+        self.model.setEntries(None, [])
         self.ui.output.clear()
-        self.displayedEntryies = []
 
         
         
@@ -58,7 +58,7 @@ def logMsg(msg, **kwargs):
           docs: a list of strings where documentation related to the message can be found
           reasons: a list of reasons (as strings) for the message
           traceback: a list of formatted callstack/trackback objects (formatting a traceback/callstack returns a list of strings), usually looks like [['line 1', 'line 2', 'line3'], ['line1', 'line2']]
-       Feel free to add your own keyword arguments. These will be saved in the log.txt file, but will not affect the content or way that messages are displayed.
+       Feel free to add your own keyword arguments. These will be saved with the entry in the log.db file of the current storage directory (see acq4.util.LogStore), but will not affect the content or way that messages are displayed.
         """
     global LOG
     if LOG is not None:
@@ -137,6 +137,8 @@ class Manager(QtCore.QObject):
     def __init__(self, configFile=None, argv=None):
         self.lock = Mutex(recursive=True)  ## used for keeping some basic methods thread-safe
         self.devices = OrderedDict()
+        self.deviceStartupTimes = OrderedDict()  ## name: import/construct timings recorded at startup
+        self._deviceStartup = None
         self.modules = OrderedDict()
         self.config = OrderedDict()
         self.definedModules = OrderedDict()
@@ -146,6 +148,7 @@ class Manager(QtCore.QObject):
         self.shortcuts = []
         self.disableDevs = []
         self.disableAllDevs = False
+        self.headless = False
         self.alreadyQuit = False
         self.taskLock = Mutex(QtCore.QMutex.Recursive)
         
@@ -161,7 +164,7 @@ class Manager(QtCore.QObject):
             
             if argv is not None:
                 try:
-                    opts, args = getopt.getopt(argv, 'c:a:m:b:s:d:nD', ['config=', 'config-name=', 'module=', 'base-dir=', 'storage-dir=', 'disable=', 'no-manager', 'disable-all'])
+                    opts, args = getopt.getopt(argv, 'c:a:m:b:s:d:nD', ['config=', 'config-name=', 'module=', 'base-dir=', 'storage-dir=', 'disable=', 'no-manager', 'disable-all', 'headless'])
                 except getopt.GetoptError, err:
                     print str(err)
                     print """
@@ -174,6 +177,8 @@ class Manager(QtCore.QObject):
         -n --no-manager    Do not load manager module
         -d --disable=      Disable the device specified
         -D --disable-all   Disable all devices
+           --headless      Load devices only; do not require any modules to be
+                           loaded (for scripts and benchmarks)
     """
                     raise
             else:
@@ -207,6 +212,9 @@ class Manager(QtCore.QObject):
                     self.disableDevs.append(a)
                 elif o in ['-D', '--disable-all']:
                     self.disableAllDevs = True
+                elif o == '--headless':
+                    self.headless = True
+                    loadManager = False
                 else:
                     print "Unhandled option", o, a
             
@@ -250,11 +258,20 @@ class Manager(QtCore.QObject):
                 
         except:
             printExc("Error while configuring Manager:")
+            if self.headless:
+                self.quit()
+                raise
         finally:
-            if len(self.modules) == 0:
+            if len(self.modules) == 0 and not self.headless:
                 self.quit()
                 raise Exception("No modules loaded during startup, exiting now.")
+        
+        if len(self.modules) > 0:
+            self._createShortcuts()
+        
+        #QtCore.QObject.connect(QtGui.QApplication.instance(), QtCore.SIGNAL('lastWindowClosed()'), self.lastWindowClosed)
             
+    def _createShortcuts(self):
         #win = QtGui.QApplication.instance().activeWindow()
         win = self.modules[self.modules.keys()[0]].window()
         #if win is None:   ## Breaks on some systems..
@@ -269,9 +286,6 @@ class Manager(QtCore.QObject):
         self.quitShortcut.activated.connect(self.quit)
         self.abortShortcut.activated.connect(self.sigAbortAll)
         self.reloadShortcut.activated.connect(self.reloadAll)
-    
-        
-        #QtCore.QObject.connect(QtGui.QApplication.instance(), QtCore.SIGNAL('lastWindowClosed()'), self.lastWindowClosed)
             
     def _getConfigFile(self):
         ## search all the default locations to find a configuration file.
@@ -310,27 +324,15 @@ class Manager(QtCore.QObject):
     def configure(self, cfg):
         """Load the devices, modules, stylesheet, and storageDir defined in cfg"""
         
+        ## must be known before 'devices' is handled, wherever it appears in cfg
+        if 'deviceStartupWorkers' in cfg:
+            self.config['deviceStartupWorkers'] = cfg['deviceStartupWorkers']
+        
         for key in cfg:
             try:
                 ## configure new devices
                 if key == 'devices':
-                    for k in cfg['devices']:
-                        if self.disableAllDevs or k in self.disableDevs:
-                            print "    --> Ignoring device '%s' -- disabled by request" % k
-                            logMsg("    --> Ignoring device '%s' -- disabled by request" % k)
-                            continue
-                        print "  === Configuring device '%s' ===" % k
-                        logMsg("  === Configuring device '%s' ===" % k)
-                        try:
-                            conf = cfg['devices'][k]
-                            driverName = conf['driver']
-                            if 'config' in conf:  # for backward compatibility
-                                conf = conf['config']
-                            self.loadDevice(driverName, conf, k)
-                        except:
-                            printExc("Error configuring device %s:" % k)
-                    print "=== Device configuration complete ==="
-                    logMsg("=== Device configuration complete ===")
+                    self.loadDevices(cfg['devices'], workers=self.config.get('deviceStartupWorkers', 4))
                             
                 ## Copy in new module definitions
                 elif key == 'modules':
@@ -453,19 +455,82 @@ class Manager(QtCore.QObject):
         with self.lock:
             return os.path.join(self.configDir, name)
     
-    def loadDevice(self, driverName, conf, name):
-        """Load the code for a device. For this to work properly, there must be 
+    def loadDevices(self, devices, workers=4):
+        """Load all devices described in *devices* (the 'devices' section of a config file).
+        
+        Device code is imported and devices are constructed concurrently in up to
+        *workers* threads, subject to the order implied by devices that refer to each other
+        in their configuration (see acq4.util.StartupScheduler). If *workers* is 0,
+        devices are loaded one at a time in the order given. Startup timings are printed,
+        logged, and stored in self.deviceStartupTimes.
+        """
+        from .util.StartupScheduler import StartupScheduler
+        sched = StartupScheduler(self.importDevice, self._constructDevice, workers=workers)
+        for k in devices:
+            if self.disableAllDevs or k in self.disableDevs:
+                print "    --> Ignoring device '%s' -- disabled by request" % k
+                logMsg("    --> Ignoring device '%s' -- disabled by request" % k)
+                continue
+            print "  === Configuring device '%s' ===" % k
+            logMsg("  === Configuring device '%s' ===" % k)
+            try:
+                conf = devices[k]
+                driverName = conf['driver']
+                if 'config' in conf:  # for backward compatibility
+                    conf = conf['config']
+                sched.add(k, driverName, conf)
+            except:
+                printExc("Error configuring device %s:" % k)
+        
+        self._deviceStartup = sched
+        try:
+            sched.run()
+        finally:
+            self._deviceStartup = None
+        
+        ## keep devices listed in configuration order rather than the order they finished starting
+        with self.lock:
+            for name in sched.specs:
+                if name in self.devices:
+                    self.devices[name] = self.devices.pop(name)
+            self.deviceStartupTimes.update(sched.timings())
+        
+        for name, rec in sched.timings().items():
+            if rec['error'] is not None:
+                logMsg("Error configuring device %s: %s" % (name, rec['error']), msgType='error')
+        report = sched.report()
+        print report
+        logMsg("=== Device configuration complete ===\n" + report)
+        print "=== Device configuration complete ==="
+        
+    def importDevice(self, driverName):
+        """Import the code for a device and return its class. There must be 
         a python module called acq4.devices.driverName which contains a class called driverName."""
         mod = __import__('acq4.devices.%s' % driverName, fromlist=['*'])
-        devclass = getattr(mod, driverName)
+        return getattr(mod, driverName)
+    
+    def _constructDevice(self, devclass, conf, name):
         dev = devclass(self, conf, name)
+        ## devices constructed in a startup worker thread must live in the GUI thread afterward
+        guiThread = QtCore.QCoreApplication.instance().thread()
+        if dev.thread() != guiThread:
+            dev.moveToThread(guiThread)
         with self.lock:
             self.devices[name] = dev
         return dev
     
+    def loadDevice(self, driverName, conf, name):
+        """Load the code for a device. For this to work properly, there must be 
+        a python module called acq4.devices.driverName which contains a class called driverName."""
+        return self._constructDevice(self.importDevice(driverName), conf, name)
+    
     def getDevice(self, name):
+        name = str(name)
+        ## a device that is still being constructed during startup will be available shortly
+        startup = self._deviceStartup
+        if startup is not None and startup.isBuilding(name):
+            startup.wait(name, timeout=60)
         with self.lock:
-            name = str(name)
             if name not in self.devices:
                 #print self.devices
                 raise Exception("No device named %s. Options are %s" % (name, str(self.devices.keys())))
@@ -874,6 +939,7 @@ class Manager(QtCore.QObject):
                 print "Closing windows.."
                 QtGui.QApplication.instance().closeAllWindows()
                 QtGui.QApplication.instance().processEvents()
+                self.logWindow.flushLog()
             #print "  done."
             print "\n    ciao."
         QtGui.QApplication.quit()
@@ -895,6 +961,8 @@ class Task:
         self.startedDevs = []
         self.startTime = None
         self.stopTime = None
+        self.phaseTimes = OrderedDict()  ## phase: duration (s) for the most recent run; see _markPhase()
+        self._phaseStart = None
 
         #self.reserved = False
         try:
@@ -986,6 +1054,8 @@ class Task:
             self.stopped = False  # whether sub-tasks have been stopped yet
             self.abortRequested = False
             self._done = False  # cached output of isDone()
+            self.phaseTimes = OrderedDict()
+            self._phaseStart = ptime.time()
 
             #print "======  Executing task %d:" % self.id
             #print self.cfg
@@ -1012,6 +1082,7 @@ class Task:
                     self.dm.unlockReserv()
                     
                 prof.mark('reserve')
+                self._markPhase('reserve')
 
                 ## Determine order of device configuration.
                 configOrder = self.getConfigOrder()
@@ -1027,11 +1098,13 @@ class Task:
                     
                 startOrder = self.getStartOrder()
                 #print "done"
+                self._markPhase('configure')
 
                 if 'leadTime' in self.cfg:
                     time.sleep(self.cfg['leadTime'])
                     
                 prof.mark('leadSleep')
+                self._phaseStart = ptime.time()
 
                 self.result = None
                 
@@ -1048,6 +1121,7 @@ class Task:
                         raise HelpfulException("Error starting device '%s'; aborting task." % devName)
                     prof.mark('start %s' % devName)
                 self.startTime = ptime.time()
+                self._markPhase('start')
                 
                 #print "  %d Task started" % self.id
                     
@@ -1165,6 +1239,7 @@ class Task:
 
             prof = Profiler("Manager.Task.stop", disabled=True)
             self.abortRequested = abort
+            self._phaseStart = ptime.time()
             try:
                 if not self.stopped:
                     ## Stop all device tasks
@@ -1176,6 +1251,7 @@ class Task:
                             printExc("Error while stopping task %s:" % t)
                         prof.mark("   ..task "+ t+ " stopped")
                     self.stopped = True
+                    self._markPhase('stop')
                 
                 if not abort and not self._tasksDone():
                     raise Exception("Cannot get result; task is still running.")
@@ -1193,6 +1269,7 @@ class Task:
                             result[devName] = None
                         prof.mark("get result: "+devName)
                     self.result = result
+                    self._markPhase('getResult')
                     #print "RESULT 1:", self.result
                     
                     ## Store data if requested
@@ -1200,6 +1277,7 @@ class Task:
                         self.cfg['storageDir'].setInfo(result['protocol'])
                         for t in self.tasks:
                             self.tasks[t].storeResult(self.cfg['storageDir'])
+                        self._markPhase('store')
                     prof.mark("store data")
             finally:   
                 ## Regardless of any other problems, at least make sure we 
@@ -1221,6 +1299,15 @@ class Task:
             self.stop()
             return self.result
 
+    def _markPhase(self, phase):
+        ## Record the time spent in *phase* (since the previous phase ended) in
+        ## self.phaseTimes. Phases are 'reserve', 'configure', 'start' (in execute),
+        ## 'stop', 'getResult' and 'store' (in stop). Lead time and the time
+        ## spent waiting for the task to finish are not included.
+        now = ptime.time()
+        self.phaseTimes[phase] = now - self._phaseStart
+        self._phaseStart = now
+
     def _releaseAll(self):
         with self.taskLock:
             #print self.id,"Task.releaseAll:"
@@ -3,6 +3,7 @@ import acq4.util.DataManager as DataManager
 import acq4.util.SequenceRunner as SequenceRunner
 from collections import OrderedDict
 import functools
+import threading, Queue, sys
 from acq4.util.metaarray import *
 import numpy as np
 
@@ -124,23 +125,24 @@ def buildSequenceArray(*args, **kargs):
         if m is None:
             return i
         
-def buildSequenceArrayIter(dh, func=None, join=True, truncate=False, fill=None):
-    """Iterator for buildSequenceArray that yields progress updates."""
+def buildSequenceArrayIter(dh, func=None, join=True, truncate=False, fill=None, workers=1):
+    """Iterator for buildSequenceArray that yields progress updates.
+    
+    If workers > 1, func is called for several protocol directories at once from
+    a pool of background threads (see SequenceLoader); in that case func must be
+    safe to call from outside the GUI thread. Progress updates are yielded in the
+    order that directories finish loading.
+    """
         
     if func is None:
         func = lambda dh: dh
         join = False
         
     params = listSequenceParams(dh)
-    #inds = OrderedDict([(k, range(len(v))) for k,v in params.iteritems()])
-    #def runFunc(dh, func, params):
-        #name = '_'.join(['%03d'%n for n in params.values()])
-        #fh = dh[name]
-        #return func(fh)
-    #data = SequenceRunner.runSequence(functools.partial(runFunc, dh, func), inds, inds.keys())
     subDirs = dh.subDirs()
     if len(subDirs) == 0:
         yield None, None
+        return
     
     ## set up meta-info for sequence axes
     seqShape = tuple([len(p) for p in params.itervalues()])
@@ -150,59 +152,150 @@ def buildSequenceArrayIter(dh, func=None, join=True, truncate=False, fill=None):
         info[i] = {'name': k, 'values': np.array(v)}
         i += 1
     
-    ## get a data sample
-    first = func(dh[subDirs[0]])
+    ## the index for each directory is read in the same worker as its data
+    loader = SequenceLoader(lambda subd: (func(subd), subd.info()), workers=workers)
     
-    ## build empty MetaArray
-    if join:
-        shape = seqShape + first.shape
-        if isinstance(first, MetaArray):
-            info = info + first._info
-        else:
-            info = info + [[] for i in range(first.ndim+1)]
-        data = MetaArray(np.empty(shape, first.dtype), info=info)
-        if fill is not None:
-            data[:] = fill
-        
-    else:
-        shape = seqShape
-        info = info + []
-        data = MetaArray(np.empty(shape, object), info=info)
-
-    ## fill data
+    data = None
+    minShape = None
     i = 0
-    if join and truncate:
-        minShape = first.shape
-        for name in subDirs:
-            subd = dh[name]
-            d = func(subd)
+    for n, (d, dhInfo) in loader.run([dh[name] for name in subDirs]):
+        if data is None:
+            ## build empty MetaArray from the first sample to arrive
+            if join:
+                shape = seqShape + d.shape
+                if isinstance(d, MetaArray):
+                    info = info + d._info
+                else:
+                    info = info + [[] for j in range(d.ndim+1)]
+                data = MetaArray(np.empty(shape, d.dtype), info=info)
+                if fill is not None:
+                    data[:] = fill
+            else:
+                data = MetaArray(np.empty(seqShape, object), info=info)
+            minShape = d.shape if join else None
+        
+        ## fill data
+        ind = [dhInfo[k] for k in params]
+        if join and truncate:
             minShape = [min(d.shape[j], minShape[j]) for j in range(d.ndim)]
-            dhInfo = subd.info()
-            ind = []
-            for k in params:
-                ind.append(dhInfo[k])
             sl = [slice(0,m) for m in minShape]
-            ind += sl
-            data[tuple(ind)] = d[sl]
-            i += 1
-            yield i, len(subDirs)
+            data[tuple(ind + sl)] = d[tuple(sl)]
+        else:
+            data[tuple(ind)] = d
+        i += 1
+        yield i, len(subDirs)
+        
+    if join and truncate:
         sl = [slice(None)] * len(seqShape)
         sl += [slice(0,m) for m in minShape]
-        data = data[sl]
-    else:
-        for name in subDirs:
-            subd = dh[name]
-            d = func(subd)
-            dhInfo = subd.info()
-            ind = []
-            for k in params:
-                ind.append(dhInfo[k])
-            data[tuple(ind)] = d
-            i += 1
-            yield i, len(subDirs)
+        data = data[tuple(sl)]
 
     yield data, None
 
+
+class SequenceLoader(object):
+    """Calls a function on many protocol directories, reading them concurrently.
+    
+    Reading a sequence one directory at a time is dominated by file-system latency
+    (especially on network shares), so the directories are handed to a small pool
+    of worker threads. The number of workers bounds the number of reads in flight.
+    Results are yielded from run() as (index, result) in the order they complete,
+    which lets callers start displaying data before the whole sequence is read.
+    
+    With workers <= 1, everything runs synchronously in the calling thread.
+    
+    Example::
+    
+        loader = SequenceLoader(readClampSweep, workers=8)
+        for i, sweep in loader.run([seqDir[name] for name in seqDir.subDirs()]):
+            ...
+    """
+    def __init__(self, func, workers=4):
+        self.func = func
+        self.workers = workers
+        
+    def run(self, handles):
+        handles = list(handles)
+        if self.workers <= 1 or len(handles) < 2:
+            for i, h in enumerate(handles):
+                yield i, self.func(h)
+            return
+        
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        abort = threading.Event()
+        for i, h in enumerate(handles):
+            tasks.put((i, h))
+        
+        def work():
+            while not abort.is_set():
+                try:
+                    i, h = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results.put((i, self.func(h), None))
+                except Exception:
+                    results.put((i, None, sys.exc_info()))
+        
+        threads = [threading.Thread(target=work) for j in range(min(self.workers, len(handles)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        
+        try:
+            for j in range(len(handles)):
+                i, result, exc = results.get()
+                if exc is not None:
+                    raise exc[0], exc[1], exc[2]
+                yield i, result
+        finally:
+            ## stops remaining reads if the caller raised or stopped iterating early
+            abort.set()
+
+
+def readClampSweep(protoDH, seqInfo=None):
+    """Read the clamp recording and its commonly used meta-info from a single
+    protocol directory. The clamp file header is only read once, and the
+    sequence index may be supplied as *seqInfo* to avoid re-reading it for
+    every sweep.
+    
+    Returns a dict, or None if the directory contains no clamp data.
+    """
+    fh = getClampFile(protoDH)
+    if fh is None:
+        return None
+    data = fh.read()
+    primary = getClampPrimary(data)
+    
+    ## the start time is stored in different places depending on the version of acq4 
+    info = primary._info
+    if 'startTime' in info[0]:
+        startTime = info[0]['startTime']
+    elif 'startTime' in info[1]:
+        startTime = info[1]['startTime']
+    elif 'startTime' in info[1]['DAQ']['command']:
+        startTime = info[1]['DAQ']['command']['startTime']
+    else:
+        startTime = 0.0
+    
+    return {
+        'dirHandle': protoDH,
+        'fileHandle': fh,
+        'data': data,
+        'primary': primary,
+        'command': getClampCommand(data),
+        'startTime': startTime,
+        'mode': getClampMode(data),
+        'devices': getDevices(protoDH),
+        'clampDevices': getClampDeviceNames(protoDH),
+        'holding': getClampHoldingLevel(fh, data=data, seqInfo=seqInfo),
+        'amplifierSettings': getWCCompSettings(fh, data=data),
+        'clampState': getClampState(fh, data=data),
+        'sampleRate': getSampleRate(fh, data=data),
+    }
+
+
 def getParent(child, parentType):
     """Return the (grand)parent of child that matches parentType"""
     if dirType(child) == parentType:
@@ -294,21 +387,27 @@ def getClampMode(data_handle, dir_handle=None):
             # else:
             #     return 'vc'  # None  kludge to handle simulations, which don't seem to fully fill the structures.
 
-def getClampHoldingLevel(data_handle):
+def getClampHoldingLevel(data_handle, data=None, seqInfo=None):
     """Given a clamp file handle, return the holding level (voltage for VC, current for IC).
+    If the file has already been read, it may be passed as *data* to avoid reading the header again.
+    Likewise, *seqInfo* may be given to avoid re-reading the index of the enclosing sequence.
     TODO: This function should add in the amplifier's internal holding value, if available?
     """
     if not isClampFile(data_handle):
         raise Exception('%s not a clamp file.' % data_handle.shortName())
     
-    data = data_handle.read(readAllData=False)
+    if data is None:
+        data = data_handle.read(readAllData=False)
     info = data._info[-1]
-    p1 = data_handle.parent()
-    p2 = p1.parent()
-    if isSequence(p2):
-        sinfo = p2.info()
+    if seqInfo is not None:
+        sinfo = seqInfo
     else:
-        sinfo = p1.info()
+        p1 = data_handle.parent()
+        p2 = p1.parent()
+        if isSequence(p2):
+            sinfo = p2.info()
+        else:
+            sinfo = p1.info()
     
     ## There are a few places we could find the holding value, depending on how old the data is
     if 'ClampState' in info and 'holding' in info['ClampState']:
@@ -326,27 +425,29 @@ def getClampHoldingLevel(data_handle):
         except KeyError:
             return None
 
-def getClampState(data_handle):
+def getClampState(data_handle, data=None):
     """
     Return the full clamp state
     """
     if not isClampFile(data_handle):
         raise Exception('%s not a clamp file.' % data_handle.shortName())
-    data = data_handle.read(readAllData=False)
+    if data is None:
+        data = data_handle.read(readAllData=False)
     info = data._info[-1]
     if 'ClampState' in info.keys():
         return info['ClampState']
     else:
         return None
 
-def getWCCompSettings(data_handle):
+def getWCCompSettings(data_handle, data=None):
     """
     return the compensation settings, if available
     Settings are returned as a group in a dictionary
     """
     if not isClampFile(data_handle):
         raise Exception('%s not a clamp file.' % data_handle.shortName())
-    data = data_handle.read(readAllData=False)
+    if data is None:
+        data = data_handle.read(readAllData=False)
     info = data._info[-1]
     d = {}
     if 'ClampState' in info.keys() and 'ClampParams' in info['ClampState'].keys():
@@ -363,11 +464,12 @@ def getWCCompSettings(data_handle):
         return {'WCCompValid': False, 'WCEnable': 0, 'WCResistance': 0., 'WholeCellCap': 0.,
                 'CompEnable': 0, 'CompCorrection': 0., 'CompBW': 50000. }
 
-def getSampleRate(data_handle):
+def getSampleRate(data_handle, data=None):
     """given clamp data, return the data sampling rate """
     if not isClampFile(data_handle):
         raise Exception('%s not a clamp file.' % data_handle.shortName())
-    data = data_handle.read(readAllData=False)
+    if data is None:
+        data = data_handle.read(readAllData=False)
     info = data._info[-1]
     if 'DAQ' in info.keys():
         return(info['DAQ']['primary']['rate'])
@@ -555,26 +657,36 @@ class GetClamps():
     def __init__(self):
         pass
 
-    def getClampData(self, dh, pars=None):
+    def getClampData(self, dh, pars=None, workers=4):
         """
         Read the clamp data - whether it is voltage or current clamp, and put the results
         into our class variables. 
         dh is the file handle (directory)
         pars is a structure that provides some control parameters usually set by the GUI
+        workers is the number of sweeps that are read concurrently (see SequenceLoader)
         Returns a short dictionary of some values; others are accessed through the class.
         Returns None if no data is found.
         """   
+        for clampInfo, n in self.iterClampData(dh, pars, workers=workers):
+            if n is None:
+                return clampInfo
+
+    def iterClampData(self, dh, pars=None, workers=4):
+        """
+        Iterator for getClampData that yields progress updates as (nRead, nTotal).
+        While iterating, self.traces is a preallocated (nTotal, nSamples) array that
+        is filled in as sweeps arrive, and self.tracesLoaded flags the rows that hold
+        data, so that a plot can be updated before the whole protocol is read.
+        The final item yielded is (clampInfo, None).
+        """
         pars = self.getParsDefaults(pars)
         clampInfo = {}
         if dh is None:
-            return None
+            yield None, None
+            return
 
         dirs = dh.subDirs()
         clampInfo['dirs'] = dirs
-        traces = []
-        cmd = []
-        cmd_wave = []
-        data = []
         self.time_base = None
         self.values = []
         self.trace_StartTimes = np.zeros(0)
@@ -624,76 +736,73 @@ class GetClamps():
                         dirs.append('%03d_%03d' % (i, j))
 ### --- end of possibly broken section
 
-        for i, directory_name in enumerate(dirs):  # dirs has the names of the runs withing the protocol
-            data_dir_handle = dh[directory_name]  # get the directory within the protocol
-            try:
-                data_file_handle = getClampFile(data_dir_handle)  # get pointer to clamp data
-                # Check if there is no clamp file for this iteration of the protocol
-                # Usually this indicates that the protocol was stopped early.
-                if data_file_handle is None:
-                    print 'PatchEPhys/GetClamps: Missing data in %s, element: %d' % (directory_name, i)
-                    continue
-            except:
-                raise Exception("Error loading data for protocol %s:"
-                                % directory_name)
-            data_file = data_file_handle.read()
-
-            self.data_mode  = getClampMode(data_file, dir_handle=dh)
-            if self.data_mode is None:
-                self.data_mode = ic_modes[0]  # set a default mode
-            if self.data_mode in ['vc']:  # should be "AND something"  - this is temp fix for Xuying's old data
-                self.data_mode = vc_modes[0]
-            if self.data_mode in ['model_ic', 'model_vc']:  # lower case means model was run
-                self.modelmode = True
-            # Assign scale factors for the different modes to display data rationally
-            if self.data_mode in ic_modes:
-                self.command_scale_factor = 1e12
-                self.command_units = 'pA'
-            elif self.data_mode in vc_modes:
-                self.command_units = 'mV'
-                self.command_scale_factor = 1e3
-            else:  # data mode not known; plot as voltage
-                self.command_units = 'V'
-                self.command_scale_factor = 1.0
+        seqInfo = dh.info()
+        handles = [dh[name] for name in dirs]
+        loader = SequenceLoader(functools.partial(readClampSweep, seqInfo=seqInfo), workers=workers)
+        sweeps = [None] * len(dirs)
+        traces = None
+        cmd_wave = None
+        self.traces = None
+        self.tracesLoaded = np.zeros(len(dirs), dtype=bool)
+        nRead = 0
+        for i, sweep in loader.run(handles):
+            nRead += 1
+            # Check if there is no clamp file for this iteration of the protocol
+            # Usually this indicates that the protocol was stopped early.
+            if sweep is None:
+                print 'PatchEPhys/GetClamps: Missing data in %s, element: %d' % (dirs[i], i)
+                yield nRead, len(dirs)
+                continue
+            self._setDataMode(sweep['mode'])
             if pars['limits']:
                 cval = self.command_scale_factor * sequence_values[i]
                 cmin = pars['cmin']
                 cmax = pars['cmax']
                 if cval < cmin or cval > cmax:
+                    yield nRead, len(dirs)
                     continue  # skip adding the data to the arrays
 
-            self.devicesUsed = getDevices(data_dir_handle)
-            self.clampDevices = getClampDeviceNames(data_dir_handle)
-            self.holding = getClampHoldingLevel(data_file_handle)
-            self.amplifierSettings = getWCCompSettings(data_file_handle)
-            self.clampState = getClampState(data_file_handle)
-            # print self.devicesUsed
-            cmd = getClampCommand(data_file)
-
-            data = getClampPrimary(data_file)
-            # store primary channel data and read command amplitude
-            info1 = data.infoCopy()
-            # we need to handle all the various cases where the data is stored in different parts of the
-            # "info" structure
-            if 'startTime' in info1[0].keys():
-                start_time = info1[0]['startTime']
-            elif 'startTime' in info1[1].keys():
-                start_time = info1[1]['startTime']
-            elif 'startTime' in info1[1]['DAQ']['command'].keys():
-                start_time = info1[1]['DAQ']['command']['startTime']
-            else:
-                start_time = 0.0
-            self.trace_StartTimes = np.append(self.trace_StartTimes, start_time)
-            traces.append(data.view(np.ndarray))
-            cmd_wave.append(cmd.view(np.ndarray))
-            # pick up and save the sequence values
+            # store primary channel data and command directly into preallocated arrays
+            trace = sweep['primary'].view(np.ndarray)
+            cmd = sweep['command'].view(np.ndarray)
+            if traces is None:
+                traces = np.empty((len(dirs),) + trace.shape, dtype=trace.dtype)
+                cmd_wave = np.empty((len(dirs),) + cmd.shape, dtype=cmd.dtype)
+                if traces.dtype.kind == 'f':
+                    traces[:] = np.nan
+                self.traces = traces
+            traces[i] = trace
+            cmd_wave[i] = cmd
+            sweeps[i] = sweep
+            self.tracesLoaded[i] = True
+            yield nRead, len(dirs)
+
+        loaded = np.argwhere(self.tracesLoaded)[:, 0]
+        if len(loaded) == 0:
+            print "PatchEPhys/GetClamps: No data found in this run..."
+            yield None, None
+            return
+
+        # pick up and save the sequence values
+        for i in loaded:
             if len(sequence_values) > 0:
                 self.values.append(sequence_values[i])
             else:
+                cmd = sweeps[i]['command']
                 self.values.append(cmd[len(cmd) / 2])
-        if traces is None or len(traces) == 0:
-            print "PatchEPhys/GetClamps: No data found in this run..."
-            return None
+
+        # per-protocol settings are taken from the last sweep that was read
+        last = sweeps[loaded[-1]]
+        self._setDataMode(last['mode'])
+        data = last['primary']
+        cmd = last['command']
+        self.devicesUsed = last['devices']
+        self.clampDevices = last['clampDevices']
+        self.holding = last['holding']
+        self.amplifierSettings = last['amplifierSettings']
+        self.clampState = last['clampState']
+        self.trace_StartTimes = np.array([sweeps[i]['startTime'] for i in loaded], dtype=float)
+
         self.RSeriesUncomp = 0.
         if self.amplifierSettings['WCCompValid']:
             if self.amplfierSettings['WCEnabled'] and self.amplifierSettings['CompEnabled']:
@@ -703,8 +812,10 @@ class GetClamps():
 
         # put relative to the start
         self.trace_StartTimes -= self.trace_StartTimes[0]
-        traces = np.vstack(traces)
-        self.cmd_wave = np.vstack(cmd_wave)
+        if len(loaded) < len(dirs):
+            traces = traces[loaded]
+            cmd_wave = cmd_wave[loaded]
+        self.cmd_wave = cmd_wave
         self.time_base = np.array(cmd.xvals('Time'))
         self.commandLevels = np.array(self.values)
         # set up the selection region correctly and
@@ -714,11 +825,10 @@ class GetClamps():
              'values': np.array(self.values)},
             data.infoCopy('Time'),
             data.infoCopy(-1)]
-        traces = traces[:len(self.values)]
         self.traces = MetaArray(traces, info=info)
 #        sfreq = self.dataModel.getSampleRate(data_file_handle)
-        self.sample_interval = 1. / getSampleRate(data_file_handle)
-        vc_command = data_dir_handle.parent().info()['devices'][self.clampDevices[0]]
+        self.sample_interval = 1. / last['sampleRate']
+        vc_command = seqInfo['devices'][self.clampDevices[0]]
         self.tstart = 0.01
         self.tdur = 0.5
         self.tend = 0.510
@@ -781,7 +891,31 @@ class GetClamps():
 
         if self.data_mode in vc_modes:
             self.spikecount = np.zeros(len(np.array(self.values)))
-        return clampInfo
+        yield clampInfo, None
+
+    def _setDataMode(self, mode):
+        """
+        Set self.data_mode from the clamp mode of a sweep, along with the scale factor and
+        units used to display command values rationally.
+        """
+        self.data_mode = mode
+        if self.data_mode is None:
+            self.data_mode = ic_modes[0]  # set a default mode
+        if self.data_mode in ['vc']:  # should be "AND something"  - this is temp fix for Xuying's old data
+            self.data_mode = vc_modes[0]
+        if self.data_mode in ['model_ic', 'model_vc']:  # lower case means model was run
+            self.modelmode = True
+        # Assign scale factors for the different modes to display data rationally
+        if self.data_mode in ic_modes:
+            self.command_scale_factor = 1e12
+            self.command_units = 'pA'
+        elif self.data_mode in vc_modes:
+            self.command_units = 'mV'
+            self.command_scale_factor = 1e3
+        else:  # data mode not known; plot as voltage
+            self.command_units = 'V'
+            self.command_scale_factor = 1.0
+        return self.data_mode
 
     def getParsDefaults(self, pars):
         """
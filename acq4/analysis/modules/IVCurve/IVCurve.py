@@ -92,6 +92,9 @@ class IVCurve(AnalysisModule):
         self.tauh_fitted = {}
         self.tau_fits = {}
         self.tau_fitted = {}
+        # kept between updates so that fits can be warm-started
+        self.tauFits = Fitting.Fitting()
+        self.tauhFits = Fitting.Fitting()
         self.regions_exist = False
         self.regions = {}
         self.analysis_summary = {}
@@ -1053,7 +1056,6 @@ class IVCurve(AnalysisModule):
             return
         rgnpk = list(self.regions['lrwin0']['region'].getRegion())
         Func = 'exp1'  # single exponential fit with DC offset.
-        Fits = Fitting.Fitting()
         if self.rmp == []:
             self.update_rmpAnalysis()
         #print self.rmp
@@ -1073,7 +1075,6 @@ class IVCurve(AnalysisModule):
         indxs = list(indxs[0])
         whichdata = ineg[0][indxs]  # restricts to valid values
         itaucmd = self.Clamps.commandLevels[ineg]
-        whichaxis = 0
         fpar = []
         names = []
         okdata = []
@@ -1082,23 +1083,22 @@ class IVCurve(AnalysisModule):
         self.tau_fitted = {}
         for j, k in enumerate(whichdata):
             self.tau_fitted[j] = self.data_plot.plot(self.Clamps.time_base,  self.Clamps.traces[k], pen=pg.mkPen('w'))
-            (fparx, xf, yf, namesx) = Fits.FitRegion([k], whichaxis,
-                                               self.Clamps.time_base,
-                                               self.Clamps.traces,
-                                               dataType='2d',
-                                               t0=rgnpk[0], t1=rgnpk[1],
-                                               fitFunc=Func,
-                                               fitPars=initpars,
-                                               method='SLSQP',
-                                               bounds=[(-0.1, 0.1), (-0.1, 0.1), (0.005, 0.30)])
-        
-            if not fparx:
-              raise Exception('IVCurve::update_Tau_membrane: Charging tau fitting failed - see log')
-            #print 'j: ', j, len(fpar)
-            if fparx[0][1] < 2.5e-3:  # amplitude must be > 2.5 mV to be useful
+        # fit all of the selected traces together; start from the previous fit while the region is dragged
+        (fparx, xf, yf, namesx) = self.tauFits.FitBatch(self.Clamps.time_base,
+                                                        self.Clamps.traces.view(np.ndarray),
+                                                        whichdata=whichdata,
+                                                        t0=rgnpk[0], t1=rgnpk[1],
+                                                        fitFunc=Func,
+                                                        fitPars=initpars,
+                                                        bounds=[(-0.1, 0.1), (-0.1, 0.1), (0.005, 0.30)],
+                                                        warmStart=True)
+        if len(whichdata) > 0 and not fparx:
+            raise Exception('IVCurve::update_Tau_membrane: Charging tau fitting failed - see log')
+        for j, k in enumerate(whichdata):
+            if fparx[j][1] < 2.5e-3:  # amplitude must be > 2.5 mV to be useful
                 continue
-            fpar.append(fparx[0])
-            names.append(namesx[0])
+            fpar.append(fparx[j])
+            names.append(namesx[j])
             okdata.append(k)
         self.taupars = fpar
         self.tauwin = rgnpk
@@ -1159,7 +1159,6 @@ class IVCurve(AnalysisModule):
             return
         rgn = self.regions['lrtau']['region'].getRegion()
         Func = 'exp1'  # single exponential fit to the whole region
-        Fits = Fitting.Fitting()
 
         initpars = [-80.0 * 1e-3, -10.0 * 1e-3, 50.0 * 1e-3]
 
@@ -1191,15 +1190,14 @@ class IVCurve(AnalysisModule):
         self.tauh_fitted = {}
         for k, d in enumerate(whichdata):
             self.tauh_fitted[k] = self.data_plot.plot(fd, pen=pg.mkPen('w'))
-            # now do the fit
-        whichaxis = 0
-        (fpar, xf, yf, names) = Fits.FitRegion(whichdata, whichaxis,
-                                               self.Clamps.traces.xvals('Time'),
-                                               self.Clamps.traces.view(np.ndarray),
-                                               dataType='2d',
-                                               t0=rgn[0], t1=rgn[1],
-                                               fitFunc=Func,
-                                               fitPars=initpars)
+        # now do the fit; start from the previous fit while the region is dragged
+        (fpar, xf, yf, names) = self.tauhFits.FitBatch(self.Clamps.traces.xvals('Time'),
+                                                       self.Clamps.traces.view(np.ndarray),
+                                                       whichdata=whichdata,
+                                                       t0=rgn[0], t1=rgn[1],
+                                                       fitFunc=Func,
+                                                       fitPars=initpars,
+                                                       warmStart=True)
         if not fpar:
             raise Exception('IVCurve::update_Tauh: tau_h fitting failed - see log')
         bluepen = pg.mkPen('b', width=2.0, style=QtCore.Qt.DashLine)
@@ -201,11 +201,15 @@ class MosaicEditor(AnalysisModule):
         if nsel == 0:
             return
        # print dir(self.selectedItems()[0].data)
-        nxm = self.canvas.selectedItems()[0].data.shape
+        # Global statistics are computed from each item's statsData(), which is the 
+        # lowest-resolution level of the image pyramid when one is available; this
+        # avoids reading every full-resolution image just to build the histogram.
+        stats = [x.statsData() for x in self.canvas.selectedItems()]
+        nxm = stats[0].shape
         meanImage = np.zeros((nxm[0], nxm[1]))
         nhistbins = 100
         # generate a histogram of the global levels in the image (all images selected)
-        hm = np.histogram(np.dstack([x.data for x in self.canvas.selectedItems()]), nhistbins)
+        hm = np.histogram(np.concatenate([np.asarray(d).ravel() for d in stats]), nhistbins)
         print hm
         #$meanImage = np.mean(self.selectedItems().asarray(), axis=0)
         n = 0
@@ -213,7 +217,7 @@ class MosaicEditor(AnalysisModule):
         print 'nsel: ', nsel
         for i in range(nsel):
             try:
-                meanImage = meanImage + np.array(self.canvas.selectedItems()[i].data)
+                meanImage = meanImage + np.array(stats[i])
                 imagemax = np.amax(np.amax(meanImage, axis=1), axis=0)
                 if imagemax > self.imageMax:
                     self.imageMax = imagemax
@@ -222,7 +226,7 @@ class MosaicEditor(AnalysisModule):
                 print 'image i = %d failed' % i
                 print 'file name: ', self.canvas.selectedItems()[i].name
                 print 'expected shape of nxm: ', nxm
-                print ' but got data shape: ', self.canvas.selectedItems()[i].data.shape
+                print ' but got data shape: ', stats[i].shape
 
         meanImage = meanImage/n # np.mean(meanImage[0:n], axis=0)
         filtwidth = np.floor(nxm[0]/10+1)
@@ -239,7 +243,7 @@ class MosaicEditor(AnalysisModule):
             xh = d.shape # capture shape just in case it is not right (have data that is NOT !!)
             # flatten the illumination using the blimg average illumination pattern
             newImage = d # / blimg[0:xh[0], 0:xh[1]] # (d - imin)/(blimg - imin) # rescale image.
-            hn = np.histogram(newImage, bins = hm[1]) # use bins from global image
+            hn = np.histogram(stats[i], bins = hm[1]) # use bins from global image
             n = np.argmax(hn[0])
             newImage = (hm[1][m]/hn[1][n])*newImage # rescale to the global max.
             self.canvas.selectedItems()[i].updateImage(newImage)
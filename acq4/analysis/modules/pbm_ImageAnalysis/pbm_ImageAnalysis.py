@@ -38,6 +38,7 @@ import PIL as Image
 from acq4.util.metaarray import MetaArray
 import numpy as np
 import scipy
+import scipy.sparse
 import ctrlTemplate
 import ctrlTemplateROIs
 import ctrlTemplateAnalysis
@@ -1629,18 +1630,33 @@ class pbm_ImageAnalysis(AnalysisModule):
         :param livePlot: flag for live plotting, passed to showThisROI
         """
         if roi in self.AllRois:
-            tr = roi.getArrayRegion(self.imageData, self.imageView.imageItem, axes=(1, 2))
-            tr = tr.mean(axis=2).mean(axis=1)  # compute average over the ROI against time
-#            trx = tr.copy()
-            if self.dataState['Normalized'] is False:
-#                trm = tr.mean()  # mean value across all time
-                tr = tr/tr.mean()  # (self.background[0:tr.shape[0]]*trm/self.backgroundmean)
-
+            tr = self.roiTraces([roi])[0]
             self.FData = self.insertFData(self.FData, tr.copy(), roi)
             self.applyROIFilters(roi)
             self.showThisROI(roi, livePlot)
             return(tr)
 
+    def roiTraces(self, rois):
+        """
+        Compute the mean of the image over each ROI against time, as
+        roi.getArrayRegion(self.imageData, ...).mean() would, for many ROIs at once.
+        Each ROI is rasterized into one row of a sparse weight matrix, and all traces
+        are computed with a single matrix product per chunk of frames.
+        :param rois: list of ROIs
+        :return: array (len(rois), nFrames); traces are divided by their mean unless the
+            image data are already normalized
+        """
+        imageItem = self.imageView.imageItem
+        frameShape = self.imageData.shape[1:]
+        weights = []
+        for roi in rois:
+            shape, vectors, origin = roi.getAffineSliceParams(self.imageData, imageItem, axes=(1, 2))
+            weights.append(FN.affineSliceWeights(frameShape, shape=shape, origin=origin, vectors=vectors))
+        tr = FN.weightedTraces(self.imageData, scipy.sparse.vstack(weights).tocsr())
+        if self.dataState['Normalized'] is False:
+            tr /= tr.mean(axis=1)[:, np.newaxis]  # (self.background[0:tr.shape[0]]*trm/self.backgroundmean)
+        return tr
+
     def scannerTimes(self, roi):
         """
         compute mean time over the roi from the scanned time information estimates
@@ -1708,9 +1724,10 @@ class pbm_ImageAnalysis(AnalysisModule):
         self.BFData = []
 
         currentROI = self.lastROITouched
-        for ourWidget in self.AllRois:
-            tr = self.updateThisROI(ourWidget, livePlot=False)
-            self.FData = self.insertFData(self.FData, tr, ourWidget)
+        if len(self.AllRois) > 0:
+            traces = self.roiTraces(self.AllRois)
+            for ourWidget, tr in zip(self.AllRois, traces):
+                self.FData = self.insertFData(self.FData, tr, ourWidget)
         self.applyROIFilters(self.AllRois)
         self.updateThisROI(currentROI) # just update the latest plot with the new format.
 
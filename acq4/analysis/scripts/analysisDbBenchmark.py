@@ -0,0 +1,107 @@
+"""
+Measure the time needed to store Photostim-style event records in an
+AnalysisDatabase. Each record refers to its source file and to its Protocol and
+ProtocolSequence directories, so every insert must resolve directory handles to
+row IDs and file handles to names:
+
+    listOfDicts -- records given as a list of dicts and inserted with
+                   iterInsert(chunkSize=30), as Photostim.storeDBSpots does
+    insertMany  -- records given as a dict of columns (arrays and lists of
+                   handles) and inserted with a single insertMany call
+
+Run with: python -m acq4.analysis.scripts.analysisDbBenchmark [nRecords]
+"""
+import sys, time, os, shutil, tempfile
+import numpy as np
+from acq4.util import DataManager
+from acq4.util.database import AnalysisDatabase
+import acq4.analysis.dataModels.PatchEPhys as PatchEPhys
+
+
+eventColumns = [('index', 'int'), ('len', 'int'), ('sum', 'real'), ('peak', 'real'), ('peakIndex', 'int'),
+                ('time', 'real'), ('fitAmplitude', 'real'), ('fitTime', 'real'), ('fitRiseTau', 'real'),
+                ('fitDecayTau', 'real'), ('fitFractionalError', 'real'), ('fitResidualStdev', 'real'),
+                ('SourceFile', 'file'), ('ProtocolDir', 'directory:Protocol'),
+                ('ProtocolSequenceDir', 'directory:ProtocolSequence')]
+
+
+def makeDirs(baseDir, nSequences=50, nProtocols=40):
+    """Create ProtocolSequence directories, each containing Protocol directories.
+    Returns a list of (protocolDir, sequenceDir)."""
+    dirs = []
+    for i in range(nSequences):
+        seq = baseDir.mkdir('map_%03d' % i, info={'dirType': 'ProtocolSequence'})
+        for j in range(nProtocols):
+            dirs.append((seq.mkdir('%03d' % j, info={'dirType': 'Protocol'}), seq))
+    return dirs
+
+
+def makeEvents(nRecords, dirs, seed=0):
+    """Return event records as a dict of columns."""
+    rng = np.random.RandomState(seed)
+    data = {}
+    for name, typ in eventColumns:
+        if typ == 'int':
+            data[name] = rng.randint(0, 10000, size=nRecords)
+        elif typ == 'real':
+            data[name] = rng.normal(size=nRecords)
+    protos = [dirs[i] for i in np.arange(nRecords) * len(dirs) // nRecords]
+    data['ProtocolDir'] = [p for p, s in protos]
+    data['ProtocolSequenceDir'] = [s for p, s in protos]
+    data['SourceFile'] = [p for p, s in protos]
+    return data
+
+
+def openDb(path, baseDir):
+    db = AnalysisDatabase(path, dataModel=PatchEPhys, baseDir=baseDir)
+    ## directory tables are normally created from Manager.suggestedDirFields
+    db.createTable('DirTable_ProtocolSequence', [('Dir', 'file')], dirType='ProtocolSequence')
+    db.createTable('DirTable_Protocol', [('ProtocolSequenceDir', 'directory:ProtocolSequence'), ('Dir', 'file')], dirType='Protocol')
+    db.checkTable('Photostim_events', owner='Photostim.events', columns=eventColumns, create=True, indexes=[['ProtocolDir']])
+    return db
+
+
+def run(nRecords=100000):
+    if DataManager.DataManager.INSTANCE is None:
+        DataManager.DataManager()
+    tmp = tempfile.mkdtemp()
+    try:
+        baseDir = DataManager.getDirHandle(os.path.join(tmp, 'data'), create=True)
+        dirs = makeDirs(baseDir)
+        events = makeEvents(nRecords, dirs)
+        records = [dict([(k, events[k][i]) for k in events]) for i in xrange(nRecords)]
+        for rec in records:
+            for k, v in rec.items():
+                if isinstance(v, np.generic):
+                    rec[k] = v.item()
+
+        def listOfDicts(db):
+            for n, nmax in db.iterInsert('Photostim_events', records, chunkSize=30):
+                pass
+
+        def insertMany(db):
+            db.insertMany('Photostim_events', events)
+
+        results = []
+        print "%d event records, %d protocol directories" % (nRecords, len(dirs))
+        print "%-12s %10s %12s" % ('method', 's', 'records/s')
+        for name, fn in [('listOfDicts', listOfDicts), ('insertMany', insertMany)]:
+            db = openDb(os.path.join(tmp, name + '.sqlite'), baseDir)
+            start = time.time()
+            with db.transaction():
+                fn(db)
+            dt = time.time() - start
+            assert db.tableLength('Photostim_events') == nRecords
+            rec = db.select('Photostim_events', limit=1, offset=nRecords-1)[0]
+            assert rec['ProtocolDir'].name() == dirs[-1][0].name() and rec['ProtocolSequenceDir'].name() == dirs[-1][1].name()
+            db.close()
+            print "%-12s %10.2f %12.0f" % (name, dt, nRecords / dt)
+            results.append((name, dt))
+        return results
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    run(n)
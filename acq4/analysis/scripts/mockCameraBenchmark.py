@@ -0,0 +1,89 @@
+"""
+Measure how many frames per second MockCamera can synthesize, so that camera
+acquisition and display can be benchmarked without hardware. newFrames() is
+polled in a loop (as AcquireThread does) for a few seconds with:
+
+    bin1    -- 512x512 frames, stage stationary
+    bin2    -- 256x256 frames (2x2 binning), stage stationary
+    moving  -- 512x512 frames, stage moved before every poll, so the
+               background and cell positions are recomputed for each frame
+
+The camera is configured with readoutTime=0 and a 1 ms exposure, so it
+produces up to 500 frames per second unless frame synthesis is slower than
+that. "render ms" is the time spent in newFrames() per frame.
+
+The Manager needs a QApplication. Without a display, the benchmark uses Qt5's
+offscreen platform; with PyQt4 or PySide, run it under xvfb-run instead.
+
+Run with: python -m acq4.analysis.scripts.mockCameraBenchmark [seconds]
+"""
+import os, sys, time, tempfile, shutil
+
+devices = {
+    'Stage': {
+        'driver': 'MockStage',
+        'transform': {'pos': (0, 0, 0), 'scale': (1, 1, 1), 'angle': 0},
+    },
+    'Camera': {
+        'driver': 'MockCamera',
+        'parentDevice': 'Stage',
+        'transform': {'position': (0, 0), 'scale': (2.581e-6, -2.581e-6), 'angle': 0},
+        'readoutTime': 0.0,
+        'defaults': {'exposure': 1e-3},
+    },
+}
+
+
+def pollFrames(cam, stage, duration, move=False):
+    cam.startCamera()
+    nFrames = 0
+    busy = 0
+    start = time.time()
+    while time.time() - start < duration:
+        if move:
+            stage.setPosition([(nFrames % 100) * 1e-6, 0, 0])
+        t = time.time()
+        frames = cam.newFrames()
+        busy += time.time() - t
+        nFrames += len(frames)
+    cam.stopCamera()
+    return nFrames / (time.time() - start), busy / max(nFrames, 1)
+
+
+def run(duration=3.0):
+    import acq4.pyqtgraph as pg
+    from acq4.util import configfile
+    from acq4.Manager import Manager
+    from acq4.pyqtgraph.Qt import QT_LIB, PYQT5
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY'):
+        ## Qt4 would abort the whole process when creating the QApplication
+        if QT_LIB != PYQT5:
+            raise Exception("No display available; run this benchmark under xvfb-run (or use PyQt5).")
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    pg.mkQApp()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        cfgFile = os.path.join(tmp, 'default.cfg')
+        configfile.writeConfigFile({'devices': devices}, cfgFile)
+        man = Manager(configFile=cfgFile, argv=['--headless'])
+        cam = man.getDevice('Camera')
+        stage = man.getDevice('Stage')
+        results = {}
+        print "%-10s %10s %10s %10s" % ('test', 'frame', 'fps', 'render ms')
+        for name, binning, move in [('bin1', 1, False), ('bin2', 2, False), ('moving', 1, True)]:
+            cam.setParams({'binningX': binning, 'binningY': binning}, autoRestart=False)
+            fps, render = pollFrames(cam, stage, duration, move)
+            results[name] = (fps, render)
+            size = "%dx%d" % (512 // binning, 512 // binning)
+            print "%-10s %10s %10.0f %10.2f" % (name, size, fps, render * 1000)
+        man.quit()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    run(duration)
+    os._exit(0)  ## skip Qt teardown at exit
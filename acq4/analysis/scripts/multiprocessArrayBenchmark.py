@@ -0,0 +1,69 @@
+"""
+Measure the time needed to move large arrays between processes with
+pyqtgraph.multiprocess:
+
+    roundTrip  -- send an array to a ForkedProcess as a call argument and get
+                  it back as the return value (rnp.asarray(data, _returnType='value'))
+    gather     -- Parallelize workers each append an equal share of the data
+                  to a results list in the parent process
+
+Each is run with arrays sent through the pipe (sharedArrayThreshold=None: byte
+messages for arguments, pickled return values) and through shared memory.
+
+Run with: python -m acq4.analysis.scripts.multiprocessArrayBenchmark [MB]
+"""
+import sys, time
+import numpy as np
+import acq4.pyqtgraph.multiprocess as mp
+from acq4.pyqtgraph.multiprocess.remoteproxy import RemoteEventHandler
+
+
+def roundTrip(data):
+    proc = mp.ForkedProcess()
+    try:
+        rnp = proc._import('numpy')
+        start = time.time()
+        res = rnp.asarray(data, _returnType='value', _timeout=60)
+        dt = time.time() - start
+        del rnp
+    finally:
+        proc.join()
+    assert res.shape == data.shape and res[-1] == data[-1]
+    return dt
+
+
+def gather(data, workers=4):
+    chunks = np.array_split(data, workers)
+    results = []
+    start = time.time()
+    with mp.Parallelize(range(workers), workers=workers, results=results) as tasker:
+        for i in tasker:
+            tasker.results.append((i, chunks[i] + 0))
+    dt = time.time() - start
+    assert sum([len(r) for i, r in results]) == len(data)
+    return dt
+
+
+def run(mb=100, repeats=3):
+    data = np.random.normal(size=mb * 2**20 // 8)
+    default = RemoteEventHandler.sharedArrayThreshold
+    times = {}
+    try:
+        for mode, threshold in [('pipe', None), ('shared', 2**20)]:
+            RemoteEventHandler.sharedArrayThreshold = threshold
+            for name, fn in [('roundTrip', roundTrip), ('gather', gather)]:
+                times[(name, mode)] = min([fn(data) for i in range(repeats)])
+    finally:
+        RemoteEventHandler.sharedArrayThreshold = default
+
+    print "%d MB float64 array" % mb
+    print "%-10s %10s %10s %8s" % ('test', 'pipe ms', 'shared ms', 'speedup')
+    for name in ['roundTrip', 'gather']:
+        tp, ts = times[(name, 'pipe')], times[(name, 'shared')]
+        print "%-10s %10.1f %10.1f %7.1fx" % (name, tp * 1000, ts * 1000, tp / ts)
+    return times
+
+
+if __name__ == '__main__':
+    mb = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    run(mb)
@@ -0,0 +1,68 @@
+"""
+Compare task dispatch in pyqtgraph.multiprocess.Parallelize with tasks of very
+uneven duration, as in map analysis or PSP fitting where a few sweeps take much
+longer than the rest:
+
+    static   -- tasks divided between workers before starting (task i goes to
+                worker i % workers)
+    dynamic  -- each worker starts with a contiguous block of tasks and takes
+                half of the remaining tasks from the busiest worker when it
+                runs out
+
+Two sets of task durations are used, each averaging 10 ms per task:
+
+    random    -- lognormal durations (sigma=1.5) in random order
+    periodic  -- every 4th task is 10x slower than the others, as when one
+                 parameter value of a cycling protocol sequence is slow to
+                 analyze; with static dispatch these all go to one worker
+
+Each task sleeps for its duration, so the results do not depend on the number
+of CPU cores. Utilization is the total task time divided by
+(workers * wall time).
+
+Run with: python -m acq4.analysis.scripts.parallelizeBenchmark [nTasks]
+"""
+import sys, time
+import numpy as np
+import acq4.pyqtgraph.multiprocess as mp
+
+
+def makeDurations(nTasks, pattern, mean=0.01, seed=0):
+    if pattern == 'random':
+        rng = np.random.RandomState(seed)
+        dur = rng.lognormal(sigma=1.5, size=nTasks)
+    else:
+        dur = np.ones(nTasks)
+        dur[::4] = 10
+    return dur * (mean / dur.mean())
+
+
+def runTasks(durations, workers, dispatch):
+    par = mp.Parallelize(enumerate(durations), workers=workers, dispatch=dispatch)
+    start = time.time()
+    with par as tasker:
+        for i, dur in tasker:
+            time.sleep(dur)
+            tasker.setResult(i)
+    dt = time.time() - start
+    assert par.results() == range(len(durations))
+    return dt
+
+
+def run(nTasks=400, workers=4):
+    print "%d tasks, %d workers" % (nTasks, workers)
+    print "%-10s %-10s %10s %10s %12s" % ('durations', 'dispatch', 'ideal s', 'wall s', 'utilization')
+    times = {}
+    for pattern in ['random', 'periodic']:
+        durations = makeDurations(nTasks, pattern)
+        total = durations.sum()
+        for dispatch in ['static', 'dynamic']:
+            dt = runTasks(durations, workers, dispatch)
+            times[(pattern, dispatch)] = dt
+            print "%-10s %-10s %10.2f %10.2f %11.0f%%" % (pattern, dispatch, total / workers, dt, 100 * total / (workers * dt))
+    return times
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    run(n)
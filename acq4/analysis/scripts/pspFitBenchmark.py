@@ -0,0 +1,79 @@
+"""
+Compare accuracy and throughput of PSP fitting methods on synthetic events:
+
+    leastsq   -- the previous fitPsp implementation (scipy.optimize.leastsq with
+                 parameters clamped inside the error function), kept here as a reference
+    fitPsp    -- one bounded Levenberg-Marquardt fit per event with the analytic Jacobian
+    batch     -- all events fit together with fitPspBatch
+    batchGrid -- fitPspBatch with grid-search initialization (multiFit=True)
+
+Run with: python -m acq4.analysis.scripts.pspFitBenchmark [nEvents]
+"""
+import sys, time
+import numpy as np
+import scipy.optimize
+import acq4.util.functions as fn
+
+
+def fitPspLeastsq(x, y, guess, bounds, risePower=2.0):
+    """Reference implementation; this is how fitPsp worked before fitPspBatch was added."""
+    def errFn(v, x, y):
+        for i in range(len(v)):
+            if bounds[i][0] is not None:
+                v[i] = max(v[i], bounds[i][0])
+            if bounds[i][1] is not None:
+                v[i] = min(v[i], bounds[i][1])
+        return y - v[0] * fn.pspInnerFunc(x-v[1], abs(v[2]), abs(v[3]), risePower)
+
+    fit = scipy.optimize.leastsq(errFn, guess, args=(x, y), ftol=1e-2, factor=0.1)[0]
+    fit[2:] = abs(fit[2:])
+    maxX = fn.pspMaxTime(fit[2], fit[3], risePower)
+    fit[0] *= (1.0 - np.exp(-maxX / fit[2]))**risePower * np.exp(-maxX / fit[3])
+    return fit
+
+
+def makeEvents(nEvents, nSamples=200, dt=1e-4, noise=3e-12, seed=0):
+    """Return x values, noisy event traces, and the true [amp, xoffset, rise, fall] of each event."""
+    rng = np.random.RandomState(seed)
+    x = np.arange(nSamples) * dt
+    true = np.empty((nEvents, 4))
+    true[:, 0] = rng.uniform(20e-12, 200e-12, nEvents)
+    true[:, 1] = rng.uniform(1e-3, 3e-3, nEvents)
+    true[:, 2] = rng.uniform(0.2e-3, 1e-3, nEvents)
+    true[:, 3] = rng.uniform(2e-3, 8e-3, nEvents)
+    y = np.empty((nEvents, nSamples))
+    for i in range(nEvents):
+        y[i] = fn.pspFunc(list(true[i]), x)
+    y += rng.normal(scale=noise, size=y.shape)
+    return x, y, true
+
+
+def run(nEvents=1000):
+    x, y, true = makeEvents(nEvents)
+    guess = [200e-12, 1.5e-3, 0.5e-3, 5e-3]
+    bounds = [(0, 1e-9), (0, 4e-3), (50e-6, 5e-3), (200e-6, 20e-3)]
+
+    methods = [
+        ('leastsq', lambda: np.array([fitPspLeastsq(x, y[i], list(guess), bounds) for i in range(nEvents)])),
+        ('fitPsp', lambda: np.array([fn.fitPsp(x, y[i], list(guess), bounds) for i in range(nEvents)])),
+        ('batch', lambda: fn.fitPspBatch(x, y, guess, bounds)),
+        ('batchGrid', lambda: fn.fitPspBatch(x, y, guess, bounds, multiFit=True)),
+    ]
+
+    print "%d events, %d samples each" % y.shape
+    print "%-10s %12s %10s   %s" % ('method', 'ms/event', 'events/s', 'median fractional error [amp, xoff, rise, fall]')
+    results = {}
+    for name, fitFn in methods:
+        start = time.time()
+        fits = fitFn()
+        elapsed = time.time() - start
+        err = np.median(np.abs(fits - true) / true, axis=0)
+        results[name] = (elapsed, err)
+        print "%-10s %12.3f %10.0f   %s" % (name, elapsed * 1000. / nEvents, nEvents / elapsed,
+                                           ', '.join(['%0.4f' % e for e in err]))
+    return results
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    run(n)
@@ -0,0 +1,69 @@
+"""
+Compare the speed and accuracy of image registration methods in acq4.util.functions
+on a stack of noisy, randomly shifted frames:
+
+    dispMap    -- exhaustive search with makeDispMap(method='diff'); the frame offset
+                  is the median of the displacement map (whole pixels only)
+    phaseMap   -- makeDispMap(method='phase'), tiled phase correlation
+    pyramid    -- pyramidRegister on each frame in turn
+    pairPool   -- registerImagePairs, frames registered in a process pool
+    stack      -- registerStack, all frames against one reference spectrum
+
+Run with: python -m acq4.analysis.scripts.registrationBenchmark [nFrames]
+"""
+import sys, time
+import numpy as np
+import scipy.ndimage
+import acq4.util.functions as fn
+
+
+def makeStack(nFrames, size=256, maxShift=8., seed=0):
+    rng = np.random.RandomState(seed)
+    base = scipy.ndimage.gaussian_filter(rng.normal(size=(size*2, size*2)), 3)
+    noise = 0.1 * base.std()
+    sl = (slice(size/2, size/2+size),) * 2
+    reference = base[sl] + rng.normal(scale=noise, size=(size, size))
+    shifts = rng.uniform(-maxShift, maxShift, size=(nFrames, 2))
+    frames = np.empty((nFrames, size, size))
+    for i, s in enumerate(shifts):
+        ## frame[x] = reference[x + shift]
+        frames[i] = scipy.ndimage.shift(base, -s, order=3)[sl] + rng.normal(scale=noise, size=(size, size))
+    return reference, frames, shifts
+
+
+def run(nFrames=20, size=256, maxShift=8):
+    reference, frames, shifts = makeStack(nFrames, size, maxShift)
+    inner = (slice(2*maxShift, -2*maxShift),) * 2
+    results = []
+
+    def dispMapOffsets(method):
+        out = []
+        for frame in frames:
+            disp, err = fn.makeDispMap(reference, frame, maxDist=maxShift+1, method=method)
+            ## makeDispMap reports displacement d with reference[x-d] ~= frame[x]
+            out.append(-np.median(disp[inner].reshape(-1, 2), axis=0))
+        return np.array(out)
+
+    methods = [
+        ('dispMap', lambda: dispMapOffsets('diff')),
+        ('phaseMap', lambda: dispMapOffsets('phase')),
+        ('pyramid', lambda: np.array([fn.pyramidRegister(reference, f, maxDist=maxShift+1)[0] for f in frames])),
+        ('pairPool', lambda: np.array([r[0] for r in fn.registerImagePairs([(reference, f) for f in frames], maxDist=maxShift+1)])),
+        ('stack', lambda: fn.registerStack(frames, reference, maxDist=maxShift+1)[0]),
+    ]
+
+    print "%d frames, %dx%d, shifts up to %d px" % (nFrames, size, size, maxShift)
+    print "%-10s %12s %12s %12s" % ('method', 'ms/frame', 'mean err', 'max err')
+    for name, fnc in methods:
+        start = time.time()
+        offsets = fnc()
+        dt = time.time() - start
+        err = np.sqrt(((offsets - shifts)**2).sum(axis=1))
+        print "%-10s %12.2f %12.3f %12.3f" % (name, dt * 1000. / nFrames, err.mean(), err.max())
+        results.append((name, dt, err))
+    return results
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    run(n)
@@ -0,0 +1,62 @@
+"""
+Compare the time needed to extract mean traces for many rectangular ROIs from
+an image stack (frames, x, y):
+
+    perROI  -- pg.affineSlice over the whole stack, then mean, once per ROI, as
+               pbm_ImageAnalysis.calculateAllROIs did via ROI.getArrayRegion
+    sparse  -- all ROIs rasterized into one sparse weight matrix with
+               affineSliceWeights, traces computed by weightedTraces in chunks
+               of frames, as pbm_ImageAnalysis.roiTraces does
+
+Run with: python -m acq4.analysis.scripts.roiTraceBenchmark [nROIs]
+"""
+import sys, time
+import numpy as np
+import scipy.sparse
+import acq4.pyqtgraph as pg
+import acq4.util.functions as fn
+
+
+def makeROIs(nROIs, frameShape, size=8., seed=0):
+    """Return a list of (shape, origin, vectors) for rotated square ROIs inside the frame."""
+    rng = np.random.RandomState(seed)
+    rois = []
+    for i in range(nROIs):
+        angle = rng.uniform(0, np.pi / 2.)
+        vectors = ((np.cos(angle), np.sin(angle)), (-np.sin(angle), np.cos(angle)))
+        origin = (rng.uniform(size * 1.5, frameShape[0] - size * 1.5), rng.uniform(size * 1.5, frameShape[1] - size * 1.5))
+        rois.append(((size, size), origin, vectors))
+    return rois
+
+
+def run(nROIs=200, nFrames=1000, frameShape=(128, 128)):
+    rng = np.random.RandomState(1)
+    stack = rng.randint(0, 4096, size=(nFrames,) + frameShape).astype(np.uint16)
+    rois = makeROIs(nROIs, frameShape)
+
+    start = time.time()
+    ref = np.empty((nROIs, nFrames))
+    for i, (shape, origin, vectors) in enumerate(rois):
+        ref[i] = pg.affineSlice(stack, shape=shape, origin=origin, vectors=vectors, axes=(1, 2)).mean(axis=2).mean(axis=1)
+    tROI = time.time() - start
+
+    start = time.time()
+    weights = scipy.sparse.vstack([fn.affineSliceWeights(frameShape, shape=s, origin=o, vectors=v) for s, o, v in rois]).tocsr()
+    tWeights = time.time() - start
+    traces = fn.weightedTraces(stack, weights)
+    tSparse = time.time() - start
+
+    err = np.abs(traces - ref).max()
+    assert np.allclose(traces, ref)
+    print "%d ROIs, %d frames of %dx%d" % (nROIs, nFrames, frameShape[0], frameShape[1])
+    print "%-10s %10s" % ('method', 'ms')
+    print "%-10s %10.1f" % ('perROI', tROI * 1000)
+    print "%-10s %10.1f   (%0.1f ms building weights)" % ('sparse', tSparse * 1000, tWeights * 1000)
+    print "max difference: %g" % err
+    print "speedup: %0.0fx" % (tROI / tSparse)
+    return tROI, tSparse
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    run(n)
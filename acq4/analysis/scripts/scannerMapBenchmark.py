@@ -0,0 +1,63 @@
+"""
+Compare the time needed to map global positions to scan mirror voltages:
+
+    perPoint -- each point mapped separately through a QMatrix4x4 and the
+                calibration polynomial, as Scanner.mapToScanner did before it
+                accepted arrays
+    batch    -- all points mapped at once with mapPoints and applyCalibration,
+                as Scanner.mapArrayToScanner does
+
+Run with: python -m acq4.analysis.scripts.scannerMapBenchmark [nPoints]
+"""
+import sys, time
+import numpy as np
+import acq4.pyqtgraph as pg
+from acq4.pyqtgraph.Qt import QtCore
+from acq4.devices.OptomechDevice import mapPoints
+from acq4.devices.Scanner.Scanner import applyCalibration
+
+
+def mapPerPoint(tr, params, pos):
+    """Reference implementation; maps one point at a time."""
+    out = np.empty(pos.shape)
+    for i in range(len(pos)):
+        p = tr.map(QtCore.QPointF(pos[i, 0], pos[i, 1]))
+        x, y = p.x(), p.y()
+        x2 = x**2
+        y2 = y**2
+        out[i, 0] = params[0][0] + params[0][1] * x + params[0][2] * y + params[0][3] * x2 + params[0][4] * y2
+        out[i, 1] = params[1][0] + params[1][1] * x + params[1][2] * y + params[1][3] * x2 + params[1][4] * y2
+    return out
+
+
+def run(nPoints=10000):
+    ## a stage-like transform and a plausible mirror calibration
+    tr = pg.SRTTransform3D()
+    tr.translate(1.2e-3, -0.4e-3, 30e-6)
+    tr.rotate(12, (0, 0, 1))
+    tr.scale(1.05, 0.98, 1)
+    params = np.array([[0.01, 2.1e4, 3e2, 1e5, -2e4], [-0.02, -2e2, 2.05e4, 3e4, 1e5]])
+    rng = np.random.RandomState(0)
+    pos = rng.uniform(-200e-6, 200e-6, size=(nPoints, 2))
+
+    start = time.time()
+    ref = mapPerPoint(tr, params, pos)
+    tPoint = time.time() - start
+
+    start = time.time()
+    matrix = pg.transformToArray(tr)
+    out = applyCalibration(params, mapPoints(matrix, pos))
+    tBatch = time.time() - start
+
+    assert np.allclose(out, ref)
+    print "%d points" % nPoints
+    print "%-10s %10s" % ('method', 'ms')
+    print "%-10s %10.2f" % ('perPoint', tPoint * 1000)
+    print "%-10s %10.2f" % ('batch', tBatch * 1000)
+    print "speedup: %0.0fx" % (tPoint / tBatch)
+    return tPoint, tBatch
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    run(n)
@@ -0,0 +1,257 @@
+"""
+Measure the time spent running acquisition tasks through the Manager, with only
+simulated devices so that it can run on any machine without hardware:
+
+    DAQ      -- NiDAQ with the mock driver (acq4/drivers/nidaq/mock.py)
+    Clamp1   -- MockClamp (builtin HH simulator), one current step per task
+    Camera   -- MockCamera, recording frames and its exposure channel
+    Stage    -- MockStage, moved to a new position before each task
+
+A protocol sequence is run *runs* times the way TaskRunner runs one
+(createTask, execute(block=False), poll isDone(), getResult()) and the latency
+of each phase is reported:
+
+    move       -- stage move and Qt event processing before the task
+    create     -- Manager.createTask
+    reserve, configure, start
+               -- Task.execute (see Task.phaseTimes)
+    wait       -- time from the end of the requested task duration until
+                  isDone() returns True
+    stop, getResult
+               -- Task.getResult
+    store      -- creating a storage directory and writing results to it
+                  (only with --store)
+    overhead   -- total time per task minus the requested duration
+
+Results can be saved as JSON with --json and compared against the JSON from an
+earlier run (eg. from a different commit) with --compare.
+
+The Manager needs a QApplication. Without a display, the benchmark uses Qt5's
+offscreen platform; with PyQt4 or PySide, run it under xvfb-run instead.
+
+Run with: python -m acq4.analysis.scripts.taskThroughputBenchmark [-n runs] [--store] [--json file] [--compare file]
+"""
+import os, sys, time, json, tempfile, shutil, platform, subprocess, argparse
+from collections import OrderedDict
+import numpy as np
+
+phases = ['move', 'create', 'reserve', 'configure', 'start', 'wait', 'stop', 'getResult', 'store', 'overhead']
+
+devices = {
+    'DAQ': {
+        'driver': 'NiDAQ',
+        'mock': True,
+        'defaultAIMode': 'NRSE',
+    },
+    'Clamp1': {
+        'driver': 'MockClamp',
+        'simulator': 'builtin',
+        'Command': {'device': 'DAQ', 'channel': '/Dev1/ao0', 'type': 'ao'},
+        'ScaledSignal': {'device': 'DAQ', 'channel': '/Dev1/ai5', 'mode': 'NRSE', 'type': 'ai'},
+        'icHolding': 0.0,
+        'vcHolding': -65e-3,
+    },
+    'Stage': {
+        'driver': 'MockStage',
+        'transform': {'pos': (0, 0, 0), 'scale': (1, 1, 1), 'angle': 0},
+    },
+    'Camera': {
+        'driver': 'MockCamera',
+        'parentDevice': 'Stage',
+        'transform': {'position': (0, 0), 'scale': (2.581e-6, -2.581e-6), 'angle': 0},
+        'exposeChannel': {'device': 'DAQ', 'channel': '/Dev1/port0/line0', 'type': 'di'},
+        'triggerInChannel': {'device': 'DAQ', 'channel': '/Dev1/port0/line1', 'type': 'do'},
+        'defaults': {'exposure': 10e-3},
+    },
+}
+
+
+def makeSequence(points, duration, rate):
+    """Return one command per sequence point: current steps from -100 pA to
+    +300 pA, each with the stage at a different position."""
+    numPts = int(duration * rate)
+    seq = []
+    for i, amp in enumerate(np.linspace(-100e-12, 300e-12, points)):
+        command = np.zeros(numPts)
+        command[numPts // 5:numPts * 4 // 5] = amp
+        cmd = {
+            'protocol': {'duration': duration, 'timeout': duration + 10.0},
+            'DAQ': {'rate': rate, 'numPts': numPts},
+            'Clamp1': {'mode': 'ic', 'holding': 0.0, 'command': command, 'recordSecondary': False},
+            'Camera': {
+                'record': True,
+                'triggerProtocol': False,
+                'params': {'triggerMode': 'Normal'},
+                'channels': {'exposure': {'record': True}},
+            },
+        }
+        pos = [(i % 4) * 100e-6, (i // 4) * 100e-6, 0]
+        seq.append((pos, cmd))
+    return seq
+
+
+def runTask(man, stage, pos, cmd, storageDir=None, name=None):
+    """Run one task the way TaskRunner.TaskThread.runOnce does and return the
+    time spent in each phase. If *storageDir* is given, results are stored in
+    a new subdirectory *name*."""
+    from acq4.pyqtgraph.Qt import QtGui
+    times = OrderedDict()
+    t0 = time.time()
+    stage.setPosition(pos)
+    QtGui.QApplication.processEvents()
+    t1 = time.time()
+    times['move'] = t1 - t0
+
+    ## devices modify their commands, so each task gets fresh copies
+    cmd = dict([(dev, c.copy()) for dev, c in cmd.items()])
+    if storageDir is not None:
+        cmd['protocol']['storeData'] = True
+        cmd['protocol']['storageDir'] = storageDir.mkdir(name)
+    mkdir = time.time() - t1
+
+    t1 = time.time()
+    task = man.createTask(cmd)
+    times['create'] = time.time() - t1
+
+    try:
+        task.execute(block=False)
+        duration = cmd['protocol']['duration']
+        endTime = task.startTime + duration
+        while not task.isDone():
+            time.sleep(np.clip((endTime - time.time()) * 0.5, 1e-3, 20e-3))
+        doneTime = time.time()
+        result = task.getResult()
+    except:
+        task.stop(abort=True)
+        raise
+    end = time.time()
+
+    times.update(task.phaseTimes)
+    times['wait'] = max(0, doneTime - endTime)
+    if storageDir is not None:
+        times['store'] += mkdir
+    times['overhead'] = (end - t0) - duration
+    assert result['Clamp1'] is not None and result['Camera'] is not None
+    return times
+
+
+def summarize(tasks):
+    summary = OrderedDict()
+    for phase in phases:
+        vals = np.array([t[phase] for t in tasks if phase in t])
+        if len(vals) == 0:
+            continue
+        summary[phase] = OrderedDict([
+            ('mean', vals.mean()),
+            ('median', np.median(vals)),
+            ('p95', np.percentile(vals, 95)),
+            ('max', vals.max()),
+        ])
+    return summary
+
+
+def gitCommit():
+    try:
+        path = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path, stderr=open(os.devnull, 'w')).strip()
+    except Exception:
+        return None
+
+
+def run(runs=5, points=10, duration=0.2, rate=20e3, store=False):
+    """Run the protocol sequence *runs* times with mock devices and return a
+    dict of results suitable for saving as JSON. Only one Manager can be created,
+    so this can only be called once per process."""
+    import acq4.pyqtgraph as pg
+    from acq4.util import configfile
+    from acq4.Manager import Manager
+    from acq4.pyqtgraph.Qt import QT_LIB, PYQT5
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY'):
+        ## Qt4 would abort the whole process when creating the QApplication
+        if QT_LIB != PYQT5:
+            raise Exception("No display available; run this benchmark under xvfb-run (or use PyQt5).")
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    pg.mkQApp()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        cfgFile = os.path.join(tmp, 'default.cfg')
+        configfile.writeConfigFile({'devices': devices}, cfgFile)
+        start = time.time()
+        man = Manager(configFile=cfgFile, argv=['--headless'])
+        startupTime = time.time() - start
+        for name in devices:
+            man.getDevice(name)  ## raise if any device failed to load
+        stage = man.getDevice('Stage')
+
+        seqDir = None
+        if store:
+            dataDir = os.path.join(tmp, 'data')
+            os.mkdir(dataDir)
+            seqDir = man.dirHandle(dataDir).mkdir('sequence')
+
+        seq = makeSequence(points, duration, rate)
+        runTask(man, stage, *seq[0])  ## warm up: start the simulator process, fill caches
+        tasks = []
+        start = time.time()
+        for i in range(runs):
+            for j, (pos, cmd) in enumerate(seq):
+                tasks.append(runTask(man, stage, pos, cmd, storageDir=seqDir, name='%03d_%03d' % (i, j)))
+        totalTime = time.time() - start
+        man.quit()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return OrderedDict([
+        ('commit', gitCommit()),
+        ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('platform', platform.platform()),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('options', OrderedDict([('runs', runs), ('points', points), ('duration', duration), ('rate', rate), ('store', store)])),
+        ('startupTime', startupTime),
+        ('totalTime', totalTime),
+        ('tasksPerSecond', len(tasks) / totalTime),
+        ('summary', summarize(tasks)),
+        ('tasks', tasks),
+    ])
+
+
+def report(results, previous=None):
+    opts = results['options']
+    print "%d runs x %d tasks, %g s each%s" % (opts['runs'], opts['points'], opts['duration'], ', storing data' if opts['store'] else '')
+    print "startup: %0.2f s   throughput: %0.2f tasks/s" % (results['startupTime'], results['tasksPerSecond'])
+    if previous is None:
+        print "%-10s %10s %10s %10s %10s" % ('phase', 'mean ms', 'median ms', 'p95 ms', 'max ms')
+        for phase, s in results['summary'].items():
+            print "%-10s %10.2f %10.2f %10.2f %10.2f" % (phase, s['mean'] * 1000, s['median'] * 1000, s['p95'] * 1000, s['max'] * 1000)
+    else:
+        print "compared with %s (%s)" % (previous['commit'], previous['date'])
+        print "%-10s %10s %10s %8s" % ('phase', 'old ms', 'new ms', 'change')
+        for phase, s in results['summary'].items():
+            if phase not in previous['summary']:
+                continue
+            old = previous['summary'][phase]['median']
+            change = "%+7.0f%%" % (100 * (s['median'] - old) / old) if old > 0 else ''
+            print "%-10s %10.2f %10.2f %8s" % (phase, old * 1000, s['median'] * 1000, change)
+        print "throughput: %0.2f -> %0.2f tasks/s" % (previous['tasksPerSecond'], results['tasksPerSecond'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure per-phase task latency with mock devices.")
+    parser.add_argument('-n', '--runs', type=int, default=5, help="number of times to run the sequence")
+    parser.add_argument('-p', '--points', type=int, default=10, help="number of tasks in the sequence")
+    parser.add_argument('-d', '--duration', type=float, default=0.2, help="duration of each task (s)")
+    parser.add_argument('--store', action='store_true', help="write results to a temporary storage directory")
+    parser.add_argument('--json', help="save results to this file")
+    parser.add_argument('--compare', help="compare with results saved by an earlier run")
+    args = parser.parse_args()
+
+    results = run(runs=args.runs, points=args.points, duration=args.duration, store=args.store)
+    previous = None
+    if args.compare is not None:
+        previous = json.load(open(args.compare))
+    report(results, previous)
+    if args.json is not None:
+        json.dump(results, open(args.json, 'w'), indent=2)
+    os._exit(0)  ## skip Qt teardown at exit
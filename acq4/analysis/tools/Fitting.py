@@ -5,6 +5,7 @@ Python class wrapper for data fitting.
 Includes the following external methods:
 getFunctions returns the list of function names (dictionary keys)
 FitRegion performs the fitting
+FitBatch fits one function to many traces at once (vectorized)
 Note that FitRegion will plot on top of the current data using MPlots routines
 if the current curve and the current plot instance are passed.
 
@@ -39,6 +40,7 @@ if the current curve and the current plot instance are passed.
 """
 
 import sys
+import time
 import numpy
 import scipy
 import scipy.optimize
@@ -115,6 +117,9 @@ class Fitting():
                     ['DC', 'a1', 'v1', 'k1', 'a2', 'v2', 'k2'],  None, self.taucurveder),
         }
         self.fitSum2Err = 0
+        self.fitSum2Errs = None
+        self.fitTiming = None
+        self._lastBatch = None
 
     def getFunctions(self):
         return(self.fitfuncmap.keys())
@@ -539,6 +544,235 @@ p[4]*numpy.exp(-(p[5] + x)/p[6]))**2.0
 #        print len(xp)
         return(xp, xf, yf, yn) # includes names with yn and range of tx
 
+    def FitBatch(self, tdat, ydat, whichdata=None, t0=None, t1=None, fitFunc='exp1',
+                 fitPars=None, fixedPars=None, bounds=None, warmStart=False,
+                 maxiter=None, tol=1e-10):
+        """
+        Fit the same function to many traces that share a time base, all at once.
+        
+        Rather than calling the optimizer once per trace (as FitRegion does), the
+        residuals of all traces are stacked and refined together with a batched
+        Levenberg-Marquardt solver. Because the traces are independent, the
+        Jacobian is block-diagonal and each iteration only needs to solve a stack
+        of small (nPars x nPars) systems. Exponential functions ('exp0', 'exp1',
+        'exptau') are seeded with a closed-form linearized estimate, so no initial
+        parameters are needed for them.
+        
+        **Arguments**
+        ============= ===================================================
+        tdat          1D time base shared by all traces
+        ydat          2D array of traces (trace, time), or a single 1D trace
+        whichdata     (optional) indexes of the traces in ydat to fit. Default is all.
+        t0, t1        (optional) fit window, as in FitRegion
+        fitFunc       (optional) The function to fit the data to (as defined in __init__). Default is 'exp1'.
+        fitPars       (optional) Initial parameters; either one set for all traces or an
+                      array of shape (len(whichdata), nPars).
+        fixedPars     (optional) Fixed parameters to pass to the function. Default=None
+        bounds        (optional) list of (min, max) per parameter; None for no limit
+        warmStart     (optional) if True and the previous call fit the same function to
+                      the same traces, start from the previous result. This makes
+                      refitting while a region is being dragged very cheap.
+        maxiter       (optional) maximum number of iterations. Default is from fitfuncmap.
+        tol           (optional) relative reduction in error below which a fit is converged
+        ============= ===================================================
+        
+        Returns (xp, xf, yf, yn) in the same form as FitRegion. The squared error of
+        each fit is stored in self.fitSum2Errs, and timing information for the
+        batch in self.fitTiming.
+        """
+        tStart = time.time()
+        func = self.fitfuncmap[fitFunc]
+        tdat = numpy.asarray(tdat)
+        ydat = numpy.asarray(ydat)
+        if ydat.ndim == 1:
+            ydat = ydat[numpy.newaxis, :]
+        if whichdata is None:
+            whichdata = range(ydat.shape[0])
+        whichdata = list(whichdata)
+        if t1 is None:
+            t1 = numpy.max(tdat)
+        if t0 is None:
+            t0 = numpy.min(tdat)
+        names = func[6]
+        if len(whichdata) == 0:
+            return [], [], [], []
+        if fitFunc == 'exppulse':
+            # expPulse uses masked assignment and cannot be evaluated for many
+            # parameter sets at once; fit one trace at a time instead.
+            return self.FitRegion(whichdata, 0, tdat, ydat, t0=t0, t1=t1, fitFunc=fitFunc,
+                                  fitPars=fitPars, fixedPars=fixedPars, dataType='2d')
+        
+        # clip the window once for all traces
+        it0 = (numpy.abs(tdat-t0)).argmin()
+        it1 = (numpy.abs(tdat-t1)).argmin()
+        if it0 > it1:
+            it0, it1 = it1, it0
+        tx = tdat[it0:it1] - t0
+        dy = ydat[whichdata, it0:it1].astype(numpy.float64)
+        nfits = dy.shape[0]
+        
+        # initial parameters
+        key = (fitFunc, tuple(whichdata))
+        warm = warmStart and self._lastBatch is not None and self._lastBatch[0] == key
+        if warm:
+            p = self._lastBatch[1].copy()
+        elif fitPars is not None:
+            p = numpy.empty((nfits, len(names)))
+            p[:] = fitPars
+        elif fitFunc in ['exp0', 'exp1', 'exptau']:
+            p = self._expInitialGuess(fitFunc, tx, dy)
+        else:
+            p = numpy.empty((nfits, len(names)))
+            p[:] = func[1]
+        if bounds is not None:
+            lb = numpy.array([-numpy.inf if b[0] is None else b[0] for b in bounds])
+            ub = numpy.array([numpy.inf if b[1] is None else b[1] for b in bounds])
+            p = numpy.clip(p, lb, ub)
+        else:
+            lb = ub = None
+        tInit = time.time()
+        
+        if maxiter is None:
+            maxiter = min(func[2], 500)
+        p, niter = self._batchLevMar(func[0], p, tx, dy, fixedPars, lb, ub, maxiter, tol)
+        tRefine = time.time()
+        
+        # evaluate all fits in one call by broadcasting parameters over the traces
+        xfit = numpy.arange(min(tx), max(tx), (max(tx)-min(tx))/100.0)
+        yfit = func[0](p.T[..., numpy.newaxis], xfit, C=fixedPars)
+        yy = func[0](p.T[..., numpy.newaxis], tx, C=fixedPars)
+        self.fitSum2Errs = numpy.sum((dy - yy)**2, axis=1)
+        self.fitSum2Err = self.fitSum2Errs[-1]
+        self._lastBatch = (key, p.copy())
+        
+        tEnd = time.time()
+        self.fitTiming = {
+            'nfits': nfits,
+            'init': tInit - tStart,
+            'refine': tRefine - tInit,
+            'total': tEnd - tStart,
+            'perFit': (tEnd - tStart) / nfits,
+            'iterations': niter,
+            'warmStart': warm,
+        }
+        return list(p), [xfit] * nfits, list(yfit), [names] * nfits
+
+    def _expInitialGuess(self, fitFunc, x, y):
+        """
+        Closed-form (linearized) initial parameters for exponential fits of
+        many traces at once.
+        For y = a0 + a1*exp(-x/tau), the running integral S of y satisfies
+        y = c0 + c1*x + c2*S with c2 = -1/tau, which is linear in c. Once tau is
+        known, a0 and a1 follow from a second linear regression.
+        """
+        n, m = y.shape
+        dx = numpy.diff(x)
+        S = numpy.zeros_like(y)
+        S[:, 1:] = numpy.cumsum(0.5 * (y[:, 1:] + y[:, :-1]) * dx, axis=1)
+        A = numpy.empty((n, m, 3))
+        A[:, :, 0] = 1.0
+        A[:, :, 1] = x
+        A[:, :, 2] = S
+        c = self._stackedLstsq(A, y)
+        with numpy.errstate(divide='ignore'):
+            tau = -1.0 / c[:, 2]
+        # fall back to a fraction of the window for traces with no clear decay
+        bad = ~numpy.isfinite(tau) | (tau <= 0)
+        tau[bad] = (x[-1] - x[0]) / 3.0
+        
+        A = numpy.empty((n, m, 2))
+        A[:, :, 0] = 1.0
+        A[:, :, 1] = numpy.exp(-x[numpy.newaxis, :] / tau[:, numpy.newaxis])
+        a = self._stackedLstsq(A, y)
+        if fitFunc == 'exp0':
+            return numpy.column_stack([a[:, 0] + a[:, 1], tau])
+        elif fitFunc == 'exptau':
+            return numpy.column_stack([a[:, 0] + a[:, 1], -a[:, 1], tau])
+        else:
+            return numpy.column_stack([a[:, 0], a[:, 1], tau])
+
+    def _stackedLstsq(self, A, y):
+        """
+        Solve many independent linear least-squares problems A[i] . c[i] = y[i]
+        using the normal equations.
+        """
+        AtA = numpy.einsum('nmi,nmj->nij', A, A)
+        Aty = numpy.einsum('nmi,nm->ni', A, y)
+        try:
+            return numpy.linalg.solve(AtA, Aty[..., numpy.newaxis])[..., 0]
+        except numpy.linalg.LinAlgError:
+            return numpy.einsum('nij,nj->ni', numpy.linalg.pinv(AtA), Aty)
+
+    def _batchLevMar(self, f, p, x, y, C, lb, ub, maxiter, tol):
+        """
+        Levenberg-Marquardt refinement of many independent fits at once.
+        p is (nfits, npars); f is one of the evaluation functions, called with
+        parameters of shape (npars, nfits, 1) so that it broadcasts to (nfits, len(x)).
+        Each fit keeps its own damping factor and stops independently.
+        Returns the fitted parameters and the number of iterations used by each fit.
+        """
+        p = p.astype(numpy.float64)
+        nfits, npars = p.shape
+        diag = (slice(None), numpy.arange(npars), numpy.arange(npars))
+        eps = numpy.sqrt(numpy.finfo(numpy.float64).eps)
+        
+        def model(pars):
+            return f(pars.T[..., numpy.newaxis], x, C=C)
+        
+        r = y - model(p)
+        cost = numpy.sum(r**2, axis=1)
+        lam = numpy.ones(nfits) * 1e-3
+        niter = numpy.zeros(nfits, dtype=int)
+        active = numpy.isfinite(cost)
+        for it in range(maxiter):
+            idx = numpy.argwhere(active)[:, 0]
+            if len(idx) == 0:
+                break
+            pa = p[idx]
+            ra = r[idx]
+            ya = y[idx]
+            fa = ya - ra
+            
+            # forward-difference Jacobian; one batched evaluation per parameter
+            J = numpy.empty(ra.shape + (npars,))
+            for k in range(npars):
+                h = eps * numpy.where(pa[:, k] == 0, 1.0, numpy.abs(pa[:, k]))
+                pk = pa.copy()
+                pk[:, k] += h
+                J[:, :, k] = (model(pk) - fa) / h[:, numpy.newaxis]
+            
+            JtJ = numpy.einsum('nmi,nmj->nij', J, J)
+            Jtr = numpy.einsum('nmi,nm->ni', J, ra)
+            A = JtJ.copy()
+            A[diag] += lam[idx, numpy.newaxis] * numpy.maximum(JtJ[diag], 1e-12)
+            try:
+                step = numpy.linalg.solve(A, Jtr[..., numpy.newaxis])[..., 0]
+            except numpy.linalg.LinAlgError:
+                step = numpy.einsum('nij,nj->ni', numpy.linalg.pinv(A), Jtr)
+            
+            pn = pa + step
+            if lb is not None:
+                pn = numpy.clip(pn, lb, ub)
+            with numpy.errstate(all='ignore'):
+                rn = ya - model(pn)
+                costn = numpy.sum(rn**2, axis=1)
+            better = numpy.isfinite(costn) & (costn < cost[idx])
+            
+            acc = idx[better]
+            converged = numpy.zeros(len(idx), dtype=bool)
+            converged[better] = (cost[acc] - costn[better]) <= tol * cost[acc]
+            p[acc] = pn[better]
+            r[acc] = rn[better]
+            cost[acc] = costn[better]
+            lam[acc] *= 0.1
+            lam[idx[~better]] *= 10.
+            niter[idx] += 1
+            
+            # stop fits that converged or can no longer make progress
+            done = converged | (lam[idx] > 1e10) | numpy.all(pn == pa, axis=1)
+            active[idx[done]] = False
+        return p, niter
+
     def FitPlot(self, xFit = None, yFit = None, fitFunc = 'exp1',
                 fitPars = None, fixedPars = None, fitPlot=None, plotInstance = None, 
                 color=None):
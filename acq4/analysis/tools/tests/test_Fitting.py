@@ -0,0 +1,45 @@
+import numpy as np
+from acq4.analysis.tools.Fitting import Fitting
+
+
+def makeTraces(n=8, seed=0):
+    ## charging curves with different amplitudes and time constants, plus noise
+    rng = np.random.RandomState(seed)
+    t = np.arange(0, 0.1, 1e-4)
+    amp = np.linspace(-20e-3, -5e-3, n)
+    tau = np.linspace(5e-3, 30e-3, n)
+    y = -65e-3 + amp[:, np.newaxis] * (1 - np.exp(-t[np.newaxis, :] / tau[:, np.newaxis]))
+    y += rng.normal(scale=0.2e-3, size=y.shape)
+    return t, y
+
+
+def perTrace(t, y, whichdata, t0, t1, pars):
+    fits = Fitting()
+    return np.array([fits.FitRegion([k], 0, t, y, t0=t0, t1=t1, fitFunc='exp1',
+                                    fitPars=pars, dataType='2d')[0][0] for k in whichdata])
+
+
+def test_fitBatch():
+    t, y = makeTraces()
+    whichdata = [1, 2, 4, 5, 7]
+    pars = [-0.06, 0.01, 0.01]
+    ref = perTrace(t, y, whichdata, 0.01, 0.09, pars)
+
+    fits = Fitting()
+    for init in [dict(fitPars=pars), dict()]:  ## given and closed-form initial parameters
+        xp, xf, yf, names = fits.FitBatch(t, y, whichdata=whichdata, t0=0.01, t1=0.09, fitFunc='exp1', **init)
+        assert len(xp) == len(xf) == len(yf) == len(names) == len(whichdata)
+        assert np.allclose(np.array(xp), ref, rtol=1e-3, atol=1e-6)
+        assert not fits.fitTiming['warmStart']
+
+    ## refit after moving the window by one sample: starts from the last result
+    ref = perTrace(t, y, whichdata, 0.0101, 0.09, pars)
+    xp = fits.FitBatch(t, y, whichdata=whichdata, t0=0.0101, t1=0.09, fitFunc='exp1', warmStart=True)[0]
+    assert fits.fitTiming['warmStart']
+    assert np.allclose(np.array(xp), ref, rtol=1e-3, atol=1e-6)
+
+    ## a different set of traces can not be warm-started
+    xp = fits.FitBatch(t, y, whichdata=whichdata[:3], t0=0.01, t1=0.09, fitFunc='exp1',
+                       fitPars=pars, warmStart=True)[0]
+    assert not fits.fitTiming['warmStart']
+    assert np.allclose(np.array(xp), perTrace(t, y, whichdata[:3], 0.01, 0.09, pars), rtol=1e-3, atol=1e-6)
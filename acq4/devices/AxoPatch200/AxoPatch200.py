@@ -70,9 +70,11 @@ class AP200DataMapping(DataMapping):
         return data * gain
         
         
-    def mapFromDaq(self, chan, data, mode=None):
+    def mapFromDaq(self, chan, data, mode=None, out=None):
         gain = self.getGain(chan, mode)
-        return data / gain
+        if out is None:
+            return data / gain
+        return np.divide(data, gain, out=out)
         
     
     
@@ -9,6 +9,7 @@ from acq4.devices.Microscope import Microscope
 from PyQt4 import QtCore
 import time
 from numpy import *
+import numpy as np
 from acq4.util.metaarray import *
 from taskGUI import *
 from deviceGUI import *
@@ -16,6 +17,7 @@ import acq4.util.ptime as ptime
 from acq4.util.Mutex import Mutex
 from acq4.util.debug import *
 from acq4.util import imaging
+import acq4.util.functions as fn
 from acq4.pyqtgraph import Vector, SRTTransform3D
 
 from CameraInterface import CameraInterface
@@ -431,7 +433,8 @@ class CameraTask(DAQGenericTask):
         self.stopAfter = False
         self.stoppedCam = False
         self.returnState = {}
-        self.frames = []
+        self.frameInfo = []  ## info of each recorded frame; the image data is kept in frameBuffer
+        self.frameBuffer = FrameBuffer()
         self.recording = False
         self.stopRecording = False
         self.resultObj = None
@@ -509,7 +512,8 @@ class CameraTask(DAQGenericTask):
         disconnect = False
         with self.lock:
             if self.recording:
-                self.frames.append(frame)
+                self.frameInfo.append(frame.info())
+                self.frameBuffer.append(frame.data())
             if self.stopRecording:
                 self.recording = False
                 disconnect = True
@@ -519,7 +523,8 @@ class CameraTask(DAQGenericTask):
         
     def start(self):
         ## arm recording
-        self.frames = []
+        self.frameInfo = []
+        self.frameBuffer = FrameBuffer(self.camCmd.get('minFrames', 16))
         self.stopRecording = False
         self.recording = True
             
@@ -538,7 +543,7 @@ class CameraTask(DAQGenericTask):
         ## should return false if recording is required to run for a specific time.
         if 'minFrames' in self.camCmd:
             with self.lock:
-                if len(self.frames) < self.camCmd['minFrames']:
+                if len(self.frameInfo) < self.camCmd['minFrames']:
                     return False
         return DAQGenericTask.isDone(self)  ## Should return True.
         
@@ -556,7 +561,15 @@ class CameraTask(DAQGenericTask):
     def getResult(self):
         if self.resultObj is None:
             daqResult = DAQGenericTask.getResult(self)
-            self.resultObj = CameraTaskResult(self, self.frames[:], daqResult)
+            with self.lock:
+                info = self.frameInfo[:]
+                arr = self.frameBuffer.array()
+                data = self.frameBuffer.frames() if arr is None else arr
+            ## frames share their data with the buffer; their info already includes the transforms
+            frames = [imaging.Frame(d, i) for d, i in zip(data, info)]
+            if arr is not None:
+                arr = arr[:len(frames)]
+            self.resultObj = CameraTaskResult(self, frames, daqResult, frameArray=arr)
         return self.resultObj
         
     def storeResult(self, dirHandle):
@@ -568,14 +581,65 @@ class CameraTask(DAQGenericTask):
             if data is not None:
                 dh.writeFile(data, k, info=info)
 
+class FrameBuffer(object):
+    """Collects image data from consecutive frames into a single contiguous array
+    as the frames arrive, so that the complete recording is available without 
+    concatenating all frames afterward.
+    
+    If the shape or dtype of the frames changes during recording, the frames are
+    kept as a list of separate arrays from then on, and array() returns None.
+    """
+    def __init__(self, capacity=16):
+        self.capacity = max(1, capacity)
+        self.buffer = None
+        self.count = 0
+        self.frameList = None  ## used instead of buffer once the frame shape changes
+        
+    def append(self, data):
+        if self.frameList is not None:
+            self.frameList.append(data)
+            return
+        if self.buffer is None:
+            self.buffer = np.empty((self.capacity,) + data.shape, dtype=data.dtype)
+        elif data.shape != self.buffer.shape[1:] or data.dtype != self.buffer.dtype:
+            self.frameList = list(self.buffer[:self.count]) + [data]
+            self.buffer = None
+            return
+        elif self.count == len(self.buffer):
+            ## grow geometrically; unused space at the end is never touched and 
+            ## costs no physical memory on most platforms.
+            newBuffer = np.empty((len(self.buffer) * 2,) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+            newBuffer[:self.count] = self.buffer[:self.count]
+            self.buffer = newBuffer
+        self.buffer[self.count] = data
+        self.count += 1
+        
+    def array(self):
+        """Return a view of all frames collected, or None if there are none 
+        (or the frames could not be combined)."""
+        if self.frameList is not None or self.buffer is None:
+            return None
+        return self.buffer[:self.count]
+    
+    def frames(self):
+        """Return a list containing the data of each frame collected."""
+        if self.frameList is not None:
+            return self.frameList[:]
+        if self.buffer is None:
+            return []
+        return list(self.buffer[:self.count])
+
+
 class CameraTaskResult:
-    def __init__(self, task, frames, daqResult):
+    def __init__(self, task, frames, daqResult, frameArray=None):
         self.lock = Mutex(recursive=True)
         self._task = task
         self._frames = frames
         self._daqResult = daqResult
         self._marr = None
         self._arr = None
+        if frameArray is not None and len(frameArray) == len(frames) and len(frames) > 0:
+            self._arr = frameArray  ## already contiguous; no need to concatenate frames
         self._frameTimes = None
         self._frameTimesPrecise = False
         
@@ -596,7 +660,7 @@ class CameraTaskResult:
             if self._arr is None:
                 #data = self._frames
                 if len(self._frames) > 0:
-                    self._arr = concatenate([f.data()[newaxis,...] for f in self._frames])
+                    self._arr = np.concatenate([f.data()[np.newaxis,...] for f in self._frames])
         return self._arr
     
     def asMetaArray(self):
@@ -609,7 +673,7 @@ class CameraTaskResult:
                     times = times[:arr.shape[0]]
                     info = [axis(name='Time', units='s', values=times), axis(name='x'), axis(name='y'), self.info()]
                     #print info
-                    self._marr = MetaArray(arr, info=info)
+                    self._marr = MetaArray(arr, info=info)  ## wraps arr without copying
             
         return self._marr
             
@@ -641,27 +705,15 @@ class CameraTaskResult:
             ## Correct times for each frame based on data recorded from exposure channel.
             if expose is not None: 
             
-                ## Extract times from trace
-                ex = expose.view(ndarray).astype(int32)
-                exd = ex[1:] - ex[:-1]
-                
+                ## Extract times from trace (in chunks; this avoids several full-length temporary arrays)
+                ex = expose.view(ndarray)
+                rising, falling = fn.findEdges(ex, threshold=0.5)
                 timeVals = expose.xvals('Time')
-                inds = argwhere(exd > 0.5)[:, 0] + 1
-                onTimes = timeVals[inds]
+                onTimes = timeVals[rising]
                 
                 ## If camera triggered DAQ, then it is likely we missed the first 0->1 transition
                 if self._task.camCmd.get('triggerProtocol', False) and ex[0] > 0.5:
-                    onTimes = array([timeVals[0]] + list(onTimes))
-                
-                #print "onTimes:", onTimes
-                inds = argwhere(exd < 0.5)[:, 0] + 1
-                offTimes = timeVals[inds]
-                
-                ## Determine average frame transfer time
-                txLen = (offTimes[:len(times)] - times[:len(offTimes)]).mean()
-                
-                ## Determine average exposure time (excluding first frame, which is often shorter)
-                expLen = (offTimes[1:len(onTimes)] - onTimes[1:len(offTimes)]).mean()
+                    onTimes = np.concatenate([timeVals[:1], onTimes])
                 
                 if self._task.camCmd['params'].get('triggerMode', 'Normal') == 'Normal' and not self._task.camCmd.get('triggerProtocol', False):
                     ## Can we make a good guess about frame times even without having triggered the first frame?
@@ -675,19 +727,15 @@ class CameraTaskResult:
                     ## New times list is onTimes, any extra frames just increment by tx+exp time
                     times[:len(onTimes)] = onTimes[:len(times)]  ## set the times for which we detected an exposure pulse
                     
-                    ## Try to determine mean framerate
-                    if len(onTimes) > 1:
-                        framePeriod = (onTimes[-1] - onTimes[0]) / (len(onTimes) - 1)
-                    else:
-                        framePeriod = (times[-1] - times[0]) / (len(times) - 1)
-                        
                     ## For any extra frames that did not have an exposure signal, just try
                     ## to guess the correct time based on the average framerate.
-                    lastTime = onTimes[-1]
-                    if framePeriod is not None:
-                        for i in range(len(onTimes), len(times)):
-                            lastTime += framePeriod
-                            times[i] = lastTime
+                    nExtra = len(times) - len(onTimes)
+                    if nExtra > 0:
+                        if len(onTimes) > 1:
+                            framePeriod = (onTimes[-1] - onTimes[0]) / (len(onTimes) - 1)
+                        else:
+                            framePeriod = (times[-1] - times[0]) / (len(times) - 1)
+                        times[len(onTimes):] = onTimes[-1] + framePeriod * np.arange(1, nExtra + 1)
                             
                     precise = True
                 
@@ -38,12 +38,42 @@ class DataMapping:
         offset = self.offset[chan]
         return (data*scale) - offset
         
-    def mapFromDaq(self, chan, data):
+    def mapFromDaq(self, chan, data, out=None):
+        """Map *data* recorded on *chan* to physical units.
+        If *out* is given, the result is written into it rather than a new array."""
         scale = self.scale[chan]
         offset = self.offset[chan]
-        return (data + offset) * scale
+        if out is None:
+            return (data + offset) * scale
+        np.add(data, offset, out=out)
+        np.multiply(out, scale, out=out)
+        return out
             
 
+def stackChannels(arrays, mapFns=None):
+    """Copy a list of 1D channel arrays into the rows of a single preallocated
+    (channels x samples) float array and return it.
+    
+    If *mapFns* is given, it must be a list of callables (one per channel, or None) 
+    that will be called as fn(data, out=row) to write the mapped data directly into
+    the output row. This avoids allocating one intermediate array per channel and then
+    a second copy of everything for np.concatenate.
+    """
+    arrays = [np.asarray(a) for a in arrays]
+    shapes = set([a.shape for a in arrays])
+    if len(shapes) != 1 or arrays[0].ndim != 1:
+        raise ValueError("Cannot stack channels with shapes %s" % [a.shape for a in arrays])
+    dtype = np.result_type(np.float64, *[a.dtype for a in arrays])
+    out = np.empty((len(arrays), len(arrays[0])), dtype=dtype)
+    for i, data in enumerate(arrays):
+        fn = None if mapFns is None else mapFns[i]
+        if fn is None:
+            out[i] = data
+        else:
+            fn(data, out=out[i])
+    return out
+
+
 class ChannelHandle(object):
     def __init__(self, dev, channel):
         self.dev = dev
@@ -424,10 +454,9 @@ class DAQGenericTask(DeviceTask):
         ## create MetaArray and fill with MC state info
         
         ## Collect data and info for each channel in the command
-        result = {}
+        result = OrderedDict()
         for ch in self.bufferedChannels:
             result[ch] = self.daqTasks[ch].getData(self.dev._DGConfig[ch]['channel'])
-            result[ch]['data'] = self.mapping.mapFromDaq(ch, result[ch]['data']) ## scale/offset/invert
             result[ch]['units'] = self.getChanUnits(ch)
         
         if len(result) > 0:
@@ -437,16 +466,12 @@ class DAQGenericTask(DeviceTask):
             ## Create an array of time values
             timeVals = np.linspace(0, float(nPts-1) / float(rate), nPts)
             
-            ## Concatenate all channels together into a single array, generate MetaArray info
-            chanList = [np.atleast_2d(result[x]['data']) for x in result]
+            ## Scale/offset/invert each channel directly into its row of a single 
+            ## (channels x samples) array. A new array is built for every call, so
+            ## callers may modify their result without affecting each other.
+            mapFns = [lambda data, out, ch=ch: self.mapping.mapFromDaq(ch, data, out=out) for ch in result]
+            arr = stackChannels([result[x]['data'] for x in result], mapFns)
             cols = [(x, result[x]['units']) for x in result]
-            # print cols
-            try:
-                arr = np.concatenate(chanList)
-            except:
-                print chanList
-                print [a.shape for a in chanList]
-                raise
             
             daqState = OrderedDict()
             for ch in self.dev._DGConfig:
@@ -6,6 +6,13 @@ from acq4.util.debug import *
 
 class Device(QtCore.QObject):
     """Abstract class defining the standard interface for Device subclasses."""
+    
+    ## If True, the Manager may construct this device in a worker thread at startup,
+    ## concurrently with other devices (see Manager.loadDevices). Only set this for devices
+    ## whose constructor creates no widgets, timers, or other QObjects besides the device
+    ## itself; the device (and its children) is moved to the GUI thread afterward.
+    threadedStartup = False
+    
     def __init__(self, deviceManager, config, name):
         QtCore.QObject.__init__(self)
         self._lock_ = Mutex(QtCore.QMutex.Recursive)  ## no, good idea
@@ -6,7 +6,6 @@ import time, sys, traceback
 import acq4.util.ptime as ptime
 from acq4.util.Mutex import Mutex
 from acq4.util.debug import *
-import acq4.util.functions as fn
 import numpy as np
 import scipy
 from collections import OrderedDict
@@ -18,9 +17,11 @@ class MockCamera(Camera):
         self.camLock = Mutex(Mutex.Recursive)  ## Lock to protect access to camera
         self.ringSize = 100
         self.frameId = 0
-        self.noise = np.random.normal(size=10000000, loc=100, scale=50)  ## pre-generate noise for use in images
+        ## pre-generate noise for use in images (clipped at 0 here, rather than in every frame)
+        self.noise = np.clip(np.random.normal(size=10000000, loc=100, scale=50), 0, None).astype(np.float32)
         self.bgData = mandelbrot(w=4000, maxIter=60).astype(np.float32)
         self.background = None
+        self.frameTemplate = None  ## background and cell pixels for the current transform and region; see getFrameTemplate()
         
         self.params = OrderedDict([
             ('triggerMode',     'Normal'),
@@ -66,6 +67,7 @@ class MockCamera(Camera):
         self.signal = sig
         
         Camera.__init__(self, *args, **kargs)  ## superclass will call setupCamera when it is ready.
+        self.readoutTime = self.camConfig.get('readoutTime', 40e-3)  ## time to read a full-resolution frame; divided by binning
         self.acqBuffer = None
         self.frameId = 0
         self.lastIndex = None
@@ -89,6 +91,7 @@ class MockCamera(Camera):
         
     def globalTransformChanged(self):
         self.background = None
+        self.frameTemplate = None
     
     def startCamera(self):
         self.cameraStarted = True
@@ -139,6 +142,47 @@ class MockCamera(Camera):
         
         return x,y
         
+    def getFrameTemplate(self):
+        """Return (background, cellPixels, cellIndex) for the current transform,
+        region and exposure:
+        
+        * background is the full-resolution background image, scaled for exposure
+        * cellPixels are flat indices of the background pixels covered by each cell
+        * cellIndex gives the index of the cell that covers each of cellPixels
+        
+        The template is cached until the global transform or camera parameters change.
+        """
+        template = self.frameTemplate
+        if template is not None:
+            return template
+        
+        region = self.getParam('region')
+        exp = self.getParam('exposure')
+        bg = self.getBackground()[region[0]:region[0]+region[2], region[1]:region[1]+region[3]]
+        bg = bg * np.float32(exp*1000)
+        
+        ## map all cells into image coordinates at once. Note we use binning=(1,1)
+        ## here because the image is downsampled later.
+        px = (self.pixelVectors()[0]**2).sum() ** 0.5
+        cameraTr = pg.SRTTransform3D(self.inverseGlobalTransform())
+        frameTr = self.makeFrameTransform(region, [1, 1]).inverted()[0]
+        tr = pg.SRTTransform(frameTr * cameraTr)
+        pos = pg.transformCoordinates(tr, np.array([self.cells['x'], self.cells['y']]))
+        start = pos.astype(int)
+        stop = start + np.round(self.cells['size'] / px).astype(int)
+        lo = np.clip(start, 0, np.array(bg.shape)[:, None])
+        hi = np.clip(stop, 0, np.array(bg.shape)[:, None])
+        
+        pixels = []
+        index = []
+        for i in range(len(self.cells)):
+            x, y = np.mgrid[lo[0,i]:hi[0,i], lo[1,i]:hi[1,i]]
+            pixels.append((x * bg.shape[1] + y).ravel())
+            index.append(np.ones(pixels[-1].size, dtype=int) * i)
+        template = (bg, np.concatenate(pixels), np.concatenate(index))
+        self.frameTemplate = template
+        return template
+
     def newFrames(self):
         """Return a list of all frames acquired since the last call to newFrames."""
         now = ptime.time()
@@ -146,51 +190,46 @@ class MockCamera(Camera):
         dt = now - self.lastFrameTime
         exp = self.getParam('exposure')
         bin = self.getParam('binning')
-        fps = 1.0 / (exp+(40e-3/(bin[0]*bin[1])))
+        fps = 1.0 / (exp+(self.readoutTime/(bin[0]*bin[1])))
         nf = int(dt * fps)
         if nf == 0:
             return []
+        if nf > self.ringSize:
+            ## frames that did not fit in the ring buffer are lost
+            self.frameId += nf - self.ringSize
+            nf = self.ringSize
         
-        region = self.getParam('region') 
-        bg = self.getBackground()[region[0]:region[0]+region[2], region[1]:region[1]+region[3]]
+        bg, cellPixels, cellIndex = self.getFrameTemplate()
         
         ## update cells
         spikes = np.random.poisson(min(dt, 0.4) * self.cells['rate'])
         self.cells['value'] *= np.exp(-dt / self.cells['decayTau'])
         self.cells['value'] = np.clip(self.cells['value'] + spikes * 0.2, 0, 1)
-        shape = region[2:]
         self.lastFrameTime = now + exp
-        data = self.getNoise(shape)
-        data[data<0] = 0
+        cellVals = (self.cells['intensity'] * self.cells['value'] * exp).astype(np.float32)
+        cellVals = cellVals[cellIndex]
         
-        data += bg * (exp*1000)
-        
-        ## draw cells
-        px = (self.pixelVectors()[0]**2).sum() ** 0.5
-        
-        ## Generate transform that maps grom global coordinates to image coordinates
-        cameraTr = pg.SRTTransform3D(self.inverseGlobalTransform())
-        # note we use binning=(1,1) here because the image is downsampled later.
-        frameTr = self.makeFrameTransform(region, [1, 1]).inverted()[0]
-        tr = pg.SRTTransform(frameTr * cameraTr)
-        
-        for cell in self.cells:
-            w = cell['size'] / px
-            pos = pg.Point(cell['x'], cell['y'])
-            imgPos = tr.map(pos)
-            start = (int(imgPos.x()), int(imgPos.y()))
-            stop = (start[0]+w, start[1]+w)
-            val = cell['intensity'] * cell['value'] * self.getParam('exposure')
-            data[max(0,start[0]):max(0,stop[0]), max(0,start[1]):max(0,stop[1])] += val
-        
-        data = fn.downsample(data, bin[0], axis=0)
-        data = fn.downsample(data, bin[1], axis=1)
-        data = data.astype(np.uint16)
-        
-        self.frameId += 1
+        w = bg.shape[0] // bin[0]
+        h = bg.shape[1] // bin[1]
         frames = []
         for i in range(nf):
-            frames.append({'data': data, 'time': now + (i / fps), 'id': self.frameId})
+            data = self.getNoise(bg.shape)
+            data += bg
+            
+            ## draw cells
+            np.add.at(data.reshape(data.size), cellPixels, cellVals)
+            
+            ## bin by averaging blocks of pixels
+            if bin[0] > 1 or bin[1] > 1:
+                blocks = data[:w*bin[0], :h*bin[1]].reshape(w, bin[0], h, bin[1])
+                data = np.zeros((w, h), dtype=np.float32)
+                for j in range(bin[0]):
+                    for k in range(bin[1]):
+                        data += blocks[:, j, :, k]
+                data *= np.float32(1.0 / (bin[0]*bin[1]))
+            
+            self.frameId += 1
+            frames.append({'data': data.astype(np.uint16), 'time': now + (i / fps), 'id': self.frameId})
         return frames
             
                 
@@ -222,6 +261,7 @@ class MockCamera(Camera):
             del params[k]
         
         self.params.update(params)
+        self.frameTemplate = None
         newVals = params
         restart = True
         if autoRestart and restart:
@@ -268,9 +308,9 @@ class MockCameraTask(CameraTask):
         sampleRate = cmd['rate']
         
         data = np.zeros(cmd['numPts'], dtype=np.uint8)
-        for f in self.frames:
-            t = f.info()['time']
-            exp = f.info()['exposure']
+        for info in self.frameInfo:
+            t = info['time']
+            exp = info['exposure']
             i0 = int((t - start) * sampleRate)
             i1 = i0 + int((exp-0.1e-3) * sampleRate)
             data[i0:i1] = 1
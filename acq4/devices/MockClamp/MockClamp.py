@@ -20,6 +20,8 @@ modeNames = ['vc', 'i=0', 'ic']
 
 class MockClamp(DAQGeneric):
     
+    threadedStartup = True  ## constructor starts the simulator process
+    
     sigModeChanged = QtCore.Signal(object)
 
     def __init__(self, dm, config, name):
@@ -203,7 +205,10 @@ class MockClampTask(DAQGenericTask):
 
     def write(self, data, dt):
         ## Called by DAQGeneric to simulate a write-to-DAQ
-        self.job = self.dev.simulator.run({'data': data, 'dt': dt, 'mode': self.cmd['mode']}, _callSync='async')
+        simCmd = {'data': data, 'dt': dt, 'mode': self.cmd['mode']}
+        if 'integrator' in self.dev.config:
+            simCmd['integrator'] = self.dev.config['integrator']
+        self.job = self.dev.simulator.run(simCmd, _callSync='async')
 
     def isDone(self):
         ## check on neuron process
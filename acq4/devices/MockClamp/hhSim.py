@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 """
-Simple Hodgkin-Huxley simulator for Python. VERY slow.
+Simple Hodgkin-Huxley simulator for Python.
 Includes Ih from Destexhe 1993 [disabled]
 Also simulates voltage clamp and current clamp with access resistance.
 
+Two integrators are available: runSim() uses scipy.integrate.odeint (accurate
+but VERY slow), and runExpEuler() uses a fixed-step exponential Euler method
+with tabulated gating rates and can simulate many cells at once. run() uses
+runExpEuler() unless odeint is requested.
+
 Luke Campagnola 2013
 """
 
+import math
 import numpy as np
 import scipy.integrate
-from PyQt4 import QtGui, QtCore
 #import scipy.weave
 
 um = 1e-6
@@ -63,6 +68,18 @@ def IAlpha(Vm, t):
             return gAlpha * (Vm - EAlpha)*(tn/Alpha_tau) * np.exp(-(tn-Alpha_tau)/Alpha_tau)
 
 
+def gatingRates(Vm):
+    """Return the opening and closing rates (am, bm, ah, bh, an, bn) of the m, h
+    and n gates in 1/ms. *Vm* is the membrane potential in mV relative to rest."""
+    am = (2.5-0.1*Vm) / (np.exp(2.5-0.1*Vm) - 1.0)
+    bm = 4. * np.exp(-Vm / 18.)
+    ah = 0.07 * np.exp(-Vm / 20.)
+    bh = 1.0 / (np.exp(3.0 - 0.1 * Vm) + 1.0)
+    an = (0.1 - 0.01*(Vm-gKShift)) / (np.exp(1.0 - 0.1*(Vm-gKShift)) - 1.0)
+    bn = 0.125 * np.exp(-Vm / 80.)
+    return am, bm, ah, bh, an, bn
+
+
 def hh(y, t, mode, cmd, dt):
     ## y is a vector [Ve, Vm, m, h, n, f, s], function returns derivatives of each variable
     ## with respect to time.
@@ -79,10 +96,10 @@ def hh(y, t, mode, cmd, dt):
     else:
         # interpolate command -- sharp steps confuse the integrator.
         fInd = t/dt
-        ind = min(len(cmd)-1, np.floor(fInd))
+        ind = min(len(cmd)-1, int(fInd))
         ind2 = min(len(cmd)-1, ind+1)
-        s = fInd - ind
-        cmd = cmd[ind] * (1-s) + cmd[ind2] * s
+        frac = fInd - ind
+        cmd = cmd[ind] * (1-frac) + cmd[ind2] * frac
         
     # determine current generated by voltage clamp 
     if mode == 'vc':
@@ -103,16 +120,9 @@ def hh(y, t, mode, cmd, dt):
     Vm = Vm + 65e-3   ## gating parameter eqns assume resting is 0mV
     Vm *= 1000.   ##  ..and that Vm is in mV
     
-    am = (2.5-0.1*Vm) / (np.exp(2.5-0.1*Vm) - 1.0)
-    bm = 4. * np.exp(-Vm / 18.)
+    am, bm, ah, bh, an, bn = gatingRates(Vm)
     dm = am * (1.0 - m) - bm * m
-    
-    ah = 0.07 * np.exp(-Vm / 20.)
-    bh = 1.0 / (np.exp(3.0 - 0.1 * Vm) + 1.0)
     dh = ah * (1.0 - h) - bh * h
-    
-    an = (0.1 - 0.01*(Vm-gKShift)) / (np.exp(1.0 - 0.1*(Vm-gKShift)) - 1.0)
-    bn = 0.125 * np.exp(-Vm / 80.)
     dn = an * (1.0 - n) - bn * n
     
     # Ih is disabled--very slow.
@@ -136,8 +146,8 @@ def hh(y, t, mode, cmd, dt):
 #plt2 = win.addPlot(labels={'left': ('Im', 'A'), 'bottom': ('Time', 's')})
 
 def runSim(initState, mode='ic', cmd=None, dt=0.1, dur=100, **args):
-    npts = int(dur/dt)
-    t = np.linspace(0, dur, npts)
+    npts = int(round(dur/dt))
+    t = np.arange(npts) * dt
     result = np.empty((npts, 9))
     
     # Run the simulation
@@ -152,6 +162,149 @@ def runSim(initState, mode='ic', cmd=None, dt=0.1, dur=100, **args):
     return result  ## result is array with dims: [npts, (time, Ie, Ve, Vm, Im, m, h, n, f, s)]
 
 
+## Gating rates for runExpEuler are looked up in tables sampled every
+## rateTableStep mV over rateTableRange (mV relative to rest)
+rateTableRange = (-150., 250.)
+rateTableStep = 0.01
+_rateTable = None
+
+def rateTable():
+    """Return tables of (rate, steady state) for the m, h and n gates, each with
+    shape (3, N). Table entry i is computed at the center of the i-th bin, so the
+    removable singularities of am and an are never evaluated."""
+    global _rateTable
+    if _rateTable is None:
+        V = np.arange(rateTableRange[0], rateTableRange[1], rateTableStep) + rateTableStep / 2.
+        am, bm, ah, bh, an, bn = gatingRates(V)
+        alpha = np.array([am, ah, an])
+        rate = alpha + np.array([bm, bh, bn])
+        _rateTable = (rate, alpha / rate)
+    return _rateTable
+
+
+def runExpEuler(initState, mode='ic', cmd=None, dt=0.1, dur=100, maxStep=0.025):
+    """Simulate with a fixed-step exponential Euler integrator.
+    
+    Arguments are the same as for runSim(), but *initState* may have shape
+    (nCells, 7) and *cmd* shape (nCells, npts) to simulate many cells (or sweeps)
+    at once. Each step of *dt* ms is divided into substeps no longer than
+    *maxStep* ms. Over each substep the gating variables are advanced exactly
+    for the rates at the starting membrane potential, then Ve and Vm are
+    advanced exactly for the resulting (fixed) conductances.
+    
+    Returns an array like runSim(), with an extra first axis of length nCells
+    if more than one cell was simulated.
+    """
+    npts = int(round(dur/dt))
+    state = np.atleast_2d(np.array(initState, dtype=float))
+    if cmd is None:
+        cmd = np.zeros(npts)
+        mode = 'ic'
+    cmd = np.asarray(cmd, dtype=float)
+    single = state.shape[0] == 1 and cmd.ndim == 1
+    cmd = np.atleast_2d(cmd)
+    nCells = max(state.shape[0], cmd.shape[0])
+    state = state * np.ones((nCells, 1))
+    cmd = cmd * np.ones((nCells, 1))
+    
+    nSub = max(1, int(math.ceil(dt / maxStep - 1e-6)))
+    h = dt / nSub
+    nSteps = (npts - 1) * nSub
+    
+    # command and alpha conductance at the middle of each substep;
+    # the command is interpolated as in hh()
+    tMid = (np.arange(nSteps) + 0.5) * h
+    cmdMid = np.array([np.interp(tMid, np.arange(cmd.shape[1]) * dt, c) for c in cmd]).T
+    tn = tMid - Alpha_t0
+    tn = np.where((tn > 0) & (tn < 10.0 * Alpha_tau), tn, 0)
+    gA = gAlpha * (tn/Alpha_tau) * np.exp(-(tn-Alpha_tau)/Alpha_tau)
+    
+    # gate updates: x = xInf + (x - xInf) * exp(-h * rate)
+    rate, xInf = rateTable()
+    decay = np.exp(-h * rate)
+    v0 = -65e-3 + rateTableRange[0] * 1e-3
+    vScale = 1e3 / rateTableStep
+    last = rate.shape[1] - 1
+    
+    # dVe/dt = a11 Ve + a12 Vm + b1;  dVm/dt = a21 Ve + a22 Vm + b2
+    # (per ms; only a22 and b2 depend on the gating variables)
+    Ga = 1.0 / Raccess
+    kE = 1e-3 / Cpip
+    kM = 1e-3 / C
+    a12 = Ga * kE
+    a21 = Ga * kM
+    a1221 = a12 * a21
+    if mode == 'vc':
+        G = 50e-6  # VC gain, as in hh()
+        a11 = -(Ga + G) * kE
+        b1 = cmdMid * (G * kE)
+    else:
+        a11 = -Ga * kE
+        b1 = cmdMid * kE
+    gH_ = gH * state[:, 5] * state[:, 6]  # f and s are constant; Ih is disabled in hh() as well
+    gFix = Ga + gL + gH_
+    gEFix = gL * EL + gH_ * EH
+    
+    if nCells == 1:
+        # a single cell is much faster with python floats than with numpy arrays
+        exp, sqrt = math.exp, math.sqrt
+        Ve, Vm, m, hg, n = state[0, :5].tolist()
+        gFix, gEFix = float(gFix[0]), float(gEFix[0])
+        b1 = b1[:, 0].tolist()
+        gA = gA.tolist()
+        infM, infH, infN = xInf.tolist()
+        decM, decH, decN = decay.tolist()
+        index = lambda v: min(max(int((v - v0) * vScale), 0), last)
+    else:
+        exp, sqrt = np.exp, np.sqrt
+        Ve, Vm, m, hg, n = state[:, :5].T.copy()
+        infM, infH, infN = xInf
+        decM, decH, decN = decay
+        index = lambda v: np.clip(((v - v0) * vScale).astype(int), 0, last)
+    
+    trace = [(Ve, Vm, m, hg, n)]
+    for j in xrange(nSteps):
+        i = index(Vm)
+        x = infM[i]
+        m = x + (m - x) * decM[i]
+        x = infH[i]
+        hg = x + (hg - x) * decH[i]
+        x = infN[i]
+        n = x + (n - x) * decN[i]
+        
+        gNa_ = gNa * m * m * m * hg
+        gK_ = n * n
+        gK_ = gK * gK_ * gK_
+        a22 = -kM * (gFix + gA[j] + gNa_ + gK_)
+        b2 = kM * (gEFix + gA[j] * EAlpha + gNa_ * ENa + gK_ * EK)
+        
+        # V(t+h) = VInf + exp(A h) (V - VInf), with exp(A h) from the eigenvalues of A
+        det = a11 * a22 - a1221
+        d = a11 - a22
+        l1 = 0.5 * (a11 + a22 - sqrt(d * d + 4 * a1221))
+        l2 = det / l1
+        VeInf = (a12 * b2 - a22 * b1[j]) / det
+        VmInf = (a21 * b1[j] - a11 * b2) / det
+        dVe = Ve - VeInf
+        dVm = Vm - VmInf
+        e1 = exp(l1 * h) / (l1 - l2)
+        e2 = exp(l2 * h) / (l1 - l2)
+        x = a11 * dVe + a12 * dVm
+        Ve = VeInf + e1 * (x - l2 * dVe) - e2 * (x - l1 * dVe)
+        x = a21 * dVe + a22 * dVm
+        Vm = VmInf + e1 * (x - l2 * dVm) - e2 * (x - l1 * dVm)
+        
+        if (j + 1) % nSub == 0:
+            trace.append((Ve, Vm, m, hg, n))
+    
+    result = np.empty((nCells, npts, 9))
+    result[..., 0] = np.arange(npts) * dt
+    result[..., 2:7] = np.array(trace).reshape(npts, 5, nCells).transpose(2, 0, 1)
+    result[..., 7:] = state[:, None, 5:]
+    result[..., 1] = (result[..., 2] - result[..., 3]) / Raccess
+    return result[0] if single else result
+
+
 initState = [-65e-3, -65e-3, 0.05, 0.6, 0.3, 0.0, 0.0]
 
 def run(cmd):
@@ -162,6 +315,7 @@ def run(cmd):
             'dt': 1e-4,
             'mode': 'ic',
             'data': np.array([...]),
+            'integrator': 'expEuler',  # optional; or 'odeint'
         }
         
     Return array of Vm or Im values.        
@@ -173,7 +327,10 @@ def run(cmd):
     data = cmd['data']
     mode = cmd['mode']
     
-    result = runSim(initState, cmd=data, mode=mode, dt=dt, dur=dt*len(data))
+    if cmd.get('integrator', 'expEuler') == 'odeint':
+        result = runSim(initState, cmd=data, mode=mode, dt=dt, dur=dt*len(data))
+    else:
+        result = runExpEuler(initState, cmd=data, mode=mode, dt=dt, dur=dt*len(data))
     
     initState = result[-1, 2:]
     if mode == 'ic':
@@ -0,0 +1,67 @@
+import os, sys
+import numpy as np
+
+## hhSim is imported by path, the same way MockClamp loads it into the simulator process
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import hhSim
+
+dt = 0.05  # ms
+npts = 4000
+
+
+def stepCommand(base, step):
+    cmd = np.ones(npts) * base
+    cmd[npts//5:npts*4//5] = step
+    return cmd
+
+
+def spikeTimes(v):
+    return np.argwhere((v[1:] > 0) & (v[:-1] <= 0))[:, 0] * dt
+
+
+def test_currentClamp():
+    for amp in [-100e-12, 50e-12, 200e-12]:
+        cmd = stepCommand(0, amp)
+        ref = hhSim.runSim(hhSim.initState, mode='ic', cmd=cmd, dt=dt, dur=dt*npts)
+        fast = hhSim.runExpEuler(hhSim.initState, mode='ic', cmd=cmd, dt=dt, dur=dt*npts)
+        assert fast.shape == ref.shape
+        assert np.all(fast[:, 0] == ref[:, 0])
+
+        ## same spikes at the same times (within one sample); Vm within 2 mV
+        assert len(spikeTimes(ref[:, 3])) == len(spikeTimes(fast[:, 3]))
+        assert np.all(np.abs(spikeTimes(ref[:, 3]) - spikeTimes(fast[:, 3])) <= dt)
+        assert np.abs(fast[:, 2:4] - ref[:, 2:4]).max() < 2e-3
+        assert np.abs(fast[:, 4:7] - ref[:, 4:7]).max() < 0.05
+    assert len(spikeTimes(ref[:, 3])) > 3
+
+
+def test_voltageClamp():
+    for step in [-120e-3, -20e-3, 0]:
+        cmd = stepCommand(-65e-3, step)
+        ref = hhSim.runSim(hhSim.initState, mode='vc', cmd=cmd, dt=dt, dur=dt*npts)
+        fast = hhSim.runExpEuler(hhSim.initState, mode='vc', cmd=cmd, dt=dt, dur=dt*npts)
+
+        ## membrane current within 1% of its range, except for the capacitive
+        ## transient in the samples where the command steps
+        mask = np.ones(npts, dtype=bool)
+        mask[npts//5] = mask[npts*4//5] = False
+        err = np.abs(fast[:, 1] - ref[:, 1])[mask]
+        assert err.max() < 0.01 * np.ptp(ref[:, 1])
+
+
+def test_manyCells():
+    amps = np.linspace(-100e-12, 300e-12, 5)
+    cmd = np.array([stepCommand(0, a) for a in amps])
+    init = np.array([hhSim.initState] * len(amps))
+    init[:, 1] = np.linspace(-70e-3, -60e-3, len(amps))
+    res = hhSim.runExpEuler(init, mode='ic', cmd=cmd, dt=dt, dur=dt*npts)
+    assert res.shape == (len(amps), npts, 9)
+    for i in range(len(amps)):
+        single = hhSim.runExpEuler(init[i], mode='ic', cmd=cmd[i], dt=dt, dur=dt*npts)
+        assert np.allclose(res[i], single, rtol=1e-9, atol=1e-15)
+
+
+def test_run():
+    for integrator in ['expEuler', 'odeint']:
+        out = hhSim.run({'dt': 1e-4, 'mode': 'vc', 'data': stepCommand(-65e-3, -20e-3)[:1234], 'integrator': integrator})
+        assert out.shape == (1234,)
@@ -4,9 +4,12 @@ from acq4.drivers.MultiClamp.MultiClamp import MultiClamp as MultiClampDriver
 from acq4.devices.Device import *
 from acq4.Manager import logMsg
 from acq4.util.metaarray import MetaArray, axis
+from acq4.devices.DAQGeneric import stackChannels
+from collections import OrderedDict
 from acq4.util.Mutex import Mutex
 from PyQt4 import QtCore
 from numpy import *
+import numpy as np
 import sys, traceback
 from DeviceGui import *
 from taskGUI import *
@@ -15,6 +18,8 @@ from acq4.util.debug import *
 
 class MultiClamp(Device):
     
+    threadedStartup = True  ## constructor waits for the first update from MultiClamp Commander
+    
     sigStateChanged = QtCore.Signal(object)
     sigHoldingChanged = QtCore.Signal(object, object)  # self, mode
     
@@ -389,7 +394,7 @@ class MultiClampTask(DeviceTask):
         with self.dev.lock:
             channels = self.getUsedChannels()
             #print channels
-            result = {}
+            result = OrderedDict()
             #result['info'] = self.state
             for ch in channels:
                 chConf = self.dev.config[ch+'Channel']
@@ -399,7 +404,7 @@ class MultiClampTask(DeviceTask):
                 rate = result[ch]['info']['rate']
                 if ch == 'command':
                     #result[ch]['data'] = result[ch]['data'] / self.dev.config['cmdScale'][self.cmd['mode']]
-                    result[ch]['data'] = result[ch]['data'] * self.state['extCmdScale']
+                    result[ch]['scale'] = self.state['extCmdScale']
                     result[ch]['name'] = 'command'
                     if self.cmd['mode'] == 'VC':
                         result[ch]['units'] = 'V'
@@ -407,8 +412,7 @@ class MultiClampTask(DeviceTask):
                         result[ch]['units'] = 'A'
                 else:
                     #scale = 1.0 / self.state[ch + 'Signal'][1]
-                    scale = self.state[ch + 'ScaleFactor']
-                    result[ch]['data'] = result[ch]['data'] * scale
+                    result[ch]['scale'] = self.state[ch + 'ScaleFactor']
                     #result[ch]['units'] = self.state[ch + 'Signal'][2]
                     result[ch]['units'] = self.state[ch + 'Units']
                     result[ch]['name'] = ch
@@ -432,18 +436,10 @@ class MultiClampTask(DeviceTask):
                 
             #timeVals = linspace(0, float(self.state['numPts']-1) / float(self.state['rate']), self.state['numPts'])
             timeVals = linspace(0, float(nPts-1) / float(rate), nPts)
-            chanList = [atleast_2d(result[x]['data']) for x in result]
-            # for l in chanList:
-            # print l.shape
+            ## scale each channel directly into its row of a new output array (no per-channel copies or concatenate)
+            mapFns = [lambda data, out, scale=result[x]['scale']: np.multiply(data, scale, out=out) for x in result]
+            arr = stackChannels([result[x]['data'] for x in result], mapFns)
             cols = [(result[x]['name'], result[x]['units']) for x in result]
-            # print cols
-            #print [a.shape for a in chanList]
-            try:
-                arr = concatenate(chanList)
-            except:
-                for a in chanList:
-                    print a.shape
-                raise
             
             info = [axis(name='Channel', cols=cols), axis(name='Time', units='s', values=timeVals)] + [{'ClampState': self.state, 'DAQ': daqState}]
             
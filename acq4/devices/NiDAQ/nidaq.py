@@ -17,6 +17,8 @@ class NiDAQ(Device):
     Config options:
         defaultAIMode: 'mode'  # mode to use for ai channels by default ('rse', 'nrse', or 'diff')
     """
+    threadedStartup = True  ## constructor only loads the driver and queries the hardware
+    
     def __init__(self, dm, config, name):
         Device.__init__(self, dm, config, name)
         self.config = config
@@ -5,6 +5,23 @@ import acq4.pyqtgraph as pg
 import collections
 import numpy as np
 
+
+def mapPoints(matrix, points):
+    """Map an array of points with shape (..., 2) or (..., 3) through the 4x4 affine
+    *matrix* (as returned by OptomechDevice.globalTransformMatrix()).
+    
+    2D points are assumed to lie in the z=0 plane and only their x,y coordinates are
+    returned. Any perspective component of the matrix is ignored.
+    """
+    points = np.asarray(points)
+    nd = points.shape[-1]
+    if nd not in (2, 3):
+        raise TypeError("Cannot map array of shape %s; last axis must have length 2 or 3." % str(points.shape))
+    out = np.dot(points, matrix[:nd, :nd].T)
+    out += matrix[:nd, 3]
+    return out
+
+
 class OptomechDevice(object):
     """
     OptomechDevice is an extenstion to the Device class which manages coordinate system mapping between
@@ -23,6 +40,11 @@ class OptomechDevice(object):
     In most cases, the transformation will be in the form of an affine matrix multiplication.
     Devices are free, however, to define an arbitrary transformation as well.
     
+    Composed global transforms (and their inverses) are cached and recomputed only after
+    the transform or subdevice selection of this device or one of its parents has changed
+    (see transformVersion()). The map methods accept an ndarray of shape (..., 2) or (..., 3)
+    to map many points at once.
+    
     Devices may also have selectable sub-devices, providing a set of interchangeable transforms.
     For example, a microscope with multiple objectives may define one sub-device per objective.
     This does not affect the hierarchy of devices, but instead simply affects the way the microscope
@@ -66,6 +88,9 @@ class OptomechDevice(object):
             ## Emitted when this device changes its list of available subdevices
         sigGlobalSubdeviceListChanged = QtCore.Signal(object, object) ## self, dev
             ## Emitted when this device or any (grand)parent changes its list of available subdevices
+            
+        sigTransformChangeQueued = QtCore.Signal()
+            ## internal; used to deliver transform changes made from other threads
     
     def __init__(self, dm, config, name):
         object.__init__(self)
@@ -85,8 +110,9 @@ class OptomechDevice(object):
         self.__config = config
         self.__children = []
         self.__parent = None
-        self.__globalTransform = 0  ## 0 indicates the cache is invalid. None indicates the transform is non-affine.
-        self.__inverseGlobalTransform = 0
+        self.__transformVersion = 0
+        self.__globalCache = {}  ## {(subdevKey, inverse): (parent versions, (QMatrix4x4, ndarray) or None if non-affine)}
+        self.__transformChangePending = False
         self.__transform = pg.SRTTransform3D()
         self.__inverseTransform = 0
         self.__lock = Mutex(recursive=True)
@@ -98,6 +124,7 @@ class OptomechDevice(object):
         self.sigSubdeviceTransformChanged.connect(self.__emitGlobalSubdeviceTransformChanged)
         self.sigSubdeviceChanged.connect(self.__emitGlobalSubdeviceChanged)
         self.sigSubdeviceListChanged.connect(self.__emitGlobalSubdeviceListChanged)
+        self.__sigProxy.sigTransformChangeQueued.connect(self.__flushTransformChanged, QtCore.Qt.QueuedConnection)
         if config is not None:
             if 'parentDevice' in config:
                 self.setParentDevice(config['parentDevice'])
@@ -144,14 +171,21 @@ class OptomechDevice(object):
             return self._mapTransform(obj, tr)
     
     def mapToGlobal(self, obj, subdev=None):
-        """Map *obj* from local coordinates to global."""
+        """Map *obj* from local coordinates to global.
+        
+        *obj* may be a QPointF, QVector3D, a tuple or list of 2 or 3 numbers, or
+        an ndarray of points. Arrays must hold one point per row, with shape
+        (..., 2) or (..., 3); the older (2, N) / (3, N) layout is rejected. A tuple
+        or list of coordinate arrays (xs, ys[, zs]) is still accepted and is
+        returned as a single array with the coordinate axis first.
+        """
         with self.__lock:
-            tr = self.globalTransform(subdev)
+            tr = self.__cachedGlobalTransform(subdev)
             if tr is not None:
-                return self._mapTransform(obj, tr)
+                return self._mapTransform(obj, *tr)
             
             ## If our transformation is nonlinear, then the local mapping step must be done separately.
-            subdev = self._subdevDict(subdev)
+            subdev = self.__subdevDict(subdev)
             o2 = self.mapToParentDevice(obj, subdev)
             parent = self.parentDevice()
             if parent is None:
@@ -162,7 +196,7 @@ class OptomechDevice(object):
     def mapToDevice(self, device, obj, subdev=None):
         """Map *obj* from local coordinates to *device*'s coordinate system."""
         with self.__lock:
-            subdev = self._subdevDict(subdev)
+            subdev = self.__subdevDict(subdev)
             return device.mapFromGlobal(self.mapToGlobal(obj, subdev), subdev)
     
     def mapFromParentDevice(self, obj, subdev=None):
@@ -174,23 +208,27 @@ class OptomechDevice(object):
             return self._mapTransform(obj, tr)
     
     def mapFromGlobal(self, obj, subdev=None):
-        """Map *obj* from global to local coordinates."""
+        """Map *obj* from global to local coordinates.
+        
+        Accepts the same types as mapToGlobal(); ndarrays hold one point per row,
+        with shape (..., 2) or (..., 3).
+        """
         with self.__lock:
-            tr = self.inverseGlobalTransform(subdev)
+            tr = self.__cachedGlobalTransform(subdev, inverse=True)
             if tr is not None:
-                return self._mapTransform(obj, tr)
+                return self._mapTransform(obj, *tr)
         
             ## If our transformation is nonlinear, then the local mapping step must be done separately.
-            subdev = self._subdevDict(subdev)
+            subdev = self.__subdevDict(subdev)
             parent = self.parentDevice()
-            if parent is None:
+            if parent is not None:
                 obj = parent.mapFromGlobal(obj, subdev)
-            return self.mapFromParent(obj, subdev)
+            return self.mapFromParentDevice(obj, subdev)
     
     def mapFromDevice(self, device, obj, subdev=None):
         """Map *obj* from the coordinate system of the specified *device* to local coordiantes."""
         with self.__lock:
-            subdev = self._subdevDict(subdev)
+            subdev = self.__subdevDict(subdev)
             return self.mapFromGlobal(device.mapToGlobal(obj, subdev), subdev)
     
     def mapGlobalToParent(self, obj, subdev=None):
@@ -213,20 +251,29 @@ class OptomechDevice(object):
             else:
                 return self.parentDevice().mapToGlobal(obj, subdev)
         
-    def _mapTransform(self, obj, tr):
+    def _mapTransform(self, obj, tr, matrix=None):
+        """Map *obj* through the QMatrix4x4 *tr*. *matrix* may be given as the
+        equivalent 4x4 ndarray to avoid converting *tr*.
+        
+        *obj* may be a QPointF, a QVector3D, a tuple or list of 2 or 3 numbers, a
+        tuple or list of coordinate arrays (xs, ys[, zs]), or an ndarray of points
+        with shape (..., 2) or (..., 3). Arrays in the older coordinate-first layout
+        (2, N) or (3, N) raise TypeError rather than being silently misread; a
+        (2, 2), (3, 3), (2, 3) or (3, 2) array is always read as one point per row.
+        """
         # convert to a type that can be mapped
         retType = None
         if isinstance(obj, (tuple, list)):
             retType = type(obj)
             if np.isscalar(obj[0]):
-                if len(obj) == 2:
-                    obj = QtCore.QPointF(*obj)
-                elif len(obj) == 3:
-                    obj = QtGui.QVector3D(*obj)
-                else:
+                if len(obj) not in (2, 3):
                     raise TypeError("Cannot map %s of length %d." % (type(obj).__name__, len(obj)))
+                if matrix is None:
+                    matrix = pg.transformToArray(tr)
+                return retType(mapPoints(matrix, np.array(obj, dtype=float)).tolist())
             elif isinstance(obj[0], np.ndarray):
-                obj = np.concatenate([x[np.newaxis, ...] for x in obj])
+                ## coordinate axis first
+                return pg.transformCoordinates(tr, np.concatenate([x[np.newaxis, ...] for x in obj]))
             else:
                 raise Exception ('Cannot map--object of type %s ' % str(type(obj[0])))
 
@@ -242,13 +289,13 @@ class OptomechDevice(object):
             return ret
 
         elif isinstance(obj, np.ndarray):
-            # m = np.array(tr.copyDataTo()).reshape(4,4)
-            # m1 = m[:2,:2, np.newaxis]
-            # obj = obj[np.newaxis,...]
-            # m2 = (m1*obj).sum(axis=0)
-            # m2 += m[:2,3,np.newaxis]
-            m2 = pg.transformCoordinates(tr, obj)
-            return m2
+            ## points along the last axis
+            if obj.ndim > 1 and obj.shape[-1] not in (2, 3) and obj.shape[0] in (2, 3):
+                raise TypeError("Cannot map array of shape %s; arrays must have one point per row, "
+                                "with shape (..., 2) or (..., 3)." % str(obj.shape))
+            if matrix is None:
+                matrix = pg.transformToArray(tr)
+            return mapPoints(matrix, obj)
         else:
             raise Exception('Cannot map--object of type %s ' % str(type(obj))) 
     
@@ -308,6 +355,25 @@ class OptomechDevice(object):
         #import traceback
         #traceback.print_stack()
         
+        self.__emitTransformChanged()
+
+    def __emitTransformChanged(self):
+        ## Changes made from the thread that owns this device are announced immediately.
+        ## Changes from other threads (eg. stage position updates) are delivered through the 
+        ## owning thread's event loop; any further changes made before then are covered by
+        ## the same signal rather than queueing one signal (and recomputation) per change.
+        if QtCore.QThread.currentThread() == self.__sigProxy.thread():
+            self.sigTransformChanged.emit(self)
+            return
+        with self.__lock:
+            if self.__transformChangePending:
+                return
+            self.__transformChangePending = True
+        self.__sigProxy.sigTransformChangeQueued.emit()
+        
+    def __flushTransformChanged(self):
+        with self.__lock:
+            self.__transformChangePending = False
         self.sigTransformChanged.emit(self)
 
     def globalTransform(self, subdev=None):
@@ -319,57 +385,94 @@ class OptomechDevice(object):
         If *subdev* is given, it must be a dictionary of {deviceName: subdevice} or
         {deviceName: subdeviceName} pairs specifying the state to compute.
         """
-        if subdev is None:
-            subdev = {}
-            
-        with self.__lock:
-            #dev = self.getSubdevice(subdev)
-            if subdev is None: ## return cached transform
-                if self.__globalTransform == 0:
-                    self.__globalTransform = self.__computeGlobalTransform()
-                return QtGui.QMatrix4x4(self.__globalTransform)
-            else:
-                return self.__computeGlobalTransform(subdev)
-                
-    def __computeGlobalTransform(self, subdev=None, inverse=False):
-        ## subdev must be a dict
-        with self.__lock:
-            devices = self.parentDevices()
-            transform = pg.SRTTransform3D()
-            for d in devices:
-                tr = d.deviceTransform(subdev)
-                if tr is None:
-                    self.__globalTransform = None
-                    return None
-                transform = tr * transform
-                
-        if inverse:
-            inv, invertible = transform.inverted()
-            if not invertible:
-                raise Exception("Transform is not invertible.")
-            return inv
-        else:
-            return transform
+        tr = self.__cachedGlobalTransform(subdev)
+        if tr is None:
+            return None
+        return QtGui.QMatrix4x4(tr[0])
         
     def inverseGlobalTransform(self, subdev=None):
         """
         See globalTransform; this method returns the inverse.
         """
+        tr = self.__cachedGlobalTransform(subdev, inverse=True)
+        if tr is None:
+            return None
+        return QtGui.QMatrix4x4(tr[0])
+    
+    def globalTransformMatrix(self, subdev=None):
+        """
+        Return the global transform as a read-only 4x4 ndarray, or None if the 
+        transform is non-affine. This is suitable for mapping large arrays of points
+        (see mapPoints()).
+        """
+        tr = self.__cachedGlobalTransform(subdev)
+        return None if tr is None else tr[1]
+        
+    def inverseGlobalTransformMatrix(self, subdev=None):
+        """
+        See globalTransformMatrix; this method returns the inverse.
+        """
+        tr = self.__cachedGlobalTransform(subdev, inverse=True)
+        return None if tr is None else tr[1]
+        
+    def transformVersion(self):
+        """
+        Return a number that is incremented every time the transform of this device 
+        (including its current subdevice) changes.
+        """
+        return self.__transformVersion
+        
+    def __cachedGlobalTransform(self, subdev=None, inverse=False):
+        ## Return (QMatrix4x4, ndarray) for the global transform (or its inverse), or None if
+        ## the transform is non-affine. Results are reused until the transform version of 
+        ## this device or any of its parents changes.
+        devices = self.parentDevices()
+        versions = tuple([d.transformVersion() for d in devices])
+        key = (self.__subdevKey(subdev), inverse)
         with self.__lock:
-            #dev = self.getSubdevice(subdev)
-            if subdev is None: ## return cached transform
-                if self.__inverseGlobalTransform == 0:
-                    tr = self.globalTransform()
-                    if tr is None:
-                        self.__inverseGlobalTransform = None
-                    else:
-                        inv, invertible = tr.inverted()
-                        if not invertible:
-                            raise Exception("Transform is not invertible.")
-                        self.__inverseGlobalTransform = inv
-                return QtGui.QMatrix4x4(self.__inverseGlobalTransform)
+            cached = self.__globalCache.get(key, None)
+            if cached is not None and cached[0] == versions:
+                return cached[1]
+            
+            if inverse:
+                fwd = self.__cachedGlobalTransform(subdev)
+                if fwd is None:
+                    tr = None
+                else:
+                    tr, invertible = fwd[0].inverted()
+                    if not invertible:
+                        raise Exception("Transform is not invertible.")
             else:
-                return self.__computeGlobalTransform(subdev, inverse=True)
+                tr = self.__computeGlobalTransform(devices, subdev)
+                
+            if tr is None:
+                result = None
+            else:
+                matrix = pg.transformToArray(tr)
+                matrix.flags.writeable = False
+                result = (tr, matrix)
+            self.__globalCache[key] = (versions, result)
+            return result
+                
+    def __computeGlobalTransform(self, devices, subdev=None):
+        if subdev is None:
+            subdev = {}
+        transform = pg.SRTTransform3D()
+        for d in devices:
+            tr = d.deviceTransform(subdev)
+            if tr is None:
+                return None
+            transform = tr * transform
+        return transform
+        
+    @staticmethod
+    def __subdevKey(subdev):
+        ## hashable version of a subdevice state dict
+        if not subdev:
+            return None
+        if not isinstance(subdev, dict):
+            return subdev if isinstance(subdev, basestring) else subdev.name()
+        return tuple(sorted([(k, v if v is None or isinstance(v, basestring) else v.name()) for k, v in subdev.items()]))
     
     def __emitGlobalTransformChanged(self):
         self.sigGlobalTransformChanged.emit(self, self)
@@ -421,8 +524,8 @@ class OptomechDevice(object):
     def invalidateCachedTransforms(self):
         with self.__lock:
             self.__inverseTransform = 0
-            self.__globalTransform = 0
-            self.__inverseGlobalTransform = 0
+            self.__transformVersion += 1
+            self.__globalCache.clear()
 
             
     def addSubdevice(self, subdev):
@@ -492,7 +595,7 @@ class OptomechDevice(object):
                 dev = self.getSubdevice(dev)
                 self.__subdevice = dev
         self.sigSubdeviceChanged.emit(self, dev, oldDev)
-        self.sigTransformChanged.emit(self)
+        self.__emitTransformChanged()
         
     def treeSubdeviceState(self):
         """return a dict of {devName: subdevName} pairs indicating the currently
@@ -522,7 +625,7 @@ class OptomechDevice(object):
         #print "Subdevice transform changed", self, subdev
         #print "   -> emit sigSubdeviceTransformChanged"
         self.invalidateCachedTransforms()
-        self.sigTransformChanged.emit(self)
+        self.__emitTransformChanged()
         self.sigSubdeviceTransformChanged.emit(self, subdev)
         
     def getDeviceStateKey(self):
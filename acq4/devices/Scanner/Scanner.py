@@ -3,7 +3,7 @@ import os, pickle
 import numpy as np
 import acq4.pyqtgraph as pg
 from acq4.devices.Device import *
-from acq4.devices.OptomechDevice import OptomechDevice
+from acq4.devices.OptomechDevice import OptomechDevice, mapPoints
 from acq4.Manager import logMsg, logExc
 from acq4.util.Mutex import Mutex
 from acq4.util.debug import *
@@ -14,6 +14,26 @@ from .DeviceGui import ScannerDeviceGui
 from .TaskGui import ScannerTaskGui
 from .scan_program import ScanProgram 
 
+
+def applyCalibration(params, pos):
+    """Map positions in the scanner's parent coordinate system to mirror voltages.
+    
+    *params* is the (2, 5) array of calibration coefficients (see Scanner.getCalibration);
+    each output voltage is c0 + c1*x + c2*y + c3*x**2 + c4*y**2.
+    *pos* is an array of shape (..., 2). Returns an array of voltages with the same shape.
+    """
+    pos = np.asarray(pos, dtype=float)
+    x = pos[..., 0]
+    y = pos[..., 1]
+    basis = np.empty(pos.shape[:-1] + (5,))
+    basis[..., 0] = 1
+    basis[..., 1] = x
+    basis[..., 2] = y
+    np.multiply(x, x, out=basis[..., 3])
+    np.multiply(y, y, out=basis[..., 4])
+    return np.dot(basis, params.T)
+
+
 class Scanner(Device, OptomechDevice):
     
     sigShutterChanged = QtCore.Signal()
@@ -27,6 +47,7 @@ class Scanner(Device, OptomechDevice):
         self.devGui = None
         self.lastRunTime = None
         self.calibrationIndex = None
+        self.calibrationCache = {}  ## {(laser, opticState): calibration coefficient array}
         self.targetList = [1.0, {}]  ## stores the grids and points used by TaskGui so that they persist
         self.currentCommand = [0,0] ## The last requested voltage values (but not necessarily the current voltage applied to the mirrors)
         self.currentVoltage = [0, 0]
@@ -136,37 +157,64 @@ class Scanner(Device, OptomechDevice):
         """Convert global coordinates to voltages required to set scan mirrors
         *laser* and *opticState* are used to look up the correct calibration data.
         If *opticState* is not given, then the current optical state is used instead.
+        
+        *x* and *y* may be scalars or arrays of the same shape; returns [xVoltage, yVoltage].
+        To map many points, mapArrayToScanner is preferred.
+        """
+        x = np.asarray(x, dtype=float)
+        pos = np.empty(x.shape + (2,))
+        pos[..., 0] = x
+        pos[..., 1] = y
+        v = self.mapArrayToScanner(pos, laser, opticState)
+        if v.ndim == 1:
+            return [float(v[0]), float(v[1])]
+        return [v[..., 0], v[..., 1]]
+        
+    def mapArrayToScanner(self, pos, laser, opticState=None):
+        """Convert an array of global positions with shape (..., 2) to an array of 
+        mirror voltages with the same shape. See mapToScanner.
         """
         if opticState is None:
             opticState = self.getDeviceStateKey() ## this tells us about objectives, filters, etc
-        cal = self.getCalibration(laser, opticState)
+        params = self.getCalibrationParams(laser, opticState)
         
-        if cal is None:
-            raise HelpfulException("The scanner device '%s' is not calibrated for this combination of laser and objective (%s, %s)" % (self.name(), laser, str(opticState)))
-            
-        ## map from global coordinates to parent
-        parentPos = self.mapGlobalToParent((x,y))
-        if isinstance(parentPos, QtCore.QPointF):
-            x = parentPos.x()
-            y = parentPos.y()
-        else:
-            x = parentPos[0]
-            y = parentPos[1]
+        ## map from global coordinates to parent (through the parent's cached inverse transform)
+        pos = np.asarray(pos, dtype=float)
+        parent = self.parentDevice()
+        if parent is not None:
+            tr = parent.inverseGlobalTransformMatrix()
+            if tr is None:
+                pos = self.mapGlobalToParent(pos)
+            else:
+                pos = mapPoints(tr, pos)
             
         ## map to voltages using calibration
-        cal = cal['params']
-        x2 = x**2
-        y2 = y**2
-        x1 = cal[0][0] + cal[0][1] * x + cal[0][2] * y + cal[0][3] * x2 + cal[0][4] * y2
-        y1 = cal[1][0] + cal[1][1] * x + cal[1][2] * y + cal[1][3] * x2 + cal[1][4] * y2
-        #print "voltage:", x1, y1
-        return [x1, y1]
+        return applyCalibration(params, pos)
+        
+    def getCalibrationParams(self, laser, opticState=None):
+        """Return the (2, 5) array of calibration coefficients used by mapToScanner.
+        Coefficients are cached until the calibration index is rewritten.
+        """
+        if opticState is None:
+            opticState = self.getDeviceStateKey()
+        key = (laser, opticState)
+        with self.lock:
+            params = self.calibrationCache.get(key, None)
+            if params is None:
+                cal = self.getCalibration(laser, opticState)
+                if cal is None:
+                    raise HelpfulException("The scanner device '%s' is not calibrated for this combination of laser and objective (%s, %s)" % (self.name(), laser, str(opticState)))
+                params = np.array(cal['params'], dtype=float)
+                params.flags.writeable = False
+                self.calibrationCache[key] = params
+            return params
         
     def getCalibrationIndex(self):
         with self.lock:
             if self.calibrationIndex is None:
                 index = self.readConfigFile('index')
                 self.calibrationIndex = index
+                self.calibrationCache = {}
             return self.calibrationIndex
         
     def writeCalibrationDefaults(self, state):
@@ -182,6 +230,7 @@ class Scanner(Device, OptomechDevice):
         with self.lock:
             self.writeConfigFile(index, 'index')
             self.calibrationIndex = index
+            self.calibrationCache = {}
 
     def getCalibration(self, laser, opticState=None):
         with self.lock:
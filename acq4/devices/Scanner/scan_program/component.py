@@ -69,9 +69,18 @@ class ScanProgramComponent(object):
     def mapToScanner(self, x, y):
         """Map from global coordinates to scan mirror voltages, using the
         ScanProgram to provide the mapping.
+        
+        *x* and *y* should be arrays containing all points in the component
+        so that the calibration is looked up and applied only once.
         """
         return self.program().scanner.mapToScanner(x, y, self.laser.name())
 
+    def mapArrayToScanner(self, pos):
+        """Map an array of global positions with shape (..., 2) to an array of
+        scan mirror voltages with the same shape.
+        """
+        return self.program().scanner.mapArrayToScanner(pos, self.laser.name())
+
     def generateVoltageArray(self, array):
         """Generate mirror voltages for this scan component and store inside
         *array*. Returns the start and stop indexes used by this component.
@@ -55,8 +55,7 @@ class LineScanComponent(ScanProgramComponent):
         sweepSpeed = 1000 * cmd['sweepSpeed'] # in m/msec
         interSweepSpeed = 1000 * cmd['interSweepSpeed']
         ScanFlag = False
-        xp = np.array([])
-        yp = np.array([])
+        segments = []
         pockels = np.array([])
         nSegmentScans = 0
         nIntersegmentScans = 0
@@ -81,11 +80,14 @@ class LineScanComponent(ScanProgramComponent):
                 pockels = np.append(pockels, np.zeros(interSweepPoints))
                 nIntersegmentScans += 1
                 scanPointList.append(interSweepPoints)
-            x, y = dev.mapToScanner(xPos, yPos, cmd['laser'])
-            xp = np.append(xp, x)
-            yp = np.append(yp, y)
+            segments.append(np.column_stack([xPos, yPos]))
             interScanFlag = not interScanFlag
             
+        ## map the whole path to mirror voltages at once
+        volts = self.program().scanner.mapArrayToScanner(np.concatenate(segments), cmd['laser'])
+        xp = volts[:, 0]
+        yp = volts[:, 1]
+            
         cmd['nSegmentScans'] = nSegmentScans
         cmd['nIntersegmentScans'] = nIntersegmentScans
         cmd['scanPointList'] = scanPointList
@@ -0,0 +1,103 @@
+import threading
+import pytest
+import numpy as np
+import acq4.pyqtgraph as pg
+from acq4.pyqtgraph.Qt import QtGui
+from acq4.devices.OptomechDevice import OptomechDevice
+
+app = pg.mkQApp()
+
+
+def makeTree():
+    ## stage -> scope -> camera, as in a typical rig
+    stage = OptomechDevice(None, {'transform': {'pos': (1e-3, 2e-3, 0)}}, 'Stage')
+    scope = OptomechDevice(None, {'transform': {'scale': (0.5, 0.5, 1), 'angle': 30}}, 'Scope')
+    scope.setParentDevice(stage)
+    cam = OptomechDevice(None, {'transform': {'pos': (-5e-6, 3e-6, 1e-6), 'scale': (2e-6, -2e-6, 1)}}, 'Camera')
+    cam.setParentDevice(scope)
+    return stage, scope, cam
+
+
+def uncachedToGlobal(dev, pts):
+    ## compose the device transforms from scratch and map one point at a time
+    tr = QtGui.QMatrix4x4()
+    for d in dev.parentDevices():
+        tr = d.deviceTransform() * tr
+    out = []
+    for p in pts:
+        v = tr.map(QtGui.QVector3D(*p))
+        out.append([v.x(), v.y(), v.z()])
+    return np.array(out)
+
+
+def checkMapping(dev, pts):
+    expected = uncachedToGlobal(dev, pts)
+    assert np.allclose(dev.mapToGlobal(pts), expected, rtol=0, atol=1e-12)
+    assert np.allclose(dev.mapToGlobal(tuple(pts[0])), expected[0], rtol=0, atol=1e-12)
+    assert np.allclose(dev.mapFromGlobal(expected), pts, rtol=0, atol=1e-9)
+
+
+def test_cachedTransforms():
+    stage, scope, cam = makeTree()
+    pts = np.random.RandomState(0).uniform(-100, 100, size=(20, 3))
+    checkMapping(cam, pts)
+    checkMapping(scope, pts)
+
+    ## parent change invalidates children; child change leaves parents alone
+    stage.setDeviceTransform({'pos': (3e-3, -1e-3, 5e-4)})
+    checkMapping(cam, pts)
+    cam.setDeviceTransform({'pos': (1e-6, 1e-6, 0), 'scale': (4e-6, -4e-6, 1), 'angle': 10})
+    checkMapping(cam, pts)
+    checkMapping(scope, pts)
+    scope.setDeviceTransform({'scale': (0.1, 0.1, 1)})
+    checkMapping(cam, pts)
+
+    ## repeated calls reuse the cached matrix until something changes
+    m1 = cam.globalTransformMatrix()
+    assert cam.globalTransformMatrix() is m1
+    stage.setDeviceTransform({'pos': (0, 0, 0)})
+    assert cam.globalTransformMatrix() is not m1
+
+
+def test_transformChangedSignals():
+    stage, scope, cam = makeTree()
+    counts = {'stage': 0, 'cam': 0}
+    def stageChanged(dev):
+        counts['stage'] += 1
+    def camChanged(dev, changed):
+        counts['cam'] += 1
+    stage.sigTransformChanged.connect(stageChanged)
+    cam.sigGlobalTransformChanged.connect(camChanged)
+
+    ## changes from the owning thread are announced once each, immediately
+    for i in range(3):
+        stage.setDeviceTransform({'pos': (i * 1e-3, 0, 0)})
+    assert counts == {'stage': 3, 'cam': 3}
+
+    ## changes from another thread are coalesced into one queued signal
+    def move():
+        for i in range(50):
+            stage.setDeviceTransform({'pos': (i * 1e-4, 1e-3, 0)})
+    th = threading.Thread(target=move)
+    th.start()
+    th.join()
+    assert counts == {'stage': 3, 'cam': 3}
+    app.processEvents()
+    assert counts == {'stage': 4, 'cam': 4}
+    checkMapping(cam, np.array([[1., 2., 3.]]))
+    app.processEvents()
+    assert counts == {'stage': 4, 'cam': 4}
+
+
+def test_pointArrayLayout():
+    stage, scope, cam = makeTree()
+    pts = np.random.RandomState(1).uniform(-100, 100, size=(5, 3))
+    expected = uncachedToGlobal(cam, pts)
+
+    ## a tuple of coordinate arrays is mapped with the coordinate axis first
+    xyz = cam.mapToGlobal(tuple(pts.T))
+    assert np.allclose(xyz, expected.T, rtol=0, atol=1e-12)
+
+    ## coordinate-first arrays are rejected rather than misread
+    with pytest.raises(TypeError):
+        cam.mapToGlobal(pts.T)
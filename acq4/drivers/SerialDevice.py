@@ -1,6 +1,8 @@
-import serial, time, sys
+import serial, time, sys, threading, collections
 import logging
 
+logger = logging.getLogger(__name__)
+
 class TimeoutError(Exception):
     """Raised when a serial communication times out.
 
@@ -24,12 +26,175 @@ class DataError(Exception):
         Exception.__init__(self, msg)
 
 
+class RingBuffer(object):
+    """FIFO byte buffer used to collect data arriving from a serial port.
+
+    Data is stored in a fixed-size bytearray that wraps around; the storage is
+    only reallocated (doubled) if more than *size* bytes are waiting to be read.
+    This class is not thread-safe; SerialDevice guards it with its own lock.
+    """
+    def __init__(self, size=65536):
+        self._buf = bytearray(size)
+        self._start = 0  # index of first unread byte
+        self._len = 0    # number of unread bytes
+
+    def __len__(self):
+        return self._len
+
+    def write(self, data):
+        """Append *data* to the end of the buffer."""
+        n = len(data)
+        size = len(self._buf)
+        if self._len + n > size:
+            self._resize(self._len + n)
+            size = len(self._buf)
+        end = (self._start + self._len) % size
+        first = min(n, size - end)
+        self._buf[end:end+first] = data[:first]
+        if first < n:
+            self._buf[:n-first] = data[first:]
+        self._len += n
+
+    def peek(self, n=None):
+        """Return (without removing) the first *n* bytes in the buffer, or all bytes if *n* is None."""
+        n = self._len if n is None else min(n, self._len)
+        end = self._start + n
+        size = len(self._buf)
+        if end <= size:
+            return bytes(self._buf[self._start:end])
+        return bytes(self._buf[self._start:] + self._buf[:end-size])
+
+    def consume(self, n=None):
+        """Remove and return the first *n* bytes in the buffer, or all bytes if *n* is None."""
+        data = self.peek(n)
+        self._len -= len(data)
+        self._start = 0 if self._len == 0 else (self._start + len(data)) % len(self._buf)
+        return data
+
+    def find(self, sub, start=0):
+        """Return the index of the first occurrence of *sub* at or after *start*, 
+        or -1 if it is not found. Indexes are relative to the first unread byte.
+        """
+        if self._start + self._len > len(self._buf):
+            # data wraps around the end of the storage; straighten it out once
+            self._resize(len(self._buf))
+        i = self._buf.find(sub, self._start + start, self._start + self._len)
+        return i if i < 0 else i - self._start
+
+    def _resize(self, minSize):
+        size = len(self._buf)
+        while size < minSize:
+            size *= 2
+        data = self.peek()
+        self._buf = bytearray(size)
+        self._buf[:len(data)] = data
+        self._start = 0
+
+
+class SerialFuture(object):
+    """Represents a packet that has been requested from a SerialDevice but 
+    may not have been received yet. See SerialDevice.request().
+
+    Exactly one of *length* or *term* must be given:
+
+    * If *length* is given, the packet is complete after *length* bytes. If *term*
+      is also given, then the packet must end with *term* (otherwise DataError is
+      raised) and the result excludes *term*.
+    * If only *term* is given, the packet is complete when *term* is received
+      after at least *minBytes* bytes, and the result includes *term*.
+    """
+    def __init__(self, dev, length=None, term=None, minBytes=0, startTime=None):
+        if length is None and term is None:
+            raise ValueError("Must specify either length or term.")
+        self.dev = dev
+        self.length = length
+        self.term = term
+        self.minBytes = minBytes
+        self.startTime = time.time() if startTime is None else startTime
+        self.finishTime = None
+        self.deadline = None
+        self._scanned = 0  # number of bytes already searched for term
+        self._result = None
+        self._exc = None
+        self._done = threading.Event()
+
+    def isDone(self):
+        """Return True if the packet has been received or the request has failed."""
+        return self._done.is_set()
+
+    def result(self, timeout=5):
+        """Wait for the packet to arrive and return it.
+
+        If the packet has not arrived after *timeout* seconds, the request is
+        cancelled and TimeoutError is raised with any partial packet data. 
+        Errors encountered while reading the packet are re-raised here.
+        """
+        if timeout is not None and not self.isDone():
+            # Timeouts are enforced by the reader thread; on python 2, waiting on an
+            # Event with a timeout polls and adds ~1 ms to every read.
+            self.dev._setReadDeadline(self, time.time() + timeout)
+        self._done.wait()
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+    def latency(self):
+        """Return the time elapsed between the request and the arrival of its 
+        packet, or None if the packet has not been received.
+        """
+        if self.finishTime is None or self._exc is not None:
+            return None
+        return self.finishTime - self.startTime
+
+    def _match(self, buf):
+        """Check whether the packet is available in *buf*. If so, remove it from
+        the buffer, finish this future, and return True.
+        """
+        if self.length is not None:
+            if len(buf) < self.length:
+                return False
+            packet = buf.consume(self.length)
+            if self.term is not None:
+                if packet[-len(self.term):] != self.term:
+                    self._finish(exc=DataError("Packet corrupt: %s (len=%d)" % (repr(packet), len(packet)), packet, ''))
+                    return True
+                packet = packet[:-len(self.term)]
+            self._finish(result=packet)
+            return True
+        else:
+            # packet must end after minBytes, so term may not end earlier than minBytes+1
+            start = max(0, self.minBytes + 1 - len(self.term), self._scanned - len(self.term) + 1)
+            i = buf.find(self.term, start)
+            if i < 0:
+                self._scanned = len(buf)
+                return False
+            self._finish(result=buf.consume(i + len(self.term)))
+            return True
+
+    def _finish(self, result=None, exc=None):
+        self.finishTime = time.time()
+        self._result = result
+        self._exc = exc
+        self._done.set()
+
+
 class SerialDevice(object):
     """
     Class used for standardizing access to serial devices. 
 
     Provides some commonly used functions for reading and writing 
     serial packets.
+
+    By default, a background thread reads all incoming data into a buffer
+    as soon as it arrives; read() and readUntil() then wait for complete packets
+    to appear in the buffer rather than polling the serial port. Commands may also 
+    be pipelined using request(), which returns a SerialFuture immediately::
+
+        futs = [dev.request('c\r', length=13, term='\r') for i in range(3)]
+        packets = [f.result() for f in futs]
+
+    Replies are matched to requests in the order the requests were made, so this
+    only works for devices that reply to every command in order.
     """
     def __init__(self, **kwds):
         """
@@ -38,8 +203,18 @@ class SerialDevice(object):
 
         If both 'port' and 'baudrate' are provided here, then 
         self.open() is called automatically.
+
+        If *bufferedRead* is False, then no reader thread is started and reads 
+        poll the serial port directly.
         """
         self.serial = None
+        self._bufferedRead = kwds.pop('bufferedRead', True)
+        self._readThread = None
+        self._readLock = threading.RLock()
+        self._readBuffer = RingBuffer()
+        self._pendingReads = collections.deque()
+        self._lastWriteTime = None
+        self._latency = collections.deque(maxlen=1000)
         self.__serialOpts = {
             'bytesize': serial.EIGHTBITS, 
             'timeout': 0, # no timeout. See SerialDevice._readWithTimeout()
@@ -78,28 +253,60 @@ class SerialDevice(object):
             'baudrate': baudrate,
             })
         self.__serialOpts.update(kwds)
-        self.serial = serial.Serial(**self.__serialOpts)
-        logging.info('Opened serial port: %s', self.__serialOpts)
+        opts = self.__serialOpts.copy()
+        if self._bufferedRead:
+            # The reader thread blocks in read(); the timeout only determines how 
+            # quickly it notices that the port is being closed.
+            opts['timeout'] = SerialReadThread.pollInterval
+        self.serial = serial.Serial(**opts)
+        logger.info('Opened serial port: %s', self.__serialOpts)
+        if self._bufferedRead:
+            self._readThread = SerialReadThread(self)
+            self._readThread.start()
 
     def close(self):
         """Close the serial port."""
+        if self._readThread is not None:
+            self._readThread.stop()
+            self._readThread = None
         self.serial.close()
         self.serial = None
-        logging.info('Closed serial port: %s', self.__serialOpts['port'])
+        self._failPendingReads(IOError("Serial port %s was closed." % self.__serialOpts['port']))
+        logger.info('Closed serial port: %s', self.__serialOpts['port'])
 
     def readAll(self):
         """Read all bytes waiting in buffer; non-blocking."""
-        n = self.serial.inWaiting()
-        if n > 0:
-            d = self.serial.read(n)
-            logging.info('Serial port %s readAll: %r', self.__serialOpts['port'], d)
-            return d
-        return ''
+        if self._bufferedRead:
+            with self._readLock:
+                d = self._readBuffer.consume()
+        else:
+            n = self.serial.inWaiting()
+            d = self.serial.read(n) if n > 0 else ''
+        if len(d) > 0 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Serial port %s readAll: %r', self.__serialOpts['port'], d)
+        return d
     
     def write(self, data):
         """Write *data* to the serial port"""
-        logging.info('Serial port %s write: %r', self.__serialOpts['port'], data)
-        self.serial.write(data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Serial port %s write: %r', self.__serialOpts['port'], data)
+        with self._readLock:
+            self._lastWriteTime = time.time()
+            self.serial.write(data)
+
+    def request(self, data, length=None, term=None, minBytes=0):
+        """Write *data* to the serial port and return a SerialFuture for the reply.
+
+        The reply is described by *length*, *term*, and *minBytes* as for 
+        read() and readUntil() (see SerialFuture). This method does not wait 
+        for the reply, so several requests may be sent before collecting their 
+        results.
+        """
+        if not self._bufferedRead:
+            raise RuntimeError("request() requires bufferedRead=True.")
+        with self._readLock:
+            self.write(data)
+            return self._queueRead(length=length, term=term, minBytes=minBytes)
 
     def read(self, length, timeout=5, term=None):
         """
@@ -109,6 +316,17 @@ class SerialDevice(object):
         return the packet excluding *term*. If the packet is not terminated 
         with *term*, then DataError is raised.
         """
+        if self._bufferedRead:
+            try:
+                packet = self._queueRead(length=length, term=term).result(timeout)
+            except DataError as err:
+                time.sleep(0.01)
+                err.extra += self.readAll()
+                raise
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Serial port %s read: %r', self.__serialOpts['port'], packet)
+            return packet
+
         #self.serial.setTimeout(timeout) #broken!
         packet = self._readWithTimeout(length, timeout)
         if len(packet) < length:
@@ -119,9 +337,9 @@ class SerialDevice(object):
                 extra = self.readAll()
                 err = DataError("Packet corrupt: %s (len=%d)" % (repr(packet), len(packet)), packet, extra)
                 raise err
-            logging.info('Serial port %s read: %r', self.__serialOpts['port'], packet)
-            return packet[:-len(term)]
-        logging.info('Serial port %s read: %r', self.__serialOpts['port'], packet)
+            packet = packet[:-len(term)]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Serial port %s read: %r', self.__serialOpts['port'], packet)
         return packet
         
     def _readWithTimeout(self, nBytes, timeout):
@@ -151,6 +369,9 @@ class SerialDevice(object):
         If *minBytes* is given, then this number of bytes will be read without checking for *term*.
         Returns the entire packet including *term*.
         """
+        if self._bufferedRead:
+            return self._queueRead(term=term, minBytes=minBytes).result(timeout)
+
         start = time.time()
 
         if minBytes > 0:
@@ -167,7 +388,7 @@ class SerialDevice(object):
                 packet += self.read(1, timeout=timeout-elapsed)
             except TimeoutError:
 
-                raise TimeoutError("Timed out while reading serial packet. Data so far: '%s'" % repr(packet))
+                raise TimeoutError("Timed out while reading serial packet. Data so far: '%s'" % repr(packet), packet)
             if len(packet) > minBytes and packet[-len(term):] == term:
 
                 return packet
@@ -181,6 +402,132 @@ class SerialDevice(object):
             print self, "Warning: discarded serial data ", repr(d)
         return d
 
+    def latencyStats(self):
+        """Return statistics on the round-trip time (in seconds) of recently 
+        completed reads, measured from the write() or request() that preceded each read.
+
+        Returns a dict with keys 'count', 'mean', 'min', 'median', 'p95', and 'max'.
+        """
+        with self._readLock:
+            lat = sorted(self._latency)
+        if len(lat) == 0:
+            return {'count': 0}
+        n = len(lat)
+        return {
+            'count': n,
+            'mean': sum(lat) / n,
+            'min': lat[0],
+            'median': lat[n//2],
+            'p95': lat[min(n-1, int(n * 0.95))],
+            'max': lat[-1],
+        }
+
+    def _queueRead(self, length=None, term=None, minBytes=0):
+        with self._readLock:
+            # latency is measured from the most recent write, if it has not 
+            # already been attributed to an earlier read
+            fut = SerialFuture(self, length=length, term=term, minBytes=minBytes, startTime=self._lastWriteTime)
+            self._lastWriteTime = None
+            if self._readThread is None or not self._readThread.is_alive():
+                fut._finish(exc=IOError("Serial port %s is not being read." % self.__serialOpts.get('port')))
+                return fut
+            self._pendingReads.append(fut)
+            self._processReadBuffer()
+        return fut
+
+    def _setReadDeadline(self, fut, deadline):
+        with self._readLock:
+            fut.deadline = deadline
+
+    def _checkReadDeadlines(self):
+        # called periodically by the reader thread
+        with self._readLock:
+            if len(self._pendingReads) == 0:
+                return
+            now = time.time()
+            for fut in list(self._pendingReads):
+                if fut.deadline is not None and fut.deadline < now:
+                    self._cancelRead(fut)
+
+    def _dataReceived(self, data):
+        # called by the reader thread
+        with self._readLock:
+            self._readBuffer.write(data)
+            self._processReadBuffer()
+
+    def _processReadBuffer(self):
+        # finish as many pending reads as possible, in order
+        while len(self._pendingReads) > 0:
+            fut = self._pendingReads[0]
+            if not fut._match(self._readBuffer):
+                break
+            self._pendingReads.popleft()
+            if fut._exc is None:
+                self._latency.append(fut.finishTime - fut.startTime)
+
+    def _cancelRead(self, fut):
+        # called by the reader thread when a SerialFuture times out
+        with self._readLock:
+            if fut.isDone():
+                return
+            if fut is self._pendingReads[0]:
+                # consume the partial packet, as a direct read would have
+                data = self._readBuffer.consume(fut.length)
+            else:
+                data = ''
+            self._pendingReads.remove(fut)
+            if fut.length is not None:
+                msg = "Timed out waiting for serial data (received so far: %s)" % repr(data)
+            else:
+                msg = "Timed out while reading serial packet. Data so far: '%s'" % repr(data)
+            fut._finish(exc=TimeoutError(msg, data))
+            self._processReadBuffer()
+
+    def _failPendingReads(self, exc):
+        with self._readLock:
+            while len(self._pendingReads) > 0:
+                self._pendingReads.popleft()._finish(exc=exc)
+
+
+class SerialReadThread(threading.Thread):
+    """Background thread that moves data from a serial port into its SerialDevice's 
+    read buffer as soon as it arrives.
+    """
+    # how often to check for read timeouts and requests to stop
+    pollInterval = 0.02
+
+    def __init__(self, dev):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dev = dev
+        self.port = dev.serial
+        self._stopEvent = threading.Event()
+
+    def stop(self):
+        self._stopEvent.set()
+        if threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while not self._stopEvent.is_set():
+            try:
+                # blocks until at least one byte arrives (or pollInterval elapses),
+                # then collects everything else that is waiting
+                data = self.port.read(1)
+                if len(data) == 0:
+                    self.dev._checkReadDeadlines()
+                    continue
+                n = self.port.inWaiting()
+                if n > 0:
+                    data += self.port.read(n)
+            except Exception as exc:
+                if not self._stopEvent.is_set():
+                    logger.error('Error reading from serial port %s: %s', self.port.port, exc)
+                    self.dev._failPendingReads(exc)
+                break
+            self.dev._dataReceived(data)
+            self.dev._checkReadDeadlines()
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+"""
+Pseudo-terminal based stand-in for serial hardware. This allows SerialDevice
+subclasses to be tested against a simulated device without any hardware attached.
+Only available on POSIX systems.
+
+Example::
+
+    def respond(cmd):
+        return 'OK\r'
+
+    port = MockSerialPort(respond, term='\r')
+    dev = SerialDevice(port=port.port, baudrate=9600)
+    dev.write('hello\r')
+    print dev.readUntil('\r')   # 'OK\r'
+"""
+import os, time, threading, select, tty
+
+
+class MockSerialPort(object):
+    """Opens a pseudo-terminal and answers data written to it by calling
+    *responder*. The name of the terminal device (to be opened by pyserial) is
+    available as the *port* attribute.
+
+    If *term* is given, incoming data is split into commands ending in *term*, and
+    *responder* is called once per command (including *term*). Otherwise it is
+    called with each chunk of data as it is received. *responder* must return
+    the data to send back, or None. Each reply is delayed by *delay* seconds to
+    simulate the response time of a real device.
+    """
+    def __init__(self, responder, term=None, delay=0):
+        self.responder = responder
+        self.term = term
+        self.delay = delay
+        self.received = []  # list of all commands received
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stopEvent = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, data):
+        """Send unsolicited data to the serial port."""
+        os.write(self._master, data)
+
+    def close(self):
+        self._stopEvent.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _run(self):
+        buf = ''
+        while not self._stopEvent.is_set():
+            r, w, x = select.select([self._master], [], [], 0.05)
+            if len(r) == 0:
+                continue
+            try:
+                buf += os.read(self._master, 4096)
+            except OSError:
+                break
+            if self.term is None:
+                cmds, buf = [buf], ''
+            else:
+                cmds = []
+                while self.term in buf:
+                    i = buf.index(self.term) + len(self.term)
+                    cmds.append(buf[:i])
+                    buf = buf[i:]
+            for cmd in cmds:
+                self.received.append(cmd)
+                reply = self.responder(cmd)
+                if reply is None:
+                    continue
+                if self.delay > 0:
+                    time.sleep(self.delay)
+                self.send(reply)
@@ -0,0 +1,95 @@
+import pytest
+
+serial = pytest.importorskip('serial')
+pytest.importorskip('tty')
+
+from acq4.drivers.SerialDevice import SerialDevice, RingBuffer, TimeoutError, DataError
+from acq4.drivers.mockSerial import MockSerialPort
+
+
+def echoCommand(cmd):
+    # replies 'X' + command for every command except 'silent\r'
+    if cmd == 'silent\r':
+        return None
+    if cmd == 'bad\r':
+        return 'XbadX'
+    return 'X' + cmd
+
+
+@pytest.fixture
+def device():
+    port = MockSerialPort(echoCommand, term='\r', delay=1e-3)
+    dev = SerialDevice(port=port.port, baudrate=9600)
+    yield dev, port
+    dev.close()
+    port.close()
+
+
+def test_ringBuffer():
+    buf = RingBuffer(size=8)
+    buf.write('abcdef')
+    assert buf.consume(4) == 'abcd'
+    buf.write('ghij')  # wraps around the end of storage
+    assert len(buf) == 6
+    assert buf.find('hi') == 3
+    assert buf.find('ef', 1) == -1
+    buf.write('klmnopqr')  # forces resize
+    assert buf.peek() == 'efghijklmnopqr'
+    assert buf.consume() == 'efghijklmnopqr'
+    assert len(buf) == 0
+
+
+def test_read(device):
+    dev, port = device
+    dev.write('abc\r')
+    assert dev.read(5, term='\r') == 'Xabc'
+    dev.write('defg\r')
+    assert dev.readUntil('\r') == 'Xdefg\r'
+    # term is not checked within the first minBytes
+    port.send('\r\rab\r')
+    assert dev.readUntil('\r', minBytes=1) == '\r\r'
+    assert dev.readUntil('\r', minBytes=2) == 'ab\r'
+
+    dev.write('bad\r')
+    with pytest.raises(DataError):
+        dev.read(5, term='\r')
+
+    dev.write('silent\r')
+    with pytest.raises(TimeoutError):
+        dev.read(3, timeout=0.1)
+    assert dev.readAll() == ''
+
+
+def test_timeoutPartial(device):
+    dev, port = device
+    port.send('ab')
+    try:
+        dev.read(4, timeout=0.2)
+        raise AssertionError("read should have timed out")
+    except TimeoutError as err:
+        assert err.data == 'ab'
+
+
+def test_pipeline(device):
+    dev, port = device
+    cmds = ['cmd%d\r' % i for i in range(50)]
+    futs = [dev.request(cmd, term='\r') for cmd in cmds]
+    assert [f.result(timeout=5) for f in futs] == ['X' + cmd for cmd in cmds]
+    assert port.received == cmds
+
+    stats = dev.latencyStats()
+    assert stats['count'] == 50
+    assert 0 < stats['min'] <= stats['median'] <= stats['p95'] <= stats['max']
+
+
+def test_unbuffered():
+    port = MockSerialPort(echoCommand, term='\r')
+    dev = SerialDevice(port=port.port, baudrate=9600, bufferedRead=False)
+    try:
+        dev.write('abc\r')
+        assert dev.read(5, term='\r') == 'Xabc'
+        dev.write('abc\r')
+        assert dev.readUntil('\r') == 'Xabc\r'
+    finally:
+        dev.close()
+        port.close()
@@ -36,9 +36,9 @@ dataTypes = {
     1: 'BINARY',
     2: np.ubyte,
     4: np.short,
-    8: np.int,
+    8: np.int32,
     16: np.float32,
-    32: np.complex,   ## two floats: (re, im)
+    32: np.complex64,   ## two floats: (re, im)
     64: np.float64,
     128: [('R', np.ubyte), ('G', np.ubyte), ('B', np.ubyte)],
     256: 'ALL'
@@ -79,42 +79,62 @@ class Obj(object):
         #return arr.view(cls)
     
 import struct
-def readA75(hdrFile):
+def readA75(hdrFile, applyScaling=True):
     """Read ANALYZE or NiFTI format. 
-      hdrFile: name of header file (.hdr, .ni1, or .nii) to read"""
+      hdrFile: name of header file (.hdr, .ni1, or .nii) to read
+      
+    Image data is memory-mapped, so only the parts of the volume that are actually 
+    accessed are read from disk. Axes are ordered (x, y, z, ...) as in the file.
+    If the NiFTI header specifies a scale factor or intercept and applyScaling 
+    is True, the scaled data must be computed in memory; use applyScaling=False
+    to keep the raw memory-mapped values (scl_slope and scl_inter are still 
+    available in the header info)."""
     
     hdrFH = open(hdrFile, 'rb')
     
     ## determine if this is NiFTI or ANALYZE
     hdrFH.seek(344)
     nii = hdrFH.read(4)
-    
-    hdrFH = open(hdrFile, 'rb')
+    hdrFH.seek(0)
     
     if nii == 'n+1\0':
         print "n+1 format; loading data from", hdrFile
-        return parseNii(hdrFH, hdrFile)
+        return parseNii(hdrFH, hdrFile, applyScaling)
     elif nii == 'ni1\0':
         imgFile = os.path.splitext(hdrFile)[0] + '.img'
         print "ni1 format; loading data from", imgFile
-        return parseNii(hdrFH, imgFile)
+        return parseNii(hdrFH, imgFile, applyScaling)
     else:  ## assume ANALYZE75 format
         imgFile = os.path.splitext(hdrFile)[0] + '.img'
         print "ANALYZE75 format; loading data from", imgFile
         return parseA75(hdrFH, imgFile)
 
 
+def mapImageData(imgFile, dtype, order, shape, offset=0):
+    """Return a read-only memmap of the image data in *imgFile*.
+    Voxels are stored with the first axis varying fastest, hence order='F'."""
+    dtype = np.dtype(dtype)
+    if dtype.fields is None:
+        dtype = dtype.newbyteorder(order)
+    size = dtype.itemsize * int(np.prod(shape))
+    available = os.path.getsize(imgFile) - offset
+    if available < size:
+        raise Exception("Data size is incorrect. Expected %d, got %d" % (size, available))
+    return np.memmap(imgFile, dtype=dtype, mode='r', offset=offset, shape=tuple(shape), order='F')
+
+
 def parseA75(headerFH, imgFile):
-    hdr = headerFH.read(348)
+    header = headerFH.read(348)
+    headerFH.close()
     if len(header) != 348:
         raise Exception("Header is wrong size! (expected 348, got %d" % len(header))
 
     order = getByteOrder(header[:4])
 
     ## break header into substructs
-    hdr_key = struct.unpack(order+'i10s18sihcc', hdr[:40])
-    img_dim = struct.unpack(order+'18h16f2i', hdr[40:148])
-    data_history = struct.unpack(order+'80s24sc10s10s10s10s10s10s3s8i', hdr[148:348])
+    hdr_key = struct.unpack(order+'i10s18sihcc', header[:40])
+    img_dim = struct.unpack(order+'18h16f2i', header[40:148])
+    data_history = struct.unpack(order+'80s24sc10s10s10s10s10s10s3s8i', header[148:348])
     
     ## pull variables from substructs
     (sizeof_hdr, data_type, db_name, extents, session_error, regular, hkey_un0) = hdr_key
@@ -124,24 +144,22 @@ def parseA75(headerFH, imgFile):
     (cal_max, cal_min, compressed, verified, glmax, glmin) = img_dim[30:]
     dim = img_dim[:8]
     (datatype, bitpix, dim_un0) = img_dim[15:18]
-    #pixdim = img_dim[18:26]
-    #vox_offset = img_dim[26]
-    
-    #print "dims:", dim
-    #print "depth:", bitpix
-    #print "type:", datatype
+    pixdim = img_dim[18:26]
+    vox_offset = int(img_dim[26])
     
-    ## read data
-    fh = open(imgFile, 'rb')
-    data = fh.read()
-    fh.close()
-    data = np.fromstring(data, dtype=dataTypes[datatype])
-    data.shape = dim[1:dim[0]]
+    dtype = dataTypes[datatype]
+    if dtype is None or isinstance(dtype, basestring):
+        raise Exception("Data type not supported: %s" % dtype)
     
-    return data
+    ## map image data
+    data = mapImageData(imgFile, dtype, order, dim[1:dim[0]+1], vox_offset)
+    info = [{} for i in range(dim[0])]
+    info.append({'dim': dim, 'datatype': datatype, 'bitpix': bitpix, 'pixdim': pixdim, 
+                 'cal_max': cal_max, 'cal_min': cal_min, 'glmax': glmax, 'glmin': glmin})
+    return MetaArray(data, info=info)
     
 
-def parseNii(headerFH, imgFile):
+def parseNii(headerFH, imgFile, applyScaling=True):
     m = Obj()
     
     ## see nifti1.h
@@ -211,48 +229,22 @@ def parseNii(headerFH, imgFile):
     
     ## do a little parsing
     shape = m.dim[1:m.dim[0]+1]
-    size = (m.bitpix / 8) * reduce(lambda a,b: a*b, shape)
     dtype = niiDataTypes[m.datatype]
-    if isinstance(dtype, basestring):
+    if dtype is None or isinstance(dtype, basestring):
         raise Exception("Data type not supported: %s"% dtype)
-    #print "Dimensions:", dim[0]
-    #print "Data shape:", shape
-    #print "Data type: %s  (%dbpp)" % (str(dtype), bitpix)
-    
-    ## read image data. Anything more than 200MB, use memmap.
-    if size < 200e6:
-        if m.magic == 'n+1\0':  ## data is in the same file as the header
-            m.vox_offset = max(352, m.vox_offset)
-            headerFH.seek(int(m.vox_offset))
-            data = headerFH.read(size)
-        elif m.magic == 'nii\0':               ## data is in a separate .img file
-            imgFile = os.path.splitext(hdrFile)[0] + '.img'
-            fh = open(imgFile, 'rb')
-            fh.seek(m.vox_offset)
-            data = fh.read(size)
-        headerFH.close()
-        
-        if len(data) != size:
-            raise Exception("Data size is incorrect. Expected %d, got %d" % (size, len(data)))
-            
-        data = np.fromstring(data, dtype=dtype)
-        data.shape = m.dim[1:m.dim[0]+1]
-    else:
-        #print "Large file; loading by memmap"
-        if m.magic == 'n+1\0':  ## data is in the same file as the header
-            m.vox_offset = max(352, m.vox_offset)
-            fh = headerFH
-        elif m.magic == 'nii\0':               ## data is in a separate .img file
-            imgFile = os.path.splitext(hdrFile)[0] + '.img'
-            fh = open(imgFile, 'rb')
-            headerFH.close()
-        data = np.memmap(fh, offset=m.vox_offset, dtype=dtype, shape=shape, mode='r')
+    
+    ## map image data
+    if m.magic == 'n+1\0':  ## data is in the same file as the header
+        m.vox_offset = max(352, m.vox_offset)
+    headerName = headerFH.name
+    headerFH.close()
+    data = mapImageData(imgFile, dtype, order, shape, m.vox_offset)
     
     ## apply scaling
     if m.scl_slope == 0.0:
         m.scl_slope = 1.0
     
-    if (m.scl_slope != 1.0 or m.scl_inter != 0.0) and m.datatype != 128: ## scaling not allowed for RGB24
+    if applyScaling and (m.scl_slope != 1.0 or m.scl_inter != 0.0) and m.datatype != 128: ## scaling not allowed for RGB24
         #print "Applying scale and offset"
         data = (data.astype(np.float32) * m.scl_slope) + m.scl_inter
 
@@ -273,7 +265,7 @@ def parseNii(headerFH, imgFile):
             info[i]['values'] = np.linspace(offset, offset + width, m.dim[i+1])
     
     if m.sform_code > 0:  ## coordinate method 3
-        print "Warning: This data (%s) has an unsupported affine transform." % headerFH.name
+        print "Warning: This data (%s) has an unsupported affine transform." % headerName
         #print "affine transform:"
         #print srow_x
         #print srow_y
@@ -325,26 +317,177 @@ def getByteOrder(hLen):
             raise Exception('Header length must be 348 (got %d (LE) or %d (BE))' % (hLen1, hLen2))
     return order
     
-def shortToByte(data, dMin=None, dMax=None):
-    if dMax is None:
-        dMax = data.max()
-    if dMin is None:
-        dMin = data.min()
-    lut = np.empty(2**16, dtype=np.ubyte)
-    diff = (dMax-dMin)/256.
-    for i in range(256):
-        lut[int(diff*i):int(diff*(i+1))] = i
-    lut[diff*255:] = 255
+class MappedArray(object):
+    """Read-only, array-like view that applies an elementwise function *func* to 
+    *data* only when it is indexed. Nothing is computed until the data is accessed,
+    and then only for the requested region."""
+    def __init__(self, data, func, dtype):
+        self.data = data
+        self.func = func
+        self.dtype = np.dtype(dtype)
+        
+    @property
+    def shape(self):
+        return self.data.shape
+    
+    @property
+    def ndim(self):
+        return len(self.shape)
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __getitem__(self, index):
+        return np.asarray(self.func(np.asarray(self.data[index])), dtype=self.dtype)
+    
+    def __array__(self, dtype=None):
+        return self[...] if dtype is None else self[...].astype(dtype)
+    
+    def asarray(self):
+        return self[...]
+    
+    
+class StackedArray(object):
+    """Read-only, array-like view of equally-shaped arrays stacked along a new last 
+    axis, as np.concatenate([a[..., np.newaxis] for a in arrays], axis=-1) would give.
+    Arrays are only read when the stack is indexed."""
+    def __init__(self, arrays):
+        self.arrays = list(arrays)
+        for a in self.arrays[1:]:
+            if a.shape != self.arrays[0].shape:
+                raise Exception("Cannot stack arrays with different shapes (%s, %s)" % (self.arrays[0].shape, a.shape))
+        self.dtype = np.dtype(self.arrays[0].dtype)
+        
+    @property
+    def shape(self):
+        return tuple(self.arrays[0].shape) + (len(self.arrays),)
+    
+    @property
+    def ndim(self):
+        return len(self.shape)
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if any([j is Ellipsis for j in index]):
+            ell = [j is Ellipsis for j in index].index(True)
+            index = index[:ell] + (slice(None),) * (self.ndim - len(index) + 1) + index[ell+1:]
+        index = index + (slice(None),) * (self.ndim - len(index))
+        simple = len(index) == self.ndim and all([isinstance(j, (int, long, np.integer, slice)) for j in index])
+        if not simple:
+            ## fancy indexing; read everything
+            return self[...][index]
+        inner = index[:-1]
+        last = index[-1]
+        if isinstance(last, slice):
+            parts = [np.asarray(self.arrays[i][inner])[..., np.newaxis] for i in range(*last.indices(len(self.arrays)))]
+            if len(parts) == 0:
+                return np.empty(np.empty(self.shape[:-1], dtype=bool)[inner].shape + (0,), dtype=self.dtype)
+            return np.concatenate(parts, axis=-1)
+        return np.asarray(self.arrays[last][inner])
+    
+    def __array__(self, dtype=None):
+        return self[...] if dtype is None else self[...].astype(dtype)
+    
+    def asarray(self):
+        return self[...]
+    
+
+def dataRange(data, chunkSize=2**24):
+    """Return (min, max) of *data*, reading one block of the first axis at a time."""
+    n = max(1, chunkSize // max(1, int(np.prod(data.shape[1:]))))
+    mn = None
+    mx = None
+    for i in range(0, data.shape[0], n):
+        chunk = np.asarray(data[i:i+n])
+        cmn = chunk.min()
+        cmx = chunk.max()
+        mn = cmn if mn is None else min(mn, cmn)
+        mx = cmx if mx is None else max(mx, cmx)
+    return mn, mx
+
+
+class ByteScaler(object):
+    """Maps values between dMin and dMax onto 0-255. If the range is not given, it is 
+    measured (with dataRange) the first time the scaler is used."""
+    def __init__(self, data, dMin=None, dMax=None):
+        self.data = data
+        self.dMin = dMin
+        self.dMax = dMax
+        self.lut = None
+        
+    def __call__(self, values):
+        if self.dMin is None or self.dMax is None:
+            mn, mx = dataRange(self.data)
+            if self.dMin is None:
+                self.dMin = mn
+            if self.dMax is None:
+                self.dMax = mx
+        diff = (self.dMax - self.dMin) / 256.
+        if diff == 0:
+            diff = 1.
+        if values.dtype.kind in 'ui' and values.dtype.itemsize <= 2:
+            ## 8- and 16-bit data are converted by lookup table
+            imin = np.iinfo(values.dtype).min
+            if self.lut is None:
+                v = np.arange(imin, np.iinfo(values.dtype).max + 1)
+                self.lut = np.clip((v - self.dMin) / diff, 0, 255).astype(np.ubyte)
+            return self.lut[values.astype(np.int32) - imin]
+        return np.clip((values - self.dMin) / diff, 0, 255).astype(np.ubyte)
+        
+
+def shortToByte(data, dMin=None, dMax=None, lazy=False):
+    """Scale *data* to unsigned bytes, mapping [dMin, dMax] onto [0, 255] (by default,
+    the range of the data). If lazy is True, return a MappedArray that converts only 
+    the regions that are accessed instead of converting the entire array."""
+    scaler = ByteScaler(data, dMin, dMax)
+    if lazy:
+        return MappedArray(data, scaler, np.ubyte)
     d2 = np.empty(data.shape, dtype=np.ubyte)
     for i in xrange(data.shape[0]):
-        d2[i] = lut[data[i]]
+        d2[i] = scaler(np.asarray(data[i]))
     return d2
 
-def loadMulti(*files):
-    d1 = shortToByte(readA75(files[0]))    
-    data = np.empty(d1.shape + (len(files),), dtype=np.ubyte)
-    data[..., 0] = d1
-    del d1
-    for i in range(1, len(files)):
-        data[..., i] = shortToByte(readA75(files[i]))
-    return data
+def headerRange(data):
+    """Return the (min, max) display range recorded in the header of a volume read 
+    by readA75, or (None, None) if the header does not specify one."""
+    if not (hasattr(data, 'implements') and data.implements('MetaArray')):
+        return None, None
+    hdr = data.infoCopy(-1)
+    for mn, mx in [('cal_min', 'cal_max'), ('glmin', 'glmax')]:
+        if hdr.get(mx, 0) > hdr.get(mn, 0):
+            return hdr[mn], hdr[mx]
+    return None, None
+
+def loadMulti(*files, **kwds):
+    """Load multiple volumes of the same shape and stack them along a new last axis,
+    scaled to unsigned bytes by shortToByte.
+    
+    By default (lazy=True), volumes are memory-mapped and both the scaling and
+    stacking happen only for the regions that are accessed. In this case, the byte
+    scaling range is taken from the header (cal_min/cal_max or glmin/glmax) if 
+    present, or measured when the volume is first accessed. With lazy=False, the
+    same scaling range is used but all volumes are converted immediately."""
+    lazy = kwds.get('lazy', True)
+    if not lazy:
+        d1 = loadByte(files[0])
+        data = np.empty(d1.shape + (len(files),), dtype=np.ubyte)
+        data[..., 0] = d1
+        del d1
+        for i in range(1, len(files)):
+            data[..., i] = loadByte(files[i])
+        return data
+    
+    return StackedArray([loadByte(f, lazy=True) for f in files])
+
+def loadByte(fileName, lazy=False):
+    """Read a single volume and scale it to unsigned bytes using the range recorded
+    in its header, or the range of the data if the header does not give one."""
+    vol = readA75(fileName)
+    dMin, dMax = headerRange(vol)
+    if hasattr(vol, 'implements') and vol.implements('MetaArray'):
+        vol = vol.asarray()
+    return shortToByte(vol, dMin, dMax, lazy=lazy)
@@ -0,0 +1,78 @@
+import struct
+import numpy as np
+from acq4.filetypes.Analyze75 import readA75, loadMulti, shortToByte, headerRange
+
+
+def writeNii(fileName, data, order='<', slope=0., inter=0.):
+    ## minimal single-file NiFTI-1 writer
+    dtypes = {np.dtype(np.int16): (4, 16), np.dtype(np.float32): (16, 32), np.dtype(np.uint8): (2, 8)}
+    datatype, bitpix = dtypes[data.dtype]
+    dim = [data.ndim] + list(data.shape) + [1] * (7 - data.ndim)
+    header = struct.pack(order+'i10s18sihcc', 348, '', '', 0, 0, 'r', '\0')
+    header += struct.pack(order+'8h3f4h11fhcB4f2i', *(dim + [0., 0., 0., 0, datatype, bitpix, 0] + 
+        [1.] * 8 + [352., slope, inter, 0, '\0', 2, 0., 0., 0., 0., 0, 0]))
+    header += struct.pack(order+'80s24s2h18f16s4s', *(['', '', 0, 0] + [0.] * 18 + ['', 'n+1\0']))
+    with open(fileName, 'wb') as fh:
+        fh.write(header + '\0' * 4)
+        fh.write(data.astype(data.dtype.newbyteorder(order)).tostring(order='F'))
+
+
+def writeA75(baseName, data, order='<', glRange=(0, 0)):
+    ## glRange is (glmin, glmax); the header stores glmax first
+    dim = [data.ndim] + list(data.shape) + [1] * (7 - data.ndim)
+    header = struct.pack(order+'i10s18sihcc', 348, '', '', 0, 0, 'r', '\0')
+    header += struct.pack(order+'18h16f2i', *(dim + [0] * 7 + [4, 16, 0] + [1.] * 8 + [0.] * 8 + [glRange[1], glRange[0]]))
+    header += struct.pack(order+'80s24sc10s10s10s10s10s10s3s8i', *(['', '', '\0'] + [''] * 7 + [0] * 8))
+    with open(baseName + '.hdr', 'wb') as fh:
+        fh.write(header)
+    with open(baseName + '.img', 'wb') as fh:
+        fh.write(data.astype(data.dtype.newbyteorder(order)).tostring(order='F'))
+
+
+def test_readA75(tmpdir):
+    data = np.arange(4*5*6, dtype=np.int16).reshape(4, 5, 6) - 50
+    for order in '<>':
+        fileName = str(tmpdir.join('vol%s.nii' % ('le' if order == '<' else 'be')))
+        writeNii(fileName, data, order)
+        vol = readA75(fileName)
+        assert vol.shape == (4, 5, 6)
+        assert isinstance(vol.asarray().base, np.memmap)
+        assert np.all(vol.asarray() == data)
+        
+    fileName = str(tmpdir.join('scaled.nii'))
+    writeNii(fileName, data, slope=2., inter=1.)
+    assert np.allclose(readA75(fileName).asarray(), data * 2. + 1)
+    assert np.all(readA75(fileName, applyScaling=False).asarray() == data)
+    
+    baseName = str(tmpdir.join('analyze'))
+    writeA75(baseName, data, '>')
+    assert np.all(readA75(baseName + '.hdr').asarray() == data)
+
+
+def test_loadMulti(tmpdir):
+    rng = np.random.RandomState(0)
+    vols = [rng.randint(-1000, 3000, size=(10, 12, 8)).astype(np.int16) for i in range(3)]
+    files = []
+    for i, v in enumerate(vols):
+        files.append(str(tmpdir.join('vol%d' % i)))
+        ## the header range of volume 1 is wider than its data range
+        writeA75(files[-1], v, glRange=(0, 0) if i != 1 else (-2000, 6000))
+    files = [f + '.hdr' for f in files]
+    assert headerRange(readA75(files[1])) == (-2000, 6000)
+    assert headerRange(readA75(files[0])) == (None, None)
+    
+    eager = loadMulti(*files, lazy=False)
+    lazy = loadMulti(*files)
+    assert lazy.shape == eager.shape == (10, 12, 8, 3) and lazy.dtype == np.ubyte
+    assert np.all(np.asarray(lazy) == eager)
+    assert np.all(eager[..., 1] == shortToByte(vols[1], -2000, 6000))
+    assert eager[..., 1].max() < 200 and eager[..., 0].max() == 255
+    assert np.all(lazy[2:5, ..., 1] == eager[2:5, ..., 1])
+    assert np.all(lazy[3, :, 4] == eager[3, :, 4])
+    assert np.all(lazy[..., ::2][1] == eager[..., ::2][1])
+    
+    ## lazy scaling matches the eager result; values span 0-255
+    b = shortToByte(vols[0], lazy=True)
+    assert np.all(b[4:6] == shortToByte(vols[0])[4:6])
+    full = np.asarray(b)
+    assert full.min() == 0 and full.max() == 255
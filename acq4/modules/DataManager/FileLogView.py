@@ -31,7 +31,7 @@ class FileLogView(LogWidget):
     
     def selectedFileChanged(self, dh):
         """Finds the log file associated with dh (a FileHandle or DirHandle). Checks dh and all (grand)parent directories
-        until a log.txt file is found, and passes that file on to be displayed. If no log.txt file is found, then nothing is displayed."""
+        until a log file (log.db, or log.txt from older versions) is found, and passes that file on to be displayed. If no log file is found, then nothing is displayed."""
         ## make sure a file is actually selected
         if dh is None:
             self.clear()
@@ -39,13 +39,13 @@ class FileLogView(LogWidget):
             self.dirFilter = False
             return
         
-        ## check dh and parents for a log.txt file
+        ## check dh and parents for a log file
         if not dh.isDir():
             dh = dh.parent()
         logDir = None 
         p = dh
         while p != self.mod.baseDir: 
-            if p.exists('log.txt'):
+            if self.logFileName(p) is not None:
                 logDir = p
                 break
             else:
@@ -102,11 +102,20 @@ class FileLogView(LogWidget):
                 #self.clear()
                 #self.ui.dirLabel.setText("")
 
+    @staticmethod
+    def logFileName(dh):
+        ## log.db takes precedence; log.txt is only read if it has not been converted yet
+        for name in ['log.db', 'log.txt']:
+            if dh.exists(name):
+                return name
+        return None
+        
     def setCurrentLog(self, dh):
         if dh is not None:
             try:
-                self.loadFile(dh['log.txt'].name())
-                self.ui.dirLabel.setText("Currently displaying " + self.currentLogDir.name(relativeTo=self.manager.baseDir)+'/log.txt')    
+                logFile = self.logFileName(dh)
+                self.loadFile(dh[logFile].name())
+                self.ui.dirLabel.setText("Currently displaying " + self.currentLogDir.name(relativeTo=self.manager.baseDir)+'/'+logFile)    
             except:
                 debug.printExc("Error loading log file:")
                 self.clear()
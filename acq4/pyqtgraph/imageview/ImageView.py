@@ -28,6 +28,7 @@ from ..graphicsItems.InfiniteLine import *
 from ..graphicsItems.ViewBox import *
 from ..graphicsItems.VTickGroup import VTickGroup
 from .. import ptime as ptime
+from ..functions import affineSlice
 from .. import debug as debug
 from ..SignalProxy import SignalProxy
 
@@ -78,6 +79,10 @@ class ImageView(QtGui.QWidget):
     sigTimeChanged = QtCore.Signal(object, object)
     sigProcessingChanged = QtCore.Signal(object)
     
+    ## maximum number of elements processed at once when a whole image stack
+    ## must be scanned (eg. to compute the mean of each frame)
+    chunkSize = 2**24
+    
     def __init__(self, parent=None, name="ImageView", view=None, imageItem=None, 
                  levelMode='mono', *args):
         """
@@ -120,6 +125,8 @@ class ImageView(QtGui.QWidget):
         self.image = None
         self.axes = {}
         self.imageDisp = None
+        self._frameMeans = None  # mean of each frame in self.image, computed when first needed
+        self._normTerms = None   # values used to normalize self.image (see _normalizationTerms)
         self.ui = Ui_Form()
         self.ui.setupUi(self)
         self.scene = self.ui.graphicsView.scene()
@@ -251,7 +258,8 @@ class ImageView(QtGui.QWidget):
                                 "  %s" % str(required))
         
         self.image = img
-        self.imageDisp = None
+        self._frameMeans = None
+        self._resetProcessing()
         if levelMode is not None:
             self.ui.histogram.setLevelMode(levelMode)
         
@@ -358,6 +366,8 @@ class ImageView(QtGui.QWidget):
             
     def autoLevels(self):
         """Set the min/max intensity levels automatically to match the image data."""
+        if self._imageLevels is None and self.image is not None:
+            self._updateLevels()
         self.setLevels(rgba=self._imageLevels)
 
     def setLevels(self, *args, **kwds):
@@ -369,20 +379,53 @@ class ImageView(QtGui.QWidget):
 
     def autoRange(self):
         """Auto scale and pan the view around the image such that the image fills the view."""
-        image = self.getProcessedImage()
         self.view.autoRange()
         
     def getProcessedImage(self):
         """Returns the image data after it has been processed by any normalization options in use.
+        
+        For a time series, frames are normalized one at a time as they are 
+        displayed; calling this method processes the entire stack at once.
         """
         if self.imageDisp is None:
-            image = self.normalize(self.image)
-            self.imageDisp = image
-            self._imageLevels = self.quickMinMax(self.imageDisp)
-            self.levelMin = min([level[0] for level in self._imageLevels])
-            self.levelMax = max([level[1] for level in self._imageLevels])
-            
+            self.imageDisp = self.normalize(self.image)
         return self.imageDisp
+    
+    def _resetProcessing(self):
+        ## Discard processed data after the image or normalization options change;
+        ## it is regenerated when next needed.
+        self.imageDisp = None
+        self._normTerms = None
+        self._imageLevels = None
+    
+    def _lazyProcessing(self):
+        ## Frames of a time series are only processed when they are requested
+        return self.image is not None and self.axes.get('t') == 0
+    
+    def _processedFrames(self, index, region=()):
+        ## Return frames *index* (an integer or slice along the time axis) of the
+        ## processed image, restricted to *region* (slices along the remaining axes).
+        key = (index,) + tuple(region)
+        if not self._lazyProcessing():
+            return self.getProcessedImage()[key]
+        frames = np.asarray(self.image[key])
+        if self.ui.normOffRadio.isChecked():
+            return frames
+        if self._normTerms is None:
+            self._normTerms = self._normalizationTerms(self.image)
+        return self._applyNorm(frames, self._normTerms, index, region)
+    
+    def _updateLevels(self):
+        ## For a time series, only the frames and pixels that quickMinMax would 
+        ## sample from the processed stack are processed.
+        if self._lazyProcessing():
+            sl = self._subsample(self.image.shape)
+            data = self._processedFrames(sl[0], sl[1:])
+        else:
+            data = self.getProcessedImage()
+        self._imageLevels = self.quickMinMax(data)
+        self.levelMin = min([level[0] for level in self._imageLevels])
+        self.levelMax = max([level[1] for level in self._imageLevels])
         
     def close(self):
         """Closes the widget nicely, making sure to clear the graphics scene and release memory."""
@@ -397,7 +440,7 @@ class ImageView(QtGui.QWidget):
         #print ev.key()
         if ev.key() == QtCore.Qt.Key_Space:
             if self.playRate == 0:
-                fps = (self.getProcessedImage().shape[0]-1) / (self.tVals[-1] - self.tVals[0])
+                fps = (self.image.shape[0]-1) / (self.tVals[-1] - self.tVals[0])
                 self.play(fps)
                 #print fps
             else:
@@ -408,7 +451,7 @@ class ImageView(QtGui.QWidget):
             self.play(0)
             ev.accept()
         elif ev.key() == QtCore.Qt.Key_End:
-            self.setCurrentIndex(self.getProcessedImage().shape[0]-1)
+            self.setCurrentIndex(self.image.shape[0]-1)
             self.play(0)
             ev.accept()
         elif ev.key() in self.noRepeatKeys:
@@ -472,7 +515,7 @@ class ImageView(QtGui.QWidget):
         
     def setCurrentIndex(self, ind):
         """Set the currently displayed frame index."""
-        self.currentIndex = np.clip(ind, 0, self.getProcessedImage().shape[0]-1)
+        self.currentIndex = np.clip(ind, 0, self.image.shape[0]-1)
         self.updateImage()
         self.ignoreTimeLine = True
         self.timeLine.setValue(self.tVals[self.currentIndex])
@@ -484,7 +527,7 @@ class ImageView(QtGui.QWidget):
             self.setCurrentIndex(self.currentIndex + n)
 
     def normRadioChanged(self):
-        self.imageDisp = None
+        self._resetProcessing()
         self.updateImage()
         self.autoLevels()
         self.roiChanged()
@@ -502,7 +545,7 @@ class ImageView(QtGui.QWidget):
             self.normRoi.hide()
         
         if not self.ui.normOffRadio.isChecked():
-            self.imageDisp = None
+            self._resetProcessing()
             self.updateImage()
             self.autoLevels()
             self.roiChanged()
@@ -555,10 +598,34 @@ class ImageView(QtGui.QWidget):
         if self.image is None:
             return
             
+        axes = (self.axes['x'], self.axes['y'])
+        if self._lazyProcessing():
+            # Average data within entire ROI for each frame, processing only the
+            # part of each frame under the ROI, a chunk of frames at a time
+            bounds = self.roi.getArraySlice(self.image, self.imageItem, axes)
+            if bounds is None:
+                return
+            region = list(bounds[0][1:])
+            offset = []
+            for ax in axes:
+                ## one extra pixel on each side for interpolation at the edges
+                start = max(0, region[ax-1].start - 1)
+                region[ax-1] = slice(start, min(self.image.shape[ax], region[ax-1].stop + 1))
+                offset.append(start)
+            shape, vectors, origin = self.roi.getAffineSliceParams(self.image, self.imageItem, axes)
+            origin = [o - off for o, off in zip(origin, offset)]
+            regionShape = [len(range(*r.indices(n))) for r, n in zip(region, self.image.shape[1:])]
+            data = []
+            for sl in self._frameChunks([self.image.shape[0]] + regionShape):
+                frames = self._processedFrames(sl, region)
+                d = affineSlice(frames, shape=shape, vectors=vectors, origin=origin, axes=axes)
+                data.append(d.mean(axis=max(axes)).mean(axis=min(axes)))
+            self._plotRoiData(self.tVals, np.concatenate(data))
+            return
+        
         image = self.getProcessedImage()
 
         # Extract image data from ROI
-        axes = (self.axes['x'], self.axes['y'])
         data, coords = self.roi.getArrayRegion(image.view(np.ndarray), self.imageItem, axes, returnMappedCoords=True)
         if data is None:
             return
@@ -573,7 +640,9 @@ class ImageView(QtGui.QWidget):
             # Average data within entire ROI for each frame
             data = data.mean(axis=max(axes)).mean(axis=min(axes))
             xvals = self.tVals
+        self._plotRoiData(xvals, data)
 
+    def _plotRoiData(self, xvals, data):
         # Handle multi-channel data
         if data.ndim == 1:
             plots = [(xvals, data, 'w')]
@@ -602,12 +671,7 @@ class ImageView(QtGui.QWidget):
         Estimate the min/max values of *data* by subsampling.
         Returns [(min, max), ...] with one item per channel
         """
-        while data.size > 1e6:
-            ax = np.argmax(data.shape)
-            sl = [slice(None)] * data.ndim
-            sl[ax] = slice(None, None, 2)
-            data = data[sl]
-            
+        data = data[self._subsample(data.shape)]
         cax = self.axes['c']
         if cax is None:
             return [(float(nanmin(data)), float(nanmax(data)))]
@@ -615,6 +679,24 @@ class ImageView(QtGui.QWidget):
             return [(float(nanmin(data.take(i, axis=cax))), 
                      float(nanmax(data.take(i, axis=cax)))) for i in range(data.shape[-1])]
 
+    @staticmethod
+    def _subsample(shape, maxSize=1e6):
+        ## Slices that reduce an array of *shape* to at most *maxSize* elements
+        ## by repeatedly halving its longest axis
+        shape = list(shape)
+        steps = [1] * len(shape)
+        while np.prod(shape) > maxSize:
+            ax = np.argmax(shape)
+            steps[ax] *= 2
+            shape[ax] = (shape[ax] + 1) // 2
+        return tuple([slice(None, None, step) for step in steps])
+
+    def _frameChunks(self, shape):
+        ## Slices along the first axis of an array of *shape*, each covering
+        ## at most chunkSize elements
+        n = max(1, int(self.chunkSize // max(1, np.prod(shape[1:]))))
+        return [slice(i, i+n) for i in range(0, shape[0], n)]
+
     def normalize(self, image):
         """
         Process *image* using the normalization options configured in the
@@ -624,39 +706,67 @@ class ImageView(QtGui.QWidget):
         """
         if self.ui.normOffRadio.isChecked():
             return image
-            
-        div = self.ui.normDivideRadio.isChecked()
-        norm = image.view(np.ndarray).copy()
-        #if div:
-            #norm = ones(image.shape)
-        #else:
-            #norm = zeros(image.shape)
-        if div:
-            norm = norm.astype(np.float32)
-            
-        if self.ui.normTimeRangeCheck.isChecked() and image.ndim == 3:
+        
+        if image is self.image:
+            if self._normTerms is None:
+                self._normTerms = self._normalizationTerms(image)
+            terms = self._normTerms
+        else:
+            terms = self._normalizationTerms(image)
+        return self._applyNorm(image.view(np.ndarray), terms)
+    
+    def _normalizationTerms(self, image):
+        ## Return the values that a 3D *image* is divided by (or that are 
+        ## subtracted from it): the mean image over the selected time range, the
+        ## mean of each frame, and the mean of each frame within normRoi after
+        ## the first two have been applied. Stacks are read a chunk of frames at a
+        ## time, and the frame means of self.image are computed only once.
+        terms = {'divide': self.ui.normDivideRadio.isChecked()}
+        if image.ndim != 3:
+            return terms
+        
+        if self.ui.normTimeRangeCheck.isChecked():
             (sind, start) = self.timeIndex(self.normRgn.lines[0])
             (eind, end) = self.timeIndex(self.normRgn.lines[1])
-            #print start, end, sind, eind
-            n = image[sind:eind+1].mean(axis=0)
-            n.shape = (1,) + n.shape
-            if div:
-                norm /= n
-            else:
-                norm -= n
-                
-        if self.ui.normFrameCheck.isChecked() and image.ndim == 3:
-            n = image.mean(axis=1).mean(axis=1)
-            n.shape = n.shape + (1, 1)
-            if div:
-                norm /= n
+            terms['range'] = image[sind:eind+1].mean(axis=0)
+            
+        if self.ui.normFrameCheck.isChecked():
+            if image is self.image and self._frameMeans is not None:
+                means = self._frameMeans
             else:
-                norm -= n
+                chunks = self._frameChunks(image.shape)
+                means = np.concatenate([image[sl].mean(axis=1).mean(axis=1) for sl in chunks])
+                if image is self.image:
+                    self._frameMeans = means
+            terms['frame'] = means
             
-        if self.ui.normROICheck.isChecked() and image.ndim == 3:
-            n = self.normRoi.getArrayRegion(norm, self.imageItem, (1, 2)).mean(axis=1).mean(axis=1)
-            n = n[:,np.newaxis,np.newaxis]
-            #print start, end, sind, eind
+        if self.ui.normROICheck.isChecked():
+            means = []
+            for sl in self._frameChunks(image.shape):
+                norm = self._applyNorm(np.asarray(image[sl]), terms, sl)
+                means.append(self.normRoi.getArrayRegion(norm, self.imageItem, (1, 2)).mean(axis=1).mean(axis=1))
+            terms['roi'] = np.concatenate(means)
+        
+        return terms
+    
+    def _applyNorm(self, frames, terms, index=slice(None), region=()):
+        ## Return a normalized copy of *frames*, which are image[index][region] 
+        ## for the image that *terms* were computed from.
+        div = terms['divide']
+        if div or frames.dtype.kind in 'biu':
+            ## integer data can not be normalized in place
+            norm = frames.astype(np.float32)
+        else:
+            norm = frames.copy()
+        
+        ns = []
+        if 'range' in terms:
+            ns.append(terms['range'][tuple(region)])
+        for name in ('frame', 'roi'):
+            if name in terms:
+                n = np.asarray(terms[name][index])
+                ns.append(n.reshape(n.shape + (1, 1)))
+        for n in ns:
             if div:
                 norm /= n
             else:
@@ -681,17 +791,18 @@ class ImageView(QtGui.QWidget):
         ## Redraw image on screen
         if self.image is None:
             return
-            
-        image = self.getProcessedImage()
+        
+        if self._imageLevels is None:
+            self._updateLevels()
         
         if autoHistogramRange:
             self.ui.histogram.setHistogramRange(self.levelMin, self.levelMax)
             
         if self.axes['t'] is None:
-            self.imageItem.updateImage(image)
+            self.imageItem.updateImage(self.getProcessedImage())
         else:
             self.ui.roiPlot.show()
-            self.imageItem.updateImage(image[self.currentIndex])
+            self.imageItem.updateImage(self._processedFrames(self.currentIndex))
             
             
     def timeIndex(self, slider):
@@ -737,12 +848,12 @@ class ImageView(QtGui.QWidget):
         being added to the file name. Images are saved as they would appear
         onscreen, with levels and lookup table applied.
         """
-        img = self.getProcessedImage()
         if self.hasTimeAxis():
+            nFrames = self.image.shape[0]
             base, ext = os.path.splitext(fileName)
-            fmt = "%%s%%0%dd%%s" % int(np.log10(img.shape[0])+1)
-            for i in range(img.shape[0]):
-                self.imageItem.setImage(img[i], autoLevels=False)
+            fmt = "%%s%%0%dd%%s" % int(np.log10(nFrames)+1)
+            for i in range(nFrames):
+                self.imageItem.setImage(self._processedFrames(i), autoLevels=False)
                 self.imageItem.save(fmt % (base, i, ext))
             self.updateImage()
         else:
@@ -9,3 +9,80 @@ def test_nan_image():
     v = pg.image(img)
     app.processEvents()
     v.window().close()
+
+
+def eagerNormalize(v, image):
+    ## normalize the whole stack at once, as ImageView.normalize used to
+    div = v.ui.normDivideRadio.isChecked()
+    norm = image.astype(np.float32) if div else image.copy()
+    terms = []
+    if v.ui.normTimeRangeCheck.isChecked():
+        sind = v.timeIndex(v.normRgn.lines[0])[0]
+        eind = v.timeIndex(v.normRgn.lines[1])[0]
+        terms.append(lambda norm: image[sind:eind+1].mean(axis=0)[np.newaxis])
+    if v.ui.normFrameCheck.isChecked():
+        terms.append(lambda norm: image.mean(axis=1).mean(axis=1)[:, np.newaxis, np.newaxis])
+    if v.ui.normROICheck.isChecked():
+        terms.append(lambda norm: v.normRoi.getArrayRegion(norm, v.imageItem, (1, 2)).mean(axis=1).mean(axis=1)[:, np.newaxis, np.newaxis])
+    for term in terms:
+        if div:
+            norm /= term(norm)
+        else:
+            norm -= term(norm)
+    return norm
+
+
+def test_lazy_normalization():
+    np.random.seed(0)
+    data = np.random.normal(loc=100., scale=10., size=(20, 30, 40))
+    data += np.linspace(0, 50, 20)[:, np.newaxis, np.newaxis]
+    v = pg.ImageView()
+    v.chunkSize = 30 * 40 * 3  ## several chunks per stack, the last one partial
+    v.setImage(data)
+    v.normRgn.setRegion([2, 8])
+    v.normRoi.setPos([5, 5])
+    v.normRoi.setSize([10, 10])
+    v.ui.roiBtn.click()
+    checks = [v.ui.normTimeRangeCheck, v.ui.normFrameCheck, v.ui.normROICheck]
+    for radio in [v.ui.normDivideRadio, v.ui.normSubtractRadio]:
+        radio.click()
+        for enabled in [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1)]:
+            for check, on in zip(checks, enabled):
+                check.setChecked(on)
+            v.updateNorm()
+            eager = eagerNormalize(v, data)
+            
+            ## only displayed frames are processed, and they match the eager result
+            for i in [0, 7, 19]:
+                v.setCurrentIndex(i)
+                assert np.allclose(v.imageItem.image, eager[i])
+            assert np.allclose(v._imageLevels, v.quickMinMax(eager))
+            roi = v.roi.getArrayRegion(eager, v.imageItem, (1, 2)).mean(axis=2).mean(axis=1)
+            assert np.allclose(v.roiCurves[0].yData, roi)
+            assert np.allclose(v.getProcessedImage(), eager)
+    
+    ## ROI traces only process the part of each frame under the ROI
+    regions = []
+    processFrames = v._processedFrames
+    def recordRegion(index, region=()):
+        frames = processFrames(index, region)
+        regions.append(frames.shape[1:])
+        return frames
+    v._processedFrames = recordRegion
+    v.roi.setPos([7.3, 4.6])
+    v.roi.setAngle(20)
+    assert len(regions) > 0
+    for shape in regions:
+        assert shape[0] < 20 and shape[1] < 20
+    roi = v.roi.getArrayRegion(eager, v.imageItem, (1, 2)).mean(axis=2).mean(axis=1)
+    assert np.allclose(v.roiCurves[0].yData, roi)
+    v.roi.setPos([25, 30])  ## partly outside the image
+    roi = v.roi.getArrayRegion(eager, v.imageItem, (1, 2)).mean(axis=2).mean(axis=1)
+    assert np.allclose(v.roiCurves[0].yData, roi)
+    del v._processedFrames
+            
+    v.ui.normOffRadio.click()
+    v.setCurrentIndex(3)
+    assert np.all(v.imageItem.image == data[3])
+    app.processEvents()
+    v.close()
@@ -1,4 +1,5 @@
-import os, sys, time, multiprocessing, re
+import os, sys, multiprocessing, re, select
+from collections import deque
 from .processes import ForkedProcess
 from .remoteproxy import ClosedError
 
@@ -25,19 +26,35 @@ class Parallelize(object):
         ## Here is the parallelized version:
         
         tasks = [1, 2, 4, 8]
-        results = []
-        with Parallelize(tasks, workers=4, results=results) as tasker:
+        par = Parallelize(tasks, workers=4)
+        with par as tasker:
             for task in tasker:
                 result = processTask(task)
-                tasker.results.append(result)
-        print(results)
+                tasker.setResult(result)
+        print(par.results())
         
         
     The only major caveat is that *result* in the example above must be picklable,
-    since it is automatically sent via pipe back to the parent process.
+    since it is automatically sent via pipe back to the parent process. (Large arrays,
+    including those inside lists, tuples, and dicts, are instead passed through shared 
+    memory; see RemoteEventHandler.sharedArrayThreshold.)
+    
+    Objects given as extra keyword arguments are available to the workers by proxy, 
+    so results may also be collected by hand::
+    
+        results = []
+        with Parallelize(tasks, workers=4, results=results) as tasker:
+            for task in tasker:
+                tasker.results.append(processTask(task))
+    
+    By default, tasks are handed out to workers one at a time as they become 
+    free ('dynamic' dispatch). Each worker starts with a contiguous block of tasks;
+    a worker that runs out of tasks takes half of the remaining tasks from the
+    worker with the most tasks left. This keeps all workers busy when some tasks
+    take much longer than others.
     """
 
-    def __init__(self, tasks=None, workers=None, block=True, progressDialog=None, randomReseed=True, **kwds):
+    def __init__(self, tasks=None, workers=None, block=True, progressDialog=None, randomReseed=True, dispatch=None, **kwds):
         """
         ===============  ===================================================================
         **Arguments:**
@@ -51,6 +68,10 @@ class Parallelize(object):
         randomReseed     If True, each forked process will reseed its random number generator
                          to ensure independent results. Works with the built-in random
                          and numpy.random.
+        dispatch         'dynamic' to hand out tasks to workers as they become free, or 
+                         'static' to divide the tasks evenly between workers before 
+                         starting (task i goes to worker i % workers). The default is 
+                         'dynamic', unless *tasks* is unspecified.
         kwds             objects to be shared by proxy with child processes (they will 
                          appear as attributes of the tasker)
         ===============  ===================================================================
@@ -71,12 +92,20 @@ class Parallelize(object):
         if not hasattr(os, 'fork'):
             workers = 1
         self.workers = workers
+        if dispatch is None:
+            dispatch = 'static' if tasks is None else 'dynamic'
+        if dispatch not in ('dynamic', 'static'):
+            raise ValueError("dispatch must be 'dynamic' or 'static' (got %r)" % dispatch)
+        self.dispatch = dispatch
         if tasks is None:
             tasks = range(workers)
         self.tasks = list(tasks)
+        self.taskResults = [None] * len(self.tasks)
         self.reseed = randomReseed
         self.kwds = kwds.copy()
         self.kwds['_taskStarted'] = self._taskStarted
+        self.kwds['_nextTask'] = self._nextTask
+        self.kwds['_setResult'] = self._setResult
         
     def __enter__(self):
         self.proc = None
@@ -101,12 +130,17 @@ class Parallelize(object):
             if self.showProgress:
                 self.progressDlg.__exit__(None, None, None)
 
+    def results(self):
+        """Return a list of the values passed to Tasker.setResult(), one per task,
+        in the same order as the tasks. Tasks with no result give None."""
+        return self.taskResults[:]
+
     def runSerial(self):
         if self.showProgress:
             self.progressDlg.__enter__()
             self.progressDlg.setMaximum(len(self.tasks))
         self.progress = {os.getpid(): []}
-        return Tasker(self, None, self.tasks, self.kwds)
+        return Tasker(self, None, range(len(self.tasks)), self.kwds)
 
     
     def runParallel(self):
@@ -114,20 +148,30 @@ class Parallelize(object):
         
         ## break up tasks into one set per worker
         workers = self.workers
-        chunks = [[] for i in xrange(workers)]
-        i = 0
-        for i in range(len(self.tasks)):
-            chunks[i%workers].append(self.tasks[i])
+        nTasks = len(self.tasks)
+        if self.dispatch == 'static':
+            chunks = [range(i, nTasks, workers) for i in xrange(workers)]
+        else:
+            ## each worker starts with a contiguous block of tasks, which may later be 
+            ## redistributed by _nextTask
+            bounds = [(nTasks * i) // workers for i in xrange(workers+1)]
+            chunks = [range(bounds[i], bounds[i+1]) for i in xrange(workers)]
         
         ## fork and assign tasks to each worker
         for i in range(workers):
             proc = ForkedProcess(target=None, preProxy=self.kwds, randomReseed=self.reseed)
             if not proc.isParent:
                 self.proc = proc
-                return Tasker(self, proc, chunks[i], proc.forkedProxies)
+                if self.dispatch == 'static':
+                    return Tasker(self, proc, chunks[i], proc.forkedProxies)
+                else:
+                    return Tasker(self, proc, None, proc.forkedProxies)
             else:
                 self.childs.append(proc)
         
+        ## Queue of task indexes not yet handed out to each worker (dynamic dispatch only)
+        self.queues = dict([(ch.childPid, deque(chunks[i])) for i, ch in enumerate(self.childs)])
+        
         ## Keep track of the progress of each worker independently.
         self.progress = dict([(ch.childPid, []) for ch in self.childs])
         ## for each child process, self.progress[pid] is a list
@@ -143,19 +187,16 @@ class Parallelize(object):
                 
             activeChilds = self.childs[:]
             self.exitCodes = []
-            pollInterval = 0.01
+            pollInterval = 0.1
             while len(activeChilds) > 0:
-                waitingChildren = 0
                 rem = []
                 for ch in activeChilds:
                     try:
-                        n = ch.processRequests()
-                        if n > 0:
-                            waitingChildren += 1
+                        ch.processRequests()
                     except ClosedError:
                         #print ch.childPid, 'process finished'
                         rem.append(ch)
-                        if self.showProgress:
+                        if self.showProgress and len(self.progress[ch.childPid]) > 0:
                             self.progressDlg += 1
                 #print "remove:", [ch.childPid for ch in rem]
                 for ch in rem:
@@ -179,14 +220,14 @@ class Parallelize(object):
                         ch.kill()
                     raise CanceledError()
                     
-                ## adjust polling interval--prefer to get exactly 1 event per poll cycle.
-                if waitingChildren > 1:
-                    pollInterval *= 0.7
-                elif waitingChildren == 0:
-                    pollInterval /= 0.7
-                pollInterval = max(min(pollInterval, 0.5), 0.0005) ## but keep it within reasonable limits
-                
-                time.sleep(pollInterval)
+                ## wait until any worker sends a request (workers waiting on _nextTask 
+                ## must get a reply quickly), but check the progress dialog regularly
+                if len(activeChilds) > 0:
+                    try:
+                        select.select([ch.conn for ch in activeChilds], [], [], pollInterval)
+                    except select.error as ex:
+                        if ex.args[0] != 4:  ## interrupted system call; just try again
+                            raise
         finally:
             if self.showProgress:
                 self.progressDlg.__exit__(None, None, None)
@@ -232,26 +273,68 @@ class Parallelize(object):
                     raise CanceledError()
         self.progress[pid].append(i)
     
+    def _nextTask(self, pid, **kwds):
+        ## called remotely by tasker (dynamic dispatch) to request the index of the next 
+        ## task to process. Returns None when no tasks are left.
+        queue = self.queues[pid]
+        if len(queue) == 0:
+            ## steal the last half of the remaining tasks from the busiest worker
+            victim = max(self.queues.values(), key=len)
+            n = (len(victim) + 1) // 2
+            stolen = [victim.pop() for i in range(n)]
+            queue.extend(stolen[::-1])
+        if len(queue) == 0:
+            return None
+        return queue.popleft()
+    
+    def _setResult(self, i, result, **kwds):
+        ## called remotely by tasker to deliver the result of task i
+        self.taskResults[i] = result
+    
     
 class Tasker(object):
-    def __init__(self, parallelizer, process, tasks, kwds):
+    def __init__(self, parallelizer, process, taskIndexes, kwds):
         self.proc = process
         self.par = parallelizer
-        self.tasks = tasks
+        self.taskIndexes = taskIndexes  ## None if tasks are requested one at a time from the parent
+        self.index = None
         for k, v in kwds.iteritems():
             setattr(self, k, v)
         
     def __iter__(self):
-        ## we could fix this up such that tasks are retrieved from the parent process one at a time..
-        for i, task in enumerate(self.tasks):
+        for i in self._iterIndexes():
             self.index = i
             #print os.getpid(), 'starting task', i
             self._taskStarted(os.getpid(), i, _callSync='off')
-            yield task
+            yield self.par.tasks[i]
         if self.proc is not None:
             #print os.getpid(), 'no more tasks'
             self.proc.close()
     
+    def _iterIndexes(self):
+        if self.taskIndexes is not None:
+            for i in self.taskIndexes:
+                yield i
+            return
+        
+        ## Ask the parent for the next task while this one is processed,
+        ## so that the worker does not need to wait between tasks.
+        pid = os.getpid()
+        req = self._nextTask(pid, _callSync='async')
+        while True:
+            i = req.result(timeout=-1)
+            if i is None:
+                return
+            req = self._nextTask(pid, _callSync='async')
+            yield i
+    
+    def setResult(self, result):
+        """
+        Set the result of the current task. After processing, the results of all 
+        tasks are available from Parallelize.results().
+        """
+        self._setResult(self.index, result, _callSync='off')
+    
     def process(self):
         """
         Process requests from parent.
@@ -154,6 +154,7 @@ class Process(RemoteEventHandler):
                 if timeout is not None and time.time() - start > timeout:
                     raise Exception('Timed out waiting for remote process to end.')
                 time.sleep(0.05)
+        self.removeSharedArrays()
         self.debugMsg('Child process exited. (%d)' % self.proc.returncode)
 
     def debugMsg(self, msg):
@@ -324,6 +325,7 @@ class ForkedProcess(RemoteEventHandler):
             os.waitpid(self.childPid, 0)
         except IOError:  ## probably remote process has already quit
             pass  
+        self.removeSharedArrays()
         self.hasJoined = True
 
     def kill(self):
@@ -331,6 +333,7 @@ class ForkedProcess(RemoteEventHandler):
         This is generally safe because forked processes are already
         expected to _avoid_ any cleanup at exit."""
         os.kill(self.childPid, signal.SIGKILL)
+        self.removeSharedArrays()
         self.hasJoined = True
         
         
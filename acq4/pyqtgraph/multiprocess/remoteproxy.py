@@ -1,4 +1,4 @@
-import os, time, sys, traceback, weakref
+import os, time, sys, traceback, weakref, tempfile, mmap, atexit
 import numpy as np
 import threading
 try:
@@ -21,6 +21,64 @@ class NoResultError(Exception):
     because the call has not yet returned."""
     pass
 
+
+## Directory used for passing large arrays between processes. Files in /dev/shm
+## are held in memory, so writing and mapping them does not touch the disk.
+if os.path.isdir('/dev/shm'):
+    sharedArrayDir = '/dev/shm'
+else:
+    sharedArrayDir = tempfile.gettempdir()
+
+class SharedArray(object):
+    """Stands in for a large array while it is pickled for sending to a remote process.
+    
+    The array data is written to a temporary file in sharedArrayDir and only the 
+    file name, dtype and shape are pickled. When unpickled, the remote process 
+    maps the file into memory (see openSharedArray) instead of copying its 
+    contents through the pipe.
+    """
+    def __init__(self, arr):
+        self.dtype = arr.dtype
+        self.shape = arr.shape
+        fd, self.path = tempfile.mkstemp(prefix='pyqtgraph-array-', dir=sharedArrayDir)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                arr.tofile(fh)
+        except:
+            os.remove(self.path)
+            raise
+    
+    def __reduce__(self):
+        return (openSharedArray, (self.path, self.dtype, self.shape))
+    
+    def discard(self):
+        """Remove the temporary file if the array could not be sent."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def openSharedArray(path, dtype, shape):
+    """Return an array that maps the data written by SharedArray. 
+    The file is removed immediately; its memory is released once the 
+    array is no longer referenced."""
+    fd = os.open(path, os.O_RDWR)
+    try:
+        size = os.fstat(fd).st_size
+        ## ACCESS_COPY: changes to the array are private to this process
+        buf = mmap.mmap(fd, size, access=mmap.ACCESS_COPY)
+    finally:
+        os.close(fd)
+        os.remove(path)
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+def removeSharedArrays():
+    """Remove the temporary files of all SharedArrays that were sent but never 
+    opened by the remote process. Called at exit."""
+    for handler in list(RemoteEventHandler.sharedArraySenders):
+        handler.removeSharedArrays()
+atexit.register(removeSharedArrays)
+
     
 class RemoteEventHandler(object):
     """
@@ -45,6 +103,16 @@ class RemoteEventHandler(object):
     """
     handlers = {}   ## maps {process ID : handler}. This allows unpickler to determine which process
                     ## an object proxy belongs to
+    
+    ## Arrays of at least this many bytes that are sent to the remote process 
+    ## (as arguments, return values, or transferred objects) are passed via 
+    ## a shared memory-mapped file rather than through the pipe (see SharedArray).
+    ## Set to None to disable. Windows does not allow removing files that are
+    ## still mapped, so this is disabled there by default.
+    sharedArrayThreshold = None if sys.platform.startswith('win') else 2**20
+    
+    ## handlers that may have SharedArray files in flight; see removeSharedArrays()
+    sharedArraySenders = weakref.WeakSet()
                          
     def __init__(self, connection, name, pid, debug=False):
         self.debug = debug
@@ -78,6 +146,11 @@ class RemoteEventHandler(object):
         self.processLock = threading.RLock()
         self.sendLock = threading.RLock()
         
+        ## temporary files of SharedArrays sent to the remote process; the remote process 
+        ## removes each file when it is opened, and any that remain when the connection
+        ## closes are removed by removeSharedArrays().
+        self.sharedArrayPaths = set()
+        
         RemoteEventHandler.handlers[pid] = self  ## register this handler as the one communicating with pid
     
     @classmethod
@@ -118,14 +191,16 @@ class RemoteEventHandler(object):
             
             numProcessed = 0
             
-            while self.conn.poll():
-                #try:
-                    #poll = self.conn.poll()
-                    #if not poll:
-                        #break
-                #except IOError:  # this can happen if the remote process dies.
-                                ## might it also happen in other circumstances?
-                    #raise ClosedError()
+            while True:
+                try:
+                    poll = self.conn.poll()
+                except IOError:  # this can happen if the remote process dies.
+                    self.debugMsg('processRequests: got IOError from poll; setting exited=True.')
+                    self.exited = True
+                    self.removeSharedArrays()
+                    raise ClosedError()
+                if not poll:
+                    break
                         
                 try:
                     self.handleRequest()
@@ -133,6 +208,7 @@ class RemoteEventHandler(object):
                 except ClosedError:
                     self.debugMsg('processRequests: got ClosedError from handleRequest; setting exited=True.')
                     self.exited = True
+                    self.removeSharedArrays()
                     raise
                 #except IOError as err:  ## let handleRequest take care of this.
                     #self.debugMsg('  got IOError from handleRequest; try again.')
@@ -345,6 +421,9 @@ class RemoteEventHandler(object):
                         This is used to send large arrays without the cost of pickling.
         ==============  ====================================================================
         
+        Arrays in *opts* (including those nested in lists, tuples, and dicts) that
+        are larger than sharedArrayThreshold are not pickled; see shareArrays().
+        
         Description of request strings and options allowed for each:
         
         =============  =============  ========================================================
@@ -428,10 +507,19 @@ class RemoteEventHandler(object):
                 
             #print os.getpid(), "send request:", request, reqId, opts
             
+            ## large arrays are passed via shared memory rather than pickled
+            shared = []
+            try:
+                opts = self.shareArrays(opts, shared)
+            except:
+                self.discardSharedArrays(shared)
+                raise
+            
             ## double-pickle args to ensure that at least status and request ID get through
             try:
                 optStr = pickle.dumps(opts)
             except:
+                self.discardSharedArrays(shared)
                 print("====  Error pickling this object:  ====")
                 print(opts)
                 print("=======================================")
@@ -443,8 +531,14 @@ class RemoteEventHandler(object):
                 
             ## Send primary request
             request = (request, reqId, nByteMsgs, optStr)
-            self.debugMsg('send request: cmd=%s nByteMsgs=%d id=%s opts=%s' % (str(request[0]), nByteMsgs, str(reqId), str(opts)))
-            self.conn.send(request)
+            self.debugMsg('send request: cmd=%s nByteMsgs=%d nSharedArrays=%d id=%s opts=%s' % (str(request[0]), nByteMsgs, len(shared), str(reqId), str(opts)))
+            try:
+                self.conn.send(request)
+            except:
+                self.discardSharedArrays(shared)
+                raise
+            if len(shared) > 0:
+                self.trackSharedArrays(shared)
             
             ## follow up by sending byte messages
             if byteData is not None:
@@ -466,12 +560,87 @@ class RemoteEventHandler(object):
             except NoResultError:
                 return req
         
+    def useSharedArray(self, arr):
+        """Return True if *arr* will be sent to the remote process via shared memory."""
+        threshold = self.sharedArrayThreshold
+        return (threshold is not None and arr.__class__ is np.ndarray and 
+                arr.nbytes >= max(threshold, 1) and not arr.dtype.hasobject)
+    
+    def shareArrays(self, obj, shared, depth=5):
+        """Return *obj* with every large array (see useSharedArray) replaced by a 
+        SharedArray. Arrays are also replaced inside lists, tuples, and dicts,
+        up to *depth* levels deep; containers are copied rather than modified. 
+        New SharedArrays are appended to the list *shared*.
+        """
+        cls = obj.__class__
+        if cls is np.ndarray:
+            if self.useSharedArray(obj):
+                obj = SharedArray(obj)
+                shared.append(obj)
+            return obj
+        if depth == 0 or self.sharedArrayThreshold is None:
+            return obj
+        
+        if cls is dict:
+            items = list(obj.items())
+        elif cls is list or cls is tuple:
+            items = list(enumerate(obj))
+        else:
+            return obj
+        
+        changed = []
+        for k, v in items:
+            if v.__class__ in (np.ndarray, dict, list, tuple):
+                v2 = self.shareArrays(v, shared, depth-1)
+                if v2 is not v:
+                    changed.append((k, v2))
+        if len(changed) == 0:
+            return obj
+        if cls is tuple:
+            obj = list(obj)
+        else:
+            obj = cls(obj)
+        for k, v in changed:
+            obj[k] = v
+        if cls is tuple:
+            obj = tuple(obj)
+        return obj
+    
+    def discardSharedArrays(self, shared):
+        for sa in shared:
+            sa.discard()
+    
+    def trackSharedArrays(self, shared):
+        ## remember the files of SharedArrays that were just sent, and forget
+        ## those that the remote process has already opened (and removed)
+        with self.sendLock:
+            self.sharedArrayPaths = set([p for p in self.sharedArrayPaths if os.path.exists(p)])
+            self.sharedArrayPaths.update([sa.path for sa in shared])
+        RemoteEventHandler.sharedArraySenders.add(self)
+    
+    def removeSharedArrays(self):
+        """Remove the temporary files of SharedArrays that were sent but not yet opened
+        by the remote process. This must only be called once the remote process can 
+        no longer receive them (after it has closed or exited)."""
+        with self.sendLock:
+            paths = self.sharedArrayPaths
+            self.sharedArrayPaths = set()
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        
     def close(self, callSync='off', noCleanup=False, **kwds):
         try:
-            self.send(request='close', opts=dict(noCleanup=noCleanup), callSync=callSync, **kwds)
+            result = self.send(request='close', opts=dict(noCleanup=noCleanup), callSync=callSync, **kwds)
             self.exited = True
         except ClosedError:
-            pass
+            self.removeSharedArrays()
+            return
+        if callSync == 'sync' and result is True:
+            ## the remote process has handled every request sent before 'close'
+            self.removeSharedArrays()
     
     def getResult(self, reqId):
         ## raises NoResultError if the result is not available yet
@@ -550,12 +719,13 @@ class RemoteEventHandler(object):
         
         ## If there are arrays in the arguments, send those as byte messages.
         ## We do this because pickling arrays is too expensive.
+        ## (arrays large enough to be passed via shared memory are left for send() to handle)
         for i,arg in enumerate(args):
-            if arg.__class__ == np.ndarray:
+            if arg.__class__ == np.ndarray and not self.useSharedArray(arg):
                 args[i] = ("__byte_message__", len(byteMsgs), (arg.dtype, arg.shape))
                 byteMsgs.append(arg)
         for k,v in kwds.items():
-            if v.__class__ == np.ndarray:
+            if v.__class__ == np.ndarray and not self.useSharedArray(v):
                 kwds[k] = ("__byte_message__", len(byteMsgs), (v.dtype, v.shape))
                 byteMsgs.append(v)
         
@@ -580,7 +750,7 @@ class RemoteEventHandler(object):
         Transfer an object by value to the remote host (the object must be picklable) 
         and return a proxy for the new remote object.
         """
-        if obj.__class__ is np.ndarray:
+        if obj.__class__ is np.ndarray and not self.useSharedArray(obj):
             opts = {'dtype': obj.dtype, 'shape': obj.shape}
             return self.send(request='transferArray', opts=opts, byteData=[obj], **kwds)            
         else:
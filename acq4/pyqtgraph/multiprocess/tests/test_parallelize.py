@@ -0,0 +1,52 @@
+import os, time
+import pyqtgraph.multiprocess as mp
+
+
+def runTasks(tasks, **kwds):
+    par = mp.Parallelize(tasks, **kwds)
+    with par as tasker:
+        for task in tasker:
+            time.sleep(task[1])
+            tasker.setResult((task[0], os.getpid()))
+    return par
+
+
+def test_results():
+    tasks = [(i, 0.001) for i in range(40)]
+    for opts in [dict(workers=1), dict(workers=3, dispatch='static'), dict(workers=3, dispatch='dynamic')]:
+        par = runTasks(tasks, **opts)
+        res = par.results()
+        assert [r[0] for r in res] == range(40)
+        if opts['workers'] > 1:
+            assert os.getpid() not in [r[1] for r in res]
+            assert len(set([r[1] for r in res])) == 3
+
+    ## legacy: results gathered by hand through a proxied list
+    results = []
+    with mp.Parallelize(range(10), workers=2, results=results) as tasker:
+        for task in tasker:
+            tasker.results.append(task * 2)
+    assert sorted(results) == range(0, 20, 2)
+
+    ## without a task list, each worker gets exactly one task
+    par = mp.Parallelize(workers=3)
+    assert par.dispatch == 'static'
+    with par as tasker:
+        for task in tasker:
+            tasker.setResult(os.getpid())
+    assert len(set(par.results())) == 3
+
+
+def test_dynamicDispatch():
+    ## a few tasks are far slower than the rest; with static chunks one worker
+    ## gets all of them, while dynamic dispatch spreads them out
+    tasks = [(i, 0.2 if i % 2 == 0 and i < 8 else 0.01) for i in range(40)]
+    times = {}
+    for dispatch in ['static', 'dynamic']:
+        start = time.time()
+        par = runTasks(tasks, workers=2, dispatch=dispatch)
+        times[dispatch] = time.time() - start
+        assert [r[0] for r in par.results()] == range(40)
+    ## static: 0.96 s for the worker with all of the slow tasks; ideal: 1.16 s / 2 workers
+    assert times['dynamic'] < 0.8
+    assert times['dynamic'] < times['static'] * 0.9
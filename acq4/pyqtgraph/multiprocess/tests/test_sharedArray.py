@@ -0,0 +1,88 @@
+import os, glob, signal
+import numpy as np
+import pyqtgraph.multiprocess as mp
+from pyqtgraph.multiprocess.remoteproxy import sharedArrayDir
+
+
+def sharedFiles():
+    return set(glob.glob(os.path.join(sharedArrayDir, 'pyqtgraph-array-*')))
+
+
+def test_sharedArrays():
+    before = sharedFiles()
+    proc = mp.ForkedProcess()
+    try:
+        rnp = proc._import('numpy')
+        data = np.random.normal(size=(300, 1000))
+        assert proc.useSharedArray(data)
+        assert not proc.useSharedArray(data[:10])
+
+        ## arrays passed as arguments and return values
+        res = rnp.add(data, 1, _returnType='value')
+        assert np.all(res == data + 1)
+        res[0, 0] = 0  ## mapped arrays are writable
+
+        ## arrays inside lists, including non-contiguous arrays
+        res = rnp.broadcast_arrays(data, np.arange(1000)[None, :], _returnType='value')
+        assert np.all(res[0] == data)
+        assert res[1].shape == data.shape and np.all(res[1] == np.arange(1000)[None, :])
+        res = rnp.array([data[:, ::2], data[:, 1::2]], _returnType='value')
+        assert np.all(res[1] == data[:, 1::2])
+
+        ## transfer
+        rdata = proc.transfer(data.T)
+        assert np.all(rdata._getValue() == data.T)
+
+        ## small arrays still go through the pipe
+        assert np.all(rnp.add(data[:10], 1, _returnType='value') == data[:10] + 1)
+    finally:
+        proc.join()
+
+    ## every temporary file was removed by the receiving process
+    assert sharedFiles() == before
+
+
+def test_sharedArraysInFlight():
+    ## files that the remote process never opened are removed when it dies
+    before = sharedFiles()
+    proc = mp.ForkedProcess()
+    rtime = proc._import('time')
+    radd = proc._import('numpy').add
+    data = np.ones((300, 1000))
+    rtime.sleep(10, _callSync='off')  ## keep the remote process busy
+    for i in range(3):
+        radd(data, i, _callSync='async')
+    assert len(sharedFiles() - before) == 3
+    os.kill(proc.childPid, signal.SIGKILL)
+    os.waitpid(proc.childPid, 0)
+    proc.hasJoined = True
+    try:
+        proc.processRequests()
+    except mp.ClosedError:
+        pass
+    else:
+        raise AssertionError("processRequests should raise ClosedError")
+    assert sharedFiles() == before
+    
+    ## ..and when it is killed, or closed with requests still queued
+    for close in ['kill', 'join']:
+        proc = mp.ForkedProcess()
+        rtime = proc._import('time')
+        radd = proc._import('numpy').add
+        rtime.sleep(10 if close == 'kill' else 0.2, _callSync='off')
+        radd(data, 1, _callSync='async')
+        assert len(sharedFiles() - before) == 1
+        getattr(proc, close)()
+        assert sharedFiles() == before
+
+
+def test_parallelizeResults():
+    before = sharedFiles()
+    results = []
+    with mp.Parallelize(range(4), workers=2, results=results) as tasker:
+        for i in tasker:
+            tasker.results.append((i, np.ones((500, 1000)) * i))
+    assert sorted([i for i, arr in results]) == range(4)
+    for i, arr in results:
+        assert arr.shape == (500, 1000) and np.all(arr == i)
+    assert sharedFiles() == before
@@ -1,11 +1,65 @@
 # -*- coding: utf-8 -*-
 from acq4.pyqtgraph.Qt import QtCore, QtGui
 from CanvasItem import CanvasItem
+import threading
 import numpy as np
 import scipy.ndimage as ndimage
 import acq4.pyqtgraph as pg
 import acq4.util.DataManager as DataManager
 import acq4.util.debug as debug
+from acq4.util.imagePyramid import ImagePyramid
+import acq4.util.imageAnalysis as imageAnalysis
+
+
+class LODImageItem(pg.ImageItem):
+    """ImageItem that can display an ImagePyramid, choosing the level that best matches 
+    the current zoom. Full-resolution data is only loaded while the image is zoomed in
+    and visible in the view; finer levels are released when no longer displayed.
+    """
+    def __init__(self, *args, **kargs):
+        pg.ImageItem.__init__(self, *args, **kargs)
+        self.pyramid = None
+        self.currentLevel = None
+
+    def setPyramid(self, pyramid):
+        """Display *pyramid*, or stop level-of-detail display if *pyramid* is None."""
+        self.pyramid = pyramid
+        self.currentLevel = None
+        if pyramid is None:
+            self.resetTransform()
+            return
+        self.showLevel(pyramid.nLevels - 1, autoLevels=True)
+        self.updateLevel()
+
+    def showLevel(self, level, autoLevels=False):
+        if level == self.currentLevel:
+            return
+        data = self.pyramid.level(level)
+        self.currentLevel = level
+        self.updateImage(data, autoLevels=autoLevels)
+        ## stretch this level to cover the same area as the full-resolution image
+        self.setRect(QtCore.QRectF(0, 0, self.pyramid.shape[0], self.pyramid.shape[1]))
+        self.pyramid.release(keep=[level])
+
+    def updateLevel(self):
+        if self.pyramid is None or self.image is None:
+            return
+        px = self.pixelLength(pg.Point(1, 0))  ## size of one screen pixel in current level pixels
+        if px is None:
+            return
+        level = self.pyramid.levelForScale(px * self.pyramid.shape[0] / float(self.image.shape[0]))
+        vr = self.viewRect()
+        if vr is not None and not vr.intersects(self.boundingRect()):
+            level = self.pyramid.nLevels - 1
+        self.showLevel(level)
+
+    def viewTransformChanged(self):
+        pg.ImageItem.viewTransformChanged(self)
+        self.updateLevel()
+
+    def viewRangeChanged(self):
+        self.updateLevel()
+
 
 class ImageCanvasItem(CanvasItem):
     def __init__(self, image=None, **opts):
@@ -16,6 +70,8 @@ class ImageCanvasItem(CanvasItem):
             image: May be a fileHandle, ndarray, or GraphicsItem.
             handle: May optionally be specified in place of image
 
+        Single images loaded from MetaArray files are displayed from an ImagePyramid; 
+        only the low-resolution levels are read until the user zooms in.
         """
 
         ## If no image was specified, check for a file handle..
@@ -23,17 +79,27 @@ class ImageCanvasItem(CanvasItem):
             image = opts.get('handle', None)
 
         item = None
-        self.data = None
+        self._data = None
+        self.pyramid = None
         self.currentT = None
+        metaInfo = None
         
         if isinstance(image, QtGui.QGraphicsItem):
             item = image
         elif isinstance(image, np.ndarray):
-            self.data = image
+            self._data = image
         elif isinstance(image, DataManager.FileHandle):
             opts['handle'] = image
             self.handle = image
-            self.data = self.handle.read()
+            if image.ext().lower() == '.ma':
+                ## reads only the file header; pixel data is loaded as needed
+                pyramid = ImagePyramid(image)
+                if ImagePyramid.isSingleImage(pyramid.shape):
+                    self.pyramid = pyramid
+                    metaInfo = pyramid.info
+            if self.pyramid is None:
+                self._data = self.handle.read()
+                metaInfo = getattr(self._data, '_info', None)
 
             if 'name' not in opts:
                 opts['name'] = self.handle.shortName()
@@ -59,10 +125,10 @@ class ImageCanvasItem(CanvasItem):
                             print 'mpos: ', m['position']
                             opts['pos'] = m['position'][0:2]
                         else:
-                            info = self.data._info[-1]
+                            info = metaInfo[-1]
                             opts['pos'] = info.get('imagePosition', None)
-                    elif hasattr(self.data, '_info'):
-                        info = self.data._info[-1]
+                    elif metaInfo is not None:
+                        info = metaInfo[-1]
                         opts['scale'] = info.get('pixelSize', None)
                         opts['pos'] = info.get('imagePosition', None)
                     else:
@@ -72,7 +138,7 @@ class ImageCanvasItem(CanvasItem):
                 debug.printExc('Error reading transformation for image file %s:' % image.name())
 
         if item is None:
-            item = pg.ImageItem()
+            item = LODImageItem()
         CanvasItem.__init__(self, item, **opts)
 
         self.histogram = pg.PlotWidget()
@@ -136,8 +202,10 @@ class ImageCanvasItem(CanvasItem):
         self.timeControls = [self.timeSlider, self.edgeBtn, self.maxBtn, self.meanBtn, self.maxBtn2,
             self.maxMedianBtn, self.filterOrder, self.zPlanes]
 
-        if self.data is not None:
-            self.updateImage(self.data)
+        if self.pyramid is not None:
+            self.showPyramid()
+        elif self._data is not None:
+            self.updateImage(self._data)
 
 
         self.graphicsItem().sigImageChanged.connect(self.updateHistogram)
@@ -155,6 +223,41 @@ class ImageCanvasItem(CanvasItem):
             return 100
         return 0
 
+    @property
+    def data(self):
+        """The full-resolution image data (this is read from disk on first access
+        if the item is displaying an image pyramid)."""
+        if self._data is None and self.pyramid is not None:
+            self._data = self.pyramid.level(0)
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        ## Data no longer matches the file; stop displaying the pyramid.
+        self._data = data
+        if self.pyramid is not None:
+            self.pyramid = None
+            if isinstance(self.graphicsItem(), LODImageItem):
+                self.graphicsItem().setPyramid(None)
+
+    def statsData(self):
+        """Return image data for computing statistics such as histograms. For image
+        pyramids this is the lowest-resolution level; otherwise it is the full data."""
+        if self.pyramid is not None:
+            return self.pyramid.statsData()
+        return self.data
+
+    def showPyramid(self):
+        for widget in self.timeControls:
+            widget.setVisible(False)
+        self.graphicsItem().setPyramid(self.pyramid)
+
+        tr = self.saveTransform()
+        self.resetUserTransform()
+        self.restoreTransform(tr)
+
+        self.updateHistogram(autoLevels=True)
+
     def timeChanged(self, t):
         self.graphicsItem().updateImage(self.data[t])
         self.currentT = t
@@ -239,7 +342,28 @@ class ImageCanvasItem(CanvasItem):
         fd = self.data[tsel,:,:].asarray().astype(float)
         filt = self.filterOrder.currentText()
         n = (int(filt) + 1) # value of 1 is no filter so start with 2
-        blur = self.tv_denoise(fd, weight=n, n_iter_max=5)
+        ## denoise in blocks of frames on worker threads so the GUI stays responsive
+        denoiser = imageAnalysis.TVDenoiser(weight=n, maxIter=5, overlap=5)
+        result = []
+        def run():
+            try:
+                result.append(denoiser.process(fd))
+            except Exception:
+                debug.printExc("Error denoising image stack:")
+        thread = threading.Thread(target=run)
+        thread.start()
+        with pg.ProgressDialog("Denoising image stack..", 0, 100) as dlg:
+            while thread.is_alive():
+                done, total = denoiser.progress()
+                if total > 0:
+                    dlg.setValue(100 * done / total)
+                QtGui.QApplication.processEvents()
+                if dlg.wasCanceled():
+                    denoiser.cancel()
+                thread.join(0.05)
+        if len(result) == 0 or result[0] is None:
+            return
+        blur = result[0]
         self.graphicsItem().updateImage(blur.max(axis=0))
         self.updateHistogram(autoLevels=True)
 
@@ -345,47 +469,7 @@ class ImageCanvasItem(CanvasItem):
         >>> mask += 0.2*np.random.randn(*mask.shape)
         >>> res = tv_denoise_3d(mask, weight=100)
         """
-        px = np.zeros_like(im)
-        py = np.zeros_like(im)
-        pz = np.zeros_like(im)
-        gx = np.zeros_like(im)
-        gy = np.zeros_like(im)
-        gz = np.zeros_like(im)
-        d = np.zeros_like(im)
-        i = 0
-        while i < n_iter_max:
-            d = - px - py - pz
-            d[1:] += px[:-1] 
-            d[:, 1:] += py[:, :-1] 
-            d[:, :, 1:] += pz[:, :, :-1] 
-        
-            out = im + d
-            E = (d**2).sum()
-
-            gx[:-1] = np.diff(out, axis=0) 
-            gy[:, :-1] = np.diff(out, axis=1) 
-            gz[:, :, :-1] = np.diff(out, axis=2) 
-            norm = np.sqrt(gx**2 + gy**2 + gz**2)
-            E += weight * norm.sum()
-            norm *= 0.5 / weight
-            norm += 1.
-            px -= 1./6.*gx
-            px /= norm
-            py -= 1./6.*gy
-            py /= norm
-            pz -= 1/6.*gz
-            pz /= norm
-            E /= float(im.size)
-            if i == 0:
-                E_init = E
-                E_previous = E
-            else:
-                if np.abs(E_previous - E) < eps * E_init:
-                    break
-                else:
-                    E_previous = E
-            i += 1
-        return out
+        return imageAnalysis.tvDenoise(im, weight, eps, n_iter_max)
  
     def _tv_denoise_2d(self, im, weight=50, eps=2.e-4, n_iter_max=200):
         """
@@ -438,40 +522,7 @@ class ImageCanvasItem(CanvasItem):
         >>> lena += 0.5 * lena.std()*np.random.randn(*lena.shape)
         >>> denoised_lena = tv_denoise(lena, weight=60.0)
         """
-        px = np.zeros_like(im)
-        py = np.zeros_like(im)
-        gx = np.zeros_like(im)
-        gy = np.zeros_like(im)
-        d = np.zeros_like(im)
-        i = 0
-        while i < n_iter_max:
-            d = -px -py
-            d[1:] += px[:-1] 
-            d[:, 1:] += py[:, :-1] 
-        
-            out = im + d
-            E = (d**2).sum()
-            gx[:-1] = np.diff(out, axis=0) 
-            gy[:, :-1] = np.diff(out, axis=1) 
-            norm = np.sqrt(gx**2 + gy**2)
-            E += weight * norm.sum()
-            norm *= 0.5 / weight
-            norm += 1
-            px -= 0.25*gx
-            px /= norm
-            py -= 0.25*gy
-            py /= norm
-            E /= float(im.size)
-            if i == 0:
-                E_init = E
-                E_previous = E
-            else:
-                if np.abs(E_previous - E) < eps * E_init:
-                    break
-                else:
-                    E_previous = E
-            i += 1
-        return out
+        return imageAnalysis.tvDenoise(im, weight, eps, n_iter_max)
 
     def tv_denoise(self, im, weight=50, eps=2.e-4, keep_type=False, n_iter_max=200):
         """
@@ -549,12 +600,9 @@ class ImageCanvasItem(CanvasItem):
         if not im_type.kind == 'f':
             im = im.astype(np.float)
 
-        if im.ndim == 2:
-            out = self._tv_denoise_2d(im, weight, eps, n_iter_max)
-        elif im.ndim == 3:
-            out = self._tv_denoise_3d(im, weight, eps, n_iter_max)
-        else:
+        if im.ndim not in (2, 3):
             raise ValueError('only 2-d and 3-d images may be denoised with this function')
+        out = imageAnalysis.tvDenoise(im, weight, eps, n_iter_max)
         if keep_type:
             return out.astype(im_type)
         else:
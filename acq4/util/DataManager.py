@@ -686,7 +686,7 @@ class DirHandle(FileHandle):
             printExc("Error while listing files in %s:" % self.name())
             files = []
         #p.mark('listdir')
-        for i in ['.index', '.log']:
+        for i in ['.index', '.log', '.pyramid']:  ## .pyramid holds cached image levels (see util.imagePyramid)
             if i in files:
                 files.remove(i)
         #self.lsCache.sort(self._cmpFileTimes)  ## very expensive!
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+LogStore.py -  Append-only, indexed storage for log entries.
+
+Log entries (dicts as generated by LogWindow.logMsg) are stored as JSON text in
+an SQLite file, with indexed columns for time, importance, message type and
+directory so that filtering a long log does not require parsing every entry.
+Appending is asynchronous: entries are queued and written in batches by a
+background thread.
+"""
+import time, json, threading, sqlite3, collections
+import numpy as np
+import acq4.util.configfile as configfile
+from acq4.util.debug import printExc
+
+
+class LogStore(object):
+    """Indexed log storage backed by an SQLite file.
+
+    *fileName* may be None (or ':memory:') to create a temporary store that is
+    never written to disk. Entries are appended with append(), which returns the
+    new entry's id immediately; the entry itself is written within *flushInterval*
+    seconds, or when flush() is called.
+    """
+    columns = ['time', 'importance', 'msgType', 'directory']
+
+    def __init__(self, fileName=None, flushInterval=0.2, cacheSize=2000):
+        if fileName is None:
+            fileName = ':memory:'
+        self.fileName = fileName
+        self.flushInterval = flushInterval
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(fileName, check_same_thread=False)
+        ## The log is append-only and writes are batched, so keeping the rollback journal
+        ## in memory is safe enough and avoids creating a journal file next to the log.
+        self.db.execute("PRAGMA journal_mode=MEMORY")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS log (
+            id INTEGER PRIMARY KEY, time REAL, importance INTEGER,
+            msgType TEXT, directory TEXT, entry TEXT)""")
+        for col in self.columns:
+            self.db.execute("CREATE INDEX IF NOT EXISTS log_%s ON log(%s)" % (col, col))
+        self.db.commit()
+
+        lastId = self.db.execute("SELECT MAX(id) FROM log").fetchone()[0]
+        self._nextId = 1 if lastId is None else lastId + 1
+        self._pending = collections.OrderedDict()  ## id: entry, not yet written
+        self._cache = collections.OrderedDict()    ## id: entry, recently read
+        self._cacheSize = cacheSize
+        self._flushed = threading.Condition(self.lock)
+        self._writeRequest = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._writeLoop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    @classmethod
+    def fromLegacyFile(cls, fileName, store=None):
+        """Read a log.txt file written by older versions of LogWindow (in configfile
+        format) and return a LogStore containing its entries. If *store* is given,
+        the entries are appended to it; otherwise a new in-memory store is created.
+        """
+        if store is None:
+            store = cls()
+        log = configfile.readConfigFile(fileName)
+        store.extend(log.values())
+        store.flush()
+        return store
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM log").fetchone()[0] + len(self._pending)
+
+    def nextId(self):
+        """Return the id that will be assigned to the next appended entry."""
+        with self.lock:
+            return self._nextId
+
+    def append(self, entry):
+        """Queue *entry* to be written and return its id (also stored as entry['id']).
+        This method does not wait for the entry to be written and may be called
+        from any thread."""
+        with self.lock:
+            eid = self._nextId
+            self._nextId += 1
+            entry['id'] = eid
+            self._pending[eid] = entry
+        self._writeRequest.set()
+        return eid
+
+    def extend(self, entries):
+        """Queue multiple entries; return the list of their ids."""
+        return [self.append(e) for e in entries]
+
+    def flush(self):
+        """Block until all queued entries have been written."""
+        with self.lock:
+            while len(self._pending) > 0 and self._writer.is_alive():
+                self._writeRequest.set()
+                self._flushed.wait()
+
+    def close(self):
+        self.flush()
+        self._closed = True
+        self._writeRequest.set()
+        self._writer.join()
+        with self.lock:
+            self.db.close()
+
+    def entry(self, eid):
+        """Return the entry with id *eid*."""
+        return self.entries([eid])[0]
+
+    def entries(self, ids):
+        """Return a list of entries for all *ids*. Entries are read from disk only
+        if they are not pending or recently used."""
+        ids = [int(i) for i in ids]
+        with self.lock:
+            found = {}
+            missing = []
+            for i in ids:
+                if i in self._pending:
+                    found[i] = self._pending[i]
+                elif i in self._cache:
+                    found[i] = self._cache[i]
+                else:
+                    missing.append(i)
+            ## read in chunks to keep the number of SQL parameters reasonable
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start+500]
+                q = "SELECT id, entry FROM log WHERE id IN (%s)" % ','.join(['?'] * len(chunk))
+                for eid, text in self.db.execute(q, chunk):
+                    found[eid] = self._cacheEntry(eid, json.loads(text))
+        return [found[i] for i in ids]
+
+    def query(self, minImportance=None, msgTypes=None, dirPrefix=None, startTime=None, stopTime=None):
+        """Return an array of the ids of all entries matching the given criteria, in order.
+
+        ==============  ======================================================
+        minImportance   Only entries with importance > minImportance
+        msgTypes        List of message types to include
+        dirPrefix       Only entries whose directory begins with this string
+        startTime       Only entries logged at or after this time (seconds since epoch)
+        stopTime        Only entries logged before this time
+        ==============  ======================================================
+        """
+        self.flush()
+        where = []
+        args = []
+        if minImportance is not None:
+            where.append("importance > ?")
+            args.append(minImportance)
+        if msgTypes is not None:
+            if len(msgTypes) == 0:
+                return np.empty(0, dtype=np.int64)
+            where.append("msgType IN (%s)" % ','.join(['?'] * len(msgTypes)))
+            args.extend(msgTypes)
+        if dirPrefix:
+            ## range comparison uses the index, unlike LIKE
+            where.append("directory >= ? AND directory < ?")
+            args.extend([dirPrefix, dirPrefix + u'\uffff'])
+        if startTime is not None:
+            where.append("time >= ?")
+            args.append(startTime)
+        if stopTime is not None:
+            where.append("time < ?")
+            args.append(stopTime)
+        q = "SELECT id FROM log"
+        if len(where) > 0:
+            q += " WHERE " + " AND ".join(where)
+        q += " ORDER BY id"
+        with self.lock:
+            rows = self.db.execute(q, args).fetchall()
+        return np.array([r[0] for r in rows], dtype=np.int64)
+
+    def matches(self, entry, minImportance=None, msgTypes=None, dirPrefix=None):
+        """Return True if *entry* would be selected by query() with the same arguments."""
+        rec = self._record(entry)
+        if minImportance is not None and not rec[1] > minImportance:
+            return False
+        if msgTypes is not None and rec[2] not in msgTypes:
+            return False
+        if dirPrefix and not rec[3].startswith(dirPrefix):
+            return False
+        return True
+
+    @staticmethod
+    def _record(entry):
+        ## values for the indexed columns of an entry
+        t = entry.get('time', None)
+        if t is None:
+            try:
+                t = time.mktime(time.strptime(entry['timestamp'], '%Y.%m.%d %H:%M:%S'))
+            except Exception:
+                t = None
+        return (t, entry.get('importance', 5), entry.get('msgType', 'status'), entry.get('currentDir', None) or '')
+
+    @staticmethod
+    def _toJson(entry):
+        try:
+            return json.dumps(entry, default=repr)
+        except UnicodeDecodeError:
+            ## non-utf8 byte strings somewhere in the entry
+            return json.dumps(entry, default=repr, encoding='latin-1')
+
+    def _cacheEntry(self, eid, entry):
+        self._cache[eid] = entry
+        while len(self._cache) > self._cacheSize:
+            self._cache.popitem(last=False)
+        return entry
+
+    def _writeLoop(self):
+        while True:
+            self._writeRequest.wait(self.flushInterval)
+            self._writeRequest.clear()
+            ## collect entries that arrive close together into one transaction
+            time.sleep(min(0.01, self.flushInterval))
+            with self.lock:
+                batch = list(self._pending.items())
+                if len(batch) > 0:
+                    rows = []
+                    for eid, entry in batch:
+                        rec = self._record(entry)
+                        rows.append((eid,) + rec + (self._toJson(entry),))
+                    try:
+                        self.db.executemany("INSERT INTO log (id, time, importance, msgType, directory, entry) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                        self.db.commit()
+                    except Exception:
+                        printExc("Error writing %d entries to log %s:" % (len(rows), self.fileName))
+                    finally:
+                        for eid, entry in batch:
+                            del self._pending[eid]
+                            self._cacheEntry(eid, entry)
+                self._flushed.notify_all()
+                if self._closed:
+                    break
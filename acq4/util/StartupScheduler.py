@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+StartupScheduler.py -  Concurrent, dependency-aware construction of devices.
+
+Devices are described by (name, driverName, config). The code for every device
+is imported in a thread pool as soon as startup begins; each device is then
+constructed once all of the devices it refers to have been constructed.
+A device refers to another device when any string in its configuration
+(other than the driver name) is the other device's name, for example
+{'device': 'DAQ', 'channel': '/Dev1/ao0'}.
+
+Construction runs in a worker thread only if the device class allows it (see
+threadedStartup in acq4.devices.Device); all other devices are constructed in
+the thread that called run(), in configuration order wherever dependencies
+allow. The import and construction times of each device are recorded and can
+be printed with report().
+"""
+import time, threading, sys, traceback
+import Queue
+from collections import OrderedDict
+
+
+class StartupScheduler(object):
+    """Construct a set of devices concurrently.
+
+    ============  ==========================================================
+    importer      importer(driverName) returns the device class
+    constructor   constructor(cls, config, name) returns the new device
+    workers       Number of worker threads. If 0, every device is imported
+                  and constructed in turn in the calling thread.
+    threaded      threaded(cls) returns True if the class may be constructed
+                  outside of the calling thread. By default, the class
+                  attribute *threadedStartup* is used.
+    ============  ==========================================================
+    """
+
+    def __init__(self, importer, constructor, workers=4, threaded=None):
+        self.importer = importer
+        self.constructor = constructor
+        self.workers = workers
+        if threaded is None:
+            threaded = lambda cls: getattr(cls, 'threadedStartup', False)
+        self.threaded = threaded
+        self.specs = OrderedDict()   ## name: (driverName, config)
+        self.records = OrderedDict() ## name: timing record
+        self.devices = OrderedDict()
+        self.wallTime = None
+        self._cond = threading.Condition()
+        self._building = set()       ## devices being constructed in a worker thread
+        self._finished = set()
+
+    def add(self, name, driverName, config):
+        if name in self.specs:
+            raise Exception("Device '%s' was already added." % name)
+        self.specs[name] = (driverName, config)
+        self.records[name] = {'driver': driverName, 'dependencies': [], 'import': None,
+                              'construct': None, 'thread': None, 'error': None}
+
+    def dependencies(self):
+        """Return a dict of {name: [names of devices it refers to]} for all added devices."""
+        names = set(self.specs.keys())
+        deps = OrderedDict()
+        for name, (driverName, config) in self.specs.items():
+            found = []
+            self._findNames(config, names, found, topLevel=True)
+            deps[name] = [n for n in found if n != name]
+        return deps
+
+    @classmethod
+    def _findNames(cls, obj, names, found, topLevel=False):
+        if isinstance(obj, basestring):
+            if obj in names and obj not in found:
+                found.append(obj)
+        elif isinstance(obj, dict):
+            for k, v in obj.items():
+                if topLevel and k == 'driver':
+                    continue
+                cls._findNames(v, names, found)
+        elif isinstance(obj, (list, tuple)):
+            for v in obj:
+                cls._findNames(v, names, found)
+
+    def isBuilding(self, name):
+        """Return True if *name* is currently being constructed in a worker thread."""
+        with self._cond:
+            return name in self._building
+
+    def wait(self, name, timeout=None):
+        """Block until device *name* has finished starting (successfully or not).
+        Return False if *timeout* seconds elapsed first."""
+        stop = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while name in self.specs and name not in self._finished:
+                if stop is None:
+                    self._cond.wait()
+                else:
+                    remaining = stop - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+        return True
+
+    def run(self):
+        """Import and construct all added devices; return an OrderedDict of
+        {name: device} (in the order devices were added) for all devices that were
+        constructed without error. Errors are recorded in the timing records
+        and printed, but do not stop other devices from starting.
+        """
+        start = time.time()
+        if self.workers < 1:
+            for name in self.specs:
+                try:
+                    cls = self._import(name)
+                except Exception:
+                    cls = None
+                self._build(name, cls, 'main')
+                self._finish(name, {})
+        else:
+            self._runPool()
+        self.wallTime = time.time() - start
+        return OrderedDict([(n, self.devices[n]) for n in self.specs if n in self.devices])
+
+    def _runPool(self):
+        from multiprocessing.pool import ThreadPool
+        deps = self.dependencies()
+        for name in deps:
+            self.records[name]['dependencies'] = deps[name]
+        events = Queue.Queue()
+        classes = {}
+        waiting = OrderedDict([(name, set(deps[name])) for name in self.specs])
+        outstanding = 0
+
+        def importJob(name):
+            try:
+                events.put(('imported', name, self._import(name)))
+            except Exception:
+                events.put(('imported', name, None))
+
+        def buildJob(name, cls):
+            try:
+                self._build(name, cls, 'worker')
+            finally:
+                events.put(('built', name, None))
+
+        pool = ThreadPool(self.workers)
+        try:
+            for name in self.specs:
+                pool.apply_async(importJob, (name,))
+                outstanding += 1
+
+            while len(waiting) > 0 or outstanding > 0:
+                ## start every device whose code is loaded and whose dependencies have finished
+                ready = [n for n in waiting if n in classes and len(waiting[n]) == 0]
+                mainReady = None
+                for name in ready:
+                    cls = classes[name]
+                    if cls is not None and self.threaded(cls):
+                        del waiting[name]
+                        with self._cond:
+                            self._building.add(name)
+                        pool.apply_async(buildJob, (name, cls))
+                        outstanding += 1
+                    elif mainReady is None:
+                        mainReady = name
+
+                if mainReady is not None:
+                    del waiting[mainReady]
+                    self._build(mainReady, classes[mainReady], 'main')
+                    self._finish(mainReady, waiting)
+                    continue
+
+                if outstanding == 0:
+                    ## nothing running and nothing ready: a dependency cycle.
+                    ## Fall back to configuration order for the first device in the cycle.
+                    name = [n for n in waiting if n in classes][0]
+                    print "Device startup: dependency cycle involving %s; ignoring its dependencies." % name
+                    waiting[name].clear()
+                    continue
+
+                event, name, cls = events.get()
+                outstanding -= 1
+                if event == 'imported':
+                    classes[name] = cls
+                else:
+                    self._finish(name, waiting)
+        finally:
+            pool.terminate()
+
+    def _finish(self, name, waiting):
+        with self._cond:
+            self._building.discard(name)
+            self._finished.add(name)
+            self._cond.notify_all()
+        for deps in waiting.values():
+            deps.discard(name)
+
+    def _import(self, name):
+        driverName = self.specs[name][0]
+        rec = self.records[name]
+        start = time.time()
+        try:
+            return self.importer(driverName)
+        except Exception:
+            rec['error'] = self._formatError("Error importing code for device %s:" % name)
+            raise
+        finally:
+            rec['import'] = time.time() - start
+
+    def _build(self, name, cls, thread):
+        rec = self.records[name]
+        if cls is None:
+            ## import failed; error was already recorded
+            return
+        rec['thread'] = thread
+        start = time.time()
+        try:
+            self.devices[name] = self.constructor(cls, self.specs[name][1], name)
+        except Exception:
+            rec['error'] = self._formatError("Error configuring device %s:" % name)
+        finally:
+            rec['construct'] = time.time() - start
+
+    def _formatError(self, msg):
+        exc = sys.exc_info()
+        tb = ''.join(traceback.format_exception(*exc))
+        print msg
+        print tb
+        return "%s: %s" % (exc[0].__name__, exc[1])
+
+    def timings(self):
+        """Return an OrderedDict of {name: record} describing how each device started.
+        Each record is a dict with keys 'driver', 'dependencies', 'import' and
+        'construct' (seconds), 'thread' ('main' or 'worker') and 'error'."""
+        return OrderedDict([(n, dict(r)) for n, r in self.records.items()])
+
+    def report(self):
+        """Return a table of device startup timings as a string."""
+        fmt = "    %-20s %-16s %10s %12s  %-7s %s"
+        lines = [fmt % ('device', 'driver', 'import ms', 'construct ms', 'thread', 'notes')]
+        for name, rec in self.records.items():
+            ms = lambda t: '-' if t is None else '%0.1f' % (t * 1000.)
+            notes = []
+            if len(rec['dependencies']) > 0:
+                notes.append('after ' + ', '.join(rec['dependencies']))
+            if rec['error'] is not None:
+                notes.append('FAILED: ' + rec['error'])
+            lines.append(fmt % (name, rec['driver'], ms(rec['import']), ms(rec['construct']), rec['thread'] or '-', '; '.join(notes)))
+        if self.wallTime is not None:
+            total = sum([(r['import'] or 0) + (r['construct'] or 0) for r in self.records.values()])
+            lines.append("    %d devices started in %0.2f s (%0.2f s if started one at a time)" % (len(self.records), self.wallTime, total))
+        return '\n'.join(lines)
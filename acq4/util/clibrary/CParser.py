@@ -9,6 +9,8 @@ signatures from C files (preferrably header files).
 """
 
 import sys, re, os
+import cPickle as pickle
+from UserDict import DictMixin
 
 __all__ = ['winDefs', 'CParser']
 
@@ -35,6 +37,78 @@ def winDefs(verbose=False):
     return p
 
 
+## First bytes of cache files written by CParser.writeCache(indexed=True)
+indexedCacheMagic = 'CParser indexed cache\n'
+
+
+class CacheData(object):
+    """Holds the pickled definitions from an indexed cache file and unpickles them on request.
+    Each definition is unpickled only once, so that a definition shared between
+    CParser.defs and CParser.fileDefs is the same object in both (as it is after importDict)."""
+    def __init__(self, data):
+        self.data = data
+        self.objs = {}
+
+    def load(self, offset, length):
+        try:
+            return self.objs[offset]
+        except KeyError:
+            obj = pickle.loads(self.data[offset:offset+length])
+            self.objs[offset] = obj
+            return obj
+
+
+class LazyDefDict(DictMixin):
+    """Dictionary of definitions, some of which may still be stored in an indexed cache.
+    Definitions are unpickled the first time they are accessed; checking for a name
+    or listing names does not unpickle anything."""
+    def __init__(self, values=None):
+        self._data = {} if values is None else dict(values)
+        self._index = {}  ## name: (CacheData, offset, length) for all definitions not loaded yet
+
+    def addIndex(self, index, data):
+        """Add definitions from *index* {name: (offset, length)}, located in CacheData *data*.
+        These replace any existing definitions with the same name."""
+        for n in set(self._data).intersection(index):
+            del self._data[n]
+        for n, (offset, length) in index.iteritems():
+            self._index[n] = (data, offset, length)
+
+    def resolved(self, name):
+        """Return True if the definition for *name* has already been unpickled."""
+        return name in self._data
+
+    def __getitem__(self, name):
+        try:
+            return self._data[name]
+        except KeyError:
+            data, offset, length = self._index[name]
+            val = data.load(offset, length)
+            self._data[name] = val
+            self._index.pop(name, None)
+            return val
+
+    def __setitem__(self, name, val):
+        self._data[name] = val
+        self._index.pop(name, None)
+
+    def __delitem__(self, name):
+        if self._index.pop(name, None) is None:
+            del self._data[name]
+
+    def __contains__(self, name):
+        return name in self._data or name in self._index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._data) + len(self._index)
+
+    def keys(self):
+        return self._data.keys() + self._index.keys()
+
+
 class CParser():
     """Class for parsing C code to extract variable, struct, enum, and function declarations as well as preprocessor macros. This is not a complete C parser; instead, it is meant to simplify the process
     of extracting definitions from header files in the absence of a complete build system. Many files 
@@ -186,7 +260,9 @@ class CParser():
         if checkValidity=True, then run several checks before loading the cache:
            - cache file must not be older than any source files
            - cache file must not be older than this library file
-           - options recorded in cache must match options used to initialize CParser"""
+           - options recorded in cache must match options used to initialize CParser
+        Definitions in indexed caches (see writeCache) are not unpickled until they are 
+        first looked up in defs or fileDefs."""
         
         ## make sure cache file exists 
         if type(cacheFile) is not str:
@@ -217,8 +293,7 @@ class CParser():
         
         try:
             ## read cache file
-            import pickle
-            cache = pickle.load(open(cacheFile, 'rb'))
+            cache = self.readCache(cacheFile)
             
             ## make sure __init__ options match (unless we can't parse the headers anyway)
             if checkValidity:
@@ -244,13 +319,31 @@ class CParser():
 
                 
             ## import all parse results
-            self.importDict(cache['fileDefs'], cache['fileOrder'])
+            if 'index' in cache:
+                self.importIndex(cache['index'], cache['fileOrder'], cache['data'])
+            else:
+                self.importDict(cache['fileDefs'], cache['fileOrder'])
             return True
         except:
             print "Warning--cache read failed:"
             sys.excepthook(*sys.exc_info())
             return False
 
+    def readCache(self, cacheFile):
+        """Read a cache file written by writeCache. Returns a dict with keys 'opts', 'version', 
+        and 'fileOrder', plus either 'fileDefs' (for caches written with indexed=False and
+        caches written by older versions of CParser) or 'index' and 'data'."""
+        fd = open(cacheFile, 'rb')
+        try:
+            if fd.read(len(indexedCacheMagic)) != indexedCacheMagic:
+                fd.seek(0)
+                return pickle.load(fd)
+            cache = pickle.load(fd)
+            cache['data'] = CacheData(fd.read())
+            return cache
+        finally:
+            fd.close()
+
     def importDict(self, data, order):
         """Import definitions from a dictionary. The dict format should be the
         same as CParser.fileDefs. Used internally; does not need to be called
@@ -262,17 +355,61 @@ class CParser():
                 for n in data[f][k]:
                     self.addDef(k, n, data[f][k][n])
 
-    def writeCache(self, cacheFile):
-        """Store all parsed declarations to cache. Used internally."""
+    def importIndex(self, index, order, data):
+        """Import definitions from an indexed cache. This has the same effect as importDict,
+        except that each definition is only unpickled from *data* the first time it is 
+        looked up. Used internally; does not need to be called manually."""
+        for f in order:
+            f = os.path.split(f)[1]
+            self.currentFile = f
+            if f not in self.fileDefs:
+                self.fileDefs[f] = {}
+                for k in self.dataList:
+                    self.fileDefs[f][k] = {}
+            for k in self.dataList:
+                for defs in (self.defs, self.fileDefs[f]):
+                    if not isinstance(defs[k], LazyDefDict):
+                        defs[k] = LazyDefDict(defs[k])
+                    defs[k].addIndex(index[f][k], data)
+
+    def writeCache(self, cacheFile, indexed=True):
+        """Store all parsed declarations to cache. Used internally.
+        
+        If *indexed* is True, each definition is pickled separately and the cache begins
+        with an index of {file: {type: {name: (offset, length)}}}; loading the cache then 
+        only requires unpickling the index (see importIndex). Otherwise, the cache is 
+        a single pickled dict containing fileDefs."""
         cache = {}
         cache['opts'] = self.initOpts
-        cache['fileDefs'] = self.fileDefs
         cache['fileOrder'] = self.fileOrder
         cache['version'] = self.cacheVersion
         #for k in self.dataList:
             #cache[k] = getattr(self, k)
-        import pickle
-        pickle.dump(cache, open(cacheFile, 'wb'))
+        fd = open(cacheFile, 'wb')
+        try:
+            if not indexed:
+                cache['fileDefs'] = self.fileDefs
+                pickle.dump(cache, fd)
+                return
+            
+            index = {}
+            blobs = []
+            offset = 0
+            for f, defs in self.fileDefs.items():
+                index[f] = {}
+                for k in self.dataList:
+                    index[f][k] = {}
+                    for n, val in defs[k].items():
+                        blob = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+                        index[f][k][n] = (offset, len(blob))
+                        blobs.append(blob)
+                        offset += len(blob)
+            cache['index'] = index
+            fd.write(indexedCacheMagic)
+            pickle.dump(cache, fd, pickle.HIGHEST_PROTOCOL)
+            fd.write(''.join(blobs))
+        finally:
+            fd.close()
 
     def loadFile(self, file, replace=None):
         """Read a file, make replacements if requested. Called by __init__, should
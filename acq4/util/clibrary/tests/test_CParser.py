@@ -0,0 +1,70 @@
+import os, sys, tempfile, shutil
+from acq4.util.clibrary.CParser import CParser, LazyDefDict
+
+clibDir = os.path.join(os.path.dirname(__file__), '..')
+nidaqDir = os.path.join(clibDir, '..', '..', 'drivers', 'nidaq')
+
+
+def checkLazy(lazy, eager):
+    """Check that every definition in *lazy* is unpickled on first access and equals
+    the definition in *eager*."""
+    for f in eager.fileDefs:
+        if f is None:
+            continue  ## definitions passed to __init__ are not read from the cache
+        for k in eager.dataList:
+            assert isinstance(lazy.fileDefs[f][k], LazyDefDict)
+            assert sorted(lazy.fileDefs[f][k].keys()) == sorted(eager.fileDefs[f][k].keys())
+            for n in eager.fileDefs[f][k]:
+                assert not lazy.fileDefs[f][k].resolved(n)
+    for k in eager.dataList:
+        assert isinstance(lazy.defs[k], LazyDefDict)
+        assert sorted(lazy.defs[k].keys()) == sorted(eager.defs[k].keys())
+        for n in eager.defs[k]:
+            assert n in lazy.defs[k]
+            assert lazy.defs[k][n] == eager.defs[k][n]
+            assert lazy.defs[k].resolved(n)
+
+
+def test_lazyCache():
+    tmp = tempfile.mkdtemp()
+    try:
+        header = os.path.join(clibDir, 'testHeader.h')
+        cache = os.path.join(tmp, 'test.cache')
+        eager = CParser(header, cache=cache, macros={'UNICODE': ''})
+        assert len(eager.defs['functions']) > 0 and len(eager.defs['structs']) > 0
+
+        lazy = CParser(header, cache=cache, checkCache=True, macros={'UNICODE': ''})
+        checkLazy(lazy, eager)
+
+        ## definitions are shared between defs and fileDefs, as they are when loaded eagerly
+        f = os.path.basename(header)
+        for n in eager.fileDefs[f]['structs']:
+            assert lazy.fileDefs[f]['structs'][n] is lazy.defs['structs'][n]
+        assert lazy.find('NESTMACRO3') == eager.find('NESTMACRO3')
+
+        ## caches written by older versions of CParser are still readable
+        legacy = os.path.join(tmp, 'legacy.cache')
+        eager.writeCache(legacy, indexed=False)
+        p = CParser(header, cache=legacy, checkCache=True, macros={'UNICODE': ''})
+        assert p.defs == eager.defs
+        assert type(p.defs['values']) is dict
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_nidaqCache():
+    tmp = tempfile.mkdtemp()
+    try:
+        header = os.path.join(nidaqDir, 'NIDAQmx.h')
+        lazy = CParser(header, cache=os.path.join(nidaqDir, 'NIDAQmx_headers_%s.cache' % sys.platform), types={'__int64': ('long long')})
+        assert len(lazy.defs['functions']) > 1000
+        assert not any([lazy.defs['functions'].resolved(n) for n in lazy.defs['functions']])
+
+        ## load the same definitions eagerly from a cache written in the old format
+        legacy = os.path.join(tmp, 'legacy.cache')
+        lazy.writeCache(legacy, indexed=False)
+        eager = CParser(header, cache=legacy, types={'__int64': ('long long')})
+        lazy = CParser(header, cache=os.path.join(nidaqDir, 'NIDAQmx_headers_%s.cache' % sys.platform), types={'__int64': ('long long')})
+        checkLazy(lazy, eager)
+    finally:
+        shutil.rmtree(tmp)
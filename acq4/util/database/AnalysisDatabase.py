@@ -31,6 +31,7 @@ class AnalysisDatabase(SqliteDatabase):
         create = False
         self.tableConfigCache = None
         self.columnConfigCache = advancedTypes.CaselessDict()
+        self.dirRowIdCache = {}  ## (table.lower(), dirName): rowid; see _tableModified()
         
         self.setDataModel(dataModel)
         self._baseDir = None
@@ -222,6 +223,7 @@ class AnalysisDatabase(SqliteDatabase):
         """Sets the base dir which prefixes all file names in the database. Must be a DirHandle."""
         self.setCtrlParam('BaseDirectory', baseDir.name())
         self._baseDir = baseDir
+        self.dirRowIdCache = {}  ## keys are relative to the base dir
 
     def ctrlParam(self, param):
         res = SqliteDatabase.select(self, 'DbParameters', ['Value'], sql="where Param='%s'"%param)
@@ -411,43 +413,102 @@ class AnalysisDatabase(SqliteDatabase):
         return tableName
     
     def addDir(self, handle):
-        """Create a record based on a DirHandle and its meta-info."""
-        info = handle.info().deepcopy()
-        for k in info:  ## replace tuple keys with strings
-            if isinstance(k, tuple):
-                n = "_".join(k)
-                info[n] = info[k]
-                del info[k]
+        """Create a record based on a DirHandle and its meta-info.
+        Returns (table, rowid); if the directory is already in the DB, its existing rowid is returned."""
+        table = self.dirTableName(handle)
+        return table, self.addDirs([handle], table)[handle]
+
+    def addDirs(self, handles, table):
+        """Return {handle: rowid} for all DirHandles in *handles*, which must all belong in
+        directory table *table*. 
+        
+        Directories already in the DB are found with one query per few hundred directories.
+        Records for the remaining directories (and, recursively, their parent directories)
+        are created from their meta-info and inserted with a single insertMany().
+        """
+        handles = set([h for h in handles if h is not None])
+        rowids = {}
+        missing = []
+        for dh in handles:
+            rid = self.dirRowIdCache.get((table.lower(), self._dirKey(dh)), None)
+            if rid is None:
+                missing.append(dh)
+            else:
+                rowids[dh] = rid
+        if len(missing) == 0:
+            return rowids
+        
+        for dh in missing:
+            if self.dirTableName(dh).lower() != table.lower():
+                linkType = self.getTableConfig(table)['DirType'] if self.hasTable(table) else table
+                raise Exception("Trying to use directory '%s' (type='%s') in table %s, which is for directories of type '%s'." % (dh.name(), self.dataModel().dirType(dh), table, linkType))
         
         with self.transaction():
-            table = self.dirTableName(handle)
-            if not self.hasTable(table):
-                self.createDirTable(handle)
-            
-            ## make sure dir is not already in DB.
-            ## if it is, just return the row ID
-            rid = self.getDirRowID(handle)
-            if rid is not None:
-                return table, rid
-            
-            ## find all directory columns, make sure linked directories are present in DB
-            conf = self.getColumnConfig(table)
-            for colName, col in conf.iteritems():
-                if col['Type'].startswith('directory'):
-                    #pTable = col['Link']
-                    pType = col['Type'].lstrip('directory:')
-                    parent = self.dataModel().getParent(handle, pType)
-                    if parent is not None:
-                        self.addDir(parent)
-                        info[colName] = parent
-                    else:
-                        info[colName] = None
-            
-            info['Dir'] = handle
-            
-            self.insert(table, info, ignoreExtraColumns=True)
-            
-            return table, self.lastInsertRow()
+            if self.hasTable(table):
+                rowids.update(self._findDirRowIds(table, missing))
+                missing = [dh for dh in missing if dh not in rowids]
+            else:
+                self.createDirTable(missing[0])
+            
+            if len(missing) > 0:
+                ## find all directory columns; linked directories are added by _prepareData
+                conf = self.getColumnConfig(table)
+                dirCols = [(colName, col['Type'].lstrip('directory:')) for colName, col in conf.iteritems() if col['Type'].startswith('directory')]
+                schema = self.tableSchema(table)
+                records = []
+                for dh in missing:
+                    info = dh.info().deepcopy()
+                    for k in info.keys():  ## replace tuple keys with strings
+                        if isinstance(k, tuple):
+                            info["_".join(k)] = info[k]
+                            del info[k]
+                    rec = dict([(k, v) for k, v in info.items() if k in schema])
+                    for colName, pType in dirCols:
+                        rec[colName] = self.dataModel().getParent(dh, pType)
+                    rec['Dir'] = dh
+                    records.append(rec)
+                    
+                ## records must all have the same columns for a batch insert
+                columns = set()
+                for rec in records:
+                    columns.update(rec.keys())
+                records = [dict([(k, rec.get(k, None)) for k in columns]) for rec in records]
+                self.insertMany(table, records)
+                rowids.update(self._findDirRowIds(table, missing))
+        return rowids
+        
+    def _findDirRowIds(self, table, handles):
+        ## Look up the rowids of directories in *table*, a few hundred at a time.
+        ## Returns {handle: rowid} for the directories that were found, and caches the results.
+        keys = dict([(dh, self._dirKey(dh)) for dh in handles])
+        uniqueKeys = list(set(keys.values()))
+        found = {}
+        for start in range(0, len(uniqueKeys), 400):
+            chunk = uniqueKeys[start:start+400]
+            ## names may have been stored with either path separator
+            names = chunk + [n.replace('/', '\\') for n in chunk]
+            cmd = 'select rowid, Dir from "%s" where Dir in (%s)' % (table, ','.join(['?'] * len(names)))
+            for rec in self.db.execute(cmd, names):
+                key = rec[1].replace('\\', '/')
+                if key not in found or rec[0] < found[key]:
+                    found[key] = rec[0]
+        for key, rid in found.items():
+            self.dirRowIdCache[(table.lower(), key)] = rid
+        return dict([(dh, found[keys[dh]]) for dh in handles if keys[dh] in found])
+        
+    def _dirKey(self, dirHandle):
+        ## name of a directory as used in dirRowIdCache
+        return dirHandle.name(relativeTo=self.baseDir()).replace('\\', '/')
+        
+    def _tableModified(self, table):
+        ## rows may have been deleted or replaced; forget cached row IDs
+        if table is None:
+            self.dirRowIdCache = {}
+        else:
+            table = table.lower()
+            for k in self.dirRowIdCache.keys():
+                if k[0] == table:
+                    del self.dirRowIdCache[k]
 
 
     def createView(self, viewName, tables):
@@ -578,6 +639,9 @@ class AnalysisDatabase(SqliteDatabase):
 
     def getDirRowID(self, dirHandle):
         table = self.dirTableName(dirHandle)
+        key = (table.lower(), self._dirKey(dirHandle))
+        if key in self.dirRowIdCache:
+            return self.dirRowIdCache[key]
             
         if not self.hasTable(table):
             return None
@@ -588,6 +652,7 @@ class AnalysisDatabase(SqliteDatabase):
         if len(rec) < 1:
             return None
         #print rec[0]
+        self.dirRowIdCache[key] = rec[0]['rowid']
         return rec[0]['rowid']
 
     def getDir(self, table, rowid):
@@ -767,32 +832,24 @@ class AnalysisDatabase(SqliteDatabase):
                 linkTable = colConf['Link']
                 if linkTable is None:
                     raise Exception('Column "%s" is type "%s" but is not linked to any table.' % (colName, colConf['Type']))
-                rowids = {None: None}
-                for dh in set(handles):
-                    if dh is None:
-                        continue
-                    dirTable, rid = self.addDir(dh)
-                    if dirTable != linkTable:
-                        linkType = self.getTableConfig(linkTable)['DirType']
-                        dirType = self.getTableConfig(dirTable)['DirType']
-                        raise Exception("Trying to use directory '%s' (type='%s') for column %s.%s, but this column is for directories of type '%s'." % (dh.name(), dirType, table, colName, linkType))
-                    rowids[dh] = rid
+                
+                rowids = self.addDirs(handles, linkTable)
+                rowids[None] = None
                     
                 ## convert dirhandles to rowids
                 data[colName] = map(rowids.get, handles)
             elif colConf.get('Type', None) == 'file':
-                ## convert filehandles to strings
-                files = []
-                for f in data[colName]:
+                ## convert filehandles to strings; many records usually share a few files
+                names = {None: None}
+                for f in set(data[colName]):
                     if f is None:
-                        files.append(None)
-                    else:
-                        try:
-                            files.append(f.name(relativeTo=self.baseDir()))
-                        except:
-                            print "f:", f
-                            raise
-                data[colName] = files
+                        continue
+                    try:
+                        names[f] = f.name(relativeTo=self.baseDir())
+                    except:
+                        print "f:", f
+                        raise
+                data[colName] = map(names.get, data[colName])
 
         newData = SqliteDatabase._prepareData(self, table, data, ignoreUnknownColumns, batch)
         
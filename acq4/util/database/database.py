@@ -30,6 +30,7 @@ class SqliteDatabase:
         self.db.row_factory = sqlite3.Row
         self.db.isolation_level = None
         self.tables = None
+        self._converterCache = {}  ## table.lower(): (schema, {column: converter}); cleared when the schema is re-read
         self._transactions = []
         self._readTableList()
         
@@ -53,7 +54,8 @@ class SqliteDatabase:
                       For each record, data is bound to the query by key name
                       {"key1": "value1"}  =>  ":key1"="value1"
             batch   - If True, then all input data is processed in a single execution.
-                      In this case, data must be provided as a dict-of-lists or record array.
+                      In this case, data must be provided as a dict-of-lists or record array,
+                      or as a list of tuples to be bound to positional ('?') parameters.
             toDict  - If True, return a list-of-dicts representation of the query results
             toArray - If True, return a record array representation of the query results
         """
@@ -63,6 +65,8 @@ class SqliteDatabase:
         if data is None:
             cur = self.db.execute(cmd)
             p.mark("Executed with no data")
+        elif batch and isinstance(data, list) and (len(data) == 0 or isinstance(data[0], tuple)):
+            cur = self.db.executemany(cmd, data)
         else:
             data = TableData(data)
             res = []
@@ -75,8 +79,16 @@ class SqliteDatabase:
                     p.mark("executed with data")
 
         if cmd is not None:
-            if str(cmd)[:6].lower() == 'create':
+            verb = str(cmd).lstrip()[:7].lower()
+            if verb.startswith(('create', 'drop', 'alter')):
                 self.tables = None  ## clear table cache
+                self._tableModified(None)
+            elif verb.startswith(('delete', 'update', 'replace', 'insert')):
+                m = _modifiedTable.match(str(cmd))
+                if m is not None:
+                    self._tableModified(m.group(1))
+                elif not verb.startswith('insert'):
+                    self._tableModified(None)
                 
         if toArray:
             ret = self._queryToArray(cur)
@@ -173,8 +185,22 @@ class SqliteDatabase:
         ignoreExtraColumns    If True, ignore any extra columns in the data that do not exist in the table
         ====================  =======================================
         """
-        for n,nmax in self.iterInsert(table=table, records=records, replaceOnConflict=replaceOnConflict, ignoreExtraColumns=ignoreExtraColumns, chunkAll=True, **args):
+        if records is None:
+            records = [args]
+        self.insertMany(table, records, replaceOnConflict=replaceOnConflict, ignoreExtraColumns=ignoreExtraColumns)
+        
+    def insertMany(self, table, records, replaceOnConflict=False, ignoreExtraColumns=False):
+        """Insert many records into table in a single transaction and a single statement execution.
+        
+        Records are converted one column at a time (see _prepareData), so this is 
+        the preferred method for large inserts, especially when *records* is a 
+        dict-of-lists or record array. Returns the number of records inserted.
+        See insert() for a description of the arguments.
+        """
+        n = 0
+        for n,nmax in self.iterInsert(table=table, records=records, replaceOnConflict=replaceOnConflict, ignoreExtraColumns=ignoreExtraColumns, chunkAll=True):
             pass
+        return n
         
     def iterInsert(self, table, records=None, replaceOnConflict=False, ignoreExtraColumns=False, chunkSize=500, chunkAll=False, **args):
         """
@@ -199,7 +225,7 @@ class SqliteDatabase:
 
         with self.transaction():
             ## Rememember that _prepareData may change the number of columns!
-            records = TableData(self._prepareData(table, records, ignoreUnknownColumns=ignoreExtraColumns, batch=True))
+            records = self._prepareData(table, records, ignoreUnknownColumns=ignoreExtraColumns, batch=True)
             p.mark("prepared data")
 
             columns = records.keys()
@@ -207,20 +233,22 @@ class SqliteDatabase:
             if replaceOnConflict:
                 insert += " OR REPLACE"
             #print "Insert:", columns
-            cmd = "%s INTO %s (%s) VALUES (%s)" % (insert, table, quoteList(columns), ','.join([':'+f for f in columns]))
+            cmd = "%s INTO %s (%s) VALUES (%s)" % (insert, table, quoteList(columns), ','.join(['?'] * len(columns)))
+            ## bind rows as tuples; much faster than building one dict per record
+            rows = zip(*[records[c] for c in columns])
+            p.mark("assembled rows")
 
-            numRecs = len(records)
+            numRecs = len(rows)
             if chunkAll: ## insert all records in one go.
-                self.exe(cmd, records, batch=True)
+                self.exe(cmd, rows, batch=True)
                 yield (numRecs, numRecs)
                 return
 
             chunkSize = int(chunkSize) ## just make sure
             offset = 0
             i = 0
-            while offset < len(records):
-                #print len(columns), len(records[0]), len(self.tableSchema(table))
-                chunk = records[offset:offset+chunkSize]
+            while offset < numRecs:
+                chunk = rows[offset:offset+chunkSize]
                 self.exe(cmd, chunk, batch=True)
                 offset += len(chunk)
                 yield (offset, numRecs)
@@ -340,6 +368,26 @@ class SqliteDatabase:
             self._readTableList()
         return self.tables[table].copy()  ## this is a case-insensitive operation
     
+    def _columnConverters(self, table):
+        """Return (schema, {column: converter}) for *table*. The result is cached until
+        the table list is next re-read, and must not be modified."""
+        if self.tables is None:
+            self._readTableList()
+        key = table.lower()
+        if key not in self._converterCache:
+            schema = self.tables[table]
+            converters = {}
+            for k, typ in schema.items():
+                converters[k] = _typeConverters.get(typ.lower(), _identity)
+            self._converterCache[key] = (schema, converters)
+        return self._converterCache[key]
+        
+    def _tableModified(self, table):
+        """Called after rows of *table* may have been changed or removed (by delete, update,
+        replace, drop, or a rolled-back transaction). If *table* is None, any table may have changed.
+        Subclasses that cache table contents should override this method."""
+        pass
+    
     def tableLength(self, table):
         return self('select count(*) from "%s"' % table)[0]['count(*)']
     
@@ -362,64 +410,42 @@ class SqliteDatabase:
         ##   - data destined for BLOB columns is pickled
         ##   - numerical columns convert to int or float
         ##   - text columns convert to unicode
-        ## converters may be a dict of {'columnName': function} 
-        ## that overrides the default conversion funcitons.
+        ## Conversion is done one column at a time using converters cached per table.
         
         ## Returns a dict-of-lists if batch=True, otherwise list-of-dicts
         data = TableData(data)
+        schema, converters = self._columnConverters(table)
         
-        converters = {}
-            
-        ## determine the conversion functions to use for each column.
-        schema = self.tableSchema(table)
-        for k in schema:
-            if k in converters:
+        newData = collections.OrderedDict()
+        for k in data.columnNames():
+            if k not in schema and ignoreUnknownColumns:
                 continue
-            
-            typ = schema[k].lower()
-            if typ == 'blob':
-                converters[k] = lambda obj: buffer(pickle.dumps(obj))
-            elif typ == 'int':
-                converters[k] = int
-            elif typ == 'real':
-                converters[k] = float
-            elif typ == 'text':
-                converters[k] = str
-            else:
-                converters[k] = lambda obj: obj
-                
+            newData[k] = self._convertColumn(table, k, data[k], schema, converters.get(k, None))
+        
         if batch:
-            newData = dict([(k,[]) for k in data.columnNames() if not (ignoreUnknownColumns and (k not in schema))])
-        else:
-            newData = []
-            
-        for rec in data:
-            newRec = {}
-            for k in rec:
-                if k not in schema:
-                    if ignoreUnknownColumns:
-                        continue
-                    #if addUnknownColumns:  ## Is this just a bad idea?
-                        #dtyp = self.suggestColumnType(rec[k])
-                        #self.addColumn(table, k, dtyp)
-                if rec[k] is None:
-                    newRec[k] = None
-                else:
-                    try:
-                        newRec[k] = converters[k](rec[k])
-                    except:
-                        newRec[k] = rec[k]
-                        if k.lower() != 'rowid':
-                            if k not in schema:
-                                raise Exception("Column '%s' not present in table '%s'" % (k, table))
-                            print "Warning: Setting %s column %s.%s with type %s" % (schema[k], table, k, str(type(rec[k])))
-            if batch:
-                for k in newData:
-                    newData[k].append(newRec.get(k, None))
-            else:
-                newData.append(newRec)
-        #print "new data:", newData
-        return newData
+            return newData
+        cols = newData.items()
+        return [dict([(k, v[i]) for k, v in cols]) for i in xrange(len(data))]
+        
+    def _convertColumn(self, table, name, values, schema, conv):
+        ## Convert all values destined for one column; returns a list.
+        if isinstance(values, np.ndarray) and ((conv is float and values.dtype.kind in 'biuf') or
+                                               (conv is int and values.dtype.kind in 'biu')):
+            return values.astype(conv).tolist()
+        out = []
+        for v in values:
+            if v is None:
+                out.append(None)
+                continue
+            try:
+                out.append(conv(v))
+            except:
+                out.append(v)
+                if name.lower() != 'rowid':
+                    if name not in schema:
+                        raise Exception("Column '%s' not present in table '%s'" % (name, table))
+                    print "Warning: Setting %s column %s.%s with type %s" % (schema[name], table, name, str(type(v)))
+        return out
 
     def _queryToDict(self, q):
         prof = debug.Profiler("_queryToDict", disabled=True)
@@ -474,9 +500,20 @@ class SqliteDatabase:
             tables[table] = columns
             
         self.tables = tables
+        self._converterCache = {}
+
+
+def _pickleBlob(obj):
+    return buffer(pickle.dumps(obj))
 
+def _identity(obj):
+    return obj
 
+## conversion functions used for values stored in columns of each type
+_typeConverters = {'blob': _pickleBlob, 'int': int, 'real': float, 'text': str}
 
+## extracts the table name from data-modifying SQL commands
+_modifiedTable = re.compile(r'\s*(?:delete\s+from|update(?:\s+or\s+\w+)?|replace\s+into|insert\s+or\s+replace\s+into)\s+["\']?(\w+)', re.I)
 
 
 def quoteList(strns):
@@ -506,6 +543,7 @@ class Transaction:
             try:
                 self.db('ROLLBACK TRANSACTION TO %s' % self.name)
                 self.db.tables = None  ## make sure we are forced to re-read the table list after the rollback.
+                self.db._tableModified(None)
             except Exception:
                 print "WARNING: Error occurred during transaction and rollback failed."
                 
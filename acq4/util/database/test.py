@@ -83,3 +83,132 @@ def testBatchInsert():
     
     for i, row in enumerate(db.iterSelect('t', limit=1)):
         assert tuple(row[0].values()) == tuple(data[i])
+
+
+def testInsertMany():
+    """Check that column-wise bulk inserts match record-by-record inserts, and that
+    cached converters follow schema changes."""
+    db = SqliteDatabase()
+    db("create table 't' ('int' int, 'real' real, 'text' text, 'blob' blob)")
+    n = 1000
+    data = {
+        'int': np.arange(n),
+        'real': np.linspace(0, 1, n),
+        'text': ['row %d' % i for i in range(n)],
+        'blob': [(i, 'x') if i % 2 else None for i in range(n)],
+    }
+    assert db.insertMany('t', data) == n
+    for i in range(n):
+        db.insert('t', {'int': int(data['int'][i]), 'real': float(data['real'][i]), 'text': data['text'][i], 'blob': data['blob'][i]})
+    
+    result = db.select('t')
+    assert len(result) == 2 * n
+    for i in range(n):
+        assert result[i] == result[i+n]
+        assert type(result[i]['int']) is int and type(result[i]['real']) is float
+    assert result[3]['blob'] == (3, 'x') and result[4]['blob'] is None
+    
+    ## converters are rebuilt when the table changes
+    db.addColumn('t', 'extra', 'real')
+    db.insertMany('t', {'int': np.array([1]), 'extra': np.array([2], dtype=np.int32)})
+    assert db.select('t', ['extra'], sql='where extra is not null') == [{'extra': 2.0}]
+    db('drop table t')
+    db("create table 't' ('int' text)")
+    db.insertMany('t', {'int': np.array([5])})
+    assert db.select('t') == [{'int': u'5'}]
+
+
+def makeAnalysisDb(tmpdir, nSequences=3, nProtocols=4):
+    """Return an AnalysisDatabase with Protocol and ProtocolSequence directory tables,
+    and a list of (protocolDir, sequenceDir) handles."""
+    from acq4.util import DataManager
+    from acq4.util.database.AnalysisDatabase import AnalysisDatabase
+    import acq4.analysis.dataModels.PatchEPhys as PatchEPhys
+    if DataManager.DataManager.INSTANCE is None:
+        DataManager.DataManager()
+    baseDir = DataManager.getDirHandle(str(tmpdir.join('data')), create=True)
+    dirs = []
+    for i in range(nSequences):
+        seq = baseDir.mkdir('map_%03d' % i, info={'dirType': 'ProtocolSequence'})
+        for j in range(nProtocols):
+            dirs.append((seq.mkdir('%03d' % j, info={'dirType': 'Protocol'}), seq))
+    db = AnalysisDatabase(str(tmpdir.join('db.sqlite')), dataModel=PatchEPhys, baseDir=baseDir)
+    db.createTable('DirTable_ProtocolSequence', [('Dir', 'file')], dirType='ProtocolSequence')
+    db.createTable('DirTable_Protocol', [('ProtocolSequenceDir', 'directory:ProtocolSequence'), ('Dir', 'file')], dirType='Protocol')
+    return db, dirs
+
+
+def testAddDirs(tmpdir):
+    db, dirs = makeAnalysisDb(tmpdir)
+    protos = [p for p, s in dirs]
+    rowids = db.addDirs(protos + [None, protos[0]], 'DirTable_Protocol')
+    assert set(rowids.keys()) == set(protos)
+    assert len(set(rowids.values())) == len(protos)
+    assert db.tableLength('DirTable_Protocol') == len(protos)
+    ## parent directories are added as well
+    assert db.tableLength('DirTable_ProtocolSequence') == 3
+    for p, s in dirs:
+        assert db.getDir('DirTable_Protocol', rowids[p]).name() == p.name()
+        rec = db.select('DirTable_Protocol', sql='where rowid=%d' % rowids[p])[0]
+        assert rec['ProtocolSequenceDir'].name() == s.name()
+        assert db.addDir(p) == ('DirTable_Protocol', rowids[p])
+    
+    ## directories that are already present are not inserted again
+    assert db.addDirs(protos, 'DirTable_Protocol') == rowids
+    assert db.tableLength('DirTable_Protocol') == len(protos)
+    
+    ## directories must match the table type
+    try:
+        db.addDirs([dirs[0][1]], 'DirTable_Protocol')
+    except Exception:
+        pass
+    else:
+        raise AssertionError("addDirs should reject a directory of the wrong type")
+
+
+def testDirRowIdCache(tmpdir):
+    db, dirs = makeAnalysisDb(tmpdir)
+    protos = [p for p, s in dirs]
+    rowids = db.addDirs(protos, 'DirTable_Protocol')
+    
+    ## cached row IDs are returned without querying the DB
+    def noQuery(*args):
+        raise AssertionError("row ID should have been cached")
+    db._findDirRowIds = noQuery
+    assert db.addDirs(protos, 'DirTable_Protocol') == rowids
+    assert db.getDirRowID(protos[2]) == rowids[protos[2]]
+    del db._findDirRowIds
+    
+    ## deleting a row clears the cached row IDs of that table only
+    last = protos[-1]
+    db.delete('DirTable_Protocol', {'rowid': rowids[last]})
+    assert not any([k[0] == 'dirtable_protocol' for k in db.dirRowIdCache])
+    assert any([k[0] == 'dirtable_protocolsequence' for k in db.dirRowIdCache])
+    assert db.getDirRowID(last) is None
+    ## sqlite may reuse the deleted row ID; the stale entry must not be returned for another dir
+    rid = db.addDir(last)[1]
+    assert db.getDir('DirTable_Protocol', rid).name() == last.name()
+    assert db.getDirRowID(last) == rid
+    assert db.tableLength('DirTable_Protocol') == len(protos)
+    
+    ## updating rows also invalidates the cache
+    db.getDirRowID(protos[0])
+    db.update('DirTable_Protocol', {'Dir': protos[1]}, rowid=rowids[protos[0]])
+    assert not any([k[0] == 'dirtable_protocol' for k in db.dirRowIdCache])
+    
+    ## directories added in a rolled-back transaction are forgotten
+    db2, dirs2 = makeAnalysisDb(tmpdir.mkdir('rollback'))
+    try:
+        with db2.transaction():
+            db2.addDirs([p for p, s in dirs2], 'DirTable_Protocol')
+            raise ValueError()
+    except ValueError:
+        pass
+    assert db2.dirRowIdCache == {}
+    assert db2.tableLength('DirTable_Protocol') == 0
+    assert db2.getDirRowID(dirs2[0][0]) is None
+    
+    ## cache keys are relative to the base dir, so changing it clears the cache
+    db.getDirRowID(protos[0])
+    db.setBaseDir(dirs[0][1])
+    assert db.dirRowIdCache == {}
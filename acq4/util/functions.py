@@ -9,11 +9,13 @@ siFormat / siEval  - functions for dealing with numbers in SI notation
 downsample - multidimensional downsampling by mean
 rmsMatch / fastRmsMatch - recursive template matching
 makeDispMap / matchDistortImg - for measuring and correcting motion/distortion between two images
+phaseCorrelate / pyramidRegister / registerStack - FFT image registration
+affineSliceWeights / weightedTraces - ROI means over many frames as one sparse product
 
 
 """
 import sys
-import os, re, math, time, threading, decimal
+import os, re, math, threading, decimal, collections
 from acq4.util.metaarray import *
 #from scipy import *
 #from scipy.optimize import leastsq
@@ -144,12 +146,32 @@ def fitExpDecay(xVals, yVals, guess=[1.0, 1.0, 0.0], **kargs):
 
 
 def pspInnerFunc(x, rise, decay, power):
+    if np.ndim(rise) > 0 or np.ndim(decay) > 0:
+        ## per-row taus (used by the batched fits). Clipping x at 0 gives 0 for
+        ## the baseline without the cost of masking broadcast arrays.
+        x = np.maximum(x, 0)
+        return (1.0 - np.exp(-x / rise))**power * np.exp(-x / decay)
     out = np.zeros(x.shape, x.dtype)
     mask = x >= 0
     xvals = x[mask]
     out[mask] =  (1.0 - np.exp(-xvals / rise))**power * np.exp(-xvals / decay)
     return out
 
+def pspInnerJacobian(x, rise, decay, power):
+    """Return pspInnerFunc along with its partial derivatives with respect to 
+    x, rise, and decay: (value, dx, drise, ddecay).
+    Arguments are broadcast against each other as in pspInnerFunc."""
+    t = np.maximum(x, 0)
+    riseExp = np.exp(-t / rise)
+    decayExp = np.exp(-t / decay)
+    riseTerm = (1.0 - riseExp)**(power-1)
+    g = riseTerm * (1.0 - riseExp) * decayExp
+    riseTerm *= power * riseExp * decayExp
+    dx = (riseTerm / rise - g / decay) * (x > 0)
+    dr = -riseTerm * t / rise**2
+    dd = g * t / decay**2
+    return g, dx, dr, dd
+
 def pspMaxTime(rise, decay, risePower=2.0):
     """Return the time from start to peak for a psp with given parameters."""
     return rise * np.log(1 + (decay * risePower / rise))
@@ -185,8 +207,14 @@ def fitPsp(x, y, guess, bounds=None, risePower=2.0, multiFit=False):
         NOTE: This fit is more likely to converge correctly if the guess amplitude 
         is larger (about 2x) than the actual amplitude.
         
-        if multiFit is True, then attempt to improve the fit by brute-force searching
-        and re-fitting. (this is very slow)
+        if multiFit is True, then the guess is first improved by a coarse grid search
+        over xoffset, rise, and fall (see pspGridGuess).
+        
+        Rise and fall taus are kept positive; any bound left as None for these is
+        replaced with half of the sample interval.
+        
+        A single event is fit by the same bounded Levenberg-Marquardt method as 
+        fitPspBatch (see _pspLevMarSingle); use fitPspBatch to fit many events at once.
     """
     if guess is None:
         guess = [
@@ -195,69 +223,210 @@ def fitPsp(x, y, guess, bounds=None, risePower=2.0, multiFit=False):
             x[-1]*0.25,
             x[-1]
         ]
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lb, ub = _pspBounds(x, bounds, 1)
+    fit = np.array(guess, dtype=np.float64)
+    fit[2:] = abs(fit[2:])
+    fit = np.clip(fit, lb[0], ub[0])
+    if multiFit:
+        fit = pspGridGuess(x, y[np.newaxis, :], fit[np.newaxis, :], lb, ub, risePower)[0]
+    lb = lb[0]
+    ub = ub[0]
+    
+    fit = _pspLevMarSingle(x, y, fit, lb, ub, risePower, maxIter=100)
     
-    ## pick some reasonable default bounds
+    ## scale amplitude such that fit[0] is the maximum value of the function
+    maxX = pspMaxTime(fit[2], fit[3], risePower)
+    fit[0] *= (1.0 - np.exp(-maxX / fit[2]))**risePower * np.exp(-maxX / fit[3])
+    return fit
+
+def _pspBounds(x, bounds, nEvents):
+    ## Return (lower, upper) bound arrays of shape (nEvents, 4) for PSP fits; 
+    ## see fitPspBatch.
+    minTau = (x[1]-x[0]) * 0.5
     if bounds is None:
-        bounds = [[None,None]] * 4
-        bounds[1][0] = -2e-3
-        minTau = (x[1]-x[0]) * 0.5
-        #bounds[2] = [minTau, None]
-        #bounds[3] = [minTau, None]
-        
-    errCache = {}
-    def errFn(v, x, y):
-        key = tuple(v)
-        if key not in errCache:
-            for i in range(len(v)):
-                if bounds[i][0] is not None:
-                    v[i] = max(v[i], bounds[i][0])
-                if bounds[i][1] is not None:
-                    v[i] = min(v[i], bounds[i][1])
-            err = y - v[0] * pspInnerFunc(x-v[1], abs(v[2]), abs(v[3]), risePower)
-                    
-            errCache[key] = (err, v.copy())
-            return err
-        err, v2 = errCache[key]
-        v[:] = v2
-        return err
-        
-    ## initial fit
-    fit = scipy.optimize.leastsq(errFn, guess, args=(x, y), ftol=1e-2, factor=0.1)[0]
+        bounds = [[None, None], [-2e-3, None], [None, None], [None, None]]
+    if np.ndim(bounds[0][0]) == 0:
+        bounds = [bounds]
+    lb = np.array([[-np.inf if b[0] is None else b[0] for b in evBounds] for evBounds in bounds], dtype=np.float64)
+    ub = np.array([[np.inf if b[1] is None else b[1] for b in evBounds] for evBounds in bounds], dtype=np.float64)
+    lb[:, 2:] = np.where(np.isfinite(lb[:, 2:]), lb[:, 2:], minTau)
+    lb = lb * np.ones((nEvents, 1))
+    ub = ub * np.ones((nEvents, 1))
+    return lb, ub
+
+def fitPspBatch(x, y, guess, bounds=None, risePower=2.0, multiFit=False, maxIter=100):
+    """
+    Fit many PSPs that share the same x values in a single vectorized problem.
     
+    y is a 2D array (events, samples). guess and bounds are given as for fitPsp, 
+    either once for all events, or per event with an extra leading axis:
+    guess may be (4,) or (events, 4) and bounds may be (4, 2) or (events, 4, 2).
     
-    ## try on a few more fits
-    if multiFit:
-        err = (errFn(fit, x, y)**2).sum()
-        #print "fit:", err
-        bestFit = fit
-        for da in [0.5, 1.0, 2.0]:
-            for dt in [0.5, 1.0, 2.0]:
-                for dr in [0.5, 1.0, 2.0]:
-                    for do in [0.002, .0, 0.002]:
-                        if da == 1.0 and dt == 1.0 and dr == 1.0 and do == 0.0:
-                            continue
-                        guess = fit.copy()            
-                        guess[0] *= da
-                        guess[1] += do
-                        guess[3] *= dt
-                        guess[2] *= dr
-                        fit2 = scipy.optimize.leastsq(errFn, guess, args=(x, y), ftol=1e-1, factor=0.1)[0]
-                        err2 = (errFn(fit2, x, y)**2).sum()
-                        if err2 < err:
-                            bestFit = fit2
-                            #print "   found better PSP fit: %s -> %s" % (err, err2), da, dt, dr, do
-                            err = err2
-        
-        fit = bestFit
+    Each event is fit by a bounded Levenberg-Marquardt solver using the analytic 
+    Jacobian of the PSP function; all events are iterated together so that the 
+    cost of each iteration is a few array operations regardless of the number of
+    events. Returns an array of [amp, xoffset, rise, fall] per event, where amp
+    is the peak value of the fit function (as in fitPsp).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    nEvents = y.shape[0]
+    lb, ub = _pspBounds(x, bounds, nEvents)
+    
+    fit = np.empty((nEvents, 4))
+    fit[:] = guess
+    fit[:, 2:] = abs(fit[:, 2:])
+    fit = np.clip(fit, lb, ub)
     
+    if multiFit:
+        fit = pspGridGuess(x, y, fit, lb, ub, risePower)
     
+    fit = _pspLevMar(x, y, fit, lb, ub, risePower, maxIter)
     
-    fit[2:] = abs(fit[2:])
-    maxX = fit[2] * np.log(1 + (fit[3]*risePower / fit[2]))
-    maxVal = (1.0 - np.exp(-maxX / fit[2]))**risePower * np.exp(-maxX / fit[3])
-    fit[0] *= maxVal
+    ## scale amplitude such that fit[0] is the maximum value of the function
+    maxX = pspMaxTime(fit[:, 2], fit[:, 3], risePower)
+    maxVal = (1.0 - np.exp(-maxX / fit[:, 2]))**risePower * np.exp(-maxX / fit[:, 3])
+    fit[:, 0] *= maxVal
+    return fit
+
+def pspGridGuess(x, y, guess, lb, ub, risePower=2.0, chunk=256):
+    """
+    Improve initial guesses for fitPspBatch by evaluating a coarse grid of 
+    xoffset, rise and fall values around each guess. For every grid point the 
+    best amplitude is computed in closed form, so the whole search is a handful 
+    of vectorized evaluations. This replaces the brute-force re-fitting that 
+    fitPsp used to do for multiFit.
+    """
+    factors = np.array([0.25, 0.5, 1.0, 2.0, 4.0])
+    offsets = np.array([-2e-3, 0.0, 2e-3])
+    grid = np.array([(do, fr, fd) for do in offsets for fr in factors for fd in factors])
+    
+    out = guess.copy()
+    for start in range(0, len(y), chunk):
+        sl = slice(start, start+chunk)
+        g = guess[sl]
+        cand = np.empty((g.shape[0], len(grid), 4))
+        cand[..., 0] = g[:, np.newaxis, 0]
+        cand[..., 1] = g[:, np.newaxis, 1] + grid[:, 0]
+        cand[..., 2] = g[:, np.newaxis, 2] * grid[:, 1]
+        cand[..., 3] = g[:, np.newaxis, 3] * grid[:, 2]
+        cand = np.clip(cand, lb[sl, np.newaxis], ub[sl, np.newaxis])
+        
+        shape = pspInnerFunc(x - cand[..., 1:2], cand[..., 2:3], cand[..., 3:4], risePower)
+        yc = y[sl, np.newaxis, :]
+        gy = (shape * yc).sum(axis=2)
+        gg = (shape * shape).sum(axis=2)
+        amp = np.where(gg > 0, gy / np.where(gg > 0, gg, 1), g[:, np.newaxis, 0])
+        cand[..., 0] = np.clip(amp, lb[sl, np.newaxis, 0], ub[sl, np.newaxis, 0])
+        err = ((yc - cand[..., 0:1] * shape)**2).sum(axis=2)
+        best = np.argmin(err, axis=1)
+        out[sl] = cand[np.arange(len(best)), best]
+    return out
+
+def _pspLevMar(x, y, fit, lb, ub, risePower, maxIter, tol=1e-4):
+    """
+    Bounded Levenberg-Marquardt refinement of many PSP fits at once. 
+    Parameters are [amp, xoffset, rise, fall] where amp scales pspInnerFunc. 
+    Each event keeps its own damping factor and stops independently.
+    """
+    fit = fit.copy()
+    n = len(fit)
+    diag = (slice(None), np.arange(4), np.arange(4))
+    
+    def residual(p, ys):
+        t = x[np.newaxis, :] - p[:, 1:2]
+        return ys - p[:, 0:1] * pspInnerFunc(t, p[:, 2:3], p[:, 3:4], risePower)
+    
+    err = residual(fit, y)
+    cost = (err**2).sum(axis=1)
+    lam = np.ones(n)
+    idx = np.arange(n)
+    for i in range(maxIter):
+        if len(idx) == 0:
+            break
+        p = fit[idx]
+        amp = p[:, 0:1]
+        t = x[np.newaxis, :] - p[:, 1:2]
+        J = np.empty((len(idx), 4, len(x)))
+        g, dx, dr, dd = pspInnerJacobian(t, p[:, 2:3], p[:, 3:4], risePower)
+        J[:, 0] = -g
+        J[:, 1] = amp * dx
+        J[:, 2] = -amp * dr
+        J[:, 3] = -amp * dd
+        
+        ## solve the damped normal equations with columns scaled to unit norm
+        JtJ = np.einsum('nim,njm->nij', J, J)
+        Jte = np.einsum('nim,nm->ni', J, err[idx])
+        scale = np.sqrt(JtJ[diag])
+        scale[scale == 0] = 1.0
+        A = JtJ / (scale[:, :, np.newaxis] * scale[:, np.newaxis, :])
+        A[diag] += lam[idx, np.newaxis]
+        try:
+            step = -np.linalg.solve(A, (Jte / scale)[..., np.newaxis])[..., 0] / scale
+        except np.linalg.LinAlgError:
+            step = -np.einsum('nij,nj->ni', np.linalg.pinv(A), Jte / scale) / scale
+        
+        pn = np.clip(p + step, lb[idx], ub[idx])
+        errn = residual(pn, y[idx])
+        costn = (errn**2).sum(axis=1)
+        better = np.isfinite(costn) & (costn < cost[idx])
+        
+        acc = idx[better]
+        converged = np.zeros(len(idx), dtype=bool)
+        converged[better] = (cost[acc] - costn[better]) <= tol * cost[acc]
+        fit[acc] = pn[better]
+        err[acc] = errn[better]
+        cost[acc] = costn[better]
+        lam[acc] *= 0.3
+        lam[idx[~better]] *= 10.
+        
+        done = converged | (lam[idx] > 1e8) | np.all(pn == p, axis=1)
+        idx = idx[~done]
     return fit
 
+def _pspLevMarSingle(x, y, fit, lb, ub, risePower, maxIter, tol=1e-4):
+    """
+    Bounded Levenberg-Marquardt refinement of a single PSP fit; this is the same
+    method as _pspLevMar without the overhead of iterating over a batch.
+    The residual is taken from the same evaluation as the Jacobian, so each 
+    trial step costs one call to pspInnerJacobian.
+    """
+    def evaluate(p):
+        g, dx, dr, dd = pspInnerJacobian(x - p[1], p[2], p[3], risePower)
+        err = y - p[0] * g
+        return err, np.dot(err, err), np.array([-g, p[0] * dx, -p[0] * dr, -p[0] * dd])
+    
+    p = np.clip(fit, lb, ub)
+    err, cost, J = evaluate(p)
+    lam = 1.0
+    eye = np.eye(4)
+    for i in range(maxIter):
+        ## damped normal equations with columns scaled to unit norm
+        JtJ = np.dot(J, J.T)
+        scale = np.sqrt(JtJ.diagonal())
+        scale[scale == 0] = 1.0
+        A = JtJ / np.outer(scale, scale)
+        b = np.dot(J, err) / scale
+        while True:
+            try:
+                step = -np.linalg.solve(A + lam * eye, b) / scale
+            except np.linalg.LinAlgError:
+                step = -np.dot(np.linalg.pinv(A + lam * eye), b) / scale
+            pn = np.clip(p + step, lb, ub)
+            errn, costn, Jn = evaluate(pn)
+            if costn < cost:  ## also False for nan
+                break
+            lam *= 10.
+            if lam > 1e8 or np.all(pn == p):
+                return p
+        converged = (cost - costn) <= tol * cost
+        p, err, cost, J = pn, errn, costn, Jn
+        lam *= 0.3
+        if converged:
+            break
+    return p
 
 
 
@@ -463,60 +632,21 @@ def downsamplend(data, div):
 
 
 def recursiveRegisterImages(i1, i2, hint=(0,0), maxDist=None, objSize=None):
-    """Given images i1 and i2, recursively find the offset for i2 that best matches with i1"""
-    time1 = time.clock()
-    ## float images
-    im1 = i1.astype(float)
-    im2 = i2.astype(float)
-    #im1 = i1.mean(axis=2).astype(float)
-    #im2 = i2.mean(axis=2).astype(float)
-    
-    ## Decide how many iterations to perform, scale images
+    """Given images i1 and i2, recursively find the offset for i2 that best matches with i1.
+    The search is done coarse-to-fine with pyramidRegister; if maxDist is given, only
+    offsets within maxDist/2 of hint are considered."""
+    ## Decide how many iterations to perform
     if objSize is not None:
         nit = int(np.floor(np.log(objSize)/np.log(2)) + 1)
     else:
         nit = 5
-    print "Doing %d iterations" % nit
-    
-    spow = 2.0
-    scales = map(lambda x: 1.0 / spow**x, range(nit-1,-1,-1))
-    imScale = [[None, None]] * nit
-    imScale[-1] = [im1, im2]
-    time2 = time.clock()
-    for i in range(nit-2,-1,-1):
-        imScale[i] = [scipy.ndimage.zoom(imScale[i+1][0], 1.0/spow, order=1), scipy.ndimage.zoom(imScale[i+1][1], 1.0/spow, order=1)]
-    print scales
-
-    time3 = time.clock()
-    lastSf = None
-    if maxDist != None:
-        start = (np.array(hint) - np.ceil(maxDist / 2.)) * scales[0]
-        end = (np.array(hint) + np.ceil(maxDist / 2.)) * scales[0]
-    else:
-        start = np.array([0,0])
-        end = None
-        
-    print "Checking range %s - %s" % (str(start), str(end))
-    for i in range(0, nit):
-        sf = scales[i]
-        im1s = imScale[i][0]
-        im2s = imScale[i][1]
-        
-        if lastSf is not None:
-            start = np.floor(np.floor(center-0.5) * sf / lastSf)
-            end = np.ceil(np.ceil(center+0.5) * sf / lastSf)
-        ## get prediction
-        #print "Scale %f: start: %s  end: %s" % (sf, str(start), str(end))
-        if end is None or any(start != end):
-            print "register:", start, end
-            center = registerImages(im1s, im2s, (start, end))
-        #print "   center = %s" % str(center/sf)
-        
-        
-        lastSf = sf
-    time4 = time.clock()
-    print "Scale time: %f   Corr time: %f    Total: %f" % (time3-time2, time4-time3, time4-time1)
-    return center
+    nit = max(1, min(nit, int(np.log2(min(i1.shape[:2] + i2.shape[:2]))) - 2))
+    
+    searchRange = None
+    if maxDist is not None:
+        searchRange = [np.array(hint) - np.ceil(maxDist / 2.), np.array(hint) + np.ceil(maxDist / 2.)]
+    offset, peak = pyramidRegister(i1, i2, levels=nit-1, searchRange=searchRange)
+    return offset
 
 def xcMax(xc):
     mi = np.where(xc == xc.max())
@@ -524,85 +654,15 @@ def xcMax(xc):
     return mi
 
 def registerImages(im1, im2, searchRange):
+    """Return the integer offset of im2 relative to im1 (so that im1[x+offset] ~= im2[x]),
+    found by phase correlation (see phaseCorrelate).
+    searchRange is [[xmin, ymin], [xmax, ymax]], or [start, None] to search all offsets.
     """
-    searchRange is [[xmin, ymin], [xmax, ymax]]
-    """
-    #print "Registering images %s and %s, %s-%s" % (str(im1.shape), str(im2.shape), str(start), str(end))
-    #(sx, sy) = searchRange
-    #start=[sx[0], sy[0]]
-    #end = [sx[1], sy[1]]
     start, end = searchRange
-    print "start:",start,"end:",end
-    
     if end is None:
-        mode = 'full'
-        im1c = im1
-        im2c = im2
-        #print "Searching full images."
-    else:
-        mode = 'valid'
-        s1x = max(0, start[0])
-        s1y = max(0, start[1])
-        print im1.shape
-        print im2.shape
-        e1x = min(im1.shape[0], im2.shape[0]+end[0])
-        e1y = min(im1.shape[1], im2.shape[1]+end[1])
-        print "%d,%d - %d,%d" % (s1x, s1y, e1x, e1y)
-        
-        s2x = max(0, -start[0])
-        s2y = max(0, -start[1])
-        e2x = min(im2.shape[0], im1.shape[0]-end[0])
-        e2y = min(im2.shape[1], im1.shape[1]-end[1])
-        print "%d,%d - %d,%d" % (s2x, s2y, e2x, e2y)
-        
-        ## Crop images
-        im1c = im1[s1x:e1x, s1y:e1y]
-        im2c = im2[s2x:e2x, s2y:e2y]
-            
-        #print "Images cropped to %d,%d-%d,%d   %d,%d-%d,%d" % (s1x, s1y, e1x, e1y, s2x, s2y, e2x, e2y)
-
-    #showImage(im1c)
-    #showImage(im2c)
-    
-    ## get full scale correlation
-    
-    #turns out cross-correlation is a really lousy way to register images.
-    #xc = scipy.signal.signaltools.correlate2d(im1c, im2c, boundary='fill', fillvalue=im1c.mean(), mode=mode)
-    def err(img):
-        try:
-            img.shape = im2c.shape
-        except:
-            print img.shape, im2c.shape
-            raise
-        return abs(im2c - img).sum()
-    
-    print im1c.shape, im2c.shape
-    xc = scipy.ndimage.generic_filter(im1c, err, footprint=im2c) 
-   # print xc.min(), xc.max()
-    #xcb = ndimage.filters.gaussian_filter(xc, 20)
-    #xc -= xcb
-    
-    xcm = np.argmin(xc)
-    # argmin returns min index of flattened array
-    xcm = np.unravel_index(xcm, xc.shape)
-
-
-    #xcm = xcMax(xc)
-    #xcc = concatenate((xc[...,newaxis], xc[...,newaxis], xc[...,newaxis]), axis=2)
-    #xcc[xcm[0], xcm[1], 0:2] = xc.min()
-    #showImage(xcc)
-    #showImage(xcb)
-    
-    print "Best match at " + str(xcm)
-    if mode == 'full':
-        xcm -= np.array(im1c.shape)-1
-    else:
-        xcm += start
-    print "  ..corrected to " + str(xcm)
-    
-    #showImage(regPair(im1, im2, xcm))
-    raise Exception()
-    return xcm
+        searchRange = None
+    offset, peak = phaseCorrelate(im1, im2, searchRange=searchRange, upsample=1)
+    return offset.astype(int)
 
 def regPair(im1, im2, reg):
     if len(im1.shape) > 2:
@@ -644,6 +704,258 @@ def regPair(im1, im2, reg):
     return scipy.concatenate((r[...,np.newaxis], g[...,np.newaxis], b[...,np.newaxis]), axis=2)
 
 
+def _fftSize(n):
+    """Return the smallest integer >= n whose only prime factors are 2, 3 and 5."""
+    n = int(n)
+    best = 2 ** int(np.ceil(np.log2(max(n, 1))))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def _taperWindow(n, taper):
+    ## Tukey window: cosine taper over a fraction *taper* of the length (1.0 is a Hann window)
+    w = np.ones(n)
+    m = int(np.floor(taper * (n - 1) / 2.))
+    if m > 0:
+        w[:m] = 0.5 * (1 - np.cos(np.pi * np.arange(m) / m))
+        w[n-m:] = w[:m][::-1]
+    return w
+
+def _registrationSpectrum(img, shape, taper=0.3):
+    """Mean-subtract and taper the edges of *img*, zero-pad to *shape*, and return its FFT.
+    *img* may be a single image or a stack with frames along the first axis."""
+    img = np.asarray(img, dtype=np.float64)
+    img = img - img.mean(axis=(-2, -1), keepdims=True)
+    if taper > 0:
+        img = img * (_taperWindow(img.shape[-2], taper)[:, None] * _taperWindow(img.shape[-1], taper)[None, :])
+    return np.fft.fft2(img, s=shape)
+
+def _upsampledDFT(data, size, upsample, offsets):
+    ## matrix-multiply DFT of *data* evaluated on a (size x size) grid, *upsample* times
+    ## finer than the FFT grid, starting at *offsets* (Guizar-Sicairos et al., 2008)
+    nr, nc = data.shape
+    colKernel = np.exp((-2j * np.pi / (nc * upsample)) * 
+        (np.fft.ifftshift(np.arange(nc))[:, None] - np.floor(nc / 2.)).dot(np.arange(size)[None, :] - offsets[1]))
+    rowKernel = np.exp((-2j * np.pi / (nr * upsample)) * 
+        (np.arange(size)[:, None] - offsets[0]).dot(np.fft.ifftshift(np.arange(nr))[None, :] - np.floor(nr / 2.)))
+    return rowKernel.dot(data).dot(colKernel)
+
+def _phaseCorrelationPeak(product, searchRange=None, upsample=10):
+    """Given normalized cross-power spectra *product* (..., rows, cols), return 
+    the (..., 2) array of offsets at the phase correlation peaks and the peak heights."""
+    shape = product.shape[-2:]
+    corr = np.fft.ifft2(product).real
+    flat = corr.reshape((-1,) + shape)
+    
+    ## signed offset represented by each element of the correlation
+    sx = np.arange(shape[0])
+    sx[sx > shape[0] // 2] -= shape[0]
+    sy = np.arange(shape[1])
+    sy[sy > shape[1] // 2] -= shape[1]
+    if searchRange is not None:
+        (x0, y0), (x1, y1) = searchRange
+        mask = ((sx >= x0) & (sx <= x1))[:, None] & ((sy >= y0) & (sy <= y1))[None, :]
+        flat = np.where(mask[None, ...], flat, -np.inf)
+    
+    ind = flat.reshape(flat.shape[0], -1).argmax(axis=1)
+    px, py = np.unravel_index(ind, shape)
+    ## scale so that a perfect match has a peak of 1
+    peaks = flat[np.arange(len(ind)), px, py] / np.abs(product.reshape(len(ind), -1)).mean(axis=1)
+    offsets = np.empty((len(ind), 2))
+    offsets[:, 0] = sx[px]
+    offsets[:, 1] = sy[py]
+    
+    if upsample > 1:
+        size = int(np.ceil(upsample * 1.5))
+        center = np.fix(size / 2.)
+        prod = product.reshape((-1,) + shape)
+        for i in range(len(offsets)):
+            off = np.round(offsets[i] * upsample) / upsample
+            cc = _upsampledDFT(prod[i].conj(), size, upsample, center - off * upsample).conj()
+            mx = np.unravel_index(np.argmax(np.abs(cc)), cc.shape)
+            offsets[i] = off + (np.array(mx) - center) / upsample
+    
+    return offsets.reshape(product.shape[:-2] + (2,)), peaks.reshape(product.shape[:-2])
+
+def _normalizeProduct(F1, F2):
+    ## Cross-power spectrum, only partially whitened: full normalization (classic phase
+    ## correlation) gives noise-dominated high frequencies as much weight as the signal.
+    prod = F1 * F2.conj()
+    prod /= np.sqrt(np.abs(prod)) + 1e-15
+    return prod
+
+def _padShape(shape1, shape2, maxDist=None):
+    ## pad enough that offsets within maxDist (or any overlapping offset) do not wrap around
+    shape = np.maximum(shape1[-2:], shape2[-2:])
+    if maxDist is None:
+        pad = shape
+    else:
+        pad = np.minimum(np.ceil(maxDist) + 1, shape).astype(int)
+    return tuple([_fftSize(s) for s in shape + pad])
+
+def phaseCorrelate(im1, im2, maxDist=None, searchRange=None, upsample=10, taper=0.3):
+    """Find the offset of *im2* relative to *im1* by FFT phase correlation.
+    
+    Returns (offset, peak), where offset is the (float) position of im2's origin
+    in im1's coordinates, so that im1[x+offset] ~= im2[x]. Peak is the height of 
+    the phase correlation peak (1.0 for a perfect match); values near 0 indicate
+    that no match was found.
+    
+    maxDist limits the search to offsets within maxDist of (0, 0) in both 
+    directions; searchRange [[xmin, ymin], [xmax, ymax]] specifies the range exactly.
+    The offset is refined to 1/upsample pixels. A fraction *taper* of each image
+    is tapered toward its edges (1.0 gives a Hann window); small values are 
+    needed when the images overlap only partially.
+    """
+    if searchRange is None and maxDist is not None:
+        searchRange = [[-maxDist, -maxDist], [maxDist, maxDist]]
+    dist = None
+    if searchRange is not None:
+        dist = np.abs(np.array(searchRange, dtype=float)).max()
+    shape = _padShape(np.array(im1.shape), np.array(im2.shape), dist)
+    prod = _normalizeProduct(_registrationSpectrum(im1, shape, taper), _registrationSpectrum(im2, shape, taper))
+    offset, peak = _phaseCorrelationPeak(prod, searchRange, upsample)
+    return offset, float(peak)
+
+def _overlap(shape1, shape2, offset):
+    ## slices of im1 and im2 that overlap when im2's origin is at integer *offset* in im1
+    s1 = []
+    s2 = []
+    for i in range(2):
+        start = max(0, -offset[i])
+        stop = min(shape2[i], shape1[i] - offset[i])
+        s2.append(slice(start, stop))
+        s1.append(slice(start + offset[i], stop + offset[i]))
+    return tuple(s1), tuple(s2)
+
+def pyramidRegister(im1, im2, levels=None, maxDist=None, searchRange=None, upsample=10, taper=0.3, minSize=32):
+    """Coarse-to-fine registration of *im2* relative to *im1*. 
+    
+    The offset is first found by phaseCorrelate on images downsampled by 2**levels
+    and then refined at each finer scale using only the overlapping regions. This 
+    is faster than phaseCorrelate for large images and more robust when the 
+    search range is large. By default, images are downsampled until the smaller
+    side is about *minSize* pixels. Other arguments and the return value are
+    the same as for phaseCorrelate.
+    """
+    im1 = np.asarray(im1, dtype=np.float64)
+    im2 = np.asarray(im2, dtype=np.float64)
+    if levels is None:
+        levels = max(0, int(np.floor(np.log2(min(im1.shape + im2.shape) / float(minSize)))))
+    pyr = [(im1, im2)]
+    for i in range(levels):
+        a, b = pyr[-1]
+        pyr.append((downsample(downsample(a, 2, axis=0), 2, axis=1), downsample(downsample(b, 2, axis=0), 2, axis=1)))
+    
+    if searchRange is None and maxDist is not None:
+        searchRange = [[-maxDist, -maxDist], [maxDist, maxDist]]
+    if searchRange is not None:
+        searchRange = np.array(searchRange, dtype=float) / 2.**levels
+        searchRange[0] = np.floor(searchRange[0]) - 1
+        searchRange[1] = np.ceil(searchRange[1]) + 1
+    
+    a, b = pyr[-1]
+    offset, peak = phaseCorrelate(a, b, searchRange=searchRange, upsample=1 if levels > 0 else upsample, taper=taper)
+    for level in range(levels-1, -1, -1):
+        a, b = pyr[level]
+        offset = np.round(offset * 2).astype(int)
+        s1, s2 = _overlap(a.shape, b.shape, offset)
+        if min(a[s1].shape) < 4:
+            ## images no longer overlap at this scale; keep the coarse estimate
+            offset = offset.astype(float)
+            continue
+        resid, peak = phaseCorrelate(a[s1], b[s2], maxDist=3, upsample=1 if level > 0 else upsample, taper=taper)
+        offset = offset + resid
+    return offset, peak
+
+def registerStack(stack, reference, maxDist=None, upsample=10, taper=0.3, chunkSize=32):
+    """Register every frame in *stack* against *reference* by phase correlation.
+    The spectrum of the reference is computed only once and frames are 
+    transformed in batches of *chunkSize*. Returns (offsets, peaks) with one 
+    (x, y) offset and peak height per frame (see phaseCorrelate)."""
+    searchRange = None
+    if maxDist is not None:
+        searchRange = [[-maxDist, -maxDist], [maxDist, maxDist]]
+    shape = _padShape(np.array(reference.shape), np.array(stack.shape[1:]), maxDist)
+    ref = _registrationSpectrum(reference, shape, taper)
+    offsets = np.empty((len(stack), 2))
+    peaks = np.empty(len(stack))
+    for start in range(0, len(stack), chunkSize):
+        stop = min(start + chunkSize, len(stack))
+        prod = _normalizeProduct(ref[None, ...], _registrationSpectrum(stack[start:stop], shape, taper))
+        offsets[start:stop], peaks[start:stop] = _phaseCorrelationPeak(prod, searchRange, upsample)
+    return offsets, peaks
+
+def _registerPair(args):
+    im1, im2, kwds = args
+    return pyramidRegister(im1, im2, **kwds)
+
+def registerImagePairs(pairs, workers=None, **kwds):
+    """Register a list of (im1, im2) image pairs with pyramidRegister, using a
+    pool of *workers* processes (default is one per CPU). Extra keyword arguments
+    are passed to pyramidRegister. Returns a list of (offset, peak) tuples."""
+    import multiprocessing
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    jobs = [(im1, im2, kwds) for im1, im2 in pairs]
+    if workers <= 1 or len(jobs) < 2:
+        return map(_registerPair, jobs)
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(_registerPair, jobs)
+    finally:
+        pool.terminate()
+
+def phaseDispMap(im1, im2, maxDist=10, searchRange=None, tileSize=32, taper=0.3):
+    """Generate a displacement map like makeDispMap, by phase correlation of 
+    (tileSize x tileSize) tiles of im2 with the surrounding regions of im1. All 
+    tiles are transformed in one batch, so this is much faster than makeDispMap's 
+    exhaustive search; the map has the resolution of the tiles.
+    
+    Returns (displacement, error) with the same format and conventions as 
+    makeDispMap; error is 1 - the phase correlation peak height of each tile.
+    """
+    im1 = np.asarray(im1, dtype=np.float64)
+    im2 = np.asarray(im2, dtype=np.float64)
+    if searchRange is None:
+        searchRange = [[-maxDist, maxDist+1], [-maxDist, maxDist+1]]
+    m = int(np.ceil(np.abs(np.array(searchRange)).max()))
+    T = int(tileSize)
+    nx = int(np.ceil(im2.shape[0] / float(T)))
+    ny = int(np.ceil(im2.shape[1] / float(T)))
+    
+    ## pad so that every tile and its search region lie inside the arrays
+    im2p = np.pad(im2, ((0, nx*T - im2.shape[0]), (0, ny*T - im2.shape[1])), mode='edge')
+    im1p = np.pad(im1, ((m, max(0, nx*T + m - im1.shape[0])), (m, max(0, ny*T + m - im1.shape[1]))), mode='edge')
+    tiles = np.empty((nx*ny, T, T))
+    regions = np.empty((nx*ny, T+2*m, T+2*m))
+    for i in range(nx):
+        for j in range(ny):
+            tiles[i*ny+j] = im2p[i*T:(i+1)*T, j*T:(j+1)*T]
+            regions[i*ny+j] = im1p[i*T:(i+1)*T+2*m, j*T:(j+1)*T+2*m]
+    
+    ## tile origin is at (m, m) in its region when the displacement is 0, and a 
+    ## displacement d (im1[x-d] ~= im2[x]) moves it to m-d
+    shape = (_fftSize(2*T + 2*m),) * 2
+    prod = _normalizeProduct(_registrationSpectrum(regions, shape, 0), _registrationSpectrum(tiles, shape, taper))
+    rng = [[m - (searchRange[0][1]-1), m - (searchRange[1][1]-1)], [m - searchRange[0][0], m - searchRange[1][0]]]
+    offsets, peaks = _phaseCorrelationPeak(prod, rng, upsample=1)
+    disp = (m - offsets).astype(int).reshape(nx, ny, 2)
+    err = (1. - peaks).reshape(nx, ny)
+    
+    disp = disp.repeat(T, axis=0).repeat(T, axis=1)[:im2.shape[0], :im2.shape[1]]
+    err = err.repeat(T, axis=0).repeat(T, axis=1)[:im2.shape[0], :im2.shape[1]]
+    return disp, err
+
+
 def vibratome(data, start, stop, axes=(0,1)):
     """Take a diagonal slice through an array. If the input is N-dimensional, the result is N-1 dimensional.
     start and stop are (x,y) tuples that indicate the beginning and end of the slice region.
@@ -736,6 +1048,140 @@ def vibratome(data, start, stop, axes=(0,1)):
     ## Untranspose array before returning
     return interpolated.transpose(tr2)
 
+class Reslicer(object):
+    """Take repeated affine slices (see affineSlice) through an array, as needed
+    when a slice plane is dragged interactively.
+    
+    * Coordinate grids are cached for each slice shape and orientation, so moving
+      the origin only costs one addition.
+    * Only the block of the data that surrounds the slice is read, one index of the
+      extra (non-sliced) axes at a time. This allows slicing memory-mapped volumes
+      that are larger than RAM.
+    * With reuseOutput=True, results are written into a cached buffer which is 
+      overwritten by the next slice of the same shape (so this should not be used
+      from more than one thread).
+    * slice(..., downsample=n) samples every n-th point, for fast previews while 
+      dragging; the full-resolution slice can be taken once the plane stops moving.
+    
+    *order* is the spline interpolation order; the default (3) is the same as for
+    scipy.ndimage.map_coordinates. For order > 1, the spline prefilter only sees the
+    block that is read (the slice bounds plus a margin of order+2 samples), so 
+    results are a close approximation of filtering the entire array. Use order=1 
+    for exact (and much faster) linear interpolation.
+    
+    Extra keyword arguments are passed to scipy.ndimage.map_coordinates.
+    """
+    def __init__(self, data=None, order=3, cacheSize=8, reuseOutput=False, **kargs):
+        self.data = data
+        self.order = order
+        self.kargs = kargs
+        self.cacheSize = cacheSize
+        self.reuseOutput = reuseOutput
+        self.lock = threading.Lock()
+        self._grids = collections.OrderedDict()    ## (shape, vectors): read-only grid
+        self._outputs = collections.OrderedDict()  ## (shape, dtype): output buffer
+    
+    def setData(self, data):
+        self.data = data
+    
+    def _cached(self, cache, key, create):
+        with self.lock:
+            if key in cache:
+                val = cache.pop(key)
+            else:
+                val = create()
+            cache[key] = val
+            while len(cache) > self.cacheSize:
+                cache.popitem(last=False)
+            return val
+    
+    def grid(self, shape, vectors):
+        """Return the (read-only) cached coordinates of every point in a slice relative to 
+        its origin; shape is (len(vectors[0]),) + shape."""
+        shape = tuple([int(np.ceil(s)) for s in shape])
+        vectors = np.array(vectors, dtype=float)
+        key = (shape, vectors.shape, vectors.tostring())
+        def create():
+            grid = np.mgrid[tuple([slice(0, s) for s in shape])].astype(float)  ## mesh grid of indexes
+            x = np.tensordot(vectors.T, grid, axes=1)
+            x.flags.writeable = False
+            return x
+        return self._cached(self._grids, key, create)
+        
+    def slice(self, shape, origin, vectors, axes, data=None, downsample=1, **kargs):
+        """Return a slice through *data* (or the data given to the constructor / setData).
+        Arguments are the same as for affineSlice; keyword arguments override those
+        given to the constructor."""
+        if data is None:
+            data = self.data
+        kargs = dict(self.kargs, **kargs)
+        kargs.setdefault('order', self.order)
+        order = kargs['order']
+        if len(shape) != len(vectors):
+            raise Exception("shape and vectors must have same length.")
+        if len(origin) != len(axes):
+            raise Exception("origin and axes must have same length.")
+        for v in vectors:
+            if len(v) != len(axes):
+                raise Exception("each vector must be same length as axes.")
+        if downsample != 1:
+            shape = [np.ceil(s / float(downsample)) for s in shape]
+            vectors = np.array(vectors, dtype=float) * downsample
+        
+        grid = self.grid(shape, vectors)
+        shape = grid.shape[1:]
+        origin = np.array(origin, dtype=float)
+        
+        ## find the block of data that contributes to the slice
+        ## (for order > 1, the spline prefilter only sees this block, so results may differ
+        ## very slightly from filtering the entire array)
+        margin = 1 if order <= 1 else order + 2
+        lo = []
+        hi = []
+        for i, ax in enumerate(axes):
+            if grid[i].size == 0:
+                lo.append(0)
+                hi.append(0)
+                continue
+            lo.append(int(np.clip(np.floor(grid[i].min() + origin[i]) - margin, 0, data.shape[ax])))
+            hi.append(int(np.clip(np.ceil(grid[i].max() + origin[i]) + margin + 1, 0, data.shape[ax])))
+        ## the cached grid is shared between threads; coordinates are computed into a new array
+        x = grid + (origin - lo).reshape((len(axes),) + (1,)*len(shape))
+        
+        extraAxes = [i for i in range(data.ndim) if i not in axes]
+        extraShape = tuple([data.shape[i] for i in extraAxes])
+        outShape = extraShape + shape
+        if self.reuseOutput:
+            output = self._cached(self._outputs, (outShape, data.dtype.str), lambda: np.empty(outShape, dtype=data.dtype))
+        else:
+            output = np.empty(outShape, dtype=data.dtype)
+        
+        empty = any([h <= l for l, h in zip(lo, hi)])
+        index = [slice(None)] * data.ndim
+        for i, ax in enumerate(axes):
+            index[ax] = slice(lo[i], hi[i])
+        for inds in np.ndindex(*extraShape):
+            if empty:
+                output[inds] = kargs.get('cval', 0)
+                continue
+            for ax, i in zip(extraAxes, inds):
+                index[ax] = i
+            ## read only this block from the (possibly memory-mapped) data
+            block = np.asarray(data[tuple(index)])
+            ## remaining axes are in their original order; map_coordinates needs the order of *axes*
+            block = block.transpose(np.argsort(np.argsort(axes)))
+            scipy.ndimage.map_coordinates(block, x, output=output[inds], **kargs)
+        
+        ## rearrange axes to match affineSlice: extra axes that precede the first slice axis
+        ## come first, then the slice axes, then the remaining extra axes.
+        nBefore = len([i for i in extraAxes if i < min(axes)])
+        nExtra = len(extraShape)
+        tr = range(nBefore) + range(nExtra, nExtra + len(shape)) + range(nBefore, nExtra)
+        return output.transpose(tr)
+
+_defaultReslicer = Reslicer(cacheSize=4)
+
+
 def affineSlice(data, shape, origin, vectors, axes, **kargs):
     """Take an arbitrary slice through an array.
     Parameters:
@@ -747,7 +1193,9 @@ def affineSlice(data, shape, origin, vectors, axes, **kargs):
                  If the vectors are not unit length, the result will be scaled.
                  If the vectors are not orthogonal, the result will be sheared.
         axes: the axes in the original dataset which correspond to the slice vectors
-        interpolate: chice between linear interpolation and nearest-neighbor
+        order: spline interpolation order (default 3, as for scipy.ndimage.map_coordinates;
+               1 gives linear interpolation). For order > 1 the result is approximate; 
+               see Reslicer.
         
         Example: start with a 4D data set, take a diagonal-planar slice out of the last 3 axes
             - data = array with dims (time, x, y, z) = (100, 40, 40, 40)
@@ -759,71 +1207,10 @@ def affineSlice(data, shape, origin, vectors, axes, **kargs):
             Note the following: 
                 len(shape) == len(vectors) 
                 len(origin) == len(axes) == len(vectors[0])
+                
+        Coordinate grids are cached between calls; see Reslicer.
     """
-    
-    # sanity check
-    if len(shape) != len(vectors):
-        raise Exception("shape and vectors must have same length.")
-    if len(origin) != len(axes):
-        raise Exception("origin and axes must have same length.")
-    for v in vectors:
-        if len(v) != len(axes):
-            raise Exception("each vector must be same length as axes.")
-    shape = (np.ceil(shape[0]), np.ceil(shape[1]))
-    
-
-    ## transpose data so slice axes come first
-    trAx = range(data.ndim)
-    for x in axes:
-        trAx.remove(x)
-    tr1 = tuple(axes) + tuple(trAx)
-    data = data.transpose(tr1)
-    #print "tr1:", tr1
-    ## dims are now [(slice axes), (other axes)]
-    
-
-    ### determine proper length of output array and pointwise vectors
-    #length = np.sqrt((stop[0]-start[0])**2 + (stop[1]-start[1])**2)
-    #dx = (stop[0]-start[0]) / length
-    #dy = (stop[1]-start[1]) / length
-    #length = np.ceil(length)  ## Extend length to be integer (can't have fractional array dimensions)
-    #nPts = int(length)+1
-    
-    ## Actual position of each point along the slice
-    #x = np.linspace(start[0], start[0]+(length*dx), nPts)
-    #y = np.linspace(start[1], start[1]+(length*dy), nPts)
-    
-    ## make sure vectors are arrays
-    vectors = np.array(vectors)
-    origin = np.array(origin)
-    origin.shape = (len(axes),) + (1,)*len(shape)
-    
-    ## Build array of sample locations. 
-    grid = np.mgrid[tuple([slice(0,x) for x in shape])]  ## mesh grid of indexes
-    x = (grid[np.newaxis,...] * vectors.transpose()[(Ellipsis,) + (np.newaxis,)*len(shape)]).sum(axis=1)  ## magic
-    #print x.shape, origin.shape
-    x += origin
-    #print "X values:"
-    #print x
-    ## iterate manually over unused axes since map_coordinates won't do it for us
-    extraShape = data.shape[len(axes):]
-    output = np.empty(tuple(shape) + extraShape, dtype=data.dtype)
-    for inds in np.ndindex(*extraShape):
-        ind = (Ellipsis,) + inds
-        output[ind] = scipy.ndimage.map_coordinates(data[ind], x, **kargs)
-    
-    
-    tr = range(output.ndim)
-    trb = []
-    for i in range(min(axes)):
-        ind = tr1.index(i) + (len(shape)-len(axes))
-        tr.remove(ind)
-        trb.append(ind)
-    tr2 = tuple(trb+tr)
-    #print "tr2", tr2
-
-    ## Untranspose array before returning
-    return output.transpose(tr2)
+    return _defaultReslicer.slice(shape, origin, vectors, axes, data=data, **kargs)
     
     
     ## old manual method. Might resurrect if performance is an issue..
@@ -967,6 +1354,65 @@ def affineSlice(data, shape, origin, vectors, axes, **kargs):
     #return interpolated.transpose(tr2)
 
 
+def affineSliceWeights(dataShape, shape, origin, vectors):
+    """Return a sparse (1 x N) matrix *w* such that w.dot(data.ravel()) is the mean of
+    pg.affineSlice(data, shape, origin, vectors, axes=(0,1)) for any 2D *data* of shape
+    *dataShape* (N = dataShape[0] * dataShape[1]).
+
+    This is the linear operator behind ROI.getArrayRegion(...).mean(): each sample is
+    bilinearly interpolated from its four neighbouring pixels, and samples that fall
+    outside the data contribute zero but still count toward the mean. Stack the rows
+    for many ROIs with scipy.sparse.vstack and pass them to weightedTraces.
+    """
+    import scipy.sparse
+    shape = [int(np.ceil(s)) for s in shape]
+    vectors = np.asarray(vectors, dtype=float)
+    grid = np.mgrid[0:shape[0], 0:shape[1]].reshape(2, -1)
+    x = np.dot(vectors.T, grid) + np.asarray(origin, dtype=float).reshape(2, 1)
+    nSamples = grid.shape[1]
+
+    valid = (x[0] >= 0) & (x[0] <= dataShape[0]-1) & (x[1] >= 0) & (x[1] <= dataShape[1]-1)
+    x = x[:, valid]
+    x0 = np.floor(x).astype(int)
+    dx = x - x0
+    cols = []
+    vals = []
+    for a in (0, 1):
+        for b in (0, 1):
+            i = x0[0] + a
+            j = x0[1] + b
+            w = (dx[0] if a else 1-dx[0]) * (dx[1] if b else 1-dx[1])
+            ## corners past the last row/column only occur with zero weight
+            keep = (i < dataShape[0]) & (j < dataShape[1]) & (w != 0)
+            cols.append(i[keep] * dataShape[1] + j[keep])
+            vals.append(w[keep])
+    cols = np.concatenate(cols)
+    vals = np.concatenate(vals) / float(max(nSamples, 1))
+    ## duplicate columns are summed by the conversion to csr
+    w = scipy.sparse.coo_matrix((vals, (np.zeros(len(cols), dtype=int), cols)), shape=(1, dataShape[0]*dataShape[1]))
+    return w.tocsr()
+
+
+def weightedTraces(data, weights, chunkSize=64):
+    """Return an array (nRows, nFrames) of weighted sums over each frame of *data*.
+
+    *data* is an array (frames, x, y, ...) and *weights* is an (nRows x N) matrix
+    (usually sparse, see affineSliceWeights) where N is the number of values in one frame.
+    Frames are read and flattened *chunkSize* at a time, so *data* may be a memory map
+    or a non-contiguous view without being copied as a whole.
+    """
+    nFrames = data.shape[0]
+    frameSize = int(np.prod(data.shape[1:]))
+    if weights.shape[1] != frameSize:
+        raise ValueError("weights have %d columns; data frames have %d values." % (weights.shape[1], frameSize))
+    out = np.empty((weights.shape[0], nFrames))
+    for start in range(0, nFrames, chunkSize):
+        stop = min(start + chunkSize, nFrames)
+        block = np.asarray(data[start:stop]).reshape(stop-start, frameSize)
+        out[:, start:stop] = weights.dot(block.T)
+    return out
+
+
 def volumeSum(data, alpha, axis=0, dtype=None):
     """Volumetric summing over one axis."""
     #if data.ndim != alpha.ndim:
@@ -1346,7 +1792,13 @@ def makeDispMap(im1, im2, maxDist=10, searchRange=None, normBlur=5.0, matchSize=
         im1dist = scipy.ndimage.geometric_transform(im1, lambda x: (x[0]-dmb[x[0]], x[1]-dmb[x[1]]))
         
         (See also: matchDistortImg)
+    
+    method may be 'diffNoise' or 'diff' for an exhaustive search over all displacements, 
+    or 'phase' for the much faster phaseDispMap (with tiles of about 3*matchSize pixels).
     """
+    if method == 'phase':
+        return phaseDispMap(im1, im2, maxDist=maxDist, searchRange=searchRange, tileSize=max(8, int(3 * matchSize)))
+    
     im1 = im1.astype(np.float32)
     im2 = im2.astype(np.float32)
     
@@ -1495,7 +1947,58 @@ def threshold(data, threshold, direction=1):
     mask = data >= threshold
     mask = mask[1:].astype(np.byte) - mask[:-1].astype(np.byte)
     return np.argwhere(mask == direction)[:, 0]
-    
+
+
+class EdgeDetector(object):
+    """Find rising and falling edges in a (digital) signal that may arrive in chunks.
+
+    Each call to process() handles one chunk; state is carried across calls so that
+    an edge falling on a chunk boundary is found exactly once. Edge indexes are
+    counted from the start of the first chunk, and refer to the first sample after
+    the transition (the first sample that is high for rising edges, or low for
+    falling edges). A sample is high if it is greater than *threshold*.
+    """
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.offset = 0     ## number of samples processed so far
+        self.last = None    ## state of the last sample processed
+        self._rising = []
+        self._falling = []
+
+    def process(self, chunk):
+        """Process the next chunk of data and return arrays (rising, falling) of
+        the edges found within it."""
+        high = np.asarray(chunk) > self.threshold
+        if len(high) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        inds = np.flatnonzero(high[1:] != high[:-1]) + 1
+        if self.last is not None and high[0] != self.last:
+            inds = np.concatenate([[0], inds])
+        rising = inds[high[inds]] + self.offset
+        falling = inds[~high[inds]] + self.offset
+        self._rising.append(rising)
+        self._falling.append(falling)
+        self.offset += len(high)
+        self.last = high[-1]
+        return rising, falling
+
+    def edges(self):
+        """Return arrays (rising, falling) of all edges found so far."""
+        if len(self._rising) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        return np.concatenate(self._rising), np.concatenate(self._falling)
+
+
+def findEdges(data, threshold=0.5, chunkSize=2**20):
+    """Return arrays (rising, falling) of the indexes of all threshold crossings in *data*.
+    See EdgeDetector. The data is processed *chunkSize* samples at a time so that no
+    temporary arrays the size of *data* are needed."""
+    data = data.view(np.ndarray)
+    det = EdgeDetector(threshold)
+    for start in range(0, len(data), chunkSize):
+        det.process(data[start:start+chunkSize])
+    return det.edges()
+
 
 
 def measureBaseline(data, threshold=2.0, iterations=2):
@@ -1985,8 +2488,7 @@ def denoise(data, radius=2, threshold=4):
 
 
 def rollingSum(data, n):
-    d1 = data.copy()
-    d1[1:] += d1[:-1]  # integrate
+    d1 = np.cumsum(data)  # integrate
     d2 = np.empty(len(d1) - n + 1, dtype=data.dtype)
     d2[0] = d1[n-1]  # copy first point
     d2[1:] = d1[n:] - d1[:-n]  # subtract
@@ -2009,7 +2511,7 @@ def clementsBekkers(data, template):
     sumT2 = (T**2).sum()
     sumD = rollingSum(D, N)
     sumD2 = rollingSum(D**2, N)
-    sumTD = correlate(D, T, mode='valid')
+    sumTD = np.correlate(D, T, mode='valid')
     
     ## compute scale factor, offset at each location:
     scale = (sumTD - sumT * sumD /N) / (sumT2 - sumT**2 /N)
@@ -2019,35 +2521,131 @@ def clementsBekkers(data, template):
     SSE = sumD2 + scale**2 * sumT2 + N * offset**2 - 2 * (scale*sumTD + offset*sumD - scale*offset*sumT)
     
     ## finally, compute error and detection criterion
-    error = sqrt(SSE / (N-1))
+    error = np.sqrt(SSE / (N-1))
     DC = scale / error
     return DC, scale, offset
     
-def cbTemplateMatch(data, template, threshold=3.0):
-    dc, scale, offset = clementsBekkers(data, template)
-    mask = dc > threshold
-    diff = mask[1:] - mask[:-1]
-    times = np.argwhere(diff==1)[:, 0]  ## every time we start OR stop a spike
-    
-    ## in the unlikely event that the very first or last point is matched, remove it
-    if abs(dc[0]) > threshold:
-        times = times[1:]
-    if abs(dc[-1]) > threshold:
-        times = times[:-1]
+CB_EVENT_DTYPE = [('peak', int), ('dc', float), ('scale', float), ('offset', float)]
+
+def clementsBekkersIter(data, template, chunkSize=2**20, workers=1, dtype=np.float64, useFFT=None):
+    """Chunked version of clementsBekkers for long recordings.
     
-    nEvents = len(times) / 2
+    The data is processed in overlapping chunks (each chunk is extended by 
+    len(template)-1 samples, as in overlap-save filtering), so memory use is 
+    proportional to chunkSize rather than to the length of the recording.
+    Yields (start, dc, scale, offset) for consecutive chunks, where start is the
+    index of the first value in the chunk. Concatenating the chunks gives the 
+    result of clementsBekkers (to within floating-point rounding).
     
-    result = np.empty(nEvents, dtype=[('peak', int), ('dc', float), ('scale', float), ('offset', float)])
-    for i in range(nEvents):
-        i1 = times[i*2]
-        i2 = times[(i*2)+1]
-        d = dc[i1:i2]
-        p = argmax(d)
-        result[0] = p+i1
-        result[1] = d[p]
-        result[2] = scale[p+i1]
-        result[3] = offset[p+i1]
-    return result
+    workers  number of threads used to process chunks in parallel (numpy and 
+             scipy release the GIL for most of the work)
+    dtype    float type of the results. With float32, the correlation is also
+             computed in float32; rolling sums are always accumulated in float64.
+    useFFT   use FFT correlation. By default this is used for templates longer
+             than 64 samples.
+    """
+    D = data.view(np.ndarray)
+    T = template.view(np.ndarray).astype(np.float64)
+    N = len(T)
+    nOut = len(D) - N + 1
+    if useFFT is None:
+        useFFT = N > 64
+    sumT = T.sum()
+    sumT2 = (T**2).sum()
+    TC = (T[::-1] if useFFT else T).astype(dtype)
+    
+    def process(start):
+        stop = min(start + chunkSize, nOut)
+        seg = D[start:stop+N-1].astype(np.float64)
+        sumD = rollingSum(seg, N)
+        sumD2 = rollingSum(seg**2, N)
+        segC = seg if dtype == np.float64 else seg.astype(dtype)
+        if useFFT:
+            sumTD = scipy.signal.fftconvolve(segC, TC, mode='valid')
+        else:
+            sumTD = np.correlate(segC, TC, mode='valid')
+        
+        ## same computation as clementsBekkers
+        scale = (sumTD - sumT * sumD /N) / (sumT2 - sumT**2 /N)
+        offset = (sumD - scale * sumT) /N
+        SSE = sumD2 + scale**2 * sumT2 + N * offset**2 - 2 * (scale*sumTD + offset*sumD - scale*offset*sumT)
+        error = np.sqrt(SSE / (N-1))
+        DC = scale / error
+        return start, DC.astype(dtype), scale.astype(dtype), offset.astype(dtype)
+    
+    starts = range(0, nOut, chunkSize)
+    if workers <= 1:
+        for start in starts:
+            yield process(start)
+        return
+    
+    ## keep a limited number of chunks in flight so that memory use stays bounded
+    ## and results are returned in order
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        pending = []
+        for start in starts:
+            pending.append(pool.apply_async(process, (start,)))
+            if len(pending) > workers:
+                yield pending.pop(0).get()
+        for result in pending:
+            yield result.get()
+    finally:
+        pool.terminate()
+
+def cbTemplateMatchIter(data, template, threshold=3.0, **kwds):
+    """Streaming version of cbTemplateMatch.
+    
+    Runs clementsBekkersIter (extra keyword arguments are passed through) and 
+    yields a record array of the events completed within each chunk, so that
+    events are reported while the rest of the recording is still being processed.
+    Each event is a contiguous region where the detection criterion exceeds 
+    threshold; the peak index, detection criterion, scale and offset are taken 
+    at the maximum of that region. Events touching either end of the data are
+    discarded.
+    """
+    pending = None  ## [firstIndex, peak, dc, scale, offset] of an event that may continue into the next chunk
+    for start, dc, scale, offset in clementsBekkersIter(data, template, **kwds):
+        mask = dc > threshold
+        edges = np.diff(mask.astype(np.int8))
+        regionStarts = list(np.argwhere(edges == 1)[:, 0] + 1)
+        regionStops = list(np.argwhere(edges == -1)[:, 0] + 1)
+        if mask[0]:
+            regionStarts.insert(0, 0)
+        if mask[-1]:
+            regionStops.append(len(mask))
+        
+        events = []
+        if pending is not None and not mask[0]:
+            ## pending event ended exactly at the chunk boundary
+            if pending[0] > 0:
+                events.append(tuple(pending[1:]))
+            pending = None
+        
+        for i1, i2 in zip(regionStarts, regionStops):
+            p = i1 + np.argmax(dc[i1:i2])
+            ev = [start+i1, start+p, dc[p], scale[p], offset[p]]
+            if i1 == 0 and pending is not None:
+                ## continuation of the event from the previous chunk
+                if pending[2] >= ev[2]:
+                    ev[1:] = pending[1:]
+                ev[0] = pending[0]
+                pending = None
+            if i2 == len(mask):
+                pending = ev
+                continue
+            if ev[0] > 0:
+                events.append(tuple(ev[1:]))
+        yield np.array(events, dtype=CB_EVENT_DTYPE)
+
+def cbTemplateMatch(data, template, threshold=3.0, **kwds):
+    """Return a record array of events detected by the Clements-Bekkers algorithm.
+    See cbTemplateMatchIter for a description of the events and extra arguments."""
+    chunks = list(cbTemplateMatchIter(data, template, threshold, **kwds))
+    if len(chunks) == 0:
+        return np.empty(0, dtype=CB_EVENT_DTYPE)
+    return np.concatenate(chunks)
 
 
 def expTemplate(dt, rise, decay, delay=None, length=None, risePow=2.0):
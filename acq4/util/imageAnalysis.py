@@ -8,6 +8,8 @@ Distributed under MIT/X11 license. See license.txt for more infomation.
 from scipy.optimize import leastsq
 from scipy import *
 from scipy.ndimage import *
+import threading
+import numpy as np
 
 def gaussian2D(v, x):
     ## v is [amplitude, x offset, y offset, sigma, Z offset]
@@ -24,3 +26,201 @@ def fitGaussian2D(image, guess):
     
 def blur(img, sigma):
     return gaussian_filter(img, sigma)
+
+
+def _tvDenoiseBlock(im, weight, eps, maxIter, nAxes, canceled=None, iterDone=None):
+    """Chambolle's TV denoising iteration over the last *nAxes* axes of *im*.
+    All buffers are allocated once and updated in place.
+    Returns the denoised array, or None if *canceled* (an Event) was set."""
+    axes = range(im.ndim - nAxes, im.ndim)
+    step = 1. / (2 * nAxes)
+    p = [np.zeros_like(im) for ax in axes]
+    d = np.empty_like(im)
+    out = np.empty_like(im)
+    g = np.empty_like(im)
+    tmp = np.empty_like(im)
+    norm = np.empty_like(im)
+    
+    def sl(ax, s):
+        ## slice *s* along axis *ax*
+        return (slice(None),) * ax + (s,)
+    
+    for i in xrange(maxIter):
+        if canceled is not None and canceled.is_set():
+            return None
+        
+        ## divergence of p
+        np.negative(p[0], out=d)
+        for pa in p[1:]:
+            d -= pa
+        for pa, ax in zip(p, axes):
+            d[sl(ax, slice(1, None))] += pa[sl(ax, slice(None, -1))]
+        np.add(im, d, out=out)
+        E = np.vdot(d, d)
+        
+        ## gradient of out; norm accumulates its squared magnitude
+        for j, ax in enumerate(axes):
+            np.subtract(out[sl(ax, slice(1, None))], out[sl(ax, slice(None, -1))], out=g[sl(ax, slice(None, -1))])
+            g[sl(ax, -1)] = 0
+            if j == 0:
+                np.multiply(g, g, out=norm)
+            else:
+                np.multiply(g, g, out=tmp)
+                norm += tmp
+            g *= step
+            p[j] -= g
+        np.sqrt(norm, out=norm)
+        E += weight * norm.sum()
+        norm *= 0.5 / weight
+        norm += 1.
+        for pa in p:
+            pa /= norm
+        E /= float(im.size)
+        
+        if iterDone is not None:
+            iterDone(1)
+        if i == 0:
+            E_init = E
+            E_previous = E
+        elif abs(E_previous - E) < eps * E_init:
+            if iterDone is not None:
+                iterDone(maxIter - i - 1)
+            break
+        else:
+            E_previous = E
+    return out
+
+
+class TVDenoiser(object):
+    """Total-variation denoising (Chambolle's algorithm for the Rudin-Osher-Fatemi
+    model) of images and image stacks.
+    
+    ============  ==========================================================
+    weight        Denoising weight; larger values remove more noise at the
+                  expense of fidelity to the input.
+    eps           Iteration stops when the relative change of the cost 
+                  function falls below eps:  (E_(n-1) - E_n) < eps * E_0
+    maxIter       Maximum number of iterations
+    dims          Number of trailing axes over which the total variation is
+                  computed. For a (frames, x, y) stack, dims=2 denoises each
+                  frame separately and dims=3 treats the stack as a volume.
+                  By default, all axes are used.
+    blockSize     Number of frames processed together. Blocks are denoised 
+                  in parallel; by default the stack is divided evenly 
+                  between the workers.
+    overlap       With dims=3, the number of extra frames included on 
+                  each side of a block and discarded afterward. The result
+                  is identical to denoising the whole volume at once as long 
+                  as overlap is at least the number of iterations (and 
+                  the stop criterion is met at the same iteration).
+    workers       Number of worker threads (default is the number of CPUs)
+    ============  ==========================================================
+    
+    process() may be called from a background thread while another thread 
+    polls progress() and calls cancel().
+    """
+    def __init__(self, weight=50., eps=2.e-4, maxIter=200, dims=None, blockSize=None, overlap=4, workers=None):
+        self.weight = float(weight)
+        self.eps = eps
+        self.maxIter = maxIter
+        self.dims = dims
+        self.blockSize = blockSize
+        self.overlap = overlap
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        self.workers = max(1, workers)
+        self._canceled = threading.Event()
+        self._lock = threading.Lock()
+        self._done = 0
+        self._total = 0
+    
+    def cancel(self):
+        """Request that a running process() call stop as soon as possible."""
+        self._canceled.set()
+        
+    def wasCanceled(self):
+        return self._canceled.is_set()
+    
+    def progress(self):
+        """Return (iterations done, total) for the current process() call. 
+        Blocks that converge early count as complete."""
+        with self._lock:
+            return self._done, self._total
+    
+    def _iterDone(self, n):
+        with self._lock:
+            self._done += n
+        
+    def blocks(self, nFrames):
+        """Return a list of (start, stop) frame ranges to be processed together."""
+        size = self.blockSize
+        if size is None:
+            size = int(np.ceil(nFrames / float(self.workers)))
+        size = max(1, size)
+        return [(i, min(i+size, nFrames)) for i in range(0, nFrames, size)]
+        
+    def process(self, data, callback=None):
+        """Return the denoised float array for *data*, or None if canceled.
+        
+        If given, *callback(done, total)* is called from the worker threads as 
+        iterations complete.
+        """
+        if data.dtype.kind != 'f':
+            data = data.astype(np.float)
+        dims = data.ndim if self.dims is None else self.dims
+        if dims not in (2, 3) or data.ndim < dims:
+            raise ValueError('only 2-d and 3-d images may be denoised with this function')
+        self._canceled.clear()
+        
+        if data.ndim == 2:
+            blocks = [(None, None)]
+        else:
+            blocks = self.blocks(data.shape[0])
+        overlap = self.overlap if dims == 3 else 0
+        with self._lock:
+            self._done = 0
+            self._total = len(blocks) * self.maxIter
+        
+        def iterDone(n):
+            self._iterDone(n)
+            if callback is not None:
+                callback(*self.progress())
+        
+        out = np.empty(data.shape, dtype=data.dtype)
+        def run(block):
+            start, stop = block
+            if start is None:
+                res = _tvDenoiseBlock(data, self.weight, self.eps, self.maxIter, dims, self._canceled, iterDone)
+                if res is not None:
+                    out[:] = res
+                return
+            ## extend blocks into neighboring frames, then keep only the central part
+            start2 = max(0, start - overlap)
+            stop2 = min(data.shape[0], stop + overlap)
+            res = _tvDenoiseBlock(np.array(data[start2:stop2]), self.weight, self.eps, self.maxIter, dims, self._canceled, iterDone)
+            if res is not None:
+                out[start:stop] = res[start-start2:stop-start2]
+        
+        if self.workers == 1 or len(blocks) == 1:
+            for block in blocks:
+                run(block)
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.workers, len(blocks)))
+            try:
+                pool.map(run, blocks)
+            finally:
+                pool.terminate()
+        
+        if self._canceled.is_set():
+            return None
+        return out
+
+
+def tvDenoise(data, weight=50., eps=2.e-4, maxIter=200, **kwds):
+    """Total-variation denoise an image or stack; see TVDenoiser for arguments.
+    Unlike TVDenoiser, a 3-d array is processed as a single block by default."""
+    if data.ndim == 3 and kwds.get('dims', 3) == 3:
+        kwds.setdefault('blockSize', data.shape[0])
+    return TVDenoiser(weight, eps, maxIter, **kwds).process(data)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-resolution image pyramids for displaying large mosaics.
+
+Each level of an ImagePyramid is a 2x2 block-averaged copy of the level before
+it (level 0 is the original image). Downsampled levels are cached as .npy files in
+a '.pyramid' directory next to the image file so that later sessions can show
+the image without reading the full-resolution data at all.
+"""
+import os
+import numpy as np
+import acq4.util.debug as debug
+
+
+def downsample2x(img):
+    """Return the 2x2 block mean of *img* along its first two axes.
+    Odd dimensions are padded by repeating the last row/column.
+    """
+    if img.shape[0] % 2 == 1 or img.shape[1] % 2 == 1:
+        pad = [(0, img.shape[0] % 2), (0, img.shape[1] % 2)] + [(0, 0)] * (img.ndim - 2)
+        img = np.pad(img, pad, mode='edge')
+    sh = (img.shape[0] // 2, 2, img.shape[1] // 2, 2) + img.shape[2:]
+    out = img.reshape(sh).mean(axis=3).mean(axis=1)
+    if img.dtype.kind in 'ui':
+        out = out.astype(img.dtype)
+    return out
+
+
+class ImagePyramid(object):
+    """Multi-resolution representation of a single 2D image (grayscale or color).
+
+    *source* may be an ndarray or a DataManager FileHandle. For file handles, only the
+    header is read on construction; pixel data is read when a level is first requested.
+    Levels are added until the image is no larger than *minSize* pixels on its
+    longest side.
+
+    Level 0 (full resolution) is read from the original file. All other levels are
+    generated from level 0 once, then cached on disk (if *cache* is True and the
+    directory is writable) and in memory until release() is called.
+    """
+    cacheDirName = '.pyramid'
+
+    def __init__(self, source, minSize=256, cache=True):
+        self.handle = None
+        self._levels = {}
+        self.info = None
+        if isinstance(source, np.ndarray):
+            self.shape = source.shape
+            self.dtype = source.dtype
+            self._levels[0] = source
+            cache = False
+            if hasattr(source, 'infoCopy'):
+                self.info = source.infoCopy()
+        else:
+            self.handle = source
+            ## read header only; for HDF5 files this leaves the data on disk
+            header = source.read(readAllData=False)
+            self.shape = tuple(header.shape)
+            self.dtype = header.dtype
+            if hasattr(header, 'infoCopy'):
+                self.info = header.infoCopy()
+            del header
+        self.cache = cache
+
+        self.nLevels = 1
+        size = max(self.shape[:2])
+        while size > minSize:
+            size = (size + 1) // 2
+            self.nLevels += 1
+
+    @staticmethod
+    def isSingleImage(shape):
+        """Return True if an array with *shape* is a single 2D (grayscale or color) image,
+        rather than a stack or video."""
+        return len(shape) == 2 or (len(shape) == 3 and shape[2] <= 4)
+
+    def levelShape(self, level):
+        sh = self.shape
+        for i in range(level):
+            sh = ((sh[0] + 1) // 2, (sh[1] + 1) // 2) + sh[2:]
+        return sh
+
+    def levelForScale(self, pxSize):
+        """Return the coarsest level whose pixels are no larger than *pxSize* full-resolution
+        pixels (usually *pxSize* is the number of image pixels covered by one screen pixel).
+        """
+        if pxSize is None or pxSize < 2:
+            return 0
+        return int(min(self.nLevels - 1, np.floor(np.log2(pxSize))))
+
+    def level(self, level):
+        """Return the image data for *level*, reading or generating it if needed."""
+        level = min(level, self.nLevels - 1)
+        if level in self._levels:
+            return self._levels[level]
+        if level == 0:
+            data = self.handle.read()
+            if hasattr(data, 'asarray'):
+                data = data.asarray()
+            self._levels[0] = data
+            return data
+
+        data = self._readCache(level)
+        if data is None:
+            ## generate all missing levels from the finest one that is available;
+            ## don't keep level 0 around unless it was already loaded.
+            keep0 = 0 in self._levels
+            img = self.level(0)
+            for i in range(1, self.nLevels):
+                img = downsample2x(img)
+                if i not in self._levels:
+                    self._writeCache(i, img)
+                    self._levels[i] = img
+            if not keep0:
+                del self._levels[0]
+            data = self._levels[level]
+        self._levels[level] = data
+        return data
+
+    def statsData(self):
+        """Return the coarsest level, for computing image statistics without
+        reading full-resolution data."""
+        return self.level(self.nLevels - 1)
+
+    def loadedLevels(self):
+        return sorted(self._levels.keys())
+
+    def release(self, keep=()):
+        """Free memory used by all levels except those in *keep* and the coarsest level.
+        Levels backed by memory (ndarray source, or cache disabled) are not released."""
+        for level in list(self._levels.keys()):
+            if level in keep or level == self.nLevels - 1:
+                continue
+            if level == 0 and self.handle is None:
+                continue
+            if level > 0 and not self._cacheFile(level):
+                continue
+            del self._levels[level]
+
+    def _cacheFile(self, level):
+        """Return the name of the cache file for *level*, or None if caching is disabled."""
+        if not self.cache or self.handle is None:
+            return None
+        dirName, fileName = os.path.split(self.handle.name())
+        return os.path.join(dirName, self.cacheDirName, '%s.L%d.npy' % (fileName, level))
+
+    def _readCache(self, level):
+        fn = self._cacheFile(level)
+        if fn is None or not os.path.isfile(fn):
+            return None
+        if os.path.getmtime(fn) < os.path.getmtime(self.handle.name()):
+            return None  ## image was modified after cache was written
+        try:
+            data = np.load(fn, mmap_mode='r')
+        except Exception:
+            debug.printExc("Error reading image cache %s:" % fn)
+            return None
+        if data.shape != self.levelShape(level):
+            return None
+        return data
+
+    def _writeCache(self, level, data):
+        fn = self._cacheFile(level)
+        if fn is None:
+            return
+        try:
+            cacheDir = os.path.dirname(fn)
+            if not os.path.isdir(cacheDir):
+                os.mkdir(cacheDir)
+            np.save(fn, data)
+        except (IOError, OSError):
+            ## not writable; levels will just be kept in memory.
+            self.cache = False
@@ -0,0 +1,60 @@
+import time
+import numpy as np
+from acq4.util.LogStore import LogStore
+
+
+def makeEntry(i, msgType='status', importance=5, currentDir=None):
+    entry = {'message': 'message %d' % i, 'msgType': msgType, 'importance': importance,
+             'timestamp': time.strftime('%Y.%m.%d %H:%M:%S'), 'time': 1000. + i}
+    if currentDir is not None:
+        entry['currentDir'] = currentDir
+    return entry
+
+
+def test_appendQuery(tmpdir):
+    fileName = str(tmpdir.join('log.db'))
+    store = LogStore(fileName, flushInterval=0.05)
+    types = ['status', 'user', 'error', 'warning']
+    for i in range(1000):
+        d = '/data/day1/cell%d' % (i % 3) if i % 2 == 0 else '/data/day2'
+        store.append(makeEntry(i, msgType=types[i % 4], importance=i % 10, currentDir=d))
+    assert len(store) == 1000
+    assert store.entry(10)['message'] == 'message 9'  ## available before being written
+
+    ids = store.query()
+    assert np.all(ids == np.arange(1, 1001))
+    ids = store.query(minImportance=7)
+    assert len(ids) == 200
+    assert all(e['importance'] > 7 for e in store.entries(ids))
+    ids = store.query(msgTypes=['error', 'warning'], dirPrefix='/data/day1')
+    ents = store.entries(ids)
+    assert len(ents) == 250
+    assert all(e['msgType'] == 'error' and e['currentDir'].startswith('/data/day1') for e in ents)
+    assert len(store.query(msgTypes=[])) == 0
+    assert len(store.query(startTime=1100, stopTime=1200)) == 100
+
+    entry = makeEntry(0, msgType='user', importance=8, currentDir='/data/day1/cell1')
+    assert store.matches(entry, minImportance=7, msgTypes=['user'], dirPrefix='/data/day1')
+    assert not store.matches(entry, msgTypes=['error'])
+    store.close()
+
+    ## entries persist, and new ids continue where the file left off
+    store = LogStore(fileName)
+    assert len(store) == 1000
+    assert store.entry(500)['message'] == 'message 499'
+    assert store.append(makeEntry(1000)) == 1001
+    store.close()
+
+
+def test_legacyFile(tmpdir):
+    fileName = str(tmpdir.join('log.txt'))
+    with open(fileName, 'w') as fh:
+        for i in range(3):
+            fh.write("%d:\n    message: 'legacy %d'\n    msgType: 'user'\n    importance: 6\n"
+                     "    timestamp: '2012.01.02 03:04:0%d'\n" % (i, i, i))
+    store = LogStore.fromLegacyFile(fileName)
+    assert len(store) == 3
+    ents = store.entries(store.query(msgTypes=['user']))
+    assert [e['message'] for e in ents] == ['legacy 0', 'legacy 1', 'legacy 2']
+    assert len(store.query(startTime=time.mktime((2012, 1, 2, 3, 4, 1, 0, 0, -1)))) == 2
+    store.close()
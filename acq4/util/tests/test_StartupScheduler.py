@@ -0,0 +1,97 @@
+import time, threading
+from acq4.util.StartupScheduler import StartupScheduler
+
+
+class MockDevice(object):
+    """Stands in for a device whose constructor waits on slow hardware."""
+    threadedStartup = True
+    delay = 0.3
+    started = []
+
+    def __init__(self, config, name):
+        time.sleep(config.get('delay', self.delay))
+        self.name = name
+        self.thread = threading.current_thread()
+        MockDevice.started.append(name)
+
+
+class MockDAQ(MockDevice):
+    pass
+
+class MockClamp(MockDevice):
+    pass
+
+class MockCamera(MockDevice):
+    pass
+
+class MockStage(MockDevice):
+    threadedStartup = False  ## e.g. creates timers that must live in the main thread
+
+
+def makeScheduler(workers=4):
+    MockDevice.started = []
+    classes = dict([(c.__name__, c) for c in [MockDAQ, MockClamp, MockCamera, MockStage]])
+    def importer(driverName):
+        if driverName not in classes:
+            raise ImportError("No module named %s" % driverName)
+        return classes[driverName]
+    def constructor(cls, config, name):
+        return cls(config, name)
+    sched = StartupScheduler(importer, constructor, workers=workers)
+    sched.add('DAQ', 'MockDAQ', {'delay': 0.4})
+    sched.add('Clamp1', 'MockClamp', {'Command': {'device': 'DAQ', 'channel': '/Dev1/ao0'}})
+    sched.add('Clamp2', 'MockClamp', {'Command': {'device': 'DAQ', 'channel': '/Dev1/ao1'}})
+    sched.add('Camera', 'MockCamera', {'delay': 0.6, 'scopeDevice': 'Microscope'})
+    sched.add('Stage', 'MockStage', {'delay': 0.2})
+    return sched
+
+
+def test_parallelStartup():
+    sched = makeScheduler()
+    start = time.time()
+    devs = sched.run()
+    wall = time.time() - start
+    assert devs.keys() == ['DAQ', 'Clamp1', 'Clamp2', 'Camera', 'Stage']
+
+    ## the slowest chain is DAQ followed by a clamp (0.7 s); one at a time would take 1.8 s
+    serial = 0.4 + 0.3 + 0.3 + 0.6 + 0.2
+    assert wall < 0.7 + 0.3
+    assert wall < serial * 0.6
+
+    ## clamps refer to the DAQ, so they must wait for it
+    started = MockDevice.started
+    assert started.index('DAQ') < started.index('Clamp1')
+    assert started.index('DAQ') < started.index('Clamp2')
+
+    times = sched.timings()
+    assert times['Clamp1']['dependencies'] == ['DAQ']
+    assert times['Camera']['dependencies'] == []  ## 'Microscope' is not a configured device
+    assert times['Stage']['thread'] == 'main'
+    assert devs['Stage'].thread is threading.current_thread()
+    assert times['Camera']['thread'] == 'worker'
+    assert abs(times['Camera']['construct'] - 0.6) < 0.1
+    assert all(t['import'] is not None and t['error'] is None for t in times.values())
+    assert 'Clamp2' in sched.report()
+
+
+def test_serialStartup():
+    sched = makeScheduler(workers=0)
+    start = time.time()
+    devs = sched.run()
+    assert time.time() - start >= 1.8
+    assert MockDevice.started == ['DAQ', 'Clamp1', 'Clamp2', 'Camera', 'Stage']
+    assert all(d.thread is threading.current_thread() for d in devs.values())
+
+
+def test_errorsAndCycles():
+    sched = makeScheduler()
+    sched.add('Broken', 'MockShutter', {})
+    ## DAQ and Camera refer to each other; startup falls back to config order
+    sched.specs['DAQ'][1]['trigger'] = 'Camera'
+    sched.specs['Camera'][1]['trigger'] = 'DAQ'
+    devs = sched.run()
+    assert 'Broken' not in devs
+    assert len(devs) == 5
+    assert 'ImportError' in sched.timings()['Broken']['error']
+    assert MockDevice.started.index('DAQ') < MockDevice.started.index('Camera')
+    assert sched.wait('Broken', timeout=0)
@@ -0,0 +1,256 @@
+import sys, threading
+import numpy as np
+import scipy.ndimage
+import acq4.util.functions as fn
+
+
+def makeEventData(n=200000, nEvents=50, seed=0):
+    rng = np.random.RandomState(seed)
+    template = fn.expTemplate(1e-4, 0.5e-3, 3e-3)
+    data = rng.normal(scale=0.2, size=n)
+    for i in rng.randint(1000, n-1000, nEvents):
+        data[i:i+len(template)] += template * rng.uniform(1, 3)
+    return data, template
+
+
+def test_clementsBekkersIter():
+    data, template = makeEventData()
+    dc, scale, offset = fn.clementsBekkers(data, template)
+
+    for kwds in [dict(chunkSize=10000, useFFT=False),
+                 dict(chunkSize=7777, useFFT=True),
+                 dict(chunkSize=10000, workers=3)]:
+        chunks = list(fn.clementsBekkersIter(data, template, **kwds))
+        starts = [c[0] for c in chunks]
+        assert starts == range(0, len(dc), kwds['chunkSize'])
+        for i, result in enumerate([dc, scale, offset]):
+            joined = np.concatenate([c[i+1] for c in chunks])
+            assert joined.shape == result.shape
+            assert np.allclose(joined, result, rtol=1e-6, atol=1e-9)
+
+    # float32 output is close, but not exact
+    chunks = list(fn.clementsBekkersIter(data, template, chunkSize=10000, dtype=np.float32))
+    dc32 = np.concatenate([c[1] for c in chunks])
+    assert dc32.dtype == np.float32
+    assert np.allclose(dc32, dc, rtol=1e-3, atol=1e-3)
+
+
+def test_cbTemplateMatch():
+    data, template = makeEventData()
+    dc, scale, offset = fn.clementsBekkers(data, template)
+    threshold = 4.0
+
+    # find events directly from the full detection criterion
+    mask = dc > threshold
+    edges = np.diff(mask.astype(int))
+    starts = np.argwhere(edges == 1)[:, 0] + 1
+    stops = np.argwhere(edges == -1)[:, 0] + 1
+    peaks = [i1 + np.argmax(dc[i1:i2]) for i1, i2 in zip(starts, stops)]
+
+    events = fn.cbTemplateMatch(data, template, threshold)
+    assert len(events) > 0
+    assert list(events['peak']) == peaks
+    assert np.allclose(events['dc'], dc[peaks])
+    assert np.allclose(events['scale'], scale[peaks])
+
+    # events that span chunk boundaries are only reported once
+    events2 = fn.cbTemplateMatch(data, template, threshold, chunkSize=500, workers=2)
+    assert list(events2['peak']) == peaks
+
+
+def test_findEdges():
+    rng = np.random.RandomState(1)
+    data = (rng.uniform(size=10000) > 0.7).astype(np.uint8)
+    d = np.diff(data.astype(int))
+    rising = np.argwhere(d > 0)[:, 0] + 1
+    falling = np.argwhere(d < 0)[:, 0] + 1
+    
+    ## chunk boundaries must not add or lose edges
+    for chunkSize in [7, 1000, 20000]:
+        r, f = fn.findEdges(data, chunkSize=chunkSize)
+        assert np.all(r == rising)
+        assert np.all(f == falling)
+        
+    det = fn.EdgeDetector()
+    det.process([0, 1, 1])
+    r, f = det.process([0, 0, 1])
+    assert list(r) == [5] and list(f) == [3]
+    assert [list(x) for x in det.edges()] == [[1, 5], [3]]
+
+
+def test_registration():
+    rng = np.random.RandomState(0)
+    base = scipy.ndimage.gaussian_filter(rng.normal(size=(400, 400)), 3)
+    base += rng.normal(scale=0.1*base.std(), size=base.shape)
+    im1 = base[100:300, 100:300]
+    
+    ## integer offsets: im2's origin lies at (12, -7) in im1
+    im2 = base[112:312, 93:293]
+    assert np.all(fn.registerImages(im1, im2, [[-20, -20], [20, 20]]) == [12, -7])
+    offset, peak = fn.phaseCorrelate(im1, im2)
+    assert np.allclose(offset, [12, -7], atol=0.15) and peak > 0.5
+    assert np.allclose(fn.pyramidRegister(im1, im2, maxDist=30)[0], [12, -7], atol=0.15)
+    assert np.allclose(fn.recursiveRegisterImages(im1, im2, maxDist=40), [12, -7], atol=0.15)
+    
+    ## partially overlapping tiles
+    offset, peak = fn.pyramidRegister(base[:200, :200], base[150:350, 20:220], taper=0.1)
+    assert np.allclose(offset, [150, 20], atol=0.15)
+    
+    ## subpixel offsets in a noisy stack
+    shifts = rng.uniform(-8, 8, size=(6, 2))
+    stack = np.array([scipy.ndimage.shift(base, -s, order=3)[100:300, 100:300] for s in shifts])
+    stack += rng.normal(scale=0.01, size=stack.shape)
+    offsets, peaks = fn.registerStack(stack, im1, maxDist=10, chunkSize=4)
+    assert np.abs(offsets - shifts).max() < 0.2
+    pairs = fn.registerImagePairs([(im1, frame) for frame in stack], workers=2, upsample=10)
+    assert np.allclose([p[0] for p in pairs], offsets, atol=0.15)
+
+
+def test_phaseDispMap():
+    rng = np.random.RandomState(1)
+    base = scipy.ndimage.gaussian_filter(rng.normal(size=(300, 300)), 2)
+    im1 = base[50:200, 50:200]
+    im2 = base[55:205, 47:197]
+    disp, err = fn.makeDispMap(im1, im2, maxDist=8, method='phase')
+    assert disp.shape == im2.shape + (2,) and err.shape == im2.shape
+    ## same convention as the exhaustive search: im1[x-d] ~= im2[x]
+    disp2, err2 = fn.makeDispMap(im1, im2, maxDist=8, method='diff')
+    inner = (slice(30, -30), slice(30, -30))
+    assert np.all(disp[inner] == [-5, 3])
+    assert np.all(np.median(disp2[inner].reshape(-1, 2), axis=0) == [-5, 3])
+
+
+def referenceSlice(data, shape, origin, vectors, axes, **kargs):
+    ## map_coordinates on the whole array, for data with the slice axes first
+    grid = np.mgrid[tuple([slice(0, s) for s in shape])]
+    x = np.tensordot(np.array(vectors, dtype=float).T, grid, axes=1) + np.array(origin, dtype=float).reshape((-1,) + (1,)*len(shape))
+    extra = data.shape[len(axes):]
+    out = np.empty(tuple(shape) + extra)
+    for inds in np.ndindex(*extra):
+        out[(Ellipsis,) + inds] = scipy.ndimage.map_coordinates(data[(Ellipsis,) + inds], x, **kargs)
+    return out
+
+
+def test_affineSlice(tmpdir):
+    rng = np.random.RandomState(0)
+    vol = rng.normal(size=(40, 50, 30))
+    vectors = ((0.8, 0.6, 0), (0, 0, 1.1))
+    ref = referenceSlice(vol, (20, 15), (5, 3, 2), vectors, (0, 1, 2), order=1)
+    assert np.allclose(fn.affineSlice(vol, (20, 15), (5, 3, 2), vectors, (0, 1, 2), order=1), ref)
+    
+    ## slice partly outside the volume, cubic interpolation
+    ref = referenceSlice(vol, (30, 25), (25, -5, 2), vectors, (0, 1, 2), order=3)
+    out = fn.affineSlice(vol, (30, 25), (25, -5, 2), vectors, (0, 1, 2), order=3)
+    assert np.allclose(out, ref, atol=1e-3)
+    ## cubic is the default, as for map_coordinates
+    assert np.all(fn.affineSlice(vol, (30, 25), (25, -5, 2), vectors, (0, 1, 2)) == out)
+    
+    ## extra (time) axis, slice axes out of order, and a memory-mapped volume
+    data = rng.normal(size=(4, 40, 50)).astype(np.float32)
+    fileName = str(tmpdir.join('vol.npy'))
+    np.save(fileName, data)
+    mm = np.load(fileName, mmap_mode='r')
+    vectors = ((0.5, 0.5), (-0.5, 0.5))
+    r = fn.Reslicer(mm, order=1, reuseOutput=True)
+    out = r.slice((10, 12), (20, 10), vectors, (2, 1))
+    assert out.shape == (4, 10, 12) and out.dtype == np.float32
+    ref = referenceSlice(data.transpose(2, 1, 0), (10, 12), (20, 10), vectors, (0, 1), order=1)
+    assert np.allclose(out, ref.transpose(2, 0, 1), atol=1e-5)
+    
+    ## cached grids and output buffers are reused when only the origin changes
+    grid = r.grid((10, 12), vectors)
+    out2 = r.slice((10, 12), (21, 11), vectors, (2, 1))
+    assert r.grid((10, 12), vectors) is grid
+    assert out2.base is out.base
+    
+    ## reduced-resolution preview
+    preview = r.slice((10, 12), (20, 10), vectors, (2, 1), downsample=2)
+    assert preview.shape == (4, 5, 6)
+    assert np.allclose(preview, ref.transpose(2, 0, 1)[:, ::2, ::2], atol=1e-5)
+
+
+def test_affineSliceThreads():
+    ## concurrent slices with the same geometry must not share coordinate buffers
+    rng = np.random.RandomState(1)
+    vol = rng.normal(size=(40, 50, 30))
+    vectors = ((0.8, 0.6, 0), (0, 0, 1.1))
+    origins = [(5 + i * 0.37, 3 + i * 0.13, 2 + i * 0.21) for i in range(32)]
+    serial = [fn.affineSlice(vol, (60, 45), o, vectors, (0, 1, 2)) for o in origins]
+    
+    errors = []
+    def run(i):
+        for j in range(20):
+            out = fn.affineSlice(vol, (60, 45), origins[i], vectors, (0, 1, 2))
+            if not np.array_equal(out, serial[i]):
+                errors.append((i, j))
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(origins))]
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)  ## switch threads as often as possible
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setcheckinterval(interval)
+    assert errors == []
+
+
+def test_weightedTraces():
+    import scipy.sparse
+    import acq4.pyqtgraph as pg
+    rng = np.random.RandomState(0)
+    stack = rng.normal(size=(30, 40, 50))
+    ## rotated, scaled, fractional and partly out-of-bounds regions like those from RectROI.getAffineSliceParams
+    regions = [((5, 7), (3.5, 12.25), ((1, 0), (0, 1))),
+               ((6.3, 4.2), (10.2, 20.7), ((0.8, 0.6), (-0.6, 0.8))),
+               ((8, 8), (35.5, -2.5), ((1, 0), (0, 1))),
+               ((12, 3), (20, 30), ((0.5, 0), (0, 2)))]
+    weights = scipy.sparse.vstack([fn.affineSliceWeights(stack.shape[1:], shape=s, origin=o, vectors=v) for s, o, v in regions])
+    traces = fn.weightedTraces(stack, weights, chunkSize=7)
+    assert traces.shape == (len(regions), 30)
+    for i, (s, o, v) in enumerate(regions):
+        ref = pg.affineSlice(stack, shape=s, origin=o, vectors=v, axes=(1, 2)).mean(axis=2).mean(axis=1)
+        assert np.allclose(traces[i], ref)
+
+
+def test_pspInnerJacobian():
+    x = np.linspace(-1e-3, 10e-3, 500)
+    for rise, decay, power in [(0.5e-3, 3e-3, 2.0), (1e-3, 8e-3, 1.0), (0.2e-3, 2e-3, 3.0)]:
+        g, dx, dr, dd = fn.pspInnerJacobian(x, rise, decay, power)
+        assert np.allclose(g, fn.pspInnerFunc(x, rise, decay, power))
+        ## central differences; skip the kink at x=0
+        for deriv, fd in [
+                (dx, lambda h: (fn.pspInnerFunc(x+h, rise, decay, power) - fn.pspInnerFunc(x-h, rise, decay, power)) / (2*h)),
+                (dr, lambda h: (fn.pspInnerFunc(x, rise+h, decay, power) - fn.pspInnerFunc(x, rise-h, decay, power)) / (2*h)),
+                (dd, lambda h: (fn.pspInnerFunc(x, rise, decay+h, power) - fn.pspInnerFunc(x, rise, decay-h, power)) / (2*h))]:
+            mask = np.abs(x) > 1e-5
+            expected = fd(1e-8)
+            assert np.allclose(deriv[mask], expected[mask], rtol=1e-4, atol=1e-6 * np.abs(expected).max())
+
+
+def test_fitPsp():
+    rng = np.random.RandomState(0)
+    x = np.arange(200) * 1e-4
+    true = np.array([[50e-12, 1.5e-3, 0.4e-3, 4e-3],
+                     [120e-12, 2.5e-3, 0.8e-3, 6e-3],
+                     [-80e-12, 1e-3, 0.3e-3, 2.5e-3]])
+    y = np.array([fn.pspFunc(list(v), x) for v in true])
+    y += rng.normal(scale=1e-12, size=y.shape)
+    bounds = [(-1e-9, 1e-9), (0, 4e-3), (50e-6, 5e-3), (200e-6, 20e-3)]
+
+    batch = fn.fitPspBatch(x, y, [100e-12, 2e-3, 0.5e-3, 5e-3], bounds)
+    for i, v in enumerate(true):
+        guess = [2 * v[0], 2e-3, 0.5e-3, 5e-3]
+        for multiFit in [False, True]:
+            fit = fn.fitPsp(x, y[i], guess, bounds, multiFit=multiFit)
+            assert np.allclose(fit, v, rtol=0.05)
+        assert np.allclose(batch[i], v, rtol=0.05)
+        ## single fits use the same method as batch fits
+        single = fn.fitPspBatch(x, y[i:i+1], guess, bounds)[0]
+        assert np.allclose(fn.fitPsp(x, y[i], guess, bounds), single, rtol=1e-6)
+
+    ## bounds are respected
+    fit = fn.fitPsp(x, y[1], [240e-12, 2e-3, 0.5e-3, 5e-3], [(0, 1e-9), (0, 2e-3), (50e-6, 5e-3), (200e-6, 20e-3)])
+    assert 0 <= fit[1] <= 2e-3
+    assert fit[1] == 2e-3  ## the true offset (2.5 ms) is outside the bounds
@@ -0,0 +1,71 @@
+import numpy as np
+from acq4.util.imageAnalysis import TVDenoiser, tvDenoise
+
+
+def referenceTV(im, weight, eps, n_iter_max):
+    ## the original allocating implementation, for 2-d or 3-d arrays
+    nd = im.ndim
+    p = [np.zeros_like(im) for i in range(nd)]
+    g = [np.zeros_like(im) for i in range(nd)]
+    i = 0
+    while i < n_iter_max:
+        d = -sum(p)
+        d[1:] += p[0][:-1]
+        d[:, 1:] += p[1][:, :-1]
+        if nd == 3:
+            d[:, :, 1:] += p[2][:, :, :-1]
+        out = im + d
+        E = (d**2).sum()
+        g[0][:-1] = np.diff(out, axis=0)
+        g[1][:, :-1] = np.diff(out, axis=1)
+        if nd == 3:
+            g[2][:, :, :-1] = np.diff(out, axis=2)
+        norm = np.sqrt(sum([x**2 for x in g]))
+        E += weight * norm.sum()
+        norm *= 0.5 / weight
+        norm += 1.
+        for j in range(nd):
+            p[j] -= g[j] / (2. * nd)
+            p[j] /= norm
+        E /= float(im.size)
+        if i == 0:
+            E_init = E_previous = E
+        elif np.abs(E_previous - E) < eps * E_init:
+            break
+        else:
+            E_previous = E
+        i += 1
+    return out
+
+
+def test_tvDenoise():
+    rng = np.random.RandomState(0)
+    im = rng.normal(size=(40, 50)) * 10 + 100
+    assert np.allclose(tvDenoise(im, weight=20), referenceTV(im, 20., 2e-4, 200))
+    
+    stack = rng.normal(size=(12, 30, 20)) * 10 + 100
+    ref = referenceTV(stack, 20., 2e-4, 50)
+    assert np.allclose(tvDenoise(stack, weight=20, maxIter=50), ref)
+    
+    ## 2-d denoising of each frame, in parallel blocks
+    tv = TVDenoiser(weight=20, maxIter=50, dims=2, blockSize=1, workers=3)
+    out = tv.process(stack.astype(np.float32))
+    for i in range(len(stack)):
+        assert np.allclose(out[i], referenceTV(stack[i].astype(np.float32), 20., 2e-4, 50), atol=1e-3)
+    assert tv.progress() == (12 * 50, 12 * 50)
+    
+    ## overlapping blocks reproduce the whole-volume result when the overlap 
+    ## covers every iteration
+    tv = TVDenoiser(weight=20, eps=0, maxIter=5, blockSize=3, overlap=5, workers=2)
+    assert np.allclose(tv.process(stack), referenceTV(stack, 20., 0, 5))
+
+
+def test_tvCancel():
+    stack = np.random.normal(size=(4, 64, 64))
+    tv = TVDenoiser(weight=10, eps=0, maxIter=1000, workers=2)
+    def callback(done, total):
+        if done >= 10:
+            tv.cancel()
+    assert tv.process(stack, callback=callback) is None
+    assert tv.wasCanceled()
+    assert tv.progress()[0] < 1000
@@ -0,0 +1,69 @@
+import os
+import numpy as np
+from acq4.util.imagePyramid import ImagePyramid, downsample2x
+
+
+class FakeFileHandle(object):
+    """Minimal stand-in for DataManager.FileHandle, backed by a .npy file."""
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.reads = 0
+
+    def name(self):
+        return self.fileName
+
+    def read(self, readAllData=True):
+        if not readAllData:
+            return np.load(self.fileName, mmap_mode='r')
+        self.reads += 1
+        return np.load(self.fileName)
+
+
+def test_downsample2x():
+    img = np.arange(30, dtype=float).reshape(5, 6)
+    ds = downsample2x(img)
+    assert ds.shape == (3, 3)
+    assert ds[0, 0] == img[:2, :2].mean()
+    assert ds[2, 2] == img[4, 4:6].mean()  ## padded by repeating last row
+
+    rgb = np.random.randint(0, 255, size=(8, 8, 3)).astype(np.uint8)
+    ds = downsample2x(rgb)
+    assert ds.shape == (4, 4, 3) and ds.dtype == np.uint8
+
+
+def test_pyramid(tmpdir):
+    img = np.random.normal(size=(1000, 700))
+    fileName = str(tmpdir.join('image.npy'))
+    np.save(fileName, img)
+
+    fh = FakeFileHandle(fileName)
+    pyr = ImagePyramid(fh, minSize=100)
+    assert pyr.shape == img.shape
+    assert pyr.nLevels == 5
+    assert fh.reads == 0  ## only the header has been read
+
+    assert pyr.levelForScale(0.5) == 0
+    assert pyr.levelForScale(3) == 1
+    assert pyr.levelForScale(1000) == pyr.nLevels - 1
+
+    low = pyr.statsData()
+    assert low.shape == pyr.levelShape(pyr.nLevels - 1) == (63, 44)
+    assert fh.reads == 1
+    assert 0 not in pyr.loadedLevels()
+    expected = img
+    for i in range(pyr.nLevels - 1):
+        expected = downsample2x(expected)
+    assert np.allclose(low, expected)
+
+    ## levels are cached next to the data; a new pyramid does not need the full image
+    fh2 = FakeFileHandle(fileName)
+    pyr2 = ImagePyramid(fh2, minSize=100)
+    assert np.allclose(pyr2.level(2), pyr.level(2))
+    assert fh2.reads == 0
+    assert os.path.isdir(str(tmpdir.join(ImagePyramid.cacheDirName)))
+
+    assert np.all(pyr2.level(0) == img)
+    assert fh2.reads == 1
+    pyr2.statsData()
+    pyr2.release()
+    assert pyr2.loadedLevels() == [pyr2.nLevels - 1]